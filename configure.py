@@ -1,6 +1,5 @@
 import os
 import huggingface_hub
-import torch
 from helpers.training import quantised_precision_levels, lycoris_defaults
 from helpers.training.optimizer_param import optimizer_choices
 
@@ -10,6 +9,15 @@ bf16_only_optims = [
 any_precision_optims = [
     key for key, value in optimizer_choices.items() if value["precision"] == "any"
 ]
+
+
+def cuda_available() -> bool:
+    # torch takes seconds to import, so it's only loaded once a question depends on it.
+    import torch
+
+    return torch.cuda.is_available()
+
+
 model_classes = {
     "full": [
         "flux",
@@ -570,7 +578,7 @@ def configure_env():
 
     # Advanced options
     env_contents["ALLOW_TF32"] = "false"
-    if torch.cuda.is_available():
+    if cuda_available():
         use_tf32 = (
             prompt_user("Would you like to enable TF32 mode? ([y]/n)", "y").lower()
             == "y"
@@ -679,7 +687,7 @@ def configure_env():
     if torch_compile:
         env_contents["VALIDATION_TORCH_COMPILE"] = "true"
         env_contents["TRAINER_DYNAMO_BACKEND"] = (
-            "inductor" if torch.cuda.is_available() else "aot_eager"
+            "inductor" if cuda_available() else "aot_eager"
         )
 
     # Summary and confirmation
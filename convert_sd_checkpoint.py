@@ -3,11 +3,21 @@
 # Does not convert optimizer state or any other thing.
 
 import argparse
+import functools
+import logging
+import os
 import os.path as osp
 import re
 
-import torch
-from safetensors.torch import load_file, save_file
+from helpers.training.checkpoint_converter import (
+    CONCATENATE,
+    RESHAPE_FOR_SD,
+    CheckpointConversion,
+    TensorSource,
+    apply_conversion_table,
+    convert_checkpoints,
+    find_weights,
+)
 
 
 # =================#
@@ -89,11 +99,12 @@ for j in range(2):
     unet_conversion_map_layer.append((sd_mid_res_prefix, hf_mid_res_prefix))
 
 
-def convert_unet_state_dict(unet_state_dict):
+@functools.lru_cache
+def unet_conversion_table(keys):
     # buyer beware: this is a *brittle* function,
     # and correct output requires that all of these pieces interact in
     # the exact order in which I have arranged them.
-    mapping = {k: k for k in unet_state_dict.keys()}
+    mapping = {k: k for k in keys}
     for sd_name, hf_name in unet_conversion_map:
         mapping[hf_name] = sd_name
     for k, v in mapping.items():
@@ -105,8 +116,13 @@ def convert_unet_state_dict(unet_state_dict):
         for sd_part, hf_part in unet_conversion_map_layer:
             v = v.replace(hf_part, sd_part)
         mapping[k] = v
-    new_state_dict = {v: unet_state_dict[k] for k, v in mapping.items()}
-    return new_state_dict
+    return {v: (None, (k,)) for k, v in mapping.items()}
+
+
+def convert_unet_state_dict(unet_state_dict):
+    return apply_conversion_table(
+        unet_conversion_table(tuple(unet_state_dict)), unet_state_dict
+    )
 
 
 # ================#
@@ -160,13 +176,9 @@ vae_conversion_map_attn = [
 ]
 
 
-def reshape_weight_for_sd(w):
-    # convert HF linear weights to SD conv2d weights
-    return w.reshape(*w.shape, 1, 1)
-
-
-def convert_vae_state_dict(vae_state_dict):
-    mapping = {k: k for k in vae_state_dict.keys()}
+@functools.lru_cache
+def vae_conversion_table(keys):
+    mapping = {k: k for k in keys}
     for k, v in mapping.items():
         for sd_part, hf_part in vae_conversion_map:
             v = v.replace(hf_part, sd_part)
@@ -176,14 +188,21 @@ def convert_vae_state_dict(vae_state_dict):
             for sd_part, hf_part in vae_conversion_map_attn:
                 v = v.replace(hf_part, sd_part)
             mapping[k] = v
-    new_state_dict = {v: vae_state_dict[k] for k, v in mapping.items()}
+    table = {v: (None, (k,)) for k, v in mapping.items()}
     weights_to_convert = ["q", "k", "v", "proj_out"]
-    for k, v in new_state_dict.items():
+    for k, (_, hf_names) in table.items():
         for weight_name in weights_to_convert:
             if f"mid.attn_1.{weight_name}.weight" in k:
                 logging.info(f"Reshaping {k} for SD format")
-                new_state_dict[k] = reshape_weight_for_sd(v)
-    return new_state_dict
+                # convert HF linear weights to SD conv2d weights
+                table[k] = (RESHAPE_FOR_SD, hf_names)
+    return table
+
+
+def convert_vae_state_dict(vae_state_dict):
+    return apply_conversion_table(
+        vae_conversion_table(tuple(vae_state_dict)), vae_state_dict
+    )
 
 
 # =========================#
@@ -216,11 +235,12 @@ textenc_pattern = re.compile("|".join(protected.keys()))
 code2idx = {"q": 0, "k": 1, "v": 2}
 
 
-def convert_text_enc_state_dict_v20(text_enc_dict):
-    new_state_dict = {}
+@functools.lru_cache
+def text_enc_v20_conversion_table(keys):
+    table = {}
     capture_qkv_weight = {}
     capture_qkv_bias = {}
-    for k, v in text_enc_dict.items():
+    for k in keys:
         if (
             k.endswith(".self_attn.q_proj.weight")
             or k.endswith(".self_attn.k_proj.weight")
@@ -230,7 +250,7 @@ def convert_text_enc_state_dict_v20(text_enc_dict):
             k_code = k[-len("q_proj.weight")]
             if k_pre not in capture_qkv_weight:
                 capture_qkv_weight[k_pre] = [None, None, None]
-            capture_qkv_weight[k_pre][code2idx[k_code]] = v
+            capture_qkv_weight[k_pre][code2idx[k_code]] = k
             continue
 
         if (
@@ -242,41 +262,124 @@ def convert_text_enc_state_dict_v20(text_enc_dict):
             k_code = k[-len("q_proj.bias")]
             if k_pre not in capture_qkv_bias:
                 capture_qkv_bias[k_pre] = [None, None, None]
-            capture_qkv_bias[k_pre][code2idx[k_code]] = v
+            capture_qkv_bias[k_pre][code2idx[k_code]] = k
             continue
 
         relabelled_key = textenc_pattern.sub(
             lambda m: protected[re.escape(m.group(0))], k
         )
-        new_state_dict[relabelled_key] = v
+        table[relabelled_key] = (None, (k,))
 
-    for k_pre, tensors in capture_qkv_weight.items():
-        if None in tensors:
+    for k_pre, names in capture_qkv_weight.items():
+        if None in names:
             raise Exception(
                 "CORRUPTED MODEL: one of the q-k-v values for the text encoder was missing"
             )
         relabelled_key = textenc_pattern.sub(
             lambda m: protected[re.escape(m.group(0))], k_pre
         )
-        new_state_dict[relabelled_key + ".in_proj_weight"] = torch.cat(tensors)
+        table[relabelled_key + ".in_proj_weight"] = (CONCATENATE, tuple(names))
 
-    for k_pre, tensors in capture_qkv_bias.items():
-        if None in tensors:
+    for k_pre, names in capture_qkv_bias.items():
+        if None in names:
             raise Exception(
                 "CORRUPTED MODEL: one of the q-k-v values for the text encoder was missing"
             )
         relabelled_key = textenc_pattern.sub(
             lambda m: protected[re.escape(m.group(0))], k_pre
         )
-        new_state_dict[relabelled_key + ".in_proj_bias"] = torch.cat(tensors)
+        table[relabelled_key + ".in_proj_bias"] = (CONCATENATE, tuple(names))
+
+    return table
 
-    return new_state_dict
+
+def convert_text_enc_state_dict_v20(text_enc_dict):
+    return apply_conversion_table(
+        text_enc_v20_conversion_table(tuple(text_enc_dict)), text_enc_dict
+    )
 
 
 def convert_text_enc_state_dict(text_enc_dict):
     return text_enc_dict
 
 
+# ==================#
+# Full Conversion #
+# ==================#
+
+
+def add_to_table(table, component, prefix, component_table):
+    for name, (transform, input_names) in component_table.items():
+        table[prefix + name] = (component, transform, input_names)
+
+
+def convert(model_path, checkpoint_path, half=False, use_safetensors=False):
+    # Tensors are read one at a time from memory-mapped weights, and safetensors output is
+    # written as they're read, so the model is never held in memory whole.
+    diffusers_weights = [
+        "diffusion_pytorch_model.safetensors",
+        "diffusion_pytorch_model.bin",
+    ]
+    sources = {
+        "unet": TensorSource(
+            find_weights(osp.join(model_path, "unet"), diffusers_weights)
+        ),
+        "vae": TensorSource(
+            find_weights(osp.join(model_path, "vae"), diffusers_weights)
+        ),
+        "text_encoder": TensorSource(
+            find_weights(
+                osp.join(model_path, "text_encoder"),
+                ["model.safetensors", "pytorch_model.bin"],
+            )
+        ),
+    }
+
+    table = {}
+    add_to_table(
+        table,
+        "unet",
+        "model.diffusion_model.",
+        unet_conversion_table(sources["unet"].keys()),
+    )
+    add_to_table(
+        table,
+        "vae",
+        "first_stage_model.",
+        vae_conversion_table(sources["vae"].keys()),
+    )
+
+    # Easiest way to identify v2.0 model seems to be that the text encoder (OpenCLIP) is deeper
+    text_enc_keys = sources["text_encoder"].keys()
+    is_v20_model = "text_model.encoder.layers.22.layer_norm2.bias" in text_enc_keys
+
+    if is_v20_model:
+        # Need to add the tag 'transformer' in advance so we can knock it out from the final layer-norm
+        text_enc_table = text_enc_v20_conversion_table(
+            tuple("transformer." + k for k in text_enc_keys)
+        )
+        add_to_table(
+            table,
+            "text_encoder",
+            "cond_stage_model.model.",
+            {
+                name: (transform, tuple(k[len("transformer.") :] for k in input_names))
+                for name, (transform, input_names) in text_enc_table.items()
+            },
+        )
+    else:
+        add_to_table(
+            table,
+            "text_encoder",
+            "cond_stage_model.transformer.",
+            {k: (None, (k,)) for k in text_enc_keys},
+        )
+
+    return CheckpointConversion(sources, table, half=half).save(
+        checkpoint_path, use_safetensors=use_safetensors
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -284,8 +387,12 @@ if __name__ == "__main__":
         "--model_path",
         default=None,
         type=str,
+        nargs="+",
         required=True,
-        help="Path to the model to convert.",
+        help=(
+            "Path to the model to convert."
+            " With more than one, --checkpoint_path is a directory for the outputs."
+        ),
     )
     parser.add_argument(
         "--checkpoint_path",
@@ -302,70 +409,36 @@ if __name__ == "__main__":
         action="store_true",
         help="Save weights use safetensors, default is ckpt.",
     )
+    parser.add_argument(
+        "--num_workers",
+        default=1,
+        type=int,
+        help="The number of models to convert at once, in separate processes.",
+    )
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
-    assert args.model_path is not None, "Must provide a model path!"
-
-    assert args.checkpoint_path is not None, "Must provide a checkpoint path!"
-
-    # Path for safetensors
-    unet_path = osp.join(args.model_path, "unet", "diffusion_pytorch_model.safetensors")
-    vae_path = osp.join(args.model_path, "vae", "diffusion_pytorch_model.safetensors")
-    text_enc_path = osp.join(args.model_path, "text_encoder", "model.safetensors")
-
-    # Load models from safetensors if it exists, if it doesn't pytorch
-    if osp.exists(unet_path):
-        unet_state_dict = load_file(unet_path, device="cpu")
-    else:
-        unet_path = osp.join(args.model_path, "unet", "diffusion_pytorch_model.bin")
-        unet_state_dict = torch.load(unet_path, map_location="cpu")
-
-    if osp.exists(vae_path):
-        vae_state_dict = load_file(vae_path, device="cpu")
+    if len(args.model_path) == 1:
+        jobs = [(args.model_path[0], args.checkpoint_path)]
     else:
-        vae_path = osp.join(args.model_path, "vae", "diffusion_pytorch_model.bin")
-        vae_state_dict = torch.load(vae_path, map_location="cpu")
-
-    if osp.exists(text_enc_path):
-        text_enc_dict = load_file(text_enc_path, device="cpu")
-    else:
-        text_enc_path = osp.join(args.model_path, "text_encoder", "pytorch_model.bin")
-        text_enc_dict = torch.load(text_enc_path, map_location="cpu")
-
-    # Convert the UNet model
-    unet_state_dict = convert_unet_state_dict(unet_state_dict)
-    unet_state_dict = {
-        "model.diffusion_model." + k: v for k, v in unet_state_dict.items()
-    }
-
-    # Convert the VAE model
-    vae_state_dict = convert_vae_state_dict(vae_state_dict)
-    vae_state_dict = {"first_stage_model." + k: v for k, v in vae_state_dict.items()}
-
-    # Easiest way to identify v2.0 model seems to be that the text encoder (OpenCLIP) is deeper
-    is_v20_model = "text_model.encoder.layers.22.layer_norm2.bias" in text_enc_dict
-
-    if is_v20_model:
-        # Need to add the tag 'transformer' in advance so we can knock it out from the final layer-norm
-        text_enc_dict = {"transformer." + k: v for k, v in text_enc_dict.items()}
-        text_enc_dict = convert_text_enc_state_dict_v20(text_enc_dict)
-        text_enc_dict = {
-            "cond_stage_model.model." + k: v for k, v in text_enc_dict.items()
-        }
-    else:
-        text_enc_dict = convert_text_enc_state_dict(text_enc_dict)
-        text_enc_dict = {
-            "cond_stage_model.transformer." + k: v for k, v in text_enc_dict.items()
-        }
-
-    # Put together new checkpoint
-    state_dict = {**unet_state_dict, **vae_state_dict, **text_enc_dict}
-    if args.half:
-        state_dict = {k: v.half() for k, v in state_dict.items()}
-
-    if args.use_safetensors:
-        save_file(state_dict, args.checkpoint_path)
-    else:
-        state_dict = {"state_dict": state_dict}
-        torch.save(state_dict, args.checkpoint_path)
+        os.makedirs(args.checkpoint_path, exist_ok=True)
+        extension = "safetensors" if args.use_safetensors else "ckpt"
+        jobs = [
+            (
+                model_path,
+                osp.join(
+                    args.checkpoint_path,
+                    f"{osp.basename(osp.normpath(model_path))}.{extension}",
+                ),
+            )
+            for model_path in args.model_path
+        ]
+
+    convert_checkpoints(
+        convert,
+        jobs,
+        num_workers=args.num_workers,
+        half=args.half,
+        use_safetensors=args.use_safetensors,
+    )
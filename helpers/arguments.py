@@ -6,6 +6,9 @@ import logging
 import sys
 import torch
 from helpers.models.smoldit import SmolDiTConfigurationNames
+from helpers.models.attention_backends import attention_backends
+from helpers.models.vae_decode import vae_decode_modes
+from helpers.training.activation_checkpointing import checkpointing_policies
 from helpers.training import quantised_precision_levels
 from helpers.training.optimizer_param import (
     map_args_to_optimizer,
@@ -74,6 +77,14 @@ def parse_args(input_args=None):
             " This is required when using the soft min SNR calculation method."
         ),
     )
+    parser.add_argument(
+        "--use_debiased_estimation",
+        action="store_true",
+        help=(
+            "When using --snr_gamma, also scale the loss of each timestep by 1/sqrt(SNR)."
+            " More details here: https://arxiv.org/abs/2310.08442."
+        ),
+    )
     parser.add_argument(
         "--model_type",
         type=str,
@@ -541,6 +552,35 @@ def parse_args(input_args=None):
             "By default, will batch-encode images before training. For some situations, ondemand may be desired, but it greatly slows training and increases memory pressure."
         ),
     )
+    parser.add_argument(
+        "--vae_cache_ondemand_lookahead",
+        type=int,
+        default=0,
+        help=(
+            "When using --vae_cache_ondemand, the sampler may draw this many batches ahead of the training step,"
+            " so that their latents are encoded in a background thread and are ready when they are needed."
+            " Each batch held in reserve costs its latents in memory. Default: 0 (disabled)"
+        ),
+    )
+    parser.add_argument(
+        "--vae_cache_store_distribution",
+        action="store_true",
+        default=False,
+        help=(
+            "Store the mean and log-variance of each image's VAE latent distribution instead of a single sample."
+            " A fresh latent is drawn from the distribution every time it is read, which gives VAE-sampling augmentation"
+            " without re-encoding, at roughly twice the cache size. Existing cache entries are still read as-is."
+        ),
+    )
+    parser.add_argument(
+        "--vae_cache_distribution_dtype",
+        type=str,
+        choices=["fp16", "bf16", "fp32"],
+        default="fp16",
+        help=(
+            "The precision used to store latent distributions when --vae_cache_store_distribution is set. Default: fp16"
+        ),
+    )
     parser.add_argument(
         "--compress_disk_cache",
         action="store_true",
@@ -711,6 +751,18 @@ def parse_args(input_args=None):
         type=int,
         help=("How many active threads or processes to run during VAE caching."),
     )
+    parser.add_argument(
+        "--data_backend_init_workers",
+        type=int,
+        default=8,
+        help=(
+            "How many datasets may run the I/O-bound phases of their startup at the same time, such as"
+            " listing files, loading aspect buckets and metadata, collecting captions and discovering caches."
+            " Datasets sharing a bucket cache file always run one after another, and text embed and VAE"
+            " encoding always run one dataset at a time. Set to 1 to initialise datasets sequentially."
+            " Default: 8."
+        ),
+    )
     parser.add_argument(
         "--aws_max_pool_connections",
         type=int,
@@ -907,6 +959,19 @@ def parse_args(input_args=None):
         action="store_true",
         help="(SD 2.x only) Whether to train the text encoder. If set, the text encoder should be float32 precision.",
     )
+    parser.add_argument(
+        "--text_encoder_offload",
+        type=str,
+        choices=["delete", "cpu", "disk"],
+        default="delete",
+        help=(
+            "What happens to the text encoders once the text embeds are cached, when they aren't being trained."
+            " 'delete' releases them, and a prompt missing from the cache is an error."
+            " 'cpu' moves them to system memory. 'disk' writes a copy to {cache_dir}/text_encoders and releases them."
+            " With 'cpu' or 'disk', they're loaded again whenever a prompt is missing from the cache,"
+            " eg. a new validation prompt. Default: delete"
+        ),
+    )
     # DeepFloyd
     parser.add_argument(
         "--tokenizer_max_length",
@@ -947,6 +1012,17 @@ def parse_args(input_args=None):
         default=None,
         help="Max number of checkpoints to store.",
     )
+    parser.add_argument(
+        "--deduplicate_checkpoints",
+        action="store_true",
+        default=False,
+        help=(
+            "When training a full model, store each checkpoint's weights in a content-addressed store under"
+            " --output_dir, so that tensors which didn't change since the previous checkpoint aren't written again."
+            " Tensors no longer used by any checkpoint are removed when checkpoints are rotated."
+            " These checkpoints can only be loaded by SimpleTuner, eg. through --resume_from_checkpoint."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -967,6 +1043,35 @@ def parse_args(input_args=None):
         action="store_true",
         help="Whether or not to use gradient checkpointing to save memory at the expense of slower backward pass.",
     )
+    parser.add_argument(
+        "--gradient_checkpointing_policy",
+        type=str,
+        choices=checkpointing_policies,
+        default="full",
+        help=(
+            "Which parts of a transformer model --gradient_checkpointing recomputes."
+            " 'full' checkpoints every block. 'every_n' checkpoints every --gradient_checkpointing_interval blocks."
+            " 'attention' and 'mlp' only checkpoint those layers of each block."
+            " 'auto' measures the first training steps with every block checkpointed,"
+            " then stops checkpointing as many blocks as fit in --gradient_checkpointing_memory_budget."
+            " Default: full"
+        ),
+    )
+    parser.add_argument(
+        "--gradient_checkpointing_interval",
+        type=int,
+        default=2,
+        help="With --gradient_checkpointing_policy=every_n, checkpoint every this many blocks. Default: 2",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing_memory_budget",
+        type=float,
+        default=None,
+        help=(
+            "With --gradient_checkpointing_policy=auto, the peak GPU memory in GB to fit within."
+            " This requires a CUDA device."
+        ),
+    )
     parser.add_argument(
         "--learning_rate",
         type=float,
@@ -1126,6 +1231,16 @@ def parse_args(input_args=None):
             " This can save memory, but may slow down training. With Quanto, there may be no benefit."
         ),
     )
+    parser.add_argument(
+        "--flatten_adapter_parameters",
+        action="store_true",
+        help=(
+            "For LoRA and LyCORIS training, pack the trainable adapter weights and their gradients into a few"
+            " contiguous buffers, so that gradient casting, norm clipping and the optimizer step each run as a"
+            " handful of large operations instead of one per tensor. Saved LoRA weights are unaffected, but"
+            " optimizer states saved with this option can only be resumed with it enabled."
+        ),
+    )
     parser.add_argument(
         "--use_8bit_adam",
         action="store_true",
@@ -1373,6 +1488,18 @@ def parse_args(input_args=None):
         default=256,
         help="Square resolution images will be output at this resolution (256x256).",
     )
+    parser.add_argument(
+        "--validation_vae_decode",
+        type=str,
+        choices=list(vae_decode_modes),
+        default="full",
+        help=(
+            "How validation images are decoded from latents. 'full' decodes every image at once, upcasting the VAE"
+            " to fp32 where it needs it. 'batched' decodes one image at a time, and 'tiled' decodes one image at a time"
+            " in overlapping, blended tiles, which keeps the VAE's peak memory flat at high validation resolutions."
+            " Both only redo a decode in fp32 when an fp16 VAE overflows. Default: full"
+        ),
+    )
     parser.add_argument(
         "--validation_noise_scheduler",
         type=str,
@@ -1473,6 +1600,22 @@ def parse_args(input_args=None):
                 " Using 'fp8-quanto' will require Quanto for quantisation (Apple Silicon, NVIDIA, AMD)."
             ),
         )
+    parser.add_argument(
+        "--quantised_model_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Base models quantised with Quanto are stored here after their first quantisation, and loaded from here"
+            " on later launches instead of loading and quantising the full-precision weights again."
+            " Entries are keyed by the model weights, precision and library versions."
+            " Default: {cache_dir}/quantised_models"
+        ),
+    )
+    parser.add_argument(
+        "--disable_quantised_model_cache",
+        action="store_true",
+        help="Quantise the base model on every launch, without storing or reusing the result.",
+    )
     parser.add_argument(
         "--local_rank",
         type=int,
@@ -1484,6 +1627,25 @@ def parse_args(input_args=None):
         action="store_true",
         help="Whether or not to use xformers.",
     )
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        choices=list(attention_backends.keys()),
+        default="sdpa",
+        help=(
+            "The attention implementation used by the bundled SmolDiT and masked Flux transformers."
+            " 'sdpa' uses scaled_dot_product_attention with dense masks. 'gqa' avoids copying key and value heads"
+            " for grouped-query attention. 'chunked' also attends --attention_chunk_size queries at a time,"
+            " reducing peak memory for long sequences. 'flex' uses PyTorch's flex_attention, and requires PyTorch 2.5."
+            " Default: sdpa"
+        ),
+    )
+    parser.add_argument(
+        "--attention_chunk_size",
+        type=int,
+        default=1024,
+        help="The number of queries attended at a time with --attention_backend=chunked. Default: 1024",
+    )
     parser.add_argument(
         "--set_grads_to_none",
         action="store_true",
@@ -2045,6 +2207,13 @@ def parse_args(input_args=None):
                 "Flux Schnell requires fewer inference steps. Consider reducing --validation_num_inference_steps to 4."
             )
 
+    if args.vae_cache_ondemand_lookahead > 0 and not args.vae_cache_ondemand:
+        warning_log(
+            "--vae_cache_ondemand_lookahead has no effect without --vae_cache_ondemand."
+        )
+    if args.vae_cache_ondemand_lookahead < 0:
+        raise ValueError("--vae_cache_ondemand_lookahead must be 0 or greater.")
+
     if args.use_ema and args.ema_cpu_only:
         args.ema_device = "cpu"
 
@@ -2075,6 +2244,53 @@ def parse_args(input_args=None):
             )
             args.gradient_precision = "fp32"
 
+    if args.attention_backend != "sdpa" and not (
+        args.smoldit or (args.flux and args.flux_attention_masked_training)
+    ):
+        warning_log(
+            f"--attention_backend={args.attention_backend} only applies to SmolDiT and to Flux with"
+            " --flux_attention_masked_training, and will be ignored."
+        )
+    if args.gradient_checkpointing_policy != "full":
+        if not args.gradient_checkpointing:
+            raise ValueError(
+                "--gradient_checkpointing_policy requires --gradient_checkpointing."
+            )
+        if args.gradient_checkpointing_interval < 1:
+            raise ValueError("--gradient_checkpointing_interval must be at least 1.")
+        if not any([args.sd3, args.flux, args.pixart_sigma, args.smoldit]):
+            warning_log(
+                "--gradient_checkpointing_policy only applies to transformer models, every U-net block will be checkpointed."
+            )
+        if (
+            args.gradient_checkpointing_policy == "auto"
+            and args.gradient_checkpointing_memory_budget is None
+        ):
+            raise ValueError(
+                "--gradient_checkpointing_policy=auto requires --gradient_checkpointing_memory_budget."
+            )
+    if args.attention_chunk_size < 1:
+        raise ValueError("--attention_chunk_size must be at least 1.")
+
+    if args.data_backend_init_workers < 1:
+        raise ValueError("--data_backend_init_workers must be at least 1.")
+
+    if args.flatten_adapter_parameters:
+        if "lora" not in args.model_type:
+            raise ValueError(
+                "--flatten_adapter_parameters is only supported for LoRA and LyCORIS training."
+            )
+        if args.optimizer_release_gradients:
+            raise ValueError(
+                "--flatten_adapter_parameters can not be used with --optimizer_release_gradients."
+            )
+
+    if args.deduplicate_checkpoints and args.push_checkpoints_to_hub:
+        # Their weights are in --output_dir/tensor_store, which isn't uploaded with them.
+        raise ValueError(
+            "--deduplicate_checkpoints can not be used with --push_checkpoints_to_hub, as deduplicated checkpoints can only be loaded by SimpleTuner."
+        )
+
     if args.use_ema:
         if args.sd3:
             raise ValueError(
@@ -0,0 +1,92 @@
+import os
+import logging
+import threading
+from helpers.training.multi_process import rank_info
+
+logger = logging.getLogger("CacheExistenceIndex")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+
+class CacheExistenceIndex:
+    """
+    An in-memory record of which cache objects exist on a data backend.
+
+    It's built from a single listing of the cache directory, and kept current by recording every
+    write and delete the cache makes. Existence checks are then set lookups, instead of a request
+    to the backend for every file (a HEAD request per object, on S3).
+    """
+
+    def __init__(self, data_backend, cache_dir: str, file_extensions: list = None):
+        self.data_backend = data_backend
+        self.cache_dir = cache_dir
+        self.file_extensions = file_extensions or ["pt"]
+        self.keys = set()
+        self.lock = threading.Lock()
+        self.populated = False
+        self.rank_info = rank_info()
+        # How many times we still had to ask the backend.
+        self.backend_checks = 0
+
+    def debug_log(self, msg: str):
+        logger.debug(f"{self.rank_info}(id={self.data_backend.id}) {msg}")
+
+    def populate(self, filenames):
+        """Replace the index contents with the given cache filenames, eg. from StateTracker."""
+        keys = {str(filename) for filename in filenames}
+        with self.lock:
+            self.keys = keys
+            self.populated = True
+        self.debug_log(f"Indexed {len(keys)} cache objects.")
+
+    def populate_from_listing(self):
+        """List the cache directory once, and index everything found."""
+        self.populate(
+            filename
+            for _, _, files in self.data_backend.list_files(
+                instance_data_dir=self.cache_dir,
+                file_extensions=self.file_extensions,
+            )
+            for filename in files
+        )
+
+    def add(self, filenames):
+        with self.lock:
+            self.keys.update(str(filename) for filename in filenames)
+
+    def discard(self, filenames):
+        with self.lock:
+            self.keys.difference_update(str(filename) for filename in filenames)
+
+    def clear(self):
+        """Record that the cache is now empty."""
+        with self.lock:
+            self.keys.clear()
+            self.populated = True
+
+    def exists(self, filename, confirm_misses: bool = False) -> bool:
+        """
+        Whether a cache object exists.
+
+        Args:
+            filename (str): The cache object's path.
+            confirm_misses (bool): Ask the backend before reporting a miss. Use this where a false miss
+                is fatal, eg. because another process may have written the object since we listed.
+        """
+        if not self.populated:
+            self.populate_from_listing()
+        with self.lock:
+            if str(filename) in self.keys:
+                return True
+        if not confirm_misses:
+            return False
+        self.backend_checks += 1
+        if self.data_backend.exists(filename):
+            self.add([filename])
+            return True
+        return False
+
+    def __contains__(self, filename) -> bool:
+        return self.exists(filename)
+
+    def __len__(self) -> int:
+        return len(self.keys)
@@ -11,3 +11,40 @@ def reclaim_memory():
         torch.mps.synchronize()
 
     gc.collect()
+
+
+def memory_usage() -> dict:
+    """
+    Current and peak memory use of this process, in GB.
+
+    The peak host figure is the process' high-water mark, which can't be reset.
+    """
+    import resource
+    import psutil
+    import torch
+
+    usage = {
+        "host": psutil.Process().memory_info().rss / 1024**3,
+        # ru_maxrss is in kilobytes on Linux.
+        "host_peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2,
+        "device": 0.0,
+        "device_peak": 0.0,
+    }
+    if torch.cuda.is_available():
+        usage["device"] = torch.cuda.memory_allocated() / 1024**3
+        usage["device_peak"] = torch.cuda.max_memory_allocated() / 1024**3
+    elif torch.backends.mps.is_available():
+        usage["device"] = torch.mps.current_allocated_memory() / 1024**3
+        # MPS doesn't track its peak allocation.
+        usage["device_peak"] = None
+    return usage
+
+
+def format_memory_usage(usage: dict) -> str:
+    device_peak = ""
+    if usage["device_peak"] is not None:
+        device_peak = f" (peak {usage['device_peak']:.2f} GB)"
+    return (
+        f"host {usage['host']:.2f} GB (peak {usage['host_peak']:.2f} GB),"
+        f" device {usage['device']:.2f} GB{device_peak}"
+    )
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from helpers.training.multi_process import should_log
+
+logger = logging.getLogger("QuantisedModelCache")
+if should_log():
+    logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+else:
+    logger.setLevel(logging.ERROR)
+
+weight_file_extensions = (".safetensors", ".bin", ".pt", ".pth")
+
+
+def _library_versions() -> dict:
+    from importlib.metadata import PackageNotFoundError, version
+
+    versions = {"torch": torch.__version__}
+    for package in ["optimum-quanto", "diffusers", "transformers"]:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def weights_fingerprint(pretrained_path: str, subfolder: str = None, revision=None):
+    """
+    Identify the weights a model would be loaded from, without reading them.
+
+    Local directories are identified by the size and modification time of their weight files.
+    Hub models are identified by the commit of their locally cached snapshot. Returns None if the
+    weights aren't available locally yet.
+    """
+    if os.path.isdir(pretrained_path):
+        folder = os.path.join(pretrained_path, subfolder or "")
+        if not os.path.isdir(folder):
+            return None
+        files = []
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(weight_file_extensions) or name == "config.json":
+                stat = os.stat(os.path.join(folder, name))
+                files.append([name, stat.st_size, stat.st_mtime_ns])
+        return files or None
+    from huggingface_hub import try_to_load_from_cache
+
+    config_path = try_to_load_from_cache(
+        pretrained_path,
+        filename="/".join(filter(None, [subfolder, "config.json"])),
+        revision=revision,
+    )
+    if not isinstance(config_path, str):
+        return None
+    # .../snapshots/<commit>/[subfolder/]config.json
+    parts = os.path.normpath(config_path).split(os.sep)
+    return parts[parts.index("snapshots") + 1] if "snapshots" in parts else None
+
+
+class QuantisedModelCache:
+    """
+    Stores Quanto-quantised models as safetensors, so that each model is quantised only once.
+
+    An entry is keyed by the model, the weights it was loaded from (the hub snapshot, or the
+    local weight files), its precision, the dtype of its unquantised parameters and the versions
+    of the libraries involved. On a hit, the model is built without weights and its frozen
+    quantised state dict is mapped in, skipping the full-precision load and quantisation.
+    """
+
+    def __init__(self, cache_dir: str, extra_key: dict = None):
+        """
+        Args:
+            cache_dir (str): Where the entries are stored.
+            extra_key (dict): Other settings that change the stored weights.
+        """
+        self.cache_dir = cache_dir
+        self.extra_key = extra_key or {}
+        # model name -> key of the entry to write once it has been quantised
+        self.pending = {}
+
+    @classmethod
+    def from_args(cls, args):
+        if args.disable_quantised_model_cache:
+            return None
+        return cls(
+            args.quantised_model_cache_dir
+            or os.path.join(args.cache_dir, "quantised_models"),
+            extra_key={
+                "base_model_default_dtype": args.base_model_default_dtype,
+                "mixed_precision": args.mixed_precision,
+            },
+        )
+
+    def key(
+        self,
+        name: str,
+        model_cls,
+        pretrained_path: str,
+        subfolder: str = None,
+        revision: str = None,
+        variant: str = None,
+        precision: str = None,
+        dtype: torch.dtype = None,
+    ):
+        fingerprint = weights_fingerprint(pretrained_path, subfolder, revision)
+        if fingerprint is None:
+            return None
+        key = {
+            "name": name,
+            "class": f"{model_cls.__module__}.{model_cls.__qualname__}",
+            "pretrained_path": pretrained_path,
+            "subfolder": subfolder,
+            "revision": revision,
+            "variant": variant,
+            "weights": fingerprint,
+            "precision": precision,
+            "dtype": str(dtype),
+            "versions": _library_versions(),
+            **self.extra_key,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def load(
+        self,
+        name: str,
+        model_cls,
+        pretrained_path: str,
+        dtype: torch.dtype = None,
+        **key_args,
+    ):
+        """
+        Return the cached quantised model, or None. On a miss, the entry is written by `save`
+        once the model has been quantised.
+        """
+        key = self.key(name, model_cls, pretrained_path, dtype=dtype, **key_args)
+        if key is None:
+            return None
+        entry_dir = self.entry_dir(key)
+        if not os.path.exists(os.path.join(entry_dir, "model.safetensors")):
+            self.pending[name] = key
+            return None
+        from accelerate import init_empty_weights
+        from optimum.quanto import requantize
+
+        with open(os.path.join(entry_dir, "config.json")) as f:
+            config = json.load(f)
+        with open(os.path.join(entry_dir, "quantization_map.json")) as f:
+            quantization_map = json.load(f)
+        with init_empty_weights():
+            if hasattr(model_cls, "config_class"):
+                # transformers
+                model = model_cls._from_config(model_cls.config_class.from_dict(config))
+            else:
+                # diffusers
+                model = model_cls.from_config(config)
+        if dtype is not None:
+            # requantize copies the weights into the skeleton's parameters, so the unquantised
+            # ones would be left in float32.
+            model.to(dtype)
+        requantize(
+            model,
+            load_file(os.path.join(entry_dir, "model.safetensors")),
+            quantization_map,
+            device=torch.device("cpu"),
+        )
+        # Buffers outside of the state dict, eg. position ids, were left uninitialised.
+        buffers_path = os.path.join(entry_dir, "buffers.safetensors")
+        if os.path.exists(buffers_path):
+            for buffer_name, value in load_file(buffers_path).items():
+                module_name, _, attribute = buffer_name.rpartition(".")
+                model.get_submodule(module_name)._buffers[attribute] = value
+        model.eval()
+        logger.info(
+            f"Loaded the quantised {name} from the cache, skipping quantisation: {entry_dir}"
+        )
+        return model
+
+    def save(self, name: str, model):
+        """Store a quantised model, if `load` missed it."""
+        key = self.pending.pop(name, None)
+        if key is None:
+            return
+        from optimum.quanto import quantization_map
+
+        entry_dir = self.entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        logger.info(f"Storing the quantised {name} in the cache: {entry_dir}")
+        # Written elsewhere then renamed into place, so that a reader never sees a partial entry.
+        temporary_dir = f"{entry_dir}.tmp-{os.getpid()}"
+        os.makedirs(temporary_dir, exist_ok=True)
+        state_dict = model.state_dict()
+        seen_storage = set()
+        tensors = {}
+        for tensor_name, tensor in state_dict.items():
+            # safetensors can't store tensors sharing memory, eg. tied embeddings.
+            storage = (tensor.untyped_storage().data_ptr(), tensor.device)
+            if storage in seen_storage:
+                tensor = tensor.clone()
+            seen_storage.add(storage)
+            tensors[tensor_name] = tensor.contiguous()
+        save_file(tensors, os.path.join(temporary_dir, "model.safetensors"))
+        buffers = {
+            buffer_name: buffer.contiguous()
+            for buffer_name, buffer in model.named_buffers()
+            if buffer_name not in state_dict
+        }
+        if buffers:
+            save_file(buffers, os.path.join(temporary_dir, "buffers.safetensors"))
+        config = model.config
+        config = config.to_dict() if hasattr(config, "to_dict") else dict(config)
+        with open(os.path.join(temporary_dir, "config.json"), "w") as f:
+            json.dump(config, f)
+        with open(os.path.join(temporary_dir, "quantization_map.json"), "w") as f:
+            json.dump(quantization_map(model), f)
+        try:
+            os.rename(temporary_dir, entry_dir)
+        except OSError:
+            # Another process stored the same entry first.
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
+_cache = None
+
+
+def quantised_model_cache(args):
+    """The cache shared by the model loaders and `quantoise`, or None if it's disabled."""
+    global _cache
+    if _cache is None:
+        _cache = QuantisedModelCache.from_args(args)
+    return _cache
+
+
+def load_quantised_model(
+    args, name: str, model_cls, pretrained_path: str, precision: str, **key_args
+):
+    """Return a model from the quantised model cache, or None if it has to be quantised."""
+    cache = quantised_model_cache(args)
+    if cache is None:
+        return None
+    return cache.load(name, model_cls, pretrained_path, precision=precision, **key_args)
@@ -8,11 +8,13 @@ from tqdm import tqdm
 from helpers.data_backend.base import BaseDataBackend
 from helpers.training.state_tracker import StateTracker
 from helpers.prompts import PromptHandler
+from helpers.caching.existence_index import CacheExistenceIndex
 from helpers.training.multi_process import rank_info
 from queue import Queue
 import queue
 from threading import Thread
 from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from helpers.training.multi_process import _get_rank as get_rank, should_log
 
 logger = logging.getLogger("TextEmbeddingCache")
@@ -96,6 +98,20 @@ def _encode_sd3_prompt_with_clip(
     return prompt_embeds, pooled_prompt_embeds
 
 
+def requires_text_encoders(fn):
+    """Hold the text encoders on the accelerator while `fn` encodes prompts."""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        text_encoder_manager = StateTracker.get_text_encoder_manager()
+        if text_encoder_manager is None:
+            return fn(*args, **kwargs)
+        with text_encoder_manager.loaded("encoding prompts"):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
 class TextEmbeddingCache:
     prompts = {}
 
@@ -150,6 +166,7 @@ class TextEmbeddingCache:
         if self.data_backend.type == "local":
             self.cache_dir = os.path.abspath(self.cache_dir)
         self.data_backend.create_directory(self.cache_dir)
+        self.cache_index = CacheExistenceIndex(self.data_backend, self.cache_dir)
         self.write_queue = Queue()
         self.process_write_batches = True
         self.batch_write_thread = Thread(
@@ -159,6 +176,13 @@ class TextEmbeddingCache:
         )
         self.batch_write_thread.start()
 
+    def can_encode_cache_misses(self) -> bool:
+        """Whether a prompt missing from the cache can still be encoded."""
+        text_encoder_manager = StateTracker.get_text_encoder_manager()
+        return (
+            text_encoder_manager is not None and text_encoder_manager.can_rematerialise
+        )
+
     def debug_log(self, msg: str):
         logger.debug(f"{self.rank_info}(id={self.id}) {msg}")
 
@@ -199,6 +223,9 @@ class TextEmbeddingCache:
                 data_backend_id=self.id,
             )
         )
+        self.cache_index.populate(
+            StateTracker.get_text_cache_files(data_backend_id=self.id) or {}
+        )
         self.debug_log(" -> done listing all text embed cache entries")
 
     def save_to_cache(self, filename, embeddings):
@@ -243,12 +270,14 @@ class TextEmbeddingCache:
             ]
             for future in futures:
                 future.result()  # Wait for all writes to complete
+        self.cache_index.add(filename for _, filename in batch)
         logger.debug(f"Completed write batch of {len(batch)} items")
 
     def load_from_cache(self, filename):
         result = self.data_backend.torch_load(filename)
         return result
 
+    @requires_text_encoders
     def encode_flux_prompt(
         self,
         text_encoders,
@@ -292,6 +321,7 @@ class TextEmbeddingCache:
         return prompt_embeds, pooled_prompt_embeds, time_ids, masks
 
     # Adapted from pipelines.StableDiffusion3Pipeline.encode_prompt
+    @requires_text_encoders
     def encode_sd3_prompt(
         self,
         text_encoders,
@@ -352,6 +382,7 @@ class TextEmbeddingCache:
 
         return prompt_embeds, pooled_prompt_embeds
 
+    @requires_text_encoders
     def encode_legacy_prompt(self, text_encoder, tokenizer, prompt):
         input_tokens = tokenizer(
             PromptHandler.filter_caption(self.data_backend, prompt),
@@ -462,6 +493,7 @@ class TextEmbeddingCache:
         return prompt_embeds, pooled_prompt_embeds
 
     # Adapted from pipelines.StableDiffusionXLPipeline.encode_prompt
+    @requires_text_encoders
     def encode_sdxl_prompts(
         self,
         text_encoders,
@@ -535,6 +567,7 @@ class TextEmbeddingCache:
 
         return prompt_embeds
 
+    @requires_text_encoders
     def compute_t5_prompt(self, prompt: str):
         """
         Tokenise, encode, optionally mask, and then return a prompt_embed for a T5 model.
@@ -557,6 +590,21 @@ class TextEmbeddingCache:
 
         return result, attn_mask
 
+    def uncached_prompts(self, all_prompts):
+        # Parallel processing for hashing
+        with ThreadPoolExecutor() as executor:
+            all_cache_filenames = list(
+                executor.map(self.hash_prompt_with_path, all_prompts)
+            )
+
+        # Determine which prompts are not cached. The index holds the startup listing,
+        # plus every embed written since, so this makes no requests to the backend.
+        return [
+            prompt
+            for prompt, filename in zip(all_prompts, all_cache_filenames)
+            if not self.cache_index.exists(filename)
+        ]
+
     def compute_embeddings_for_prompts(
         self,
         all_prompts,
@@ -572,25 +620,7 @@ class TextEmbeddingCache:
             self.batch_write_thread = Thread(target=self.batch_write_embeddings)
             self.batch_write_thread.start()
 
-        existing_cache_filenames = list(
-            StateTracker.get_text_cache_files(data_backend_id=self.id).keys()
-        )
-
-        # Parallel processing for hashing
-        with ThreadPoolExecutor() as executor:
-            all_cache_filenames = list(
-                executor.map(self.hash_prompt_with_path, all_prompts)
-            )
-
-        # Create a set for faster lookups
-        existing_cache_filenames_set = set(existing_cache_filenames)
-
-        # Determine which prompts are not cached
-        uncached_prompts = [
-            prompt
-            for prompt, filename in zip(all_prompts, all_cache_filenames)
-            if filename not in existing_cache_filenames_set
-        ]
+        uncached_prompts = self.uncached_prompts(all_prompts)
 
         # If all prompts are cached and certain conditions are met, return None
         if not uncached_prompts and not return_concat:
@@ -699,6 +729,7 @@ class TextEmbeddingCache:
                 position=get_rank() + self.accelerator.num_processes + 1,
             ):
                 filename = os.path.join(self.cache_dir, self.hash_prompt(prompt))
+                cache_miss = False
                 debug_msg = f"Processing file: {filename}, prompt: {prompt}"
                 prompt = PromptHandler.filter_caption(self.data_backend, prompt)
                 debug_msg = f"{debug_msg}\n -> filtered prompt: {prompt}"
@@ -716,11 +747,12 @@ class TextEmbeddingCache:
                             f"\n-> error: {e}"
                             f"\n-> id: {self.id}, data_backend id: {self.data_backend.id}"
                         )
-                        should_encode = True
-                        raise Exception(
-                            "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
-                        )
-                if should_encode:
+                        if not self.can_encode_cache_misses():
+                            raise Exception(
+                                "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
+                            )
+                        cache_miss = True
+                if should_encode or cache_miss:
                     # If load_from_cache is True, should_encode would be False unless we failed to load.
                     # self.debug_log(f"Encoding prompt: {prompt}")
                     prompt_embeds, pooled_prompt_embeds = self.encode_sdxl_prompts(
@@ -832,6 +864,7 @@ class TextEmbeddingCache:
                 position=get_rank() + self.accelerator.num_processes + 1,
             ):
                 filename = os.path.join(self.cache_dir, self.hash_prompt(prompt))
+                cache_miss = False
                 if prompt != "":
                     prompt = PromptHandler.filter_caption(self.data_backend, prompt)
                 if prompt is None:
@@ -854,12 +887,13 @@ class TextEmbeddingCache:
                             f"\n-> filename: {filename}"
                             f"\n-> error: {e}"
                         )
-                        should_encode = True
-                        raise Exception(
-                            "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
-                        )
+                        if not self.can_encode_cache_misses():
+                            raise Exception(
+                                "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
+                            )
+                        cache_miss = True
 
-                if should_encode:
+                if should_encode or cache_miss:
                     # self.debug_log(f"Encoding prompt: {prompt}")
                     # Get the current size of the queue.
                     current_size = self.write_queue.qsize()
@@ -975,6 +1009,7 @@ class TextEmbeddingCache:
                 position=get_rank() + self.accelerator.num_processes + 1,
             ):
                 filename = os.path.join(self.cache_dir, self.hash_prompt(prompt))
+                cache_miss = False
                 debug_msg = f"Processing file: {filename}, prompt: {prompt}"
                 prompt = PromptHandler.filter_caption(self.data_backend, prompt)
                 debug_msg = f"{debug_msg}\n -> filtered prompt: {prompt}"
@@ -1008,11 +1043,12 @@ class TextEmbeddingCache:
                             f"\n-> error: {e}"
                             f"\n-> id: {self.id}, data_backend id: {self.data_backend.id}"
                         )
-                        should_encode = True
-                        raise Exception(
-                            "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
-                        )
-                if should_encode:
+                        if not self.can_encode_cache_misses():
+                            raise Exception(
+                                "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
+                            )
+                        cache_miss = True
+                if should_encode or cache_miss:
                     # If load_from_cache is True, should_encode would be False unless we failed to load.
                     self.debug_log(f"Encoding prompt: {prompt}")
                     prompt_embeds, pooled_prompt_embeds, time_ids, masks = (
@@ -1128,6 +1164,7 @@ class TextEmbeddingCache:
                 position=get_rank() + self.accelerator.num_processes + 1,
             ):
                 filename = os.path.join(self.cache_dir, self.hash_prompt(prompt))
+                cache_miss = False
                 debug_msg = f"Processing file: {filename}, prompt: {prompt}"
                 prompt = PromptHandler.filter_caption(self.data_backend, prompt)
                 debug_msg = f"{debug_msg}\n -> filtered prompt: {prompt}"
@@ -1151,11 +1188,12 @@ class TextEmbeddingCache:
                             f"\n-> error: {e}"
                             f"\n-> id: {self.id}, data_backend id: {self.data_backend.id}"
                         )
-                        should_encode = True
-                        raise Exception(
-                            "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
-                        )
-                if should_encode:
+                        if not self.can_encode_cache_misses():
+                            raise Exception(
+                                "Cache retrieval for text embed file failed. Ensure your dataloader config value for skip_file_discovery does not contain 'text', and that preserve_data_backend_cache is disabled or unset."
+                            )
+                        cache_miss = True
+                if should_encode or cache_miss:
                     # If load_from_cache is True, should_encode would be False unless we failed to load.
                     self.debug_log(f"Encoding prompt: {prompt}")
                     prompt_embeds, pooled_prompt_embeds = self.encode_sd3_prompt(
@@ -1,4 +1,5 @@
 import os
+import math
 import torch
 import logging
 import traceback
@@ -19,13 +20,18 @@ from queue import Queue
 from concurrent.futures import as_completed
 from hashlib import sha256
 from helpers.training import image_file_extensions
+from helpers.caching.vae_lookahead import VAEEncodeLookahead
+from helpers.caching.existence_index import CacheExistenceIndex
 
 logger = logging.getLogger("VAECache")
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
 
 
 def prepare_sample(
-    image: Image.Image = None, data_backend_id: str = None, filepath: str = None
+    image: Image.Image = None,
+    data_backend_id: str = None,
+    filepath: str = None,
+    crop_coordinates: tuple = None,
 ):
     metadata = StateTracker.get_metadata_by_filepath(
         filepath, data_backend_id=data_backend_id
@@ -41,7 +47,7 @@ def prepare_sample(
         image_metadata=metadata,
         image_path=filepath,
     )
-    prepared_sample = training_sample.prepare()
+    prepared_sample = training_sample.prepare(crop_coordinates=crop_coordinates)
     return (
         prepared_sample.image,
         prepared_sample.crop_coordinates,
@@ -72,7 +78,11 @@ class VAECache:
         minimum_image_size: int = None,
         max_workers: int = 32,
         vae_cache_ondemand: bool = False,
+        vae_cache_ondemand_lookahead: int = 0,
         hash_filenames: bool = False,
+        store_distribution: bool = False,
+        distribution_dtype: torch.dtype = torch.float16,
+        crop_variants: int = 1,
     ):
         self.id = id
         if image_data_backend.id != id:
@@ -96,6 +106,7 @@ class VAECache:
         self.resolution_type = resolution_type
         self.minimum_image_size = minimum_image_size
         self.cache_data_backend.create_directory(self.cache_dir)
+        self.cache_index = CacheExistenceIndex(self.cache_data_backend, self.cache_dir)
         self.delete_problematic_images = delete_problematic_images
         self.write_batch_size = write_batch_size
         self.read_batch_size = read_batch_size
@@ -109,6 +120,19 @@ class VAECache:
             self.metadata_backend.load_image_metadata()
 
         self.vae_cache_ondemand = vae_cache_ondemand
+        self.store_distribution = store_distribution
+        self.distribution_dtype = distribution_dtype
+        self.storage_accounting_logged = False
+        self.crop_variants = max(1, int(crop_variants))
+        self.missing_crop_variants_logged = False
+        self.lookahead = None
+        if vae_cache_ondemand and vae_cache_ondemand_lookahead > 0:
+            # Room for the batch being trained on, plus every batch the sampler has peeked at.
+            self.lookahead = VAEEncodeLookahead(
+                self,
+                max_parked=(vae_cache_ondemand_lookahead + 1)
+                * StateTracker.get_args().train_batch_size,
+            )
 
         self.max_workers = max_workers
         if (maximum_image_size and not target_downsample_size) or (
@@ -128,14 +152,22 @@ class VAECache:
     def debug_log(self, msg: str):
         logger.debug(f"{self.rank_info}{msg}")
 
-    def generate_vae_cache_filename(self, filepath: str) -> tuple:
-        """Get the cache filename for a given image filepath and its base name."""
+    def generate_vae_cache_filename(
+        self, filepath: str, crop_variant: int = 0
+    ) -> tuple:
+        """
+        Get the cache filename for a given image filepath and its base name.
+
+        Crop variants beyond the first are stored alongside the primary latent, with a `-crop{n}` suffix.
+        """
         if filepath.endswith(".pt"):
             return filepath, os.path.basename(filepath)
         # Extract the base name from the filepath and replace the image extension with .pt
         base_filename = os.path.splitext(os.path.basename(filepath))[0]
         if self.hash_filenames:
             base_filename = str(sha256(str(base_filename).encode()).hexdigest())
+        if crop_variant > 0:
+            base_filename = f"{base_filename}-crop{crop_variant}"
         base_filename = str(base_filename) + ".pt"
         # Find the subfolders the sample was in, and replace the instance_data_dir with the cache_dir
         subfolders = ""
@@ -169,25 +201,63 @@ class VAECache:
         self.image_path_to_vae_path = {}
         self.vae_path_to_image_path = {}
         for image_file in all_image_files:
-            cache_filename, _ = self.generate_vae_cache_filename(image_file)
-            if self.cache_data_backend.type == "local":
-                cache_filename = os.path.abspath(cache_filename)
-            self.image_path_to_vae_path[image_file] = cache_filename
-            self.vae_path_to_image_path[cache_filename] = image_file
+            for crop_variant in range(self.crop_variants):
+                cache_filename, _ = self.generate_vae_cache_filename(
+                    image_file, crop_variant
+                )
+                if self.cache_data_backend.type == "local":
+                    cache_filename = os.path.abspath(cache_filename)
+                if crop_variant == 0:
+                    self.image_path_to_vae_path[image_file] = cache_filename
+                self.vae_path_to_image_path[cache_filename] = image_file
+
+    def _crop_variant_cache_filenames(self, filepath: str) -> list:
+        """The extra cache files an image needs, beyond its primary latent, for its crop variants."""
+        if self.get_crop_variant_coordinates(filepath) is None:
+            return []
+        return [
+            self.generate_vae_cache_filename(filepath, crop_variant)[0]
+            for crop_variant in range(1, self.crop_variants)
+        ]
 
     def already_cached(self, filepath: str) -> bool:
         test_path = self.image_path_to_vae_path.get(filepath, None)
-        if self.cache_data_backend.exists(test_path):
-            return True
-        return False
+        if not self.cache_index.exists(test_path):
+            return False
+        for variant_path in self._crop_variant_cache_filenames(filepath):
+            if not self.cache_index.exists(variant_path):
+                return False
+        return True
+
+    def get_crop_variant_coordinates(self, filepath: str) -> list:
+        """
+        Return the (top, left) coordinates recorded for every crop variant of an image.
+
+        Returns None when the dataset caches a single crop, or when the metadata predates crop_variants.
+        """
+        if self.crop_variants <= 1:
+            return None
+        coordinates = self.metadata_backend.get_metadata_attribute_by_filepath(
+            filepath=filepath, attribute="crop_variant_coordinates"
+        )
+        if coordinates is None or len(coordinates) < self.crop_variants:
+            if not self.missing_crop_variants_logged:
+                self.missing_crop_variants_logged = True
+                logger.warning(
+                    f"(id={self.id}) Image metadata has no coordinates for {self.crop_variants} crop variants (eg. {filepath})."
+                    " Those images will only have a single crop cached. Clear the aspect bucket cache and VAE cache to regenerate them."
+                )
+            return None
+        return [tuple(coordinates[idx]) for idx in range(self.crop_variants)]
 
     def _read_from_storage(
-        self, filename: str, hide_errors: bool = False
+        self, filename: str, hide_errors: bool = False, sample_distribution=True
     ) -> torch.Tensor:
         """Read an image or cache object from the storage backend.
 
         Args:
             filename (str): The path to the cache item, eg. `vae_cache/foo.pt` or `instance_data_dir/foo.png`
+            sample_distribution (bool): Draw a latent from stored distribution parameters, rather than returning them.
 
         Returns:
             Image or cache object
@@ -204,7 +274,10 @@ class VAECache:
                     )
                 raise e
         try:
-            return self.cache_data_backend.torch_load(filename).to("cpu")
+            cache_object = self.cache_data_backend.torch_load(filename)
+            if sample_distribution:
+                return self.sample_latent_distribution(cache_object).to("cpu")
+            return cache_object
         except Exception as e:
             if hide_errors:
                 self.debug_log(
@@ -213,10 +286,28 @@ class VAECache:
                 return None
             raise e
 
-    def retrieve_from_cache(self, filepath: str):
+    @staticmethod
+    def sample_latent_distribution(cache_object):
+        """
+        Draw a fresh latent from a stored distribution, or pass a stored latent through.
+
+        Distributions are stored already scaled and shifted, so that a sample is one fused
+        multiply-add, and every read of the same cache entry yields a new VAE sample.
+        """
+        if not isinstance(cache_object, dict):
+            return cache_object
+        mean = cache_object["latent_mean"]
+        std = torch.exp(0.5 * cache_object["latent_logvar"].float())
+        return torch.addcmul(mean.float(), std, torch.randn_like(std)).to(mean.dtype)
+
+    def retrieve_from_cache(self, filepath: str, crop_variant: int = 0):
         """
         Use the encode_images method to emulate a single image encoding.
+
+        A nonzero crop_variant reads that cached crop of the image instead of the primary one.
         """
+        if crop_variant > 0:
+            filepath = self.generate_vae_cache_filename(filepath, crop_variant)[0]
         return self.encode_images([None], [filepath])[0]
 
     def retreve_batch_from_cache(self, filepaths: list):
@@ -341,6 +432,7 @@ class VAECache:
                     raise e
         # Clear the StateTracker list of VAE objects:
         StateTracker.set_vae_cache_files([], data_backend_id=self.id)
+        self.cache_index.clear()
 
     def _list_cached_images(self):
         """
@@ -361,6 +453,8 @@ class VAECache:
         existing_cache_files = set(
             StateTracker.get_vae_cache_files(data_backend_id=self.id)
         )
+        # Every existence check from here on is answered from this listing, rather than the backend.
+        self.cache_index.populate(existing_cache_files)
         # Convert cache filenames to their corresponding image filenames
         already_cached_images = []
         for cache_file in existing_cache_files:
@@ -373,6 +467,16 @@ class VAECache:
                     f"Could not find image path for cache file {cache_file}: {e}"
                 )
                 continue
+        if self.crop_variants > 1:
+            # An image only counts as cached once every one of its crop variants is.
+            cache_file_counts = {}
+            for image_file in already_cached_images:
+                cache_file_counts[image_file] = cache_file_counts.get(image_file, 0) + 1
+            already_cached_images = [
+                image_file
+                for image_file, count in cache_file_counts.items()
+                if count > len(self._crop_variant_cache_filenames(image_file))
+            ]
 
         # Identify unprocessed files
         self.local_unprocessed_files = [
@@ -397,7 +501,10 @@ class VAECache:
         for full_image_path in aspect_bucket_cache[bucket]:
             total_files += 1
             comparison_path = self.generate_vae_cache_filename(full_image_path)[0]
-            if os.path.splitext(comparison_path)[0] in processed_images:
+            if os.path.splitext(comparison_path)[0] in processed_images and all(
+                os.path.splitext(variant_path)[0] in processed_images
+                for variant_path in self._crop_variant_cache_filenames(full_image_path)
+            ):
                 # processed_images contains basename *cache* paths:
                 skipped_files += 1
                 # self.debug_log(
@@ -438,56 +545,16 @@ class VAECache:
             self.generate_vae_cache_filename(filepath)[0] for filepath in filepaths
         ]
 
-        # Check cache for each image and filter out already cached ones
-        uncached_images = []
+        # Check cache for each image and filter out already cached ones.
+        # Reading from a precomputed cache, a miss is fatal, so it's confirmed with the backend first;
+        # another process may have written the entry since we listed the cache.
+        confirm_misses = load_from_cache and not self.vae_cache_ondemand
         uncached_image_indices = [
             i
             for i, filename in enumerate(full_filenames)
-            if not self.cache_data_backend.exists(filename)
-        ]
-        uncached_image_paths = [
-            filepaths[i]
-            for i, filename in enumerate(full_filenames)
-            if i in uncached_image_indices
+            if not self.cache_index.exists(filename, confirm_misses=confirm_misses)
         ]
-
-        # We need to populate any uncached images with the actual image data if they are None.
-        missing_images = [
-            i
-            for i, image in enumerate(images)
-            if i in uncached_image_indices and image is None
-        ]
-        missing_image_pixel_values = []
-        written_latents = []
-        if len(missing_images) > 0 and self.vae_cache_ondemand:
-            missing_image_paths = [filepaths[i] for i in missing_images]
-            missing_image_data_generator = self._read_from_storage_concurrently(
-                missing_image_paths, hide_errors=True
-            )
-            # extract images from generator:
-            missing_image_data = [
-                retrieved_image_data[1]
-                for retrieved_image_data in missing_image_data_generator
-            ]
-            missing_image_pixel_values = self._process_images_in_batch(
-                missing_image_paths, missing_image_data, disable_queue=True
-            )
-            missing_image_vae_outputs = self._encode_images_in_batch(
-                image_pixel_values=missing_image_pixel_values, disable_queue=True
-            )
-            written_latents = self._write_latents_in_batch(missing_image_vae_outputs)
-            if len(written_latents) == len(images):
-                return written_latents
-
-        if len(uncached_image_indices) > 0:
-            uncached_images = [images[i] for i in uncached_image_indices]
-        elif len(missing_images) > 0 and len(missing_image_pixel_values) > 0:
-            uncached_images = []
-            for i in uncached_image_indices:
-                if images[i] is not None:
-                    uncached_images.append(images[i])
-                elif i in missing_image_pixel_values:
-                    uncached_images.append(missing_image_pixel_values[i])
+        uncached_image_paths = [filepaths[i] for i in uncached_image_indices]
 
         if (
             len(uncached_image_indices) > 0
@@ -499,48 +566,134 @@ class VAECache:
                 f"(id={self.id}) Some images were not correctly cached during the VAE Cache operations. Ensure --skip_file_discovery=vae is not set.\nProblematic images: {uncached_image_paths}"
             )
 
-        latents = []
+        latents = [None] * batch_size
+        # We need to populate any uncached images with the actual image data if they are None.
+        missing_images = [i for i in uncached_image_indices if images[i] is None]
+        if len(missing_images) > 0 and self.vae_cache_ondemand:
+            ondemand_latents = self._encode_missing_images(
+                [filepaths[i] for i in missing_images]
+            )
+            for i in missing_images:
+                latents[i] = ondemand_latents.get(filepaths[i])
+
+        uncached_images = [i for i in uncached_image_indices if images[i] is not None]
+        if len(uncached_images) > 0:
+            # Process images not found in cache
+            latents_uncached = self._encode_pixel_values(
+                torch.stack([images[i] for i in uncached_images])
+            )
+            for uncached_idx, i in enumerate(uncached_images):
+                latents[i] = latents_uncached[uncached_idx]
+        elif not load_from_cache:
+            # Nothing was handed to us that needed encoding.
+            return []
+
+        # Anything left over is already in the cache.
+        for i, latent in enumerate(latents):
+            if latent is None:
+                latents[i] = self._read_from_storage(
+                    full_filenames[i],
+                    hide_errors=self.vae_cache_ondemand,
+                    sample_distribution=False,
+                )
         if load_from_cache:
-            # If all images are cached, simply load them
+            # Callers reading from the cache want latents, not distribution parameters.
             latents = [
-                self._read_from_storage(filename, hide_errors=self.vae_cache_ondemand)
-                for filename in full_filenames
-                if filename not in uncached_images
+                (
+                    self.sample_latent_distribution(latent)
+                    if latent is not None
+                    else None
+                )
+                for latent in latents
             ]
+        return latents
 
-        if len(uncached_images) > 0 and (
-            len(images) != len(latents) or len(filepaths) != len(latents)
+    def _encode_pixel_values(self, pixel_values: torch.Tensor):
+        """
+        Run a stacked batch of pixel values through the VAE.
+
+        Returns scaled latents, or when store_distribution is set, a list of dicts holding the
+        scaled mean and log-variance of each image's latent distribution.
+        """
+        with torch.no_grad():
+            processed_images = pixel_values.to(
+                self.accelerator.device, dtype=StateTracker.get_vae_dtype()
+            )
+            latent_dist = self.vae.encode(processed_images).latent_dist
+            if self.store_distribution:
+                latents = latent_dist.mean
+            else:
+                latents = latent_dist.sample()
+            if (
+                hasattr(self.vae, "config")
+                and hasattr(self.vae.config, "shift_factor")
+                and self.vae.config.shift_factor is not None
+            ):
+                latents = (
+                    latents - self.vae.config.shift_factor
+                ) * self.vae.config.scaling_factor
+            else:
+                latents = latents * self.vae.config.scaling_factor
+            logger.debug(f"Latents shape: {latents.shape}")
+            if not self.store_distribution:
+                return latents
+            # Scaling the latent by s scales its variance by s^2.
+            logvar = latent_dist.logvar + 2 * math.log(self.vae.config.scaling_factor)
+            self._log_storage_accounting(latents[0])
+            return [
+                {
+                    "latent_mean": mean.to(self.distribution_dtype),
+                    "latent_logvar": image_logvar.to(self.distribution_dtype),
+                }
+                for mean, image_logvar in zip(latents, logvar)
+            ]
+
+    def _log_storage_accounting(self, latent: torch.Tensor):
+        """Report, once, what storing distributions costs compared to storing a single sample."""
+        if self.storage_accounting_logged:
+            return
+        self.storage_accounting_logged = True
+        sample_bytes = latent.numel() * latent.element_size()
+        distribution_bytes = (
+            2
+            * latent.numel()
+            * torch.empty((), dtype=self.distribution_dtype).element_size()
+        )
+        image_count = len(getattr(self, "image_path_to_vae_path", {}))
+        logger.info(
+            f"(id={self.id}) Storing VAE latent distributions as {self.distribution_dtype}:"
+            f" {distribution_bytes} bytes per {tuple(latent.shape)} latent, versus {sample_bytes} bytes for a single {latent.dtype} sample"
+            f" ({distribution_bytes / sample_bytes:.2f}x)."
+            f" For {image_count} images, that is ~{distribution_bytes * image_count / 1024**2:.1f}MiB"
+            f" instead of ~{sample_bytes * image_count / 1024**2:.1f}MiB, in exchange for a fresh VAE sample on every read."
+        )
+
+    def _encode_missing_images(self, filepaths: list) -> dict:
+        """
+        Read, process, encode and write the given images for --vae_cache_ondemand.
+
+        Returns:
+            dict: image filepath -> latent, for every image that could be encoded.
+        """
+        image_paths, image_data = [], []
+        for filepath, image in self._read_from_storage_concurrently(
+            filepaths, hide_errors=True
         ):
-            # Process images not found in cache
-            with torch.no_grad():
-                processed_images = torch.stack(uncached_images).to(
-                    self.accelerator.device, dtype=StateTracker.get_vae_dtype()
-                )
-                latents_uncached = self.vae.encode(
-                    processed_images
-                ).latent_dist.sample()
-                if (
-                    hasattr(self.vae, "config")
-                    and hasattr(self.vae.config, "shift_factor")
-                    and self.vae.config.shift_factor is not None
-                ):
-                    latents_uncached = (
-                        latents_uncached - self.vae.config.shift_factor
-                    ) * self.vae.config.scaling_factor
-                else:
-                    latents_uncached = latents_uncached * self.vae.config.scaling_factor
-                logger.debug(f"Latents shape: {latents_uncached.shape}")
-
-            # Prepare final latents list by combining cached and newly computed latents
-            cached_idx, uncached_idx = 0, 0
-            for i in range(batch_size):
-                if i in uncached_image_indices:
-                    latents.append(latents_uncached[uncached_idx])
-                    uncached_idx += 1
-                else:
-                    latents.append(self._read_from_storage(full_filenames[i]))
-                    cached_idx += 1
-        return latents
+            image_paths.append(filepath)
+            image_data.append(image)
+        pixel_values = self._process_images_in_batch(
+            image_paths, image_data, disable_queue=True
+        )
+        vae_outputs = self._encode_images_in_batch(
+            image_pixel_values=pixel_values, disable_queue=True
+        )
+        if not vae_outputs:
+            return {}
+        encoded = {filepath: latent for _, filepath, latent in vae_outputs}
+        # _write_latents_in_batch consumes the list it is given.
+        self._write_latents_in_batch(list(vae_outputs))
+
+        return encoded
 
     def _write_latents_in_batch(self, input_latents: list = None):
         # Pull the 'filepaths' and 'latents' from self.write_queue
@@ -562,9 +715,15 @@ class VAECache:
                 )
             filepaths.append(output_file)
             # pytorch will hold onto all of the tensors in the list if we do not use clone()
-            latents.append(latent_vector.clone())
+            if isinstance(latent_vector, dict):
+                latents.append(
+                    {key: value.clone() for key, value in latent_vector.items()}
+                )
+            else:
+                latents.append(latent_vector.clone())
 
         self.cache_data_backend.write_batch(filepaths, latents)
+        self.cache_index.add(filepaths)
 
         return latents
 
@@ -618,14 +777,44 @@ class VAECache:
                 # image.save(f"test_{os.path.basename(filepath)}.png")
                 initial_data.append((filepath, image, aspect_bucket))
 
+            # Every crop variant is cut from its own copy of the image, so the workers never share one.
+            crop_variant_coordinates = {
+                data[0]: self.get_crop_variant_coordinates(data[0])
+                for data in initial_data
+            }
+            crop_variant_images = {
+                (data[0], crop_variant): data[1].copy()
+                for data in initial_data
+                if crop_variant_coordinates[data[0]] is not None
+                for crop_variant in range(1, self.crop_variants)
+            }
+
             # Process Pool Execution
             processed_images = []
             with ThreadPoolExecutor(self.max_workers) as executor:
+                crop_variant_futures = {
+                    (filepath, crop_variant): executor.submit(
+                        prepare_sample,
+                        image=image,
+                        data_backend_id=self.id,
+                        filepath=filepath,
+                        crop_coordinates=crop_variant_coordinates[filepath][
+                            crop_variant
+                        ],
+                    )
+                    for (filepath, crop_variant), image in crop_variant_images.items()
+                }
                 futures = [
                     executor.submit(
                         prepare_sample,
+                        image=data[1],
                         data_backend_id=self.id,
                         filepath=data[0],
+                        crop_coordinates=(
+                            crop_variant_coordinates[data[0]][0]
+                            if crop_variant_coordinates[data[0]] is not None
+                            else None
+                        ),
                     )
                     for data in initial_data
                 ]
@@ -683,12 +872,34 @@ class VAECache:
                 pixel_values = self.transform(image).to(
                     self.accelerator.device, dtype=self.vae.dtype
                 )
-                output_value = (pixel_values, filepath, aspect_bucket, is_final_sample)
-                output_values.append(output_value)
-                if not disable_queue:
-                    self.vae_input_queue.put(
-                        (pixel_values, filepath, aspect_bucket, is_final_sample)
+                # Crop variants share the aspect bucket, so they are encoded in the same batch as their image.
+                # They're addressed by their cache path, which _encode_images_in_batch passes through as-is.
+                sample_outputs = [(pixel_values, filepath)]
+                for crop_variant in range(1, self.crop_variants):
+                    variant_future = crop_variant_futures.get((filepath, crop_variant))
+                    if variant_future is None:
+                        continue
+                    variant_image, _, _ = variant_future.result()
+                    sample_outputs.append(
+                        (
+                            self.transform(variant_image).to(
+                                self.accelerator.device, dtype=self.vae.dtype
+                            ),
+                            self.generate_vae_cache_filename(filepath, crop_variant)[0],
+                        )
                     )
+                for sample_idx, (sample_pixel_values, sample_path) in enumerate(
+                    sample_outputs
+                ):
+                    output_value = (
+                        sample_pixel_values,
+                        sample_path,
+                        aspect_bucket,
+                        is_final_sample and sample_idx == len(sample_outputs) - 1,
+                    )
+                    output_values.append(output_value)
+                    if not disable_queue:
+                        self.vae_input_queue.put(output_value)
                 # Update the crop_coordinates in the metadata document
                 # NOTE: This is currently a no-op because the metadata is now considered 'trustworthy'.
                 #       The VAE encode uses the preexisting metadata, and the TrainingSample class will not update.
@@ -0,0 +1,167 @@
+import os
+import time
+import torch
+import logging
+import threading
+import traceback
+from collections import OrderedDict
+from queue import Queue, Empty
+from helpers.training.multi_process import rank_info
+
+logger = logging.getLogger("VAELookahead")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+
+class VAEEncodeLookahead:
+    """
+    Encode upcoming batches ahead of time when --vae_cache_ondemand is in use.
+
+    The sampler announces every batch it draws via `enqueue`, which happens up to
+    `--vae_cache_ondemand_lookahead` batches before collate_fn asks for the latents.
+    A background thread encodes them (on a dedicated CUDA stream, when one is available)
+    and parks the results in a bounded LRU, so that `retrieve` can usually return
+    without touching the VAE on the training thread.
+    """
+
+    def __init__(self, vae_cache, max_parked: int = 64):
+        self.vae_cache = vae_cache
+        self.max_parked = max(1, int(max_parked))
+        self.pending = Queue()
+        self.parked = OrderedDict()
+        self.in_flight = set()
+        self.condition = threading.Condition()
+        self.stream = None
+        self.thread = None
+        self.keep_running = True
+        self.rank_info = rank_info()
+        # Statistics, for reporting the encode stall time.
+        self.hits = 0
+        self.misses = 0
+        self.last_stall_time = 0.0
+        self.total_stall_time = 0.0
+
+    def debug_log(self, msg: str):
+        logger.debug(f"{self.rank_info}{msg}")
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        device = torch.device(self.vae_cache.accelerator.device)
+        if device.type == "cuda" and torch.cuda.is_available():
+            self.stream = torch.cuda.Stream(device=device)
+        self.keep_running = True
+        self.thread = threading.Thread(
+            target=self._encode_worker,
+            name=f"VAEEncodeLookahead-{self.vae_cache.id}",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.keep_running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.condition:
+            self.in_flight.clear()
+            self.condition.notify_all()
+
+    def enqueue(self, filepaths: list):
+        """Schedule a batch of image paths for background encoding."""
+        with self.condition:
+            filepaths = [
+                filepath
+                for filepath in dict.fromkeys(filepaths)
+                if filepath not in self.parked and filepath not in self.in_flight
+            ]
+            self.in_flight.update(filepaths)
+        if len(filepaths) == 0:
+            return
+        self.start()
+        self.pending.put(filepaths)
+        self.debug_log(f"Queued {len(filepaths)} images for lookahead encoding.")
+
+    def _encode(self, filepaths: list) -> list:
+        if self.stream is None:
+            return self.vae_cache.encode_images([None] * len(filepaths), filepaths)
+        with torch.cuda.stream(self.stream):
+            latents = self.vae_cache.encode_images([None] * len(filepaths), filepaths)
+        # The consumer runs on the default stream, so the results must be complete before we hand them out.
+        self.stream.synchronize()
+        return latents
+
+    def _encode_worker(self):
+        while self.keep_running:
+            try:
+                filepaths = self.pending.get(timeout=0.5)
+            except Empty:
+                continue
+            try:
+                latents = self._encode(filepaths)
+            except Exception as e:
+                logger.error(
+                    f"(id={self.vae_cache.id}) Lookahead encode failed, these will be encoded on the training thread instead: {e}"
+                )
+                self.debug_log(f"Error traceback: {traceback.format_exc()}")
+                latents = [None] * len(filepaths)
+            with self.condition:
+                for filepath, latent in zip(filepaths, latents):
+                    self.in_flight.discard(filepath)
+                    if latent is None:
+                        continue
+                    self.parked[filepath] = latent
+                    self.parked.move_to_end(filepath)
+                while len(self.parked) > self.max_parked:
+                    # Evicted entries were written to the cache, so they can still be read back.
+                    self.parked.popitem(last=False)
+                self.condition.notify_all()
+
+    def retrieve(self, filepaths: list) -> list:
+        """
+        Return latents for the given image paths, in order.
+
+        Parked latents are returned immediately. Paths that are still being encoded are waited on,
+        and anything the lookahead never saw is encoded synchronously. The wall time spent here is
+        recorded as the encode stall for this batch.
+        """
+        start_time = time.monotonic()
+        latents = [None] * len(filepaths)
+        with self.condition:
+            while True:
+                waiting = False
+                for idx, filepath in enumerate(filepaths):
+                    if latents[idx] is not None:
+                        continue
+                    if filepath in self.parked:
+                        latents[idx] = self.parked.pop(filepath)
+                    elif filepath in self.in_flight:
+                        waiting = True
+                if not waiting or self.thread is None or not self.thread.is_alive():
+                    break
+                self.condition.wait(timeout=0.5)
+        missing_indices = [idx for idx, latent in enumerate(latents) if latent is None]
+        self.hits += len(filepaths) - len(missing_indices)
+        self.misses += len(missing_indices)
+        if len(missing_indices) > 0:
+            self.debug_log(
+                f"Lookahead miss for {len(missing_indices)} of {len(filepaths)} images, encoding synchronously."
+            )
+            missing_latents = self.vae_cache.encode_images(
+                [None] * len(missing_indices),
+                [filepaths[idx] for idx in missing_indices],
+            )
+            for idx, latent in zip(missing_indices, missing_latents):
+                latents[idx] = latent
+        self.last_stall_time = time.monotonic() - start_time
+        self.total_stall_time += self.last_stall_time
+        return latents
+
+    def statistics(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total > 0 else 0.0,
+            "parked": len(self.parked),
+            "total_stall_time": self.total_stall_time,
+        }
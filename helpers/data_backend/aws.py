@@ -145,7 +145,7 @@ class S3DataBackend(BaseDataBackend):
         real_key = str(s3_key)
         for i in range(self.write_retry_limit):
             try:
-                if type(data) == Tensor:
+                if type(data) == Tensor or type(data) == dict:
                     return self.torch_save(data, real_key)
                 response = self.client.put_object(
                     Body=data,
@@ -194,6 +194,22 @@ class S3DataBackend(BaseDataBackend):
             for item in response.get("Contents", [])
         ]
 
+    def list_file_signatures(
+        self, file_extensions: list, instance_data_dir: str = None
+    ) -> dict:
+        """List all objects matching the given file extensions, with their ETag."""
+        signatures = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self.bucket_name, Prefix=instance_data_dir or "", MaxKeys=1000
+        ):
+            for obj in page.get("Contents", []):
+                ext = splitext(obj["Key"])[1].lower()[1:]
+                if file_extensions and ext not in file_extensions:
+                    continue
+                signatures[obj["Key"]] = obj.get("ETag")
+        return signatures
+
     def list_files(self, file_extensions: list, instance_data_dir: str = None):
         # Initialize the results list
         results = []
@@ -47,6 +47,23 @@ class BaseDataBackend(ABC):
         """
         pass
 
+    def list_file_signatures(
+        self, file_extensions: list, instance_data_dir: str = None
+    ) -> dict:
+        """
+        List all files matching the pattern, as a dict of {path: signature}.
+
+        The signature changes whenever the file does (eg. its mtime, or ETag). Backends that
+        can't provide one cheaply return None, which means the file must always be re-read.
+        """
+        return {
+            filename: None
+            for _, _, files in self.list_files(
+                file_extensions=file_extensions, instance_data_dir=instance_data_dir
+            )
+            for filename in files
+        }
+
     @abstractmethod
     def read_image(self, filepath: str, delete_problematic_images: bool = False):
         """
@@ -119,8 +119,8 @@ class CSVDataBackend(BaseDataBackend):
         )
         filepath.parent.mkdir(parents=True, exist_ok=True)
         with open(filepath, "wb") as file:
-            # Check if data is a Tensor, and if so, save it appropriately
-            if isinstance(data, torch.Tensor):
+            # Check if data is a Tensor (or a dict of them), and if so, save it appropriately
+            if isinstance(data, (torch.Tensor, dict)):
                 # logger.debug(f"Writing a torch file to disk.")
                 return self.torch_save(data, file)
             if isinstance(data, str):
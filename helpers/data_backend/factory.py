@@ -2,6 +2,9 @@ from helpers.data_backend.local import LocalDataBackend
 from helpers.data_backend.aws import S3DataBackend
 from helpers.data_backend.csv import CSVDataBackend
 from helpers.data_backend.base import BaseDataBackend
+from helpers.data_backend.initialiser import BackendInitialiser
+from helpers.image_manipulation.perceptual_hash import hash_methods
+from helpers.metadata.deduplication import deduplicate_actions
 from helpers.training.default_settings import default, latest_config_version
 from helpers.caching.text_embeds import TextEmbeddingCache
 
@@ -89,6 +92,23 @@ def init_backend_config(backend: dict, args: dict, accelerator) -> dict:
         output["config"]["ignore_epochs"] = backend["ignore_epochs"]
     if "repeats" in backend:
         output["config"]["repeats"] = backend["repeats"]
+    if backend.get("deduplicate"):
+        deduplicate = {"hash": "phash", "max_distance": 4, "action": "downweight"}
+        if type(backend["deduplicate"]) is dict:
+            deduplicate.update(backend["deduplicate"])
+        if deduplicate["hash"] not in hash_methods:
+            raise ValueError(
+                f"(id={backend['id']}) deduplicate hash must be one of {hash_methods}."
+            )
+        if deduplicate["action"] not in deduplicate_actions:
+            raise ValueError(
+                f"(id={backend['id']}) deduplicate action must be one of {deduplicate_actions}."
+            )
+        if not 0 <= deduplicate["max_distance"] < 32:
+            raise ValueError(
+                f"(id={backend['id']}) deduplicate max_distance must be between 0 and 31 bits."
+            )
+        output["config"]["deduplicate"] = deduplicate
     if "crop" in backend:
         output["config"]["crop"] = backend["crop"]
     else:
@@ -128,6 +148,20 @@ def init_backend_config(backend: dict, args: dict, accelerator) -> dict:
         output["config"]["crop_style"] = backend["crop_style"]
     else:
         output["config"]["crop_style"] = "random"
+    output["config"]["crop_variants"] = int(backend.get("crop_variants", 1))
+    if output["config"]["crop_variants"] < 1:
+        raise ValueError(f"(id={backend['id']}) crop_variants must be at least 1.")
+    if output["config"]["crop_variants"] > 1:
+        if not output["config"]["crop"] or output["config"]["crop_style"] != "random":
+            logger.warning(
+                f"(id={backend['id']}) crop_variants requires crop=true and crop_style=random, otherwise every variant is the same crop. Caching a single crop instead."
+            )
+            output["config"]["crop_variants"] = 1
+        elif args.vae_cache_ondemand or "deepfloyd" in args.model_type:
+            logger.warning(
+                f"(id={backend['id']}) crop_variants requires a precomputed VAE cache, and cannot be used with --vae_cache_ondemand or DeepFloyd. Caching a single crop instead."
+            )
+            output["config"]["crop_variants"] = 1
     output["config"]["disable_validation"] = backend.get("disable_validation", False)
     if "resolution" in backend:
         output["config"]["resolution"] = backend["resolution"]
@@ -307,6 +341,18 @@ def configure_parquet_database(backend: dict, args, data_backend: BaseDataBacken
     )
 
 
+def _shared_resources(init_backend: dict) -> list:
+    """The files a dataset's initialisation writes that another dataset could also use."""
+    resources = []
+    if "metadata_backend" in init_backend:
+        resources.append(("metadata", str(init_backend["metadata_backend"].cache_file)))
+    if "text_embed_cache" in init_backend and init_backend.get("dataset_type") == (
+        "text_embeds"
+    ):
+        resources.append(("text_embeds", init_backend.get("cache_dir")))
+    return resources
+
+
 def configure_multi_databackend(
     args: dict, accelerator, text_encoders, tokenizers, prompt_handler
 ):
@@ -336,6 +382,10 @@ def configure_multi_databackend(
 
     text_embed_backends = {}
     image_embed_backends = {}
+    initialiser = BackendInitialiser(
+        max_workers=args.data_backend_init_workers,
+        shared_resources=_shared_resources,
+    )
 
     ###                                            ###
     #    now we configure the text embed backends    #
@@ -354,6 +404,7 @@ def configure_multi_databackend(
             continue
 
         info_log(f'Configuring text embed backend: {backend["id"]}')
+        setup_start_time = time.perf_counter()
         if backend.get("default", None):
             if default_text_embed_backend_id is not None:
                 raise ValueError(
@@ -412,22 +463,9 @@ def configure_multi_databackend(
             model_type=StateTracker.get_model_type(),
             write_batch_size=backend.get("write_batch_size", 1),
         )
-        with accelerator.main_process_first():
-            init_backend["text_embed_cache"].discover_all_files()
-        accelerator.wait_for_everyone()
-
-        if backend.get("default", False):
-            # The default embed cache will be used for eg. validation prompts.
-            StateTracker.set_default_text_embed_cache(init_backend["text_embed_cache"])
-            logger.debug(f"Set the default text embed cache to {init_backend['id']}.")
-            # We will compute the null embedding for caption dropout here.
-            info_log("Pre-computing null embedding")
-            with accelerator.main_process_first():
-                init_backend["text_embed_cache"].compute_embeddings_for_prompts(
-                    [""], return_concat=False, load_from_cache=False
-                )
-            time.sleep(5)
-            accelerator.wait_for_everyone()
+        initialiser.record(
+            "setup", init_backend["id"], time.perf_counter() - setup_start_time
+        )
         if args.caption_dropout_probability == 0.0:
             logger.warning(
                 "Not using caption dropout will potentially lead to overfitting on captions, eg. CFG will not work very well. Set --caption-dropout_probability=0.1 as a recommended value."
@@ -441,6 +479,49 @@ def configure_multi_databackend(
             "Your dataloader config must contain at least one image dataset AND at least one text_embed dataset."
             " See this link for more information about dataset_type: https://github.com/bghira/SimpleTuner/blob/main/documentation/DATALOADER.md#configuration-options"
         )
+
+    # The main process discovers the existing embeds first, then the others do.
+    def discover_text_embeds(init_backend):
+        init_backend["text_embed_cache"].discover_all_files()
+
+    for is_turn in [
+        accelerator.is_main_process,
+        not accelerator.is_main_process,
+    ]:
+        if is_turn:
+            initialiser.run(
+                "cache discovery",
+                list(text_embed_backends.values()),
+                discover_text_embeds,
+                concurrent=True,
+            )
+        accelerator.wait_for_everyone()
+
+    if default_text_embed_backend_id is not None:
+        # The default embed cache will be used for eg. validation prompts.
+        default_text_embed_cache = text_embed_backends[default_text_embed_backend_id][
+            "text_embed_cache"
+        ]
+        StateTracker.set_default_text_embed_cache(default_text_embed_cache)
+        logger.debug(
+            f"Set the default text embed cache to {default_text_embed_backend_id}."
+        )
+        # We will compute the null embedding for caption dropout here.
+        info_log("Pre-computing null embedding")
+
+        def compute_null_embedding(init_backend):
+            with accelerator.main_process_first():
+                init_backend["text_embed_cache"].compute_embeddings_for_prompts(
+                    [""], return_concat=False, load_from_cache=False
+                )
+
+        initialiser.run(
+            "text embeds",
+            [text_embed_backends[default_text_embed_backend_id]],
+            compute_null_embedding,
+        )
+        time.sleep(5)
+        accelerator.wait_for_everyone()
     if not default_text_embed_backend_id and len(text_embed_backends) > 1:
         raise ValueError(
             f"You have {len(text_embed_backends)} text_embed dataset{'s' if len(text_embed_backends) > 1 else ''}, but no default text embed was defined."
@@ -516,6 +597,14 @@ def configure_multi_databackend(
     ###                                       ###
     #    now we configure the image backends    #
     ###                                       ###
+    # Each dataset is set up in config order, then every dataset goes through each phase of
+    #  initialisation together. I/O-bound phases run concurrently across independent datasets,
+    #  while encoding runs one dataset at a time. Every process meets at the same barriers.
+    init_backends = []
+    backend_configs = {}
+    image_embed_data_backends = {}
+    text_embed_ids = {}
+    caption_settings = {}
     vae_cache_dir_paths = []  # tracking for duplicates
     for backend in data_backend_config:
         dataset_type = backend.get("dataset_type", None)
@@ -533,9 +622,11 @@ def configure_multi_databackend(
         if (
             "id" not in backend
             or backend["id"] == ""
+            or backend["id"] in backend_configs
             or backend["id"] in StateTracker.get_data_backends()
         ):
             raise ValueError("Each dataset needs a unique 'id' field.")
+        setup_start_time = time.perf_counter()
         resolution_type = backend.get("resolution_type", args.resolution_type)
         if resolution_type == "pixel_area":
             pixel_edge_length = backend.get("resolution")
@@ -723,24 +814,52 @@ def configure_multi_databackend(
             ),
             cache_file_suffix=backend.get("cache_file_suffix", None),
             repeats=init_backend["config"].get("repeats", 0),
+            deduplicate=init_backend["config"].get("deduplicate"),
             **metadata_backend_args,
         )
 
+        image_embed_data_backends[init_backend["id"]] = image_embed_data_backend
+        text_embed_ids[init_backend["id"]] = text_embed_id
+        backend_configs[init_backend["id"]] = backend
+        init_backends.append(init_backend)
+        initialiser.record(
+            "setup", init_backend["id"], time.perf_counter() - setup_start_time
+        )
+
+    # Bucketing may fork worker processes, which isn't safe from more than one thread.
+    concurrent_bucketing = not args.enable_multiprocessing
+
+    def refresh_buckets(init_backend):
+        backend = backend_configs[init_backend["id"]]
         if "aspect" not in args.skip_file_discovery and "aspect" not in backend.get(
             "skip_file_discovery", ""
         ):
-            if accelerator.is_local_main_process:
-                info_log(
-                    f"(id={init_backend['id']}) Refreshing aspect buckets on main process."
-                )
-                init_backend["metadata_backend"].refresh_buckets(rank_info())
-        accelerator.wait_for_everyone()
-        if not accelerator.is_main_process:
             info_log(
-                f"(id={init_backend['id']}) Reloading bucket manager cache on subprocesses."
+                f"(id={init_backend['id']}) Refreshing aspect buckets on main process."
             )
-            init_backend["metadata_backend"].reload_cache()
-        accelerator.wait_for_everyone()
+            init_backend["metadata_backend"].refresh_buckets(rank_info())
+
+    if accelerator.is_local_main_process:
+        initialiser.run(
+            "aspect buckets",
+            init_backends,
+            refresh_buckets,
+            concurrent=concurrent_bucketing,
+        )
+    accelerator.wait_for_everyone()
+
+    def reload_bucket_cache(init_backend):
+        info_log(
+            f"(id={init_backend['id']}) Reloading bucket manager cache on subprocesses."
+        )
+        init_backend["metadata_backend"].reload_cache()
+
+    if not accelerator.is_main_process:
+        initialiser.run("metadata", init_backends, reload_bucket_cache, concurrent=True)
+    accelerator.wait_for_everyone()
+
+    def configure_dataset(init_backend):
+        backend = backend_configs[init_backend["id"]]
         if init_backend["metadata_backend"].has_single_underfilled_bucket():
             raise Exception(
                 f"Cannot train using a dataset that has a single bucket with fewer than {args.train_batch_size} images."
@@ -762,6 +881,7 @@ def configure_multi_databackend(
             "maximum_image_size",
             "target_downsample_size",
             "parquet",
+            "deduplicate",
         ]
         # we will set the latest version by default.
         current_config_version = latest_config_version()
@@ -864,6 +984,11 @@ def configure_multi_databackend(
                 "prepend_instance_prompt", args.prepend_instance_prompt
             ),
             instance_prompt=backend.get("instance_prompt", args.instance_prompt),
+            lookahead=(
+                args.vae_cache_ondemand_lookahead
+                if args.vae_cache_ondemand and "deepfloyd" not in args.model_type
+                else 0
+            ),
         )
         if init_backend["sampler"].caption_strategy == "parquet":
             configure_parquet_database(backend, args, init_backend["data_backend"])
@@ -877,9 +1002,9 @@ def configure_multi_databackend(
             persistent_workers=False,
         )
 
-        init_backend["text_embed_cache"] = text_embed_backends[text_embed_id][
-            "text_embed_cache"
-        ]
+        init_backend["text_embed_cache"] = text_embed_backends[
+            text_embed_ids[init_backend["id"]]
+        ]["text_embed_cache"]
         prepend_instance_prompt = backend.get(
             "prepend_instance_prompt", args.prepend_instance_prompt
         )
@@ -891,34 +1016,58 @@ def configure_multi_databackend(
 
         # Update the backend registration here so the metadata backend can be found.
         StateTracker.register_data_backend(init_backend)
+        caption_settings[init_backend["id"]] = {
+            "use_captions": use_captions,
+            "prepend_instance_prompt": prepend_instance_prompt,
+            "instance_prompt": instance_prompt,
+        }
+
+    initialiser.run("dataset", init_backends, configure_dataset)
+
+    # We get captions from the IMAGE dataset. Not the text embeds dataset.
+    captions = {}
 
-        # We get captions from the IMAGE dataset. Not the text embeds dataset.
-        if "text" not in args.skip_file_discovery and "text" not in backend.get(
+    def collect_captions(init_backend):
+        backend = backend_configs[init_backend["id"]]
+        if "text" in args.skip_file_discovery or "text" in backend.get(
             "skip_file_discovery", ""
         ):
-            info_log(f"(id={init_backend['id']}) Collecting captions.")
-            captions = PromptHandler.get_all_captions(
-                data_backend=init_backend["data_backend"],
-                instance_data_dir=init_backend["instance_data_dir"],
-                prepend_instance_prompt=prepend_instance_prompt,
-                instance_prompt=instance_prompt,
-                use_captions=use_captions,
-                caption_strategy=backend.get("caption_strategy", args.caption_strategy),
-            )
-            logger.debug(
-                f"Pre-computing text embeds / updating cache. We have {len(captions)} captions to process, though these will be filtered next."
-            )
-            caption_strategy = backend.get("caption_strategy", args.caption_strategy)
-            info_log(
-                f"(id={init_backend['id']}) Initialise text embed pre-computation using the {caption_strategy} caption strategy. We have {len(captions)} captions to process."
-            )
-            init_backend["text_embed_cache"].compute_embeddings_for_prompts(
-                captions, return_concat=False, load_from_cache=False
-            )
-            info_log(
-                f"(id={init_backend['id']}) Completed processing {len(captions)} captions."
-            )
+            return
+        info_log(f"(id={init_backend['id']}) Collecting captions.")
+        captions[init_backend["id"]] = PromptHandler.get_all_captions(
+            data_backend=init_backend["data_backend"],
+            instance_data_dir=init_backend["instance_data_dir"],
+            caption_strategy=backend.get("caption_strategy", args.caption_strategy),
+            max_workers=backend.get("max_workers", args.max_workers),
+            **caption_settings[init_backend["id"]],
+        )
+
+    initialiser.run("captions", init_backends, collect_captions, concurrent=True)
 
+    def compute_text_embeds(init_backend):
+        if init_backend["id"] not in captions:
+            return
+        backend_captions = captions.pop(init_backend["id"])
+        logger.debug(
+            f"Pre-computing text embeds / updating cache. We have {len(backend_captions)} captions to process, though these will be filtered next."
+        )
+        caption_strategy = backend_configs[init_backend["id"]].get(
+            "caption_strategy", args.caption_strategy
+        )
+        info_log(
+            f"(id={init_backend['id']}) Initialise text embed pre-computation using the {caption_strategy} caption strategy. We have {len(backend_captions)} captions to process."
+        )
+        init_backend["text_embed_cache"].compute_embeddings_for_prompts(
+            backend_captions, return_concat=False, load_from_cache=False
+        )
+        info_log(
+            f"(id={init_backend['id']}) Completed processing {len(backend_captions)} captions."
+        )
+
+    initialiser.run("text embeds", init_backends, compute_text_embeds)
+
+    def create_vae_cache(init_backend):
+        backend = backend_configs[init_backend["id"]]
         # Register the backend here so the sampler can be found.
         StateTracker.register_data_backend(init_backend)
 
@@ -930,79 +1079,105 @@ def configure_multi_databackend(
         StateTracker.set_data_backend_config(init_backend["id"], init_backend["config"])
         logger.debug(f"Hashing filenames: {hash_filenames}")
 
-        if "deepfloyd" not in StateTracker.get_args().model_type:
-            info_log(f"(id={init_backend['id']}) Creating VAE latent cache.")
-            vae_cache_dir = backend.get("cache_dir_vae", None)
-            if vae_cache_dir in vae_cache_dir_paths:
-                raise ValueError(
-                    f"VAE image embed cache directory {init_backend.get('cache_dir_vae')} is the same as another VAE image embed cache directory. This is not allowed, the trainer will get confused and sleepy and wake up in a distant place with no memory and no money for a taxi ride back home, forever looking in the mirror and wondering who they are. This should be avoided."
-                )
-            vae_cache_dir_paths.append(vae_cache_dir)
-
-            if (
-                vae_cache_dir is not None
-                and vae_cache_dir in text_embed_cache_dir_paths
-            ):
-                raise ValueError(
-                    f"VAE image embed cache directory {init_backend.get('cache_dir_vae')} is the same as the text embed cache directory. This is not allowed, the trainer will get confused."
-                )
-            init_backend["vaecache"] = VAECache(
-                id=init_backend["id"],
-                vae=StateTracker.get_vae(),
-                accelerator=accelerator,
-                metadata_backend=init_backend["metadata_backend"],
-                image_data_backend=init_backend["data_backend"],
-                cache_data_backend=image_embed_data_backend["data_backend"],
-                instance_data_dir=init_backend["instance_data_dir"],
-                delete_problematic_images=backend.get(
-                    "delete_problematic_images", args.delete_problematic_images
-                ),
-                resolution=backend.get("resolution", args.resolution),
-                resolution_type=backend.get("resolution_type", args.resolution_type),
-                maximum_image_size=backend.get(
-                    "maximum_image_size",
-                    args.maximum_image_size
-                    or backend.get("resolution", args.resolution) * 1.5,
-                ),
-                target_downsample_size=backend.get(
-                    "target_downsample_size",
-                    args.target_downsample_size
-                    or backend.get("resolution", args.resolution) * 1.25,
-                ),
-                minimum_image_size=backend.get(
-                    "minimum_image_size",
-                    args.minimum_image_size,
-                ),
-                vae_batch_size=backend.get("vae_batch_size", args.vae_batch_size),
-                write_batch_size=backend.get("write_batch_size", args.write_batch_size),
-                read_batch_size=backend.get("read_batch_size", args.read_batch_size),
-                cache_dir=backend.get("cache_dir_vae", args.cache_dir_vae),
-                max_workers=backend.get("max_workers", args.max_workers),
-                process_queue_size=backend.get(
-                    "image_processing_batch_size", args.image_processing_batch_size
-                ),
-                vae_cache_ondemand=args.vae_cache_ondemand,
-                hash_filenames=hash_filenames,
+        if "deepfloyd" in StateTracker.get_args().model_type:
+            return
+        info_log(f"(id={init_backend['id']}) Creating VAE latent cache.")
+        vae_cache_dir = backend.get("cache_dir_vae", None)
+        if vae_cache_dir in vae_cache_dir_paths:
+            raise ValueError(
+                f"VAE image embed cache directory {init_backend.get('cache_dir_vae')} is the same as another VAE image embed cache directory. This is not allowed, the trainer will get confused and sleepy and wake up in a distant place with no memory and no money for a taxi ride back home, forever looking in the mirror and wondering who they are. This should be avoided."
             )
+        vae_cache_dir_paths.append(vae_cache_dir)
 
-            if not args.vae_cache_ondemand:
-                info_log(f"(id={init_backend['id']}) Discovering cache objects..")
-                if accelerator.is_local_main_process:
-                    init_backend["vaecache"].discover_all_files()
-                accelerator.wait_for_everyone()
-            all_image_files = StateTracker.get_image_files(
-                data_backend_id=init_backend["id"]
-            )
-            init_backend["vaecache"].build_vae_cache_filename_map(
-                all_image_files=all_image_files
+        if vae_cache_dir is not None and vae_cache_dir in text_embed_cache_dir_paths:
+            raise ValueError(
+                f"VAE image embed cache directory {init_backend.get('cache_dir_vae')} is the same as the text embed cache directory. This is not allowed, the trainer will get confused."
             )
+        init_backend["vaecache"] = VAECache(
+            id=init_backend["id"],
+            vae=StateTracker.get_vae(),
+            accelerator=accelerator,
+            metadata_backend=init_backend["metadata_backend"],
+            image_data_backend=init_backend["data_backend"],
+            cache_data_backend=image_embed_data_backends[init_backend["id"]][
+                "data_backend"
+            ],
+            instance_data_dir=init_backend["instance_data_dir"],
+            delete_problematic_images=backend.get(
+                "delete_problematic_images", args.delete_problematic_images
+            ),
+            resolution=backend.get("resolution", args.resolution),
+            resolution_type=backend.get("resolution_type", args.resolution_type),
+            maximum_image_size=backend.get(
+                "maximum_image_size",
+                args.maximum_image_size
+                or backend.get("resolution", args.resolution) * 1.5,
+            ),
+            target_downsample_size=backend.get(
+                "target_downsample_size",
+                args.target_downsample_size
+                or backend.get("resolution", args.resolution) * 1.25,
+            ),
+            minimum_image_size=backend.get(
+                "minimum_image_size",
+                args.minimum_image_size,
+            ),
+            vae_batch_size=backend.get("vae_batch_size", args.vae_batch_size),
+            write_batch_size=backend.get("write_batch_size", args.write_batch_size),
+            read_batch_size=backend.get("read_batch_size", args.read_batch_size),
+            cache_dir=backend.get("cache_dir_vae", args.cache_dir_vae),
+            max_workers=backend.get("max_workers", args.max_workers),
+            process_queue_size=backend.get(
+                "image_processing_batch_size", args.image_processing_batch_size
+            ),
+            vae_cache_ondemand=args.vae_cache_ondemand,
+            vae_cache_ondemand_lookahead=args.vae_cache_ondemand_lookahead,
+            hash_filenames=hash_filenames,
+            store_distribution=backend.get(
+                "vae_cache_store_distribution", args.vae_cache_store_distribution
+            ),
+            distribution_dtype={
+                "fp16": torch.float16,
+                "bf16": torch.bfloat16,
+                "fp32": torch.float32,
+            }[args.vae_cache_distribution_dtype],
+            crop_variants=init_backend["config"].get("crop_variants", 1),
+        )
 
+    initialiser.run("vae cache", init_backends, create_vae_cache)
+
+    def discover_vae_cache(init_backend):
+        if "vaecache" not in init_backend:
+            return
+        info_log(f"(id={init_backend['id']}) Discovering cache objects..")
+        init_backend["vaecache"].discover_all_files()
+
+    if not args.vae_cache_ondemand and accelerator.is_local_main_process:
+        initialiser.run(
+            "cache discovery", init_backends, discover_vae_cache, concurrent=True
+        )
+    if not args.vae_cache_ondemand:
+        accelerator.wait_for_everyone()
+
+    def build_vae_cache_filename_map(init_backend):
+        if "vaecache" not in init_backend:
+            return
+        all_image_files = StateTracker.get_image_files(
+            data_backend_id=init_backend["id"]
+        )
+        init_backend["vaecache"].build_vae_cache_filename_map(
+            all_image_files=all_image_files
+        )
+
+    initialiser.run("cache discovery", init_backends, build_vae_cache_filename_map)
+
+    def scan_for_errors(init_backend):
+        backend = backend_configs[init_backend["id"]]
         if (
             (
                 "metadata" not in args.skip_file_discovery
                 or "metadata" not in backend.get("skip_file_discovery", "")
             )
-            and accelerator.is_main_process
             and backend.get("scan_for_errors", False)
             and "deepfloyd" not in StateTracker.get_args().model_type
         ):
@@ -1017,11 +1192,24 @@ def configure_multi_databackend(
             )
             init_backend["metadata_backend"].scan_for_metadata()
 
-        accelerator.wait_for_everyone()
-        if not accelerator.is_main_process:
-            init_backend["metadata_backend"].load_image_metadata()
-        accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        initialiser.run(
+            "error scan",
+            init_backends,
+            scan_for_errors,
+            concurrent=concurrent_bucketing,
+        )
+    accelerator.wait_for_everyone()
 
+    def load_image_metadata(init_backend):
+        init_backend["metadata_backend"].load_image_metadata()
+
+    if not accelerator.is_main_process:
+        initialiser.run("metadata", init_backends, load_image_metadata, concurrent=True)
+    accelerator.wait_for_everyone()
+
+    def encode_images(init_backend):
+        backend = backend_configs[init_backend["id"]]
         if (
             not args.vae_cache_ondemand
             and "vae" not in args.skip_file_discovery
@@ -1038,6 +1226,9 @@ def configure_multi_databackend(
         StateTracker.register_data_backend(init_backend)
         init_backend["metadata_backend"].save_cache()
 
+    initialiser.run("vae encode", init_backends, encode_images)
+    info_log(initialiser.report())
+
     # For each image backend, connect it to its conditioning backend.
     for backend in data_backend_config:
         dataset_type = backend.get("dataset_type", "image")
@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers.training.multi_process import should_log
+
+logger = logging.getLogger("BackendInitialiser")
+if should_log():
+    logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+else:
+    logger.setLevel(logging.ERROR)
+
+
+class BackendInitialiser:
+    """
+    Run each phase of data backend initialisation over every dataset, timing it per dataset.
+
+    I/O-bound phases, eg. file listing, bucket and metadata loading, caption collection and cache
+    discovery, can run concurrently across datasets. Datasets that share a resource, such as an
+    aspect bucket cache file or an image embed backend, are placed in one dependency group and
+    run one after another within it. Every other phase, including the encoding phases that use
+    the accelerator, runs on the calling thread one dataset at a time, in config order.
+    """
+
+    def __init__(self, max_workers: int = 1, shared_resources=None):
+        """
+        Args:
+            max_workers (int): The most datasets that run a concurrent phase at once. 1 runs
+                every phase on the calling thread.
+            shared_resources (callable): Returns the keys of the resources a dataset's I/O
+                touches. Datasets with a key in common are never run concurrently.
+        """
+        self.max_workers = max(1, max_workers)
+        self.shared_resources = shared_resources or (lambda init_backend: [])
+        # backend id -> phase -> seconds
+        self.timings = defaultdict(dict)
+        # phase -> wall seconds
+        self.phase_times = {}
+        self._lock = threading.Lock()
+
+    def dependency_groups(self, init_backends: list) -> list:
+        """Split the datasets into groups that share no resources, keeping config order."""
+        parent = list(range(len(init_backends)))
+
+        def find(index):
+            while parent[index] != index:
+                parent[index] = parent[parent[index]]
+                index = parent[index]
+            return index
+
+        owners = {}
+        for index, init_backend in enumerate(init_backends):
+            for resource in self.shared_resources(init_backend):
+                if resource in owners:
+                    parent[find(index)] = find(owners[resource])
+                else:
+                    owners[resource] = index
+        groups = {}
+        for index, init_backend in enumerate(init_backends):
+            groups.setdefault(find(index), []).append(init_backend)
+        return list(groups.values())
+
+    def run(self, phase: str, init_backends: list, fn, concurrent: bool = False):
+        """
+        Call `fn(init_backend)` for every dataset.
+
+        Args:
+            phase (str): The name the timings are reported under.
+            init_backends (list): The datasets, in config order.
+            fn (callable): The work for one dataset.
+            concurrent (bool): Whether independent datasets may run at the same time.
+        """
+        start_time = time.perf_counter()
+        groups = self.dependency_groups(init_backends) if concurrent else []
+        if len(groups) > 1 and self.max_workers > 1:
+            logger.debug(
+                f"Running {phase} for {len(init_backends)} datasets in {len(groups)} dependency groups."
+            )
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(groups)),
+                thread_name_prefix="BackendInitialiser",
+            ) as executor:
+                futures = [
+                    executor.submit(self._run_group, phase, group, fn)
+                    for group in groups
+                ]
+                # Raise the first failure, in config order.
+                for future in futures:
+                    future.result()
+        else:
+            self._run_group(phase, init_backends, fn)
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + (
+            time.perf_counter() - start_time
+        )
+
+    def _run_group(self, phase: str, init_backends: list, fn):
+        for init_backend in init_backends:
+            start_time = time.perf_counter()
+            fn(init_backend)
+            elapsed = time.perf_counter() - start_time
+            with self._lock:
+                timings = self.timings[init_backend["id"]]
+                timings[phase] = timings.get(phase, 0.0) + elapsed
+
+    def record(self, phase: str, backend_id: str, elapsed: float):
+        """Add time spent outside of `run` to a dataset's phase."""
+        with self._lock:
+            timings = self.timings[backend_id]
+            timings[phase] = timings.get(phase, 0.0) + elapsed
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + elapsed
+
+    def report(self) -> str:
+        phases = list(self.phase_times)
+        lines = ["Data backend initialisation timings, in seconds:"]
+        for backend_id, timings in self.timings.items():
+            phase_timings = ", ".join(
+                f"{phase}={timings[phase]:.2f}" for phase in phases if phase in timings
+            )
+            lines.append(
+                f"  (id={backend_id}) {phase_timings}, total={sum(timings.values()):.2f}"
+            )
+        wall_timings = ", ".join(
+            f"{phase}={elapsed:.2f}" for phase, elapsed in self.phase_times.items()
+        )
+        lines.append(
+            f"  Wall time: {wall_timings}, total={sum(self.phase_times.values()):.2f}"
+        )
+        return "\n".join(lines)
@@ -32,8 +32,8 @@ class LocalDataBackend(BaseDataBackend):
         """Write the provided data to the specified filepath."""
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
         with open(filepath, "wb") as file:
-            # Check if data is a Tensor, and if so, save it appropriately
-            if isinstance(data, torch.Tensor):
+            # Check if data is a Tensor (or a dict of them), and if so, save it appropriately
+            if isinstance(data, (torch.Tensor, dict)):
                 # logger.debug(f"Writing a torch file to disk.")
                 return self.torch_save(data, file)
             elif isinstance(data, str):
@@ -124,6 +124,20 @@ class LocalDataBackend(BaseDataBackend):
         results = [(subdir, [], files) for subdir, files in path_dict.items()]
         return results
 
+    def list_file_signatures(self, file_extensions: list, instance_data_dir: str):
+        """List all files matching the given file extensions, with their mtime and size."""
+        signatures = {}
+        for _, _, files in self.list_files(
+            file_extensions=file_extensions, instance_data_dir=instance_data_dir
+        ):
+            for filename in files:
+                try:
+                    stat_result = os.stat(filename)
+                except OSError:
+                    continue
+                signatures[filename] = [stat_result.st_mtime_ns, stat_result.st_size]
+        return signatures
+
     def read_image(self, filepath: str, delete_problematic_images: bool = False):
         # Remove embedded null byte:
         filepath = filepath.replace("\x00", "")
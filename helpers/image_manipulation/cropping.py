@@ -31,6 +31,25 @@ class BaseCropping:
     def crop(self, target_width, target_height):
         raise NotImplementedError("Subclasses must implement this method")
 
+    def crop_at(self, target_width, target_height, crop_coordinates):
+        """Crop at previously recorded (top, left) coordinates, eg. to reproduce a cached crop variant."""
+        top, left = int(crop_coordinates[0]), int(crop_coordinates[1])
+        if self.image:
+            return (
+                self.image.crop((left, top, left + target_width, top + target_height)),
+                (top, left),
+            )
+        elif self.image_metadata:
+            return None, (top, left)
+
+    def random_crop_coordinates(self, target_width, target_height):
+        """Draw (top, left) coordinates the way RandomCropping would, without cropping anything."""
+        import random
+
+        left = random.randint(0, max(0, self.intermediary_width - target_width))
+        top = random.randint(0, max(0, self.intermediary_height - target_height))
+        return (top, left)
+
     def set_image(self, image: Image.Image):
         if type(image) is not Image.Image:
             raise TypeError("Image must be a PIL Image object")
@@ -0,0 +1,88 @@
+import numpy as np
+from PIL import Image
+
+# Hashes are 64 bits, from an 8x8 grid, stored as 16 hex digits in the image metadata.
+HASH_SIZE = 8
+# pHash keeps the lowest frequencies of the DCT of a 32x32 thumbnail.
+PHASH_SIZE = 32
+hash_methods = ("phash", "dhash")
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """The DCT-II basis, so that the DCT of a square image `x` is `D @ x @ D.T`."""
+    n = np.arange(size)
+    return np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)).astype(
+        np.float32
+    )
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+# The number of set bits in each byte value.
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def _thumbnails(images: list, size: tuple) -> np.ndarray:
+    """
+    Greyscale (width, height) thumbnails of the images, as one (n, height, width) array. They're
+    box-reduced most of the way first, as resampling the whole image is most of a hash's cost.
+    """
+    return np.stack(
+        [
+            np.asarray(
+                image.convert("L").resize(
+                    size, Image.Resampling.LANCZOS, reducing_gap=2.0
+                ),
+                dtype=np.float32,
+            )
+            for image in images
+        ]
+    )
+
+
+def _pack(bits: np.ndarray) -> np.ndarray:
+    """(n, 8, 8) booleans to n uint64 hashes, the first bit being the most significant."""
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return packed.view(">u8")[:, 0].astype(np.uint64)
+
+
+def phashes(images: list) -> np.ndarray:
+    """The pHash of each image: which of its lowest DCT frequencies are above their median."""
+    pixels = _thumbnails(images, (PHASH_SIZE, PHASH_SIZE))
+    coefficients = (_DCT @ pixels @ _DCT.T)[:, :HASH_SIZE, :HASH_SIZE]
+    medians = np.median(coefficients.reshape(len(pixels), -1), axis=1)
+    return _pack(coefficients > medians[:, None, None])
+
+
+def dhashes(images: list) -> np.ndarray:
+    """The dHash of each image: whether each pixel of a 9x8 thumbnail is brighter than its left."""
+    pixels = _thumbnails(images, (HASH_SIZE + 1, HASH_SIZE))
+    return _pack(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+
+def image_hashes(images: list, method: str = "phash") -> np.ndarray:
+    """
+    Hash a batch of images at once.
+
+    Args:
+        images (list): PIL images.
+        method (str): One of `hash_methods`.
+
+    Returns:
+        np.ndarray: One uint64 hash per image.
+    """
+    if method not in hash_methods:
+        raise ValueError(f"Unknown image hash {method}, expected {hash_methods}.")
+    if len(images) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return phashes(images) if method == "phash" else dhashes(images)
+
+
+def image_hash(image: Image.Image, method: str = "phash") -> str:
+    """The hash of one image, as 16 hex digits."""
+    return f"{int(image_hashes([image], method)[0]):016x}"
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """How many bits each of the uint64 `hashes` differs from `value` by."""
+    differences = np.ascontiguousarray(hashes ^ np.uint64(value))
+    return _POPCOUNT[differences.view(np.uint8)].reshape(-1, 8).sum(axis=1)
@@ -71,6 +71,8 @@ class TrainingSample:
             "crop_aspect_buckets", []
         )
         self.crop_coordinates = (0, 0)
+        self.crop_variants = int(self.data_backend_config.get("crop_variants", 1) or 1)
+        self.crop_variant_coordinates = None
         crop_handler_cls = crop_handlers.get(self.crop_style)
         if not crop_handler_cls:
             raise ValueError(f"Unknown crop style: {self.crop_style}")
@@ -298,12 +300,13 @@ class TrainingSample:
         # Default to 1.0 if none of the conditions above match
         return 1.0
 
-    def prepare(self, return_tensor: bool = False):
+    def prepare(self, return_tensor: bool = False, crop_coordinates: tuple = None):
         """
         Perform initial image preparations such as converting to RGB and applying EXIF transformations.
 
         Args:
-            image (Image.Image): The image to prepare.
+            return_tensor (bool): Return a normalised tensor instead of a PIL image.
+            crop_coordinates (tuple): Crop at these (top, left) coordinates rather than asking the crop handler.
 
         Returns: tuple
             - image data (PIL.Image)
@@ -311,7 +314,7 @@ class TrainingSample:
             - aspect_ratio (float)
         """
         self.save_debug_image(f"images/{time.time()}-0-original.png")
-        self.crop()
+        self.crop(crop_coordinates)
         self.save_debug_image(f"images/{time.time()}-1-cropped.png")
         if not self.crop_enabled:
             self.save_debug_image(f"images/{time.time()}-1b-nocrop-resize.png")
@@ -330,6 +333,7 @@ class TrainingSample:
             image_metadata=self.image_metadata,
             target_size=self.target_size,
             intermediary_size=self.intermediary_size,
+            crop_variant_coordinates=self.crop_variant_coordinates,
         )
         if webhook_handler:
             webhook_handler.send(
@@ -515,11 +519,14 @@ class TrainingSample:
             self.image = exif_transpose(self.image)
         return self
 
-    def crop(self):
+    def crop(self, crop_coordinates: tuple = None):
         """
         Crop the image using the detected crop handler class.
         If cropping is not enabled, we do nothing.
 
+        Args:
+            crop_coordinates (tuple): Optional (top, left) coordinates to crop at, instead of the crop handler's choice.
+
         Returns:
             TrainingSample: The current TrainingSample instance.
         """
@@ -534,15 +541,52 @@ class TrainingSample:
             self.cropper.set_image(self.image)
         logger.debug(f"Cropper size updating to {self.current_size}")
         self.cropper.set_intermediary_size(self.current_size[0], self.current_size[1])
-        self.image, self.crop_coordinates = self.cropper.crop(
-            self.target_size[0], self.target_size[1]
-        )
+        if crop_coordinates is not None:
+            self.image, self.crop_coordinates = self.cropper.crop_at(
+                self.target_size[0], self.target_size[1], crop_coordinates
+            )
+        else:
+            self.image, self.crop_coordinates = self.cropper.crop(
+                self.target_size[0], self.target_size[1]
+            )
+        self._select_crop_variant_coordinates()
         self.current_size = self.target_size
         logger.debug(
             f"Cropped to {self.image.size if self.image is not None else self.current_size} via crop coordinates {self.crop_coordinates} {'resulting in current_size of' if self.image is not None else ''} {self.current_size if self.image is not None else ''}"
         )
         return self
 
+    def _select_crop_variant_coordinates(self):
+        """
+        When the dataset caches several crop variants per image, pick their (top, left) coordinates.
+
+        Every variant shares this image's aspect bucket, target size and intermediary size; only the crop
+        position differs. The first variant is always the primary crop. Coordinates already recorded in the
+        metadata are reused, so that they keep matching the cached latents.
+
+        Returns:
+            TrainingSample: The current TrainingSample instance.
+        """
+        if self.crop_variants <= 1:
+            return self
+        existing_coordinates = (
+            self.image_metadata.get("crop_variant_coordinates")
+            if self.valid_metadata
+            else None
+        )
+        if existing_coordinates and len(existing_coordinates) == self.crop_variants:
+            self.crop_variant_coordinates = [
+                tuple(coordinates) for coordinates in existing_coordinates
+            ]
+            return self
+        self.crop_variant_coordinates = [tuple(self.crop_coordinates)] + [
+            self.cropper.random_crop_coordinates(
+                self.target_size[0], self.target_size[1]
+            )
+            for _ in range(self.crop_variants - 1)
+        ]
+        return self
+
     def resize(self, size: tuple = None):
         """
         Resize the image to a new size. If one is not provided, we will use the precalculated self.target_size
@@ -653,6 +697,7 @@ class PreparedSample:
         target_size: tuple,
         aspect_ratio: float,
         crop_coordinates: tuple,
+        crop_variant_coordinates: list = None,
     ):
         """
         Initializes a new PreparedSample instance with a provided PIL.Image object and optional metadata.
@@ -660,6 +705,7 @@ class PreparedSample:
         Args:
         image (Image.Image): A PIL Image object.
         metadata (dict): Optional metadata associated with the image.
+        crop_variant_coordinates (list): Optional (top, left) coordinates of every cached crop variant.
         """
         self.image = image
         self.image_metadata = image_metadata if image_metadata else {}
@@ -673,6 +719,7 @@ class PreparedSample:
         else:
             self.aspect_ratio = aspect_ratio
         self.crop_coordinates = crop_coordinates
+        self.crop_variant_coordinates = crop_variant_coordinates
 
     def __str__(self):
         return f"PreparedSample(image={self.image}, original_size={self.original_size}, intermediary_size={self.intermediary_size}, target_size={self.target_size}, aspect_ratio={self.aspect_ratio}, crop_coordinates={self.crop_coordinates})"
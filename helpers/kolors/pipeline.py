@@ -16,6 +16,7 @@ from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import PIL.Image
 import torch
+from helpers.models.vae_decode import decode_latents
 
 from diffusers.callbacks import MultiPipelineCallbacks, PipelineCallback
 from diffusers.image_processor import PipelineImageInput, VaeImageProcessor
@@ -822,6 +823,7 @@ class KolorsImg2ImgPipeline(
         ] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 256,
+        vae_decode: str = "full",
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -958,6 +960,10 @@ class KolorsImg2ImgPipeline(
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
             max_sequence_length (`int` defaults to 256): Maximum sequence length to use with the `prompt`.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -1232,8 +1238,11 @@ class KolorsImg2ImgPipeline(
 
         if not output_type == "latent":
             # make sure the VAE is in float32 mode, as it overflows in float16
+            # decoding one image or tile at a time only upcasts the decodes that overflow.
             needs_upcasting = (
-                self.vae.dtype == torch.float16 and self.vae.config.force_upcast
+                vae_decode == "full"
+                and self.vae.dtype == torch.float16
+                and self.vae.config.force_upcast
             )
 
             if needs_upcasting:
@@ -1249,10 +1258,11 @@ class KolorsImg2ImgPipeline(
             # unscale/denormalize the latents
             latents = latents / self.vae.config.scaling_factor
 
-            image = self.vae.decode(
+            image = decode_latents(
+                self.vae,
                 latents.to(device=self.vae.device, dtype=self.vae.dtype),
-                return_dict=False,
-            )[0]
+                vae_decode,
+            )
 
             # cast back to fp16 if needed
             if needs_upcasting:
@@ -1803,6 +1813,7 @@ class KolorsPipeline(
         ] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 256,
+        vae_decode: str = "full",
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -1923,6 +1934,10 @@ class KolorsPipeline(
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
             max_sequence_length (`int` defaults to 256): Maximum sequence length to use with the `prompt`.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -2160,8 +2175,11 @@ class KolorsPipeline(
 
         if not output_type == "latent":
             # make sure the VAE is in float32 mode, as it overflows in float16
+            # decoding one image or tile at a time only upcasts the decodes that overflow.
             needs_upcasting = (
-                self.vae.dtype == torch.float16 and self.vae.config.force_upcast
+                vae_decode == "full"
+                and self.vae.dtype == torch.float16
+                and self.vae.config.force_upcast
             )
 
             if needs_upcasting:
@@ -2177,10 +2195,11 @@ class KolorsPipeline(
             # unscale/denormalize the latents
             latents = latents / self.vae.config.scaling_factor
 
-            image = self.vae.decode(
+            image = decode_latents(
+                self.vae,
                 latents.to(device=self.vae.device, dtype=self.vae.dtype),
-                return_dict=False,
-            )[0]
+                vae_decode,
+            )
 
             # cast back to fp16 if needed
             if needs_upcasting:
@@ -16,6 +16,7 @@ import inspect
 from typing import Any, Callable, Dict, List, Optional, Union
 
 import torch
+from helpers.models.vae_decode import decode_latents
 from packaging import version
 from transformers import (
     CLIPImageProcessor,
@@ -883,6 +884,7 @@ class StableDiffusionPipeline(
         clip_skip: Optional[int] = None,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
+        vae_decode: str = "full",
         **kwargs,
     ):
         r"""
@@ -956,6 +958,10 @@ class StableDiffusionPipeline(
                 The list of tensor inputs for the `callback_on_step_end` function. The tensors specified in the list
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -1161,11 +1167,18 @@ class StableDiffusionPipeline(
                         callback(step_idx, t, latents)
 
         if not output_type == "latent":
-            image = self.vae.decode(
-                latents.to(self.vae.dtype) / self.vae.config.scaling_factor,
-                return_dict=False,
-                generator=generator,
-            )[0]
+            if vae_decode == "full":
+                image = self.vae.decode(
+                    latents.to(self.vae.dtype) / self.vae.config.scaling_factor,
+                    return_dict=False,
+                    generator=generator,
+                )[0]
+            else:
+                image = decode_latents(
+                    self.vae,
+                    latents.to(self.vae.dtype) / self.vae.config.scaling_factor,
+                    vae_decode,
+                )
             image, has_nsfw_concept = self.run_safety_checker(
                 image, device, prompt_embeds.dtype
             )
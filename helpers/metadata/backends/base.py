@@ -5,12 +5,16 @@ import logging
 import threading
 import torch
 from helpers.data_backend.base import BaseDataBackend
+from helpers.image_manipulation.load import load_image
+from helpers.image_manipulation.perceptual_hash import image_hash
+from helpers.metadata.deduplication import find_duplicates
 from helpers.multiaspect.image import MultiaspectImage
 from helpers.training.state_tracker import StateTracker
 from helpers.training.multi_process import should_log
 from multiprocessing import Process, Queue
 from threading import Thread
 from pathlib import Path
+from io import BytesIO
 from tqdm import tqdm
 from PIL import Image
 from math import floor
@@ -44,6 +48,7 @@ class MetadataBackend:
         minimum_image_size: int = None,
         cache_file_suffix: str = None,
         repeats: int = 0,
+        deduplicate: dict = None,
     ):
         self.id = id
         if self.id != data_backend.id:
@@ -64,6 +69,10 @@ class MetadataBackend:
         self.image_metadata = {}  # Store image metadata
         self.seen_images = {}
         self.config = {}
+        self.deduplicate = deduplicate
+        # Near-duplicate images, by the image they were grouped with. See deduplicate_images.
+        self.duplicates = {}
+        self.duplicate_groups = {}
         self.reload_cache()
         self.resolution = resolution
         self.resolution_type = resolution_type
@@ -355,7 +364,7 @@ class MetadataBackend:
 
     def mark_as_seen(self, image_path):
         """Mark an image as seen."""
-        self.seen_images[image_path] = True
+        self.mark_batch_as_seen([image_path])
 
     def mark_batch_as_seen(self, image_paths):
         """Efficiently extend the Manager with new contents, image_paths
@@ -363,6 +372,13 @@ class MetadataBackend:
         Args:
             image_paths (list): A list of image paths to mark as seen.
         """
+        if self.duplicate_groups:
+            # A group of near-duplicates is only trained on once per epoch.
+            image_paths = [
+                path
+                for image_path in image_paths
+                for path in self.duplicate_groups.get(image_path, [image_path])
+            ]
         self.seen_images.update({image_path: True for image_path in image_paths})
 
     def is_seen(self, image_path):
@@ -426,11 +442,110 @@ class MetadataBackend:
             f"Refreshing buckets for rank {rank} via data_backend id {self.id}."
         )
         existing_files = StateTracker.get_image_files(data_backend_id=self.id)
+        self.deduplicate_images(existing_files)
 
         # Update bucket indices to remove entries that no longer exist
         self.update_buckets_with_existing_files(existing_files)
         return
 
+    def _group_duplicates(self):
+        """Map each image of a group of near-duplicates to the whole group, for downweighting."""
+        self.duplicate_groups = {}
+        if (self.deduplicate or {}).get("action") != "downweight":
+            return
+        for duplicate, image_path in self.duplicates.items():
+            group = self.duplicate_groups.setdefault(image_path, [image_path])
+            group.append(duplicate)
+            self.duplicate_groups[duplicate] = group
+
+    def _image_hash(self, image_path: str, method: str):
+        """An image's perceptual hash from its metadata, or from the image if it has none yet."""
+        metadata = self.get_metadata_by_filepath(image_path)
+        if metadata is not None and metadata.get(method) is not None:
+            return metadata[method], False
+        image_data = self.data_backend.read(image_path)
+        if image_data is None:
+            return None, False
+        with load_image(BytesIO(image_data)) as image:
+            value = image_hash(image, method)
+        if metadata is not None:
+            metadata[method] = value
+        return value, True
+
+    def deduplicate_images(self, existing_files=None):
+        """
+        Group near-duplicate images by the Hamming distance between their perceptual hashes,
+        before they are split between processes. Images are grouped around the largest.
+
+        With the "drop" action, only the largest image of each group is kept in the buckets.
+        With "downweight", every image is kept, but the whole group is marked as seen when any
+        of them is, so it's trained on once per epoch rather than once per image.
+        """
+        previous_duplicates = self.duplicates
+        self.duplicates = {}
+        if (self.deduplicate is not None or previous_duplicates) and (
+            not self.image_metadata
+        ):
+            self.load_image_metadata()
+        if self.deduplicate is not None:
+            method = self.deduplicate["hash"]
+            image_paths = set().union(*self.aspect_ratio_bucket_indices.values())
+            image_paths.update(previous_duplicates)
+            if existing_files is not None:
+                image_paths.intersection_update(existing_files)
+
+            def size(image_path):
+                original_size = self.get_metadata_attribute_by_filepath(
+                    image_path, "original_size"
+                )
+                return original_size[0] * original_size[1] if original_size else 0
+
+            hashes = []
+            computed_hashes = 0
+            for image_path in tqdm(
+                sorted(image_paths, key=lambda path: (-size(path), path)),
+                desc="Hashing images for deduplication",
+                leave=False,
+                ncols=100,
+                disable=len(image_paths) < 1000,
+            ):
+                value, computed = self._image_hash(image_path, method)
+                computed_hashes += computed
+                if value is not None:
+                    hashes.append((image_path, int(value, 16)))
+            self.duplicates = find_duplicates(hashes, self.deduplicate["max_distance"])
+            if computed_hashes:
+                self.save_image_metadata()
+            logger.info(
+                f"(id={self.id}) Found {len(self.duplicates)} near-duplicates of"
+                f" {len(set(self.duplicates.values()))} images, which will be"
+                f" {'dropped' if self.deduplicate['action'] == 'drop' else 'trained on once per epoch'}."
+            )
+        dropped = (
+            set(self.duplicates)
+            if (self.deduplicate or {}).get("action") == "drop"
+            else set()
+        )
+        for bucket, images in self.aspect_ratio_bucket_indices.items():
+            self.aspect_ratio_bucket_indices[bucket] = [
+                image for image in images if image not in dropped
+            ]
+        # Images that were dropped before, and no longer are, go back into their buckets.
+        bucketed = set().union(*self.aspect_ratio_bucket_indices.values())
+        for image_path in previous_duplicates:
+            if image_path in dropped or image_path in bucketed:
+                continue
+            if existing_files is not None and image_path not in existing_files:
+                continue
+            aspect_ratio = self.get_metadata_attribute_by_filepath(
+                image_path, "aspect_ratio"
+            )
+            if aspect_ratio is not None:
+                self.aspect_ratio_bucket_indices.setdefault(
+                    str(aspect_ratio), []
+                ).append(image_path)
+        self._group_duplicates()
+
     def _enforce_min_bucket_size(self):
         """
         Remove buckets that have fewer samples than batch_size and enforce minimum image size constraints.
@@ -798,6 +913,7 @@ class MetadataBackend:
                 elif vae_cache_behavior == "recreate":
                     # Delete the cache file if it doesn't match the aspect bucket indices
                     if self.is_cache_inconsistent(vae_cache, cache_file, cache_content):
+                        vae_cache.cache_index.discard([cache_file])
                         threading.Thread(
                             target=self.data_backend.delete,
                             args=(cache_file,),
@@ -10,6 +10,7 @@ import os
 import traceback
 from io import BytesIO
 from helpers.image_manipulation.brightness import calculate_luminance
+from helpers.image_manipulation.perceptual_hash import image_hash
 from helpers.training import image_file_extensions
 
 logger = logging.getLogger("JsonMetadataBackend")
@@ -38,6 +39,7 @@ class JsonMetadataBackend(MetadataBackend):
         minimum_image_size: int = None,
         cache_file_suffix: str = None,
         repeats: int = 0,
+        deduplicate: dict = None,
     ):
         super().__init__(
             id=id,
@@ -55,6 +57,7 @@ class JsonMetadataBackend(MetadataBackend):
             minimum_image_size=minimum_image_size,
             cache_file_suffix=cache_file_suffix,
             repeats=repeats,
+            deduplicate=deduplicate,
         )
 
     def _discover_new_files(
@@ -108,6 +111,8 @@ class JsonMetadataBackend(MetadataBackend):
                 for paths in self.aspect_ratio_bucket_indices.values()
                 for path in paths
             )
+            # Dropped near-duplicates were processed, they just aren't in a bucket.
+            processed_files.update(self.duplicates)
             result = [
                 file for file in all_image_files_set if file not in processed_files
             ]
@@ -137,6 +142,8 @@ class JsonMetadataBackend(MetadataBackend):
             self.aspect_ratio_bucket_indices = cache_data.get(
                 "aspect_ratio_bucket_indices", {}
             )
+            self.duplicates = cache_data.get("duplicates", {})
+            self._group_duplicates()
             if set_config:
                 self.config = cache_data.get("config", {})
                 if self.config != {}:
@@ -173,6 +180,7 @@ class JsonMetadataBackend(MetadataBackend):
                 data_backend_id=self.data_backend.id
             ),
             "aspect_ratio_bucket_indices": aspect_ratio_bucket_indices_str,
+            "duplicates": self.duplicates,
         }
         logger.debug(f"save_cache has config to write: {cache_data['config']}")
         cache_data_str = json.dumps(cache_data)
@@ -244,6 +252,13 @@ class JsonMetadataBackend(MetadataBackend):
                         "luminance": calculate_luminance(image),
                     }
                 )
+                if self.deduplicate is not None:
+                    method = self.deduplicate["hash"]
+                    image_metadata[method] = image_hash(image, method)
+                if prepared_sample.crop_variant_coordinates is not None:
+                    image_metadata["crop_variant_coordinates"] = (
+                        prepared_sample.crop_variant_coordinates
+                    )
                 logger.debug(
                     f"Image {image_path_str} has aspect ratio {prepared_sample.aspect_ratio} and size {image.size}."
                 )
@@ -41,6 +41,7 @@ class ParquetMetadataBackend(MetadataBackend):
         minimum_image_size: int = None,
         cache_file_suffix: str = None,
         repeats: int = 0,
+        deduplicate: dict = None,
     ):
         self.parquet_config = parquet_config
         self.parquet_path = parquet_config.get("path", None)
@@ -62,6 +63,7 @@ class ParquetMetadataBackend(MetadataBackend):
             minimum_image_size=minimum_image_size,
             cache_file_suffix=cache_file_suffix,
             repeats=repeats,
+            deduplicate=deduplicate,
         )
         self.load_parquet_database()
         self.caption_cache = self._extract_captions_to_fast_list()
@@ -136,24 +138,39 @@ class ParquetMetadataBackend(MetadataBackend):
         identifier_includes_extension = self.parquet_config.get(
             "identifier_includes_extension", False
         )
-        captions = {}
-        for index, row in self.parquet_database.iterrows():
-            if filename_column in row:
-                filename = str(row[filename_column])
+        # Pull whole columns out at once, rather than walking the table row by row.
+        parquet_database = self.parquet_database
+        if filename_column in parquet_database.columns:
+            filenames = parquet_database[filename_column].tolist()
+        else:
+            filenames = parquet_database.index.tolist()
+        if type(caption_column) == list:
+            if len(caption_column) > 0:
+                column_captions = [
+                    list(row)
+                    for row in zip(
+                        *[parquet_database[c].tolist() for c in caption_column]
+                    )
+                ]
             else:
-                filename = str(index)
+                column_captions = [None] * len(parquet_database)
+        else:
+            column_captions = parquet_database[caption_column].tolist()
+        fallback_captions = (
+            parquet_database[fallback_caption_column].tolist()
+            if fallback_caption_column
+            else [None] * len(parquet_database)
+        )
+        captions = {}
+        for filename, caption, fallback_caption in zip(
+            filenames, column_captions, fallback_captions
+        ):
+            filename = str(filename)
             if not identifier_includes_extension:
                 filename = os.path.splitext(filename)[0]
 
-            if type(caption_column) == list:
-                caption = None
-                if len(caption_column) > 0:
-                    caption = [row[c] for c in caption_column]
-            else:
-                caption = row[caption_column]
-
             if not caption and fallback_caption_column:
-                caption = row[fallback_caption_column]
+                caption = fallback_caption
             if not caption:
                 raise ValueError(
                     f"Could not locate caption for image {filename} in sampler_backend {self.id} with filename column {filename_column}, caption column {caption_column}, and a parquet database with {len(self.parquet_database)} entries."
@@ -227,6 +244,8 @@ class ParquetMetadataBackend(MetadataBackend):
                 for paths in self.aspect_ratio_bucket_indices.values()
                 for path in paths
             )
+            # Dropped near-duplicates were processed, they just aren't in a bucket.
+            processed_files.update(self.duplicates)
             result = [
                 file for file in all_image_files_set if file not in processed_files
             ]
@@ -256,6 +275,8 @@ class ParquetMetadataBackend(MetadataBackend):
             self.aspect_ratio_bucket_indices = cache_data.get(
                 "aspect_ratio_bucket_indices", {}
             )
+            self.duplicates = cache_data.get("duplicates", {})
+            self._group_duplicates()
             if set_config:
                 self.config = cache_data.get("config", {})
                 if self.config != {}:
@@ -287,6 +308,7 @@ class ParquetMetadataBackend(MetadataBackend):
                 data_backend_id=self.data_backend.id
             ),
             "aspect_ratio_bucket_indices": aspect_ratio_bucket_indices_str,
+            "duplicates": self.duplicates,
         }
         logger.debug(f"save_cache has config to write: {cache_data['config']}")
         cache_data_str = json.dumps(cache_data)
@@ -543,6 +565,20 @@ class ParquetMetadataBackend(MetadataBackend):
                     ),
                 }
             )
+            if prepared_sample.crop_variant_coordinates is not None:
+                image_metadata["crop_variant_coordinates"] = (
+                    prepared_sample.crop_variant_coordinates
+                )
+            if self.deduplicate is not None:
+                # Hashes that aren't in the parquet are computed from the images when deduplicating.
+                method = self.deduplicate["hash"]
+                hash_column = self.parquet_config.get(f"{method}_column")
+                if hash_column is not None:
+                    value = database_image_metadata[hash_column]
+                    if value is not None and not pd.isna(value):
+                        image_metadata[method] = (
+                            value if isinstance(value, str) else f"{int(value):016x}"
+                        )
             # logger.debug(
             #     f"Data types for metadata: {[type(v) for v in image_metadata.values()]}"
             # )
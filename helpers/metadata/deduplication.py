@@ -0,0 +1,91 @@
+from array import array
+
+import numpy as np
+
+from helpers.image_manipulation.perceptual_hash import hamming_distances
+
+# drop: only the largest image of each group of near-duplicates is kept in the buckets.
+# downweight: every image is kept, but a group is only trained on once per epoch.
+deduplicate_actions = ("drop", "downweight")
+
+
+class HammingIndex:
+    """
+    Finds the 64-bit hashes within `max_distance` bits of a query, by multi-index hashing.
+
+    The hashes are split into `max_distance + 1` blocks of bits. Two hashes that differ by no
+    more than `max_distance` bits must match exactly on at least one block, so each block is
+    indexed in a dict, and a query is only compared against the hashes that share a block with
+    it rather than against every hash.
+    """
+
+    def __init__(self, max_distance: int):
+        if not 0 <= max_distance < 32:
+            raise ValueError(
+                f"max_distance must be between 0 and 31 bits, not {max_distance}."
+            )
+        self.max_distance = max_distance
+        bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+        # (shift, mask) of each block, from the most significant bits.
+        self._blocks = [
+            (64 - int(stop), (1 << int(stop - start)) - 1)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        self._tables = [{} for _ in self._blocks]
+        self._hashes = array("Q")
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, value: int):
+        position = len(self.keys)
+        self.keys.append(key)
+        self._hashes.append(value)
+        for table, (shift, mask) in zip(self._tables, self._blocks):
+            table.setdefault((value >> shift) & mask, []).append(position)
+
+    def query(self, value: int) -> list:
+        """The (key, distance) of each hash within `max_distance` bits, the closest first."""
+        candidates = []
+        for table, (shift, mask) in zip(self._tables, self._blocks):
+            candidates.extend(table.get((value >> shift) & mask, ()))
+        if not candidates:
+            return []
+        candidates = np.unique(np.array(candidates, dtype=np.int64))
+        distances = hamming_distances(
+            np.frombuffer(self._hashes, dtype=np.uint64)[candidates], value
+        )
+        matches = distances <= self.max_distance
+        order = np.argsort(distances[matches], kind="stable")
+        return [
+            (self.keys[position], int(distance))
+            for position, distance in zip(
+                candidates[matches][order], distances[matches][order]
+            )
+        ]
+
+
+def find_duplicates(hashes: list, max_distance: int) -> dict:
+    """
+    Group near-duplicate images around the first image of each group.
+
+    Args:
+        hashes (list): (key, hash) of each image, in order of preference to be kept.
+        max_distance (int): How many bits the hashes of near-duplicates may differ by.
+
+    Returns:
+        dict: The key of the image each near-duplicate was grouped with, by its key. The first
+            images of the groups, and images without near-duplicates, aren't included.
+    """
+    # Only the first image of each group is indexed, so groups don't chain together through
+    # images that are each close to the next.
+    index = HammingIndex(max_distance)
+    duplicates = {}
+    for key, value in hashes:
+        matches = index.query(value)
+        if matches:
+            duplicates[key] = matches[0][0]
+        else:
+            index.add(key, value)
+    return duplicates
@@ -0,0 +1,259 @@
+import logging
+import os
+from functools import lru_cache
+from typing import Optional, Union
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger("AttentionBackends")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+# name -> fn(query, key, value, attn_mask, scale, **options)
+attention_backends = {}
+
+
+def register_attention_backend(name: str):
+    """
+    Register an attention implementation under `name`.
+
+    Backends receive query as (batch, heads, query_len, head_dim) and key/value as
+    (batch, kv_heads, kv_len, head_dim), where heads is a multiple of kv_heads. Query head `i`
+    attends with key/value head `i // (heads // kv_heads)`, as `repeat_interleave` would give.
+    The mask is None, a tensor broadcastable to (batch, heads, query_len, kv_len), or a
+    SlidingWindowBias.
+    """
+
+    def decorator(fn):
+        attention_backends[name] = fn
+        return fn
+
+    return decorator
+
+
+class SlidingWindowBias:
+    """
+    The sliding window SmolDiT adds to its self-attention scores: 1 for keys within `window_size`
+    positions of the query, 0 elsewhere.
+
+    SmolDiT was trained with this added to the scores rather than blocking attention outside of
+    the window, so that's what is reproduced here. It's described instead of stored, so backends
+    only build the rows they need, once per shape.
+    """
+
+    def __init__(self, window_size: int):
+        self.window_size = window_size
+
+    def rows(self, start: int, end: int, kv_len: int, device, dtype) -> torch.Tensor:
+        return _sliding_window_rows(
+            self.window_size, start, end, kv_len, torch.device(device), dtype
+        )
+
+
+@lru_cache(maxsize=32)
+def _sliding_window_rows(window_size, start, end, kv_len, device, dtype):
+    query_positions = torch.arange(start, end, device=device)[:, None]
+    key_positions = torch.arange(kv_len, device=device)[None, :]
+    window = (query_positions - key_positions).abs() <= window_size
+    return window.to(dtype)[None, None]
+
+
+@lru_cache(maxsize=None)
+def sdpa_supports_gqa() -> bool:
+    """Whether this version of PyTorch accepts `enable_gqa` in scaled_dot_product_attention."""
+    try:
+        F.scaled_dot_product_attention(
+            torch.zeros(1, 2, 1, 1),
+            torch.zeros(1, 1, 1, 1),
+            torch.zeros(1, 1, 1, 1),
+            enable_gqa=True,
+        )
+    except TypeError:
+        return False
+    return True
+
+
+def flex_attention_available() -> bool:
+    try:
+        from torch.nn.attention.flex_attention import flex_attention  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def _mask_rows(attn_mask, start: int, end: int, query: torch.Tensor, kv_len: int):
+    """The mask for query rows [start, end), without materialising broadcast dimensions."""
+    if attn_mask is None:
+        return None
+    if isinstance(attn_mask, SlidingWindowBias):
+        return attn_mask.rows(start, end, kv_len, query.device, query.dtype)
+    while attn_mask.ndim < 4:
+        attn_mask = attn_mask.unsqueeze(0)
+    if attn_mask.shape[-2] > 1 and (start, end) != (0, attn_mask.shape[-2]):
+        attn_mask = attn_mask[..., start:end, :]
+    return attn_mask
+
+
+def _expand_kv_heads(query, key, value):
+    heads_per_kv_head = query.shape[1] // key.shape[1]
+    if heads_per_kv_head > 1:
+        key = torch.repeat_interleave(key, heads_per_kv_head, dim=1)
+        value = torch.repeat_interleave(value, heads_per_kv_head, dim=1)
+    return key, value
+
+
+def _sdpa_grouped(query, key, value, attn_mask, scale):
+    """scaled_dot_product_attention, sharing each key/value head between its group of query heads."""
+    batch_size, heads, query_len, head_dim = query.shape
+    kv_heads = key.shape[1]
+    if kv_heads == heads:
+        return F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_mask, scale=scale
+        )
+    if sdpa_supports_gqa():
+        return F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attn_mask, scale=scale, enable_gqa=True
+        )
+    # Fold each group of query heads into the sequence dimension of its key/value head.
+    group_size = heads // kv_heads
+    query = query.reshape(batch_size, kv_heads, group_size * query_len, head_dim)
+    if attn_mask is not None and (attn_mask.shape[1] > 1 or attn_mask.shape[2] > 1):
+        attn_mask = attn_mask.expand(
+            attn_mask.shape[0], heads, query_len, attn_mask.shape[-1]
+        ).reshape(attn_mask.shape[0], kv_heads, group_size * query_len, -1)
+    hidden_states = F.scaled_dot_product_attention(
+        query, key, value, attn_mask=attn_mask, scale=scale
+    )
+    return hidden_states.reshape(batch_size, heads, query_len, head_dim)
+
+
+@register_attention_backend("sdpa")
+def sdpa_attention(query, key, value, attn_mask=None, scale=None):
+    """scaled_dot_product_attention over dense masks, with key/value heads repeated for each query head."""
+    key, value = _expand_kv_heads(query, key, value)
+    attn_mask = _mask_rows(attn_mask, 0, query.shape[2], query, key.shape[2])
+    return F.scaled_dot_product_attention(
+        query, key, value, attn_mask=attn_mask, scale=scale
+    )
+
+
+@register_attention_backend("gqa")
+def gqa_attention(query, key, value, attn_mask=None, scale=None):
+    """scaled_dot_product_attention without copying key/value heads for grouped-query attention."""
+    attn_mask = _mask_rows(attn_mask, 0, query.shape[2], query, key.shape[2])
+    return _sdpa_grouped(query, key, value, attn_mask, scale)
+
+
+@register_attention_backend("chunked")
+def chunked_attention(query, key, value, attn_mask=None, scale=None, chunk_size=1024):
+    """
+    Attend `chunk_size` queries at a time, so the scores (and masks) for long sequences are
+    never held in full.
+    """
+    query_len, kv_len = query.shape[2], key.shape[2]
+    if query_len <= chunk_size:
+        return gqa_attention(query, key, value, attn_mask=attn_mask, scale=scale)
+    chunks = []
+    for start in range(0, query_len, chunk_size):
+        end = min(start + chunk_size, query_len)
+        chunks.append(
+            _sdpa_grouped(
+                query[:, :, start:end],
+                key,
+                value,
+                _mask_rows(attn_mask, start, end, query, kv_len),
+                scale,
+            )
+        )
+    return torch.cat(chunks, dim=2)
+
+
+@register_attention_backend("flex")
+def flex_attention_backend(query, key, value, attn_mask=None, scale=None):
+    """
+    PyTorch's flex_attention, with masks applied as score modifications computed from the
+    positions, instead of dense tensors. This is intended for compiled models.
+    """
+    from torch.nn.attention.flex_attention import flex_attention
+
+    score_mod = None
+    if isinstance(attn_mask, SlidingWindowBias):
+        window_size = attn_mask.window_size
+
+        def score_mod(score, batch, head, query_idx, kv_idx):
+            return score + ((query_idx - kv_idx).abs() <= window_size).to(score.dtype)
+
+    elif attn_mask is not None:
+        bias = _mask_rows(attn_mask, 0, query.shape[2], query, key.shape[2])
+        if bias.dtype == torch.bool:
+            bias = torch.zeros_like(bias, dtype=query.dtype).masked_fill(
+                ~bias, float("-inf")
+            )
+        bias = bias.expand(query.shape[0], query.shape[1], query.shape[2], key.shape[2])
+
+        def score_mod(score, batch, head, query_idx, kv_idx):
+            return score + bias[batch, head, query_idx, kv_idx].to(score.dtype)
+
+    return flex_attention(
+        query,
+        key,
+        value,
+        score_mod=score_mod,
+        scale=scale,
+        enable_gqa=key.shape[1] != query.shape[1],
+    )
+
+
+def get_attention_backend(name: str):
+    if name not in attention_backends:
+        raise ValueError(
+            f"Unknown attention backend '{name}'. Choose from: {', '.join(attention_backends)}"
+        )
+    if name == "flex" and not flex_attention_available():
+        raise ValueError("The flex attention backend requires PyTorch 2.5 or newer.")
+    return attention_backends[name]
+
+
+def attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    attn_mask: Optional[Union[torch.Tensor, SlidingWindowBias]] = None,
+    scale: Optional[float] = None,
+    backend: str = "sdpa",
+    **options,
+) -> torch.Tensor:
+    """Run the named attention backend. See `register_attention_backend` for the expected shapes."""
+    return get_attention_backend(backend)(
+        query, key, value, attn_mask=attn_mask, scale=scale, **options
+    )
+
+
+def set_attention_backend(model: torch.nn.Module, backend: str, **options) -> int:
+    """
+    Select the attention backend used by every supporting attention layer in a model.
+
+    Args:
+        model: The model, eg. a SmolDiT2DModel or FluxTransformer2DModelWithMasking.
+        backend (str): A registered backend name.
+        **options: Passed to the backend on each call, eg. `chunk_size` for "chunked".
+
+    Returns:
+        int: The number of attention layers updated.
+    """
+    get_attention_backend(backend)
+    updated = 0
+    for module in model.modules():
+        for target in (module, getattr(module, "processor", None)):
+            if target is not None and hasattr(target, "attention_backend"):
+                target.attention_backend = backend
+                target.attention_backend_options = dict(options)
+                updated += 1
+    if updated == 0:
+        logger.warning(
+            f"{type(model).__name__} has no attention layers that support selecting a backend,"
+            f" '{backend}' will not be used."
+        )
+    else:
+        logger.info(f"Using the '{backend}' attention backend for {updated} layers.")
+    return updated
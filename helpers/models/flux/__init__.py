@@ -1,5 +1,19 @@
-import torch
-from helpers.models.flux.pipeline import FluxPipeline
+from helpers.models.flux.positions import (
+    prepare_latent_image_ids,
+    prepare_text_ids,
+)
+from helpers.registry import LazyRegistry
+
+# The pipeline imports diffusers and transformers, so it's only loaded once it's used.
+_lazy_classes = LazyRegistry(
+    "Flux class", {"FluxPipeline": "helpers.models.flux.pipeline.FluxPipeline"}
+)
+
+
+def __getattr__(name):
+    if name in _lazy_classes:
+        return _lazy_classes.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def update_flux_schedule_to_fast(args, noise_scheduler_to_copy):
@@ -40,26 +54,3 @@ def unpack_latents(latents, height, width, vae_scale_factor):
     latents = latents.reshape(batch_size, channels // (2 * 2), height * 2, width * 2)
 
     return latents
-
-
-def prepare_latent_image_ids(batch_size, height, width, device, dtype):
-    latent_image_ids = torch.zeros(height // 2, width // 2, 3)
-    latent_image_ids[..., 1] = (
-        latent_image_ids[..., 1] + torch.arange(height // 2)[:, None]
-    )
-    latent_image_ids[..., 2] = (
-        latent_image_ids[..., 2] + torch.arange(width // 2)[None, :]
-    )
-
-    latent_image_id_height, latent_image_id_width, latent_image_id_channels = (
-        latent_image_ids.shape
-    )
-
-    latent_image_ids = latent_image_ids[None, :].repeat(batch_size, 1, 1, 1)
-    latent_image_ids = latent_image_ids.reshape(
-        batch_size,
-        latent_image_id_height * latent_image_id_width,
-        latent_image_id_channels,
-    )
-
-    return latent_image_ids.to(device=device, dtype=dtype)
@@ -17,6 +17,7 @@ from typing import Any, Callable, Dict, List, Optional, Union
 
 import numpy as np
 import torch
+from helpers.models.vae_decode import decode_latents
 from transformers import (
     CLIPTextModel,
     CLIPTokenizer,
@@ -39,6 +40,10 @@ from diffusers.utils import (
 )
 from diffusers.utils.torch_utils import randn_tensor
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline
+from helpers.models.flux.positions import (
+    prepare_latent_image_ids,
+    prepare_text_ids,
+)
 
 
 if is_torch_xla_available():
@@ -404,8 +409,8 @@ class FluxPipeline(DiffusionPipeline, SD3LoraLoaderMixin):
                 # Retrieve the original scale by scaling back the LoRA layers
                 unscale_lora_layers(self.text_encoder_2, lora_scale)
 
-        text_ids = torch.zeros(batch_size, prompt_embeds.shape[1], 3).to(
-            device=device, dtype=prompt_embeds.dtype
+        text_ids = prepare_text_ids(
+            batch_size, prompt_embeds.shape[1], device=device, dtype=prompt_embeds.dtype
         )
 
         return prompt_embeds, pooled_prompt_embeds, text_ids, prompt_attention_mask
@@ -473,26 +478,7 @@ class FluxPipeline(DiffusionPipeline, SD3LoraLoaderMixin):
 
     @staticmethod
     def _prepare_latent_image_ids(batch_size, height, width, device, dtype):
-        latent_image_ids = torch.zeros(height // 2, width // 2, 3)
-        latent_image_ids[..., 1] = (
-            latent_image_ids[..., 1] + torch.arange(height // 2)[:, None]
-        )
-        latent_image_ids[..., 2] = (
-            latent_image_ids[..., 2] + torch.arange(width // 2)[None, :]
-        )
-
-        latent_image_id_height, latent_image_id_width, latent_image_id_channels = (
-            latent_image_ids.shape
-        )
-
-        latent_image_ids = latent_image_ids[None, :].repeat(batch_size, 1, 1, 1)
-        latent_image_ids = latent_image_ids.reshape(
-            batch_size,
-            latent_image_id_height * latent_image_id_width,
-            latent_image_id_channels,
-        )
-
-        return latent_image_ids.to(device=device, dtype=dtype)
+        return prepare_latent_image_ids(batch_size, height, width, device, dtype)
 
     @staticmethod
     def _pack_latents(latents, batch_size, num_channels_latents, height, width):
@@ -609,6 +595,7 @@ class FluxPipeline(DiffusionPipeline, SD3LoraLoaderMixin):
         negative_prompt_embeds: Optional[torch.FloatTensor] = None,
         negative_pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
         no_cfg_until_timestep: int = 2,
+        vae_decode: str = "full",
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -674,6 +661,10 @@ class FluxPipeline(DiffusionPipeline, SD3LoraLoaderMixin):
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
             max_sequence_length (`int` defaults to 512): Maximum sequence length to use with the `prompt`.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -907,10 +898,11 @@ class FluxPipeline(DiffusionPipeline, SD3LoraLoaderMixin):
                 latents / self.vae.config.scaling_factor
             ) + self.vae.config.shift_factor
 
-            image = self.vae.decode(
+            image = decode_latents(
+                self.vae,
                 latents.to(device=self.vae.device, dtype=self.vae.dtype),
-                return_dict=False,
-            )[0]
+                vae_decode,
+            )
             image = self.image_processor.postprocess(image, output_type=output_type)
 
         # Offload all models
@@ -0,0 +1,119 @@
+import torch
+from collections import OrderedDict
+
+
+def _is_compiling() -> bool:
+    compiler = getattr(torch, "compiler", None)
+    return compiler is not None and compiler.is_compiling()
+
+
+class FluxPositionCache:
+    """
+    Flux's position ids, and the rotary embeddings made from them, only depend on the latent size and
+    the text length. Training batches come from a handful of aspect buckets, so each variant is built
+    once, directly on its device, and reused by every step and validation run after that.
+
+    The ids are stored without a batch dimension and handed out as expanded views, so callers must not
+    modify them in-place.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self.ids = OrderedDict()
+        self.rotary_embeddings = OrderedDict()
+
+    def _remember(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+        return value
+
+    def latent_image_ids(self, height: int, width: int, device, dtype) -> torch.Tensor:
+        """The (1, height // 2 * width // 2, 3) image position ids for a latent of this size."""
+        device = torch.device(device)
+        key = ("image", height, width, device, dtype)
+        latent_image_ids = self.ids.get(key)
+        if latent_image_ids is not None:
+            self.ids.move_to_end(key)
+            return latent_image_ids
+        latent_image_ids = torch.zeros(height // 2, width // 2, 3, device=device)
+        latent_image_ids[..., 1] = torch.arange(height // 2, device=device)[:, None]
+        latent_image_ids[..., 2] = torch.arange(width // 2, device=device)[None, :]
+        latent_image_ids = latent_image_ids.reshape(1, -1, 3).to(dtype=dtype)
+        return self._remember(self.ids, key, latent_image_ids)
+
+    def text_ids(self, text_len: int, device, dtype) -> torch.Tensor:
+        """The (1, text_len, 3) text position ids, which are all zero."""
+        device = torch.device(device)
+        key = ("text", text_len, device, dtype)
+        text_ids = self.ids.get(key)
+        if text_ids is not None:
+            self.ids.move_to_end(key)
+            return text_ids
+        text_ids = torch.zeros(1, text_len, 3, device=device, dtype=dtype)
+        return self._remember(self.ids, key, text_ids)
+
+    def rotary_embedding(
+        self, pos_embed, txt_ids: torch.Tensor, img_ids: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Return `pos_embed(torch.cat((txt_ids, img_ids), dim=1))`, reusing an earlier result for the same ids.
+
+        Ids are recognised by their storage and version counter, rather than by comparing their contents,
+        which would need a device sync. The cache keeps a reference to the ids it has seen, so their memory
+        can't be handed to another tensor while the entry exists, and an in-place change bumps the version.
+        Ids that are expanded views of a single row, like the ones handed out above, are embedded once
+        for the whole batch.
+        """
+        if _is_compiling():
+            return pos_embed(torch.cat((txt_ids, img_ids), dim=1))
+        key = (
+            id(pos_embed),
+            *(
+                (
+                    ids.data_ptr(),
+                    ids._version,
+                    tuple(ids.shape),
+                    ids.stride(),
+                    ids.dtype,
+                    ids.device,
+                )
+                for ids in (txt_ids, img_ids)
+            ),
+        )
+        entry = self.rotary_embeddings.get(key)
+        if entry is not None:
+            self.rotary_embeddings.move_to_end(key)
+            return entry[-1]
+        batch_size = img_ids.shape[0]
+        if all(ids.shape[0] == 1 or ids.stride(0) == 0 for ids in (txt_ids, img_ids)):
+            ids = torch.cat((txt_ids[:1], img_ids[:1]), dim=1)
+            image_rotary_emb = pos_embed(ids)
+            image_rotary_emb = image_rotary_emb.expand(
+                batch_size, *image_rotary_emb.shape[1:]
+            )
+        else:
+            image_rotary_emb = pos_embed(torch.cat((txt_ids, img_ids), dim=1))
+        return self._remember(
+            self.rotary_embeddings,
+            key,
+            (pos_embed, txt_ids, img_ids, image_rotary_emb),
+        )[-1]
+
+    def clear(self):
+        self.ids.clear()
+        self.rotary_embeddings.clear()
+
+
+position_cache = FluxPositionCache()
+
+
+def prepare_latent_image_ids(batch_size, height, width, device, dtype):
+    return position_cache.latent_image_ids(height, width, device, dtype).expand(
+        batch_size, -1, -1
+    )
+
+
+def prepare_text_ids(batch_size, text_len, device, dtype):
+    return position_cache.text_ids(text_len, device, dtype).expand(batch_size, -1, -1)
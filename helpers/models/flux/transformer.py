@@ -35,6 +35,8 @@ from diffusers.models.embeddings import (
     CombinedTimestepTextProjEmbeddings,
 )
 from diffusers.models.modeling_outputs import Transformer2DModelOutput
+from helpers.models.attention_backends import attention
+from helpers.models.flux.positions import position_cache
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -45,11 +47,13 @@ class FluxSingleAttnProcessor2_0:
     Processor for implementing scaled dot-product attention (enabled by default if you're using PyTorch 2.0).
     """
 
-    def __init__(self):
+    def __init__(self, attention_backend: str = "sdpa"):
         if not hasattr(F, "scaled_dot_product_attention"):
             raise ImportError(
                 "AttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0."
             )
+        self.attention_backend = attention_backend
+        self.attention_backend_options = {}
 
     def __call__(
         self,
@@ -102,13 +106,13 @@ class FluxSingleAttnProcessor2_0:
 
         # the output of sdp = (batch, num_heads, seq_len, head_dim)
         # TODO: add support for attn.scale when we move to Torch 2.1
-        hidden_states = F.scaled_dot_product_attention(
+        hidden_states = attention(
             query,
             key,
             value,
-            dropout_p=0.0,
-            is_causal=False,
             attn_mask=attention_mask,
+            backend=self.attention_backend,
+            **self.attention_backend_options,
         )
 
         hidden_states = hidden_states.transpose(1, 2).reshape(
@@ -127,11 +131,13 @@ class FluxSingleAttnProcessor2_0:
 class FluxAttnProcessor2_0:
     """Attention processor used typically in processing the SD3-like self-attention projections."""
 
-    def __init__(self):
+    def __init__(self, attention_backend: str = "sdpa"):
         if not hasattr(F, "scaled_dot_product_attention"):
             raise ImportError(
                 "FluxAttnProcessor2_0 requires PyTorch 2.0, to use it, please upgrade PyTorch to 2.0."
             )
+        self.attention_backend = attention_backend
+        self.attention_backend_options = {}
 
     def __call__(
         self,
@@ -216,13 +222,13 @@ class FluxAttnProcessor2_0:
                 device=hidden_states.device, dtype=hidden_states.dtype
             )
 
-        hidden_states = F.scaled_dot_product_attention(
+        hidden_states = attention(
             query,
             key,
             value,
-            dropout_p=0.0,
-            is_causal=False,
             attn_mask=attention_mask,
+            backend=self.attention_backend,
+            **self.attention_backend_options,
         )
         hidden_states = hidden_states.transpose(1, 2).reshape(
             batch_size, -1, attn.heads * head_dim
@@ -299,16 +305,22 @@ class EmbedND(nn.Module):
 def expand_flux_attention_mask(
     hidden_states: torch.Tensor,
     attn_mask: torch.Tensor,
+    sequence_length: Optional[int] = None,
 ) -> torch.Tensor:
     """
     Expand a mask so that the image is included.
+
+    The expanded mask is created on the same device as `attn_mask`. Pass `sequence_length` to
+    expand to a longer sequence than `hidden_states` holds, eg. the joint text and image sequence.
     """
     bsz = attn_mask.shape[0]
     assert bsz == hidden_states.shape[0]
-    residual_seq_len = hidden_states.shape[1]
+    residual_seq_len = (
+        sequence_length if sequence_length is not None else hidden_states.shape[1]
+    )
     mask_seq_len = attn_mask.shape[1]
 
-    expanded_mask = torch.ones(bsz, residual_seq_len)
+    expanded_mask = torch.ones(bsz, residual_seq_len, device=attn_mask.device)
 
     start_index = residual_seq_len - mask_seq_len
     expanded_mask[:, start_index:] = attn_mask
@@ -459,8 +471,10 @@ class FluxTransformerBlock(nn.Module):
 
         if attention_mask is not None:
             attention_mask = expand_flux_attention_mask(
-                torch.cat([hidden_states, encoder_hidden_states], dim=1),
+                hidden_states,
                 attention_mask,
+                sequence_length=hidden_states.shape[1]
+                + encoder_hidden_states.shape[1],
             )
 
         # Attention.
@@ -669,8 +683,9 @@ class FluxTransformer2DModelWithMasking(
         )
         encoder_hidden_states = self.context_embedder(encoder_hidden_states)
 
-        ids = torch.cat((txt_ids, img_ids), dim=1)
-        image_rotary_emb = self.pos_embed(ids)
+        image_rotary_emb = position_cache.rotary_embedding(
+            self.pos_embed, txt_ids, img_ids
+        )
 
         for index_block, block in enumerate(self.transformer_blocks):
             if self.training and self.gradient_checkpointing:
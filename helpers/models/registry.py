@@ -0,0 +1,31 @@
+from helpers.registry import LazyRegistry
+
+# (model type, task) -> pipeline class. Each model family's pipeline is imported when it's used.
+pipeline_classes = LazyRegistry(
+    "pipeline",
+    {
+        ("sdxl", "text2img"): "helpers.sdxl.pipeline.StableDiffusionXLPipeline",
+        ("sdxl", "img2img"): "helpers.sdxl.pipeline.StableDiffusionXLImg2ImgPipeline",
+        (
+            "sdxl",
+            "controlnet",
+        ): "diffusers.pipelines.StableDiffusionXLControlNetPipeline",
+        ("kolors", "text2img"): "helpers.kolors.pipeline.KolorsPipeline",
+        ("kolors", "img2img"): "helpers.kolors.pipeline.KolorsImg2ImgPipeline",
+        ("legacy", "text2img"): "helpers.legacy.pipeline.StableDiffusionPipeline",
+        (
+            "legacy",
+            "superresolution",
+        ): "diffusers.pipelines.IFSuperResolutionPipeline",
+        ("sd3", "text2img"): "helpers.sd3.pipeline.StableDiffusion3Pipeline",
+        ("sd3", "img2img"): "helpers.sd3.pipeline.StableDiffusion3Img2ImgPipeline",
+        ("pixart_sigma", "text2img"): "helpers.pixart.pipeline.PixArtSigmaPipeline",
+        ("flux", "text2img"): "helpers.models.flux.pipeline.FluxPipeline",
+        ("smoldit", "text2img"): "helpers.models.smoldit.pipeline.SmolDiTPipeline",
+    },
+)
+
+
+def get_pipeline_class(model_type: str, task: str = "text2img"):
+    """Import and return the pipeline class of a model family, eg. get_pipeline_class("sdxl")."""
+    return pipeline_classes.get((model_type, task))
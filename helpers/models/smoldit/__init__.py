@@ -1,5 +1,20 @@
-from helpers.models.smoldit.transformer import SmolDiT2DModel
-from helpers.models.smoldit.pipeline import SmolDiTPipeline
+from helpers.registry import LazyRegistry
+
+# The model and pipeline import diffusers, so they're only loaded once they're used.
+_lazy_classes = LazyRegistry(
+    "SmolDiT class",
+    {
+        "SmolDiT2DModel": "helpers.models.smoldit.transformer.SmolDiT2DModel",
+        "SmolDiTPipeline": "helpers.models.smoldit.pipeline.SmolDiTPipeline",
+    },
+)
+
+
+def __getattr__(name):
+    if name in _lazy_classes:
+        return _lazy_classes.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 SmolDiTConfigurations = {
     "smoldit-small": {
@@ -15,6 +15,7 @@ import inspect
 from typing import Callable, List, Optional, Union
 
 import torch
+from helpers.models.vae_decode import decode_latents
 from transformers import T5EncoderModel, T5Tokenizer
 from diffusers.models.embeddings import get_2d_rotary_pos_embed
 from diffusers.pipelines.hunyuandit.pipeline_hunyuandit import (
@@ -428,6 +429,7 @@ class SmolDiTPipeline(DiffusionPipeline):
         callback: Optional[Callable[[int, int, torch.Tensor], None]] = None,
         callback_steps: int = 1,
         max_sequence_length: int = 300,
+        vae_decode: str = "full",
     ):
         # 1. Check inputs. Raise error if not correct
         height = height or self.transformer.config.sample_size * self.vae_scale_factor
@@ -591,11 +593,12 @@ class SmolDiTPipeline(DiffusionPipeline):
                         callback(step_idx, t, latents)
 
         if not output_type == "latent":
-            image = self.vae.decode(
+            image = decode_latents(
+                self.vae,
                 latents.to(device=self.vae.device, dtype=self.vae.dtype)
                 / self.vae.config.scaling_factor,
-                return_dict=False,
-            )[0]
+                vae_decode,
+            )
         else:
             image = latents
 
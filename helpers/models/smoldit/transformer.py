@@ -14,6 +14,7 @@
 from typing import Optional, Tuple
 
 import torch
+import torch.utils.checkpoint
 import torch.nn.functional as F
 from torch import nn
 
@@ -31,6 +32,7 @@ from diffusers.models.modeling_utils import ModelMixin
 from diffusers.models.normalization import AdaLayerNormContinuous, FP32LayerNorm
 from diffusers.models.transformers.hunyuan_transformer_2d import AdaLayerNormShift
 from diffusers.utils import logging
+from helpers.models.attention_backends import SlidingWindowBias, attention
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -45,6 +47,7 @@ class SmolDiTAttention(nn.Module):
         num_heads,
         kv_heads,
         sliding_window=None,
+        attention_backend: str = "sdpa",
     ):
         super().__init__()
 
@@ -59,6 +62,8 @@ class SmolDiTAttention(nn.Module):
 
         self.scale = dim_head**-0.5
         self.sliding_window = sliding_window
+        self.attention_backend = attention_backend
+        self.attention_backend_options = {}
 
         self.to_q = nn.Linear(query_dim, self.inner_dim, bias=False)
         self.to_k = nn.Linear(self.cross_attention_dim, self.inner_kv_dim, bias=False)
@@ -101,14 +106,11 @@ class SmolDiTAttention(nn.Module):
         num_heads: int,
         device,
     ) -> torch.Tensor:
-        mask = torch.zeros(
-            (batch_size, num_heads, sequence_length, sequence_length), device=device
+        return (
+            SlidingWindowBias(window_size)
+            .rows(0, sequence_length, sequence_length, device, torch.float32)
+            .expand(batch_size, num_heads, sequence_length, sequence_length)
         )
-        for i in range(sequence_length):
-            start = max(0, i - window_size)
-            end = min(sequence_length, i + window_size + 1)
-            mask[:, :, i, start:end] = 1
-        return mask
 
     def forward(
         self,
@@ -134,13 +136,7 @@ class SmolDiTAttention(nn.Module):
             )
             attention_mask = encoder_attention_mask
         elif self.sliding_window:
-            attention_mask = self.sliding_window_attention_mask(
-                sequence_length=hidden_states.shape[1],
-                window_size=self.sliding_window,
-                batch_size=batch_size,
-                num_heads=self.num_heads,
-                device=hidden_states.device,
-            )
+            attention_mask = SlidingWindowBias(self.sliding_window)
 
         # Projections.
         query = self.to_q(hidden_states)
@@ -158,24 +154,28 @@ class SmolDiTAttention(nn.Module):
         key = key.view(batch_size, -1, kv_heads, head_dim).transpose(1, 2)
         value = value.view(batch_size, -1, kv_heads, head_dim).transpose(1, 2)
 
-        # GQA
-        if kv_heads != self.num_heads:
-            # if GQA or MQA, repeat the key/value heads to reach the number of query heads.
-            heads_per_kv_head = self.num_heads // kv_heads
-            key = torch.repeat_interleave(key, heads_per_kv_head, dim=1)
-            value = torch.repeat_interleave(value, heads_per_kv_head, dim=1)
-
         # Apply RoPE if needed
         if image_rotary_emb is not None:
             query = apply_rotary_emb(query, image_rotary_emb)
             query = query.to(dtype)
             if not self.is_cross_attention:
-                key = apply_rotary_emb(key, image_rotary_emb)
-                key = query.to(dtype)
+                # The keys are replaced by the rotated queries, as this model was trained,
+                # so the values need one head per query head to match them.
+                key = query
+                value = torch.repeat_interleave(
+                    value, self.num_heads // kv_heads, dim=1
+                )
 
-        # the output of sdpa = (batch, num_heads, seq_len, head_dim)
-        hidden_states = F.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, scale=self.scale
+        # the output of attention = (batch, num_heads, seq_len, head_dim)
+        # GQA key/value heads are shared by their query heads inside the backend.
+        hidden_states = attention(
+            query,
+            key,
+            value,
+            attn_mask=attention_mask,
+            scale=self.scale,
+            backend=self.attention_backend,
+            **self.attention_backend_options,
         )
 
         # out
@@ -266,6 +266,8 @@ class SmolDiTBlock(nn.Module):
 
 
 class SmolDiT2DModel(ModelMixin, ConfigMixin):
+    _supports_gradient_checkpointing = True
+
     @register_to_config
     def __init__(
         self,
@@ -335,6 +337,12 @@ class SmolDiT2DModel(ModelMixin, ConfigMixin):
             self.inner_dim, patch_size * patch_size * out_channels
         )
 
+        self.gradient_checkpointing = False
+
+    def _set_gradient_checkpointing(self, module, value=False):
+        if hasattr(module, "gradient_checkpointing"):
+            module.gradient_checkpointing = value
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -372,13 +380,24 @@ class SmolDiT2DModel(ModelMixin, ConfigMixin):
         )
 
         for _, block in enumerate(self.blocks):
-            hidden_states = block(
-                hidden_states=hidden_states,
-                temb=temb,
-                encoder_hidden_states=encoder_hidden_states,
-                encoder_attention_mask=encoder_attention_mask,
-                image_rotary_emb=image_rotary_emb,
-            )  # (N, L, D)
+            if self.training and self.gradient_checkpointing:
+                hidden_states = torch.utils.checkpoint.checkpoint(
+                    block,
+                    hidden_states,
+                    temb,
+                    encoder_hidden_states,
+                    encoder_attention_mask,
+                    image_rotary_emb,
+                    use_reentrant=False,
+                )
+            else:
+                hidden_states = block(
+                    hidden_states=hidden_states,
+                    temb=temb,
+                    encoder_hidden_states=encoder_hidden_states,
+                    encoder_attention_mask=encoder_attention_mask,
+                    image_rotary_emb=image_rotary_emb,
+                )  # (N, L, D)
 
         # final layer
         hidden_states = self.norm_out(hidden_states, temb.to(torch.float32))
@@ -0,0 +1,134 @@
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger("VAEDecode")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+# full: every image in one vae.decode call, as the pipelines always did.
+# batched: one image at a time, so the decoder's activations are only ever held for one image.
+# tiled: one image at a time, in overlapping tiles that are blended together.
+vae_decode_modes = ("full", "batched", "tiled")
+
+
+def vae_scale_factor(vae) -> int:
+    return 2 ** (len(vae.config.block_out_channels) - 1)
+
+
+def tile_starts(size: int, tile_size: int, overlap: int) -> list:
+    """Where each tile starts along one side, so that tiles overlap and the last ends at `size`."""
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    return starts + [size - tile_size]
+
+
+def blend_ramp(length: int, ramp: int, start: bool, end: bool, device) -> torch.Tensor:
+    """A tile's weight along one side: ramping up over `ramp` pixels from each blended edge."""
+    weights = torch.ones(length, device=device)
+    ramp = min(ramp, length)
+    if ramp > 0:
+        up = (torch.arange(ramp, device=device, dtype=torch.float32) + 0.5) / ramp
+        if start:
+            weights[:ramp] = torch.minimum(weights[:ramp], up)
+        if end:
+            weights[-ramp:] = torch.minimum(weights[-ramp:], up.flip(0))
+    return weights
+
+
+def decode_fp16_safe(vae, latents: torch.Tensor) -> torch.Tensor:
+    """
+    Decode in the VAE's precision. If an fp16 VAE overflows, only this decode is done again with
+    the VAE in fp32, rather than keeping the whole VAE upcast for every image.
+    """
+    image = vae.decode(latents.to(vae.dtype), return_dict=False)[0]
+    if vae.dtype != torch.float16 or torch.isfinite(image).all():
+        return image
+    logger.debug("The VAE overflowed in fp16, decoding again in fp32.")
+    vae.to(dtype=torch.float32)
+    try:
+        return vae.decode(latents.to(torch.float32), return_dict=False)[0]
+    finally:
+        vae.to(dtype=torch.float16)
+
+
+def tiled_decode(
+    vae, latents: torch.Tensor, tile_size: int = 64, tile_overlap: int = 16
+) -> torch.Tensor:
+    """
+    Decode latents in overlapping tiles of `tile_size` latent pixels, blending the overlaps
+    linearly. The decoder's activations are only ever held for one tile, so peak memory no
+    longer grows with the resolution. The decoder's attention only sees one tile at a time, so
+    results differ slightly from a full-frame decode.
+    """
+    scale = vae_scale_factor(vae)
+    batch, _, height, width = latents.shape
+    output = None
+    weights = torch.zeros(1, 1, height * scale, width * scale, device=latents.device)
+    rows = tile_starts(height, tile_size, tile_overlap)
+    columns = tile_starts(width, tile_size, tile_overlap)
+    for top in rows:
+        for left in columns:
+            tile = decode_fp16_safe(
+                vae, latents[:, :, top : top + tile_size, left : left + tile_size]
+            )
+            if output is None:
+                output = torch.zeros(
+                    batch,
+                    tile.shape[1],
+                    height * scale,
+                    width * scale,
+                    device=latents.device,
+                )
+            ramp = tile_overlap * scale
+            weight = blend_ramp(
+                tile.shape[2], ramp, top != rows[0], top != rows[-1], latents.device
+            )[:, None] * blend_ramp(
+                tile.shape[3],
+                ramp,
+                left != columns[0],
+                left != columns[-1],
+                latents.device,
+            )
+            y, x = top * scale, left * scale
+            output[:, :, y : y + tile.shape[2], x : x + tile.shape[3]] += (
+                tile.float() * weight
+            )
+            weights[:, :, y : y + tile.shape[2], x : x + tile.shape[3]] += weight
+            del tile
+    return output / weights
+
+
+@torch.no_grad()
+def decode_latents(
+    vae,
+    latents: torch.Tensor,
+    mode: str = "full",
+    tile_size: int = 64,
+    tile_overlap: int = 16,
+) -> torch.Tensor:
+    """
+    Decode already-unscaled latents into images in [-1, 1], as `vae.decode(latents).sample`.
+
+    Args:
+        vae: The AutoencoderKL to decode with.
+        latents (torch.Tensor): The latents, (batch, channels, height, width).
+        mode (str): One of `vae_decode_modes`.
+        tile_size (int): The size of a tile in latent pixels, for "tiled".
+        tile_overlap (int): How many latent pixels neighbouring tiles share, for "tiled".
+    """
+    if mode not in vae_decode_modes:
+        raise ValueError(
+            f"Unknown VAE decode mode {mode}, expected {vae_decode_modes}."
+        )
+    if mode == "full":
+        return decode_fp16_safe(vae, latents)
+    images = []
+    for sample in latents.split(1):
+        if mode == "tiled":
+            image = tiled_decode(vae, sample, tile_size, tile_overlap)
+        else:
+            image = decode_fp16_safe(vae, sample)
+        images.append(image.to(latents.dtype))
+    return torch.cat(images)
@@ -2,6 +2,7 @@ import torch
 import logging
 import random
 import os
+from collections import deque
 from helpers.training.multi_process import rank_info
 from helpers.metadata.backends.base import MetadataBackend
 from helpers.image_manipulation.training_sample import TrainingSample
@@ -38,6 +39,7 @@ class MultiAspectSampler(torch.utils.data.Sampler):
         use_captions=True,
         prepend_instance_prompt=False,
         instance_prompt: str = None,
+        lookahead: int = 0,
     ):
         """
         Initializes the sampler with provided settings.
@@ -49,6 +51,7 @@ class MultiAspectSampler(torch.utils.data.Sampler):
         - debug_aspect_buckets: Flag to log state for debugging purposes.
         - delete_unwanted_images: Flag to decide whether to delete unwanted (small) images or just remove from the bucket.
         - minimum_image_size: The minimum pixel length of the smallest side of an image.
+        - lookahead: Number of upcoming batches to draw ahead of time and announce to the VAE cache.
         """
         self.id = id
         if self.id != data_backend.id or self.id != metadata_backend.id:
@@ -80,6 +83,8 @@ class MultiAspectSampler(torch.utils.data.Sampler):
         self.exhausted_buckets = []
         self.buckets = self.load_buckets()
         self.state_manager = BucketStateManager(self.id)
+        self.lookahead = lookahead
+        self._reset_lookahead()
 
     def save_state(self, state_path: str):
         """
@@ -104,6 +109,7 @@ class MultiAspectSampler(torch.utils.data.Sampler):
         except Exception as e:
             raise e
         self.exhausted_buckets = []
+        self._reset_lookahead()
         if "exhausted_buckets" in previous_state:
             self.logger.info(
                 f"Previous checkpoint had {len(previous_state['exhausted_buckets'])} exhausted buckets."
@@ -413,6 +419,7 @@ class MultiAspectSampler(torch.utils.data.Sampler):
                 raise Exception(
                     f"An image was discovered ({image_path}) that did not have its metadata: {self.metadata_backend.get_metadata_by_filepath(image_path)}"
                 )
+            image_metadata = self._select_crop_variant(image_path, image_metadata)
             image_metadata["data_backend_id"] = self.id
             image_metadata["image_path"] = image_path
 
@@ -434,6 +441,30 @@ class MultiAspectSampler(torch.utils.data.Sampler):
             to_yield.append(image_metadata)
         return to_yield
 
+    def _select_crop_variant(self, image_path: str, image_metadata: dict) -> dict:
+        """
+        Pick which of an image's cached crop variants to train on this epoch.
+
+        The choice is seeded by the epoch and image path, so every rank (and a resumed run) picks the
+        same variant, and the crop coordinates given to the model match the latent that collate loads.
+        """
+        crop_variants = StateTracker.get_data_backend_config(self.id).get(
+            "crop_variants", 1
+        )
+        coordinates = image_metadata.get("crop_variant_coordinates")
+        if crop_variants <= 1 or not coordinates or len(coordinates) < crop_variants:
+            return image_metadata
+        crop_variant = random.Random(
+            f"{StateTracker.get_epoch()}:{image_path}"
+        ).randrange(crop_variants)
+        self.debug_log(f"Selected crop variant {crop_variant} for {image_path}")
+        # The stored metadata keeps describing the primary crop.
+        return {
+            **image_metadata,
+            "crop_variant": crop_variant,
+            "crop_coordinates": tuple(coordinates[crop_variant]),
+        }
+
     def _clear_batch_accumulator(self):
         self.batch_accumulator = []
 
@@ -469,10 +500,68 @@ class MultiAspectSampler(torch.utils.data.Sampler):
             outputs.append(conditioning_sample)
         return tuple(outputs)
 
+    def _reset_lookahead(self):
+        self._lookahead_batches = deque()
+        self._lookahead_iterator = None
+        self._lookahead_exhausted = False
+
+    def _announce_lookahead_batch(self, batch: tuple):
+        """
+        Tell the VAE cache which images are coming up, so it can encode them in the background.
+        """
+        vaecache = StateTracker.get_data_backends().get(self.id, {}).get("vaecache")
+        if vaecache is None or getattr(vaecache, "lookahead", None) is None:
+            return
+        vaecache.lookahead.enqueue(
+            [
+                sample["image_path"]
+                for sample in batch
+                if type(sample) is not TrainingSample
+            ]
+        )
+
+    def _fill_lookahead(self):
+        """
+        Draw batches until we hold the next one to yield, plus `self.lookahead` upcoming ones.
+
+        The dataloader builds a new iterator for every step, so the upcoming batches and
+        the generator producing them are kept on the sampler rather than in __iter__.
+        Batches are marked as seen when they are drawn, not when they are trained on.
+        """
+        while (
+            not self._lookahead_exhausted
+            and len(self._lookahead_batches) <= self.lookahead
+        ):
+            if self._lookahead_iterator is None:
+                self._lookahead_iterator = self._iter_batches()
+            try:
+                batch = next(self._lookahead_iterator)
+            except MultiDatasetExhausted:
+                # The epoch ended while looking ahead. Drain what we hold before we report it.
+                self._lookahead_iterator = None
+                self._lookahead_exhausted = True
+                break
+            self._lookahead_batches.append(batch)
+            self._announce_lookahead_batch(batch)
+
     def __iter__(self):
         """
         Iterate over the sampler to yield image paths in batches.
         """
+        if self.lookahead <= 0:
+            yield from self._iter_batches()
+            return
+        while True:
+            self._fill_lookahead()
+            if len(self._lookahead_batches) == 0:
+                self._lookahead_exhausted = False
+                raise MultiDatasetExhausted()
+            yield self._lookahead_batches.popleft()
+
+    def _iter_batches(self):
+        """
+        Generate batches of image metadata, one aspect bucket per batch.
+        """
         self._clear_batch_accumulator()  # Initialize an empty list to accumulate images for a batch
         self.change_bucket()
         while True:
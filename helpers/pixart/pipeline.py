@@ -19,6 +19,7 @@ import urllib.parse as ul
 from typing import Callable, List, Optional, Tuple, Union
 
 import torch
+from helpers.models.vae_decode import decode_latents
 from transformers import T5EncoderModel, T5Tokenizer
 
 from diffusers.image_processor import PixArtImageProcessor, PipelineImageInput
@@ -871,6 +872,7 @@ class PixArtSigmaPipeline(DiffusionPipeline):
         clean_caption: bool = True,
         use_resolution_binning: bool = True,
         max_sequence_length: int = 300,
+        vae_decode: str = "full",
         **kwargs,
     ) -> Union[ImagePipelineOutput, Tuple]:
         """
@@ -967,6 +969,10 @@ class PixArtSigmaPipeline(DiffusionPipeline):
                 `ASPECT_RATIO_1024_BIN`. After the produced latents are decoded into images, they are resized back to
                 the requested resolution. Useful for generating non-square images.
             max_sequence_length (`int` defaults to 300): Maximum sequence length to use with the `prompt`.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -1231,11 +1237,12 @@ class PixArtSigmaPipeline(DiffusionPipeline):
                         callback(step_idx, t, latents)
 
         if not output_type == "latent":
-            image = self.vae.decode(
+            image = decode_latents(
+                self.vae,
                 latents.to(device=self.vae.device, dtype=self.vae.dtype)
                 / self.vae.config.scaling_factor,
-                return_dict=False,
-            )[0]
+                vae_decode,
+            )
             if use_resolution_binning:
                 image = self.image_processor.resize_and_crop_tensor(
                     image, orig_width, orig_height
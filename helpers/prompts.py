@@ -86,11 +86,15 @@ def prompt_library_injection(new_prompts: dict) -> dict:
 import logging
 from helpers.data_backend.base import BaseDataBackend
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 logger = logging.getLogger("PromptHandler")
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
 
+# Compiled caption filter lists, keyed by data backend id.
+compiled_caption_filters = {}
+
 
 class PromptHandler:
     def __init__(
@@ -254,6 +258,14 @@ class PromptHandler:
             raise ValueError(
                 f"Could not locate caption for image {image_path} in sampler_backend {sampler_backend_id} with filename column {filename_column}, caption column {caption_column}, and a parquet database with {len(parquet_db)} entries."
             )
+        return PromptHandler._finalise_parquet_caption(
+            image_caption, prepend_instance_prompt, instance_prompt
+        )
+
+    @staticmethod
+    def _finalise_parquet_caption(
+        image_caption, prepend_instance_prompt: bool, instance_prompt: str = None
+    ):
         if type(image_caption) == bytes:
             image_caption = image_caption.decode("utf-8")
         if image_caption:
@@ -304,26 +316,35 @@ class PromptHandler:
             raise FileNotFoundError(f"Caption file {caption_file} not found.")
         try:
             image_caption = data_backend.read(caption_file)
-            # Convert from bytes to str:
-            if type(image_caption) == bytes:
-                image_caption = image_caption.decode("utf-8")
-
-            # any newlines? split into array
-            if "\n" in image_caption:
-                image_caption = image_caption.split("\n")
-                # Remove any empty strings
-                image_caption = [x for x in image_caption if x]
-
-            if prepend_instance_prompt:
-                if type(image_caption) is list:
-                    image_caption = [instance_prompt + " " + x for x in image_caption]
-                else:
-                    image_caption = instance_prompt + " " + image_caption
-
-            return image_caption
+            return PromptHandler._parse_caption_text(
+                image_caption, prepend_instance_prompt, instance_prompt
+            )
         except Exception as e:
             logger.error(f"Could not read caption file {caption_file}: {e}")
 
+    @staticmethod
+    def _parse_caption_text(
+        image_caption, prepend_instance_prompt: bool, instance_prompt: str = None
+    ):
+        """Turn the contents of a caption textfile into one caption, or a list of them."""
+        # Convert from bytes to str:
+        if type(image_caption) == bytes:
+            image_caption = image_caption.decode("utf-8")
+
+        # any newlines? split into array
+        if "\n" in image_caption:
+            image_caption = image_caption.split("\n")
+            # Remove any empty strings
+            image_caption = [x for x in image_caption if x]
+
+        if prepend_instance_prompt:
+            if type(image_caption) is list:
+                image_caption = [instance_prompt + " " + x for x in image_caption]
+            else:
+                image_caption = instance_prompt + " " + image_caption
+
+        return image_caption
+
     @staticmethod
     def magic_prompt(
         image_path: str,
@@ -393,6 +414,7 @@ class PromptHandler:
         data_backend: BaseDataBackend,
         caption_strategy: str,
         instance_prompt: str = None,
+        max_workers: int = 32,
     ) -> list:
         captions = []
         all_image_files = StateTracker.get_image_files(
@@ -405,12 +427,22 @@ class PromptHandler:
         )
         if type(all_image_files) == list and type(all_image_files[0]) == tuple:
             all_image_files = all_image_files[0][2]
-        from tqdm import tqdm
-
-        # if caption_strategy == "parquet":
-        #     return PromptHandler.retrieve_prompt_column_from_parquet(
-        #         sampler_backend_id=data_backend.id
-        #     )
+        if caption_strategy == "textfile" and use_captions:
+            return PromptHandler._get_all_captions_from_textfiles(
+                all_image_files,
+                instance_data_dir=instance_data_dir,
+                prepend_instance_prompt=prepend_instance_prompt,
+                data_backend=data_backend,
+                instance_prompt=instance_prompt,
+                max_workers=max_workers,
+            )
+        if caption_strategy == "parquet" and use_captions:
+            return PromptHandler._get_all_captions_from_parquet(
+                all_image_files,
+                prepend_instance_prompt=prepend_instance_prompt,
+                data_backend=data_backend,
+                instance_prompt=instance_prompt,
+            )
 
         for image_path in tqdm(
             all_image_files,
@@ -464,6 +496,166 @@ class PromptHandler:
 
         return captions
 
+    @staticmethod
+    def _get_all_captions_from_textfiles(
+        all_image_files,
+        instance_data_dir: str,
+        prepend_instance_prompt: bool,
+        data_backend: BaseDataBackend,
+        instance_prompt: str = None,
+        max_workers: int = 32,
+    ) -> list:
+        """
+        Load the caption textfile of every image.
+
+        The caption files are found with a single listing of the dataset, instead of an existence check
+        per image. Files whose signature (mtime locally, ETag on S3) matches the persisted caption index
+        are taken from the index, and the remainder are read concurrently.
+        """
+        caption_files = [
+            os.path.splitext(str(image_path))[0] + ".txt"
+            for image_path in all_image_files
+        ]
+        signatures = data_backend.list_file_signatures(
+            instance_data_dir=instance_data_dir, file_extensions=["txt"]
+        )
+        previous_index = StateTracker.get_caption_index(data_backend.id)
+        caption_index = {}
+        caption_texts = {}
+        files_to_read = []
+        for caption_file in dict.fromkeys(caption_files):
+            if caption_file not in signatures:
+                # Not in the listing, eg. a path spelt differently. Ask the backend before giving up.
+                if not data_backend.exists(caption_file):
+                    raise FileNotFoundError(f"Caption file {caption_file} not found.")
+                signatures[caption_file] = None
+            signature = signatures[caption_file]
+            index_entry = previous_index.get(caption_file)
+            if (
+                signature is not None
+                and index_entry is not None
+                and index_entry[0] == signature
+            ):
+                caption_texts[caption_file] = index_entry[1]
+                caption_index[caption_file] = index_entry
+            else:
+                files_to_read.append(caption_file)
+
+        def read_caption_file(caption_file):
+            try:
+                image_caption = data_backend.read(caption_file)
+                if type(image_caption) == bytes:
+                    image_caption = image_caption.decode("utf-8")
+                return image_caption
+            except Exception as e:
+                logger.error(f"Could not read caption file {caption_file}: {e}")
+
+        if len(files_to_read) > 0:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for caption_file, image_caption in zip(
+                    files_to_read,
+                    tqdm(
+                        executor.map(read_caption_file, files_to_read),
+                        desc="Loading captions",
+                        total=len(files_to_read),
+                        disable=True if get_rank() > 0 else False,
+                        leave=False,
+                        ncols=125,
+                    ),
+                ):
+                    caption_texts[caption_file] = image_caption
+                    if (
+                        image_caption is not None
+                        and signatures[caption_file] is not None
+                    ):
+                        caption_index[caption_file] = [
+                            signatures[caption_file],
+                            image_caption,
+                        ]
+        logger.debug(
+            f"(id={data_backend.id}) Read {len(files_to_read)} caption files, reused {len(caption_texts) - len(files_to_read)} from the caption index."
+        )
+        if caption_index != previous_index:
+            StateTracker.set_caption_index(
+                data_backend.id, caption_index, save=get_rank() == 0
+            )
+
+        captions = []
+        for caption_file in caption_files:
+            caption = caption_texts[caption_file]
+            if caption is not None:
+                try:
+                    caption = PromptHandler._parse_caption_text(
+                        caption, prepend_instance_prompt, instance_prompt
+                    )
+                except Exception as e:
+                    logger.error(f"Could not read caption file {caption_file}: {e}")
+                    caption = None
+            if type(caption) not in [tuple, list, dict]:
+                captions.append(caption)
+            else:
+                captions.extend(caption)
+
+        return captions
+
+    @staticmethod
+    def _get_all_captions_from_parquet(
+        all_image_files,
+        prepend_instance_prompt: bool,
+        data_backend: BaseDataBackend,
+        instance_prompt: str = None,
+    ) -> list:
+        """
+        Look up the caption of every image in the metadata backend's caption cache.
+
+        This is the same lookup as prepare_instance_prompt_from_parquet, with the backend and
+        parquet configuration resolved once for the whole dataset instead of once per image.
+        """
+        try:
+            metadata_backend = StateTracker.get_data_backend(data_backend.id)[
+                "metadata_backend"
+            ]
+            identifier_includes_extension = StateTracker.get_parquet_database(
+                data_backend.id
+            )[4]
+            caption_cache = metadata_backend.caption_cache
+        except Exception as e:
+            logger.error(
+                f"(id={data_backend.id}) Could not retrieve the parquet caption cache: {e}"
+            )
+            return []
+        instance_data_dir = StateTracker.get_data_backend_config(
+            data_backend_id=data_backend.id
+        ).get("instance_data_dir")
+
+        captions = []
+        for image_path in all_image_files:
+            image_filename_stem = str(image_path)
+            if (
+                instance_data_dir is not None
+                and instance_data_dir in image_filename_stem
+            ):
+                image_filename_stem = image_filename_stem.replace(instance_data_dir, "")
+                if image_filename_stem.startswith("/"):
+                    image_filename_stem = image_filename_stem[1:]
+            if not identifier_includes_extension:
+                image_filename_stem = os.path.splitext(image_filename_stem)[0]
+            image_caption = caption_cache.get(image_filename_stem, None)
+            if instance_prompt is None and not image_caption:
+                continue
+            try:
+                caption = PromptHandler._finalise_parquet_caption(
+                    image_caption, prepend_instance_prompt, instance_prompt
+                )
+            except Exception:
+                continue
+            if type(caption) not in [tuple, list, dict]:
+                captions.append(caption)
+            else:
+                captions.extend(caption)
+
+        return captions
+
     @staticmethod
     def filter_caption(data_backend: BaseDataBackend, caption: str) -> str:
         """Just filter a single caption.
@@ -483,20 +675,30 @@ class PromptHandler:
         return PromptHandler.filter_captions(data_backend, [caption])[0]
 
     @staticmethod
-    def filter_captions(data_backend: BaseDataBackend, captions: list) -> list:
+    def _load_caption_filter_list(data_backend: BaseDataBackend):
         """
-        If the data backend config contains the entry "caption_filter_list", this function will filter the captions.
+        Retrieve the compiled caption filter list for a data backend.
 
-        The caption_filter file contains strings or regular expressions, one per line.
+        Text embed caching filters one prompt at a time, so the filter list is loaded and its patterns
+        compiled once, and then reused until the backend's caption_filter_list (or the file it points to)
+        changes.
 
-        If a line doesn't have any regex control characters in it, we'll treat it as a string.
+        Returns:
+            list: Tuples of (filter_item, search_pattern, replacement, removal_pattern), or None if the
+                backend has no usable filter list.
         """
         data_backend_config = StateTracker.get_data_backend_config(
             data_backend_id=data_backend.id
         )
         caption_filter_list = data_backend_config.get("caption_filter_list", None)
         if not caption_filter_list or caption_filter_list == "":
-            return captions
+            return None
+        cache_key = repr(caption_filter_list)
+        if type(caption_filter_list) == str and os.path.exists(caption_filter_list):
+            cache_key += f":{os.stat(caption_filter_list).st_mtime_ns}"
+        cached_entry = compiled_caption_filters.get(data_backend.id)
+        if cached_entry is not None and cached_entry[0] == cache_key:
+            return cached_entry[1]
         if (
             type(caption_filter_list) == str
             and os.path.splitext(caption_filter_list)[1] == ".json"
@@ -532,11 +734,41 @@ class PromptHandler:
             logger.debug(
                 f"Data backend '{data_backend.id}' has an invalid or empty caption filter list."
             )
-            return captions
-        elif type(caption_filter_list) is not list:
-            raise ValueError(
-                f"Data backend '{data_backend.id}' has an invalid caption filter list: {caption_filter_list}"
+            compiled_caption_filters[data_backend.id] = (cache_key, None)
+            return None
+        # The filters are applied in order, each one to the output of the last, so they can't be
+        # merged into one alternation without changing the result. Instead, compile each one once here.
+        compiled_filters = []
+        for filter_item in caption_filter_list:
+            search_pattern, replacement = None, None
+            # Check for special replace pattern 's/replace/entry/'
+            if filter_item.startswith("s/") and filter_item.count("/") == 2:
+                _, search, replacement = filter_item.split("/")
+                search_pattern = re.compile(search)
+            try:
+                # Assume all filters as regex patterns for flexibility
+                removal_pattern = re.compile(filter_item)
+            except re.error as e:
+                logger.error(f"Regex error with pattern {filter_item}: {e}")
+                removal_pattern = None
+            compiled_filters.append(
+                (filter_item, search_pattern, replacement, removal_pattern)
             )
+        compiled_caption_filters[data_backend.id] = (cache_key, compiled_filters)
+        return compiled_filters
+
+    @staticmethod
+    def filter_captions(data_backend: BaseDataBackend, captions: list) -> list:
+        """
+        If the data backend config contains the entry "caption_filter_list", this function will filter the captions.
+
+        The caption_filter file contains strings or regular expressions, one per line.
+
+        If a line doesn't have any regex control characters in it, we'll treat it as a string.
+        """
+        caption_filter_list = PromptHandler._load_caption_filter_list(data_backend)
+        if caption_filter_list is None:
+            return captions
         # Iterate through each caption
         filtered_captions = []
         for caption in tqdm(
@@ -556,42 +788,24 @@ class PromptHandler:
                     f"Encountered a None caption in the list, data backend: {data_backend.id}"
                 )
                 continue
-            for filter_item in caption_filter_list:
-                # Check for special replace pattern 's/replace/entry/'
-                if filter_item.startswith("s/") and filter_item.count("/") == 2:
-                    _, search, replace = filter_item.split("/")
-                    regex_modified_caption = re.sub(search, replace, modified_caption)
-                    if regex_modified_caption != modified_caption:
-                        # logger.debug(
-                        #     f"Applying regex SEARCH {filter_item} to caption: {modified_caption}"
-                        # )
-                        modified_caption = regex_modified_caption
+            for (
+                filter_item,
+                search_pattern,
+                replacement,
+                removal_pattern,
+            ) in caption_filter_list:
+                if search_pattern is not None:
+                    modified_caption = search_pattern.sub(replacement, modified_caption)
                 else:
                     # Treat as plain string and remove occurrences
-                    if modified_caption is not None:
-                        modified_caption = str(modified_caption).replace(
-                            filter_item, ""
-                        )
-                try:
-                    # Assume all filters as regex patterns for flexibility
-                    pattern = re.compile(filter_item)
+                    modified_caption = str(modified_caption).replace(filter_item, "")
+                if removal_pattern is not None:
                     try:
-                        regex_modified_caption = pattern.sub("", modified_caption)
+                        modified_caption = removal_pattern.sub("", modified_caption)
                     except:
-                        regex_modified_caption = modified_caption
-                    if regex_modified_caption != modified_caption:
-                        # logger.debug(
-                        #     f"Applying regex FILTER {filter_item} to caption: {modified_caption}"
-                        # )
-                        modified_caption = regex_modified_caption
-                except re.error as e:
-                    logger.error(f"Regex error with pattern {filter_item}: {e}")
+                        pass
 
             # Add the modified caption to the filtered list
-            # if caption != modified_caption:
-            #     logger.debug(
-            #         f"After all filters have finished, here is the modified caption: {modified_caption}"
-            #     )
             filtered_captions.append(modified_caption)
 
         # Return the list of modified captions
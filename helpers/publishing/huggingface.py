@@ -3,8 +3,9 @@ import logging
 from pathlib import Path
 from helpers.training.state_tracker import StateTracker
 from helpers.publishing.metadata import save_model_card
+from helpers.publishing.upload_queue import HubUploader, UploadQueue, folder_files
 
-from huggingface_hub import create_repo, upload_folder, upload_file
+from huggingface_hub import create_repo
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", logging.INFO))
@@ -25,6 +26,13 @@ class HubManager:
         self.validation_prompts = None
         self.validation_shortnames = None
         self.collected_data_backend_str = None
+        self.webhook_handler = None
+        # Uploads run in the background, and resume from here if the run is restarted.
+        self.upload_queue = UploadQueue(
+            HubUploader(self._repo_id, token=self.hub_token),
+            state_dir=os.path.join(self.config.output_dir, "publishing"),
+            notify=self._notify,
+        )
 
     def _create_repo(self):
         self._repo_id = create_repo(
@@ -62,24 +70,25 @@ class HubManager:
         self.validation_prompts = validation_prompts
         self.validation_shortnames = validation_shortnames
 
+    def _notify(self, message: str, level: str):
+        webhook_handler = self.webhook_handler or StateTracker.get_webhook_handler()
+        if webhook_handler:
+            webhook_handler.send(message=message, message_level=level)
+
     def upload_validation_folder(self, webhook_handler=None, override_path=None):
-        try:
-            upload_folder(
-                repo_id=self._repo_id,
-                folder_path=os.path.join(
-                    override_path or self.config.output_dir, "assets"
-                ),
-                path_in_repo="assets/",
-                commit_message="Validation images auto-generated by SimpleTuner",
-            )
-        except Exception as e:
-            logger.error(f"Error uploading validation images to Hugging Face Hub: {e}")
+        folder_path = os.path.join(override_path or self.config.output_dir, "assets")
+        if not os.path.isdir(folder_path):
+            return
+        self.webhook_handler = webhook_handler or self.webhook_handler
+        self.upload_queue.enqueue(
+            folder_files(folder_path, "assets"),
+            commit_message="Validation images auto-generated by SimpleTuner",
+            description="validation images",
+            key="assets",
+        )
 
     def upload_model(self, validation_images, webhook_handler=None, override_path=None):
-        if webhook_handler:
-            webhook_handler.send(
-                message=f"Uploading {'model' if override_path is None else 'intermediary checkpoint'} to Hugging Face Hub as `{self.repo_id}`."
-            )
+        self.webhook_handler = webhook_handler or self.webhook_handler
         save_model_card(
             repo_id=self.repo_id,
             images=validation_images,
@@ -94,66 +103,60 @@ class HubManager:
                 "pipeline" if "lora" not in self.config.model_type else "",
             ),
         )
-
-        try:
-            self.upload_validation_folder(
-                webhook_handler=webhook_handler, override_path=override_path
-            )
-        except:
-            logger.error("Error uploading validation images to Hugging Face Hub.")
-
-        attempt = 0
-        while attempt < 3:
-            attempt += 1
-            try:
-                if "lora" not in self.config.model_type:
-                    self.upload_full_model(override_path=override_path)
-                else:
-                    self.upload_lora_model(override_path=override_path)
-                break
-            except Exception as e:
-                if webhook_handler:
-                    webhook_handler.send(
-                        message=f"(attempt {attempt}/3) Error uploading model to Hugging Face Hub: {e}. Retrying..."
-                    )
+        self.upload_validation_folder(
+            webhook_handler=webhook_handler, override_path=override_path
+        )
+        if "lora" not in self.config.model_type:
+            self.upload_full_model(override_path=override_path)
+        else:
+            self.upload_lora_model(override_path=override_path)
         if webhook_handler:
             webhook_handler.send(
-                message=f"Model is now available [on Hugging Face Hub](https://huggingface.co/{self._repo_id})."
+                message=f"Queued the upload of {'the model' if override_path is None else 'an intermediary checkpoint'} to [Hugging Face Hub](https://huggingface.co/{self._repo_id}). {self.upload_queue.status_message()}"
             )
 
     def upload_full_model(self, override_path=None):
-        folder_path = os.path.join(self.config.output_dir, "pipeline")
-        try:
-            upload_folder(
-                repo_id=self._repo_id,
-                folder_path=override_path or folder_path,
-                commit_message=self._commit_message(),
-            )
-        except Exception as e:
-            logger.error(f"Failed to upload pipeline to hub: {e}")
+        folder_path = override_path or os.path.join(self.config.output_dir, "pipeline")
+        # Checkpoints and the final model overwrite one another on the Hub, so a queued one
+        # that hasn't started yet is dropped for a newer one.
+        self.upload_queue.enqueue(
+            folder_files(str(folder_path)),
+            commit_message=self._commit_message(),
+            description="the model" if override_path is None else str(folder_path),
+            key="model",
+        )
 
     def upload_lora_model(self, override_path=None):
-        lora_weights_path = os.path.join(
-            override_path or self.config.output_dir, LORA_SAFETENSORS_FILENAME
+        folder_path = override_path or self.config.output_dir
+        self.upload_queue.enqueue(
+            [
+                (
+                    os.path.join(folder_path, LORA_SAFETENSORS_FILENAME),
+                    LORA_SAFETENSORS_FILENAME,
+                ),
+                (os.path.join(folder_path, "README.md"), "README.md"),
+            ],
+            commit_message=self._commit_message(),
+            description=(
+                "the LoRA weights" if override_path is None else str(folder_path)
+            ),
+            key="model",
         )
-        try:
-            upload_file(
-                repo_id=self._repo_id,
-                path_in_repo=f"/{LORA_SAFETENSORS_FILENAME}",
-                path_or_fileobj=lora_weights_path,
-                commit_message=self._commit_message(),
-            )
-            readme_path = os.path.join(
-                override_path or self.config.output_dir, "README.md"
+
+    def wait_for_uploads(self, timeout: float = None):
+        """Block until every queued upload has finished or failed, eg. before the run exits."""
+        status = self.upload_queue.status()
+        if status["queued"] or status["uploading"]:
+            logger.info(
+                f"Waiting for the Hub uploads to finish. {self.upload_queue.status_message()}"
             )
-            upload_file(
-                repo_id=self._repo_id,
-                path_in_repo="/README.md",
-                path_or_fileobj=readme_path,
-                commit_message="Model card auto-generated by SimpleTuner",
+        if not self.upload_queue.wait(timeout):
+            logger.warning(
+                "The Hub uploads didn't finish in time, the next run with this output_dir will resume them."
             )
-        except Exception as e:
-            logger.error(f"Failed to upload LoRA weights to hub: {e}")
+        failed = self.upload_queue.status()["failed"]
+        if failed:
+            logger.error(f"These Hub uploads failed: {', '.join(failed)}")
 
     def find_latest_checkpoint(self):
         checkpoints = list(Path(self.config.output_dir).rglob("checkpoint-*"))
@@ -182,13 +185,18 @@ class HubManager:
                     webhook_handler=webhook_handler,
                 )
             except Exception as e:
-                logger.error(f"Failed to upload latest checkpoint: {e}")
+                logger.error(f"Failed to queue the latest checkpoint for upload: {e}")
 
     def upload_validation_images(
         self, validation_images, webhook_handler=None, override_path=None
     ):
         logging.info(f"Validation images for upload: {validation_images}")
         if validation_images and len(validation_images) > 0:
+            os.makedirs(
+                os.path.join(override_path or self.config.output_dir, "assets"),
+                exist_ok=True,
+            )
+            image_paths = []
             idx = 0
             for shortname, images in (
                 validation_images.items()
@@ -206,20 +214,15 @@ class HubManager:
                         f"image_{idx}_{sub_idx}.png",
                     )
                     image.save(image_path, format="PNG")
-                    attempt = 0
-                    while attempt < 3:
-                        attempt += 1
-                        try:
-                            upload_file(
-                                repo_id=self._repo_id,
-                                path_in_repo=f"/assets/image_{idx}_{sub_idx}.png",
-                                path_or_fileobj=image_path,
-                                commit_message="Validation image auto-generated by SimpleTuner",
-                            )
-                        except Exception as e:
-                            if webhook_handler:
-                                webhook_handler.send(
-                                    message=f"(attempt {attempt}/3) Error uploading validation image to Hugging Face Hub: {e}. Retrying..."
-                                )
+                    image_paths.append(
+                        (image_path, f"assets/image_{idx}_{sub_idx}.png")
+                    )
                     sub_idx += 1
                     idx += 1
+            self.webhook_handler = webhook_handler or self.webhook_handler
+            self.upload_queue.enqueue(
+                image_paths,
+                commit_message="Validation images auto-generated by SimpleTuner",
+                description="validation images",
+                key="assets",
+            )
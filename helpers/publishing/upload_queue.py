@@ -0,0 +1,479 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from huggingface_hub import CommitOperationAdd, HfApi
+from huggingface_hub.lfs import LFS_HEADERS, UploadInfo, post_lfs_batch_info
+from huggingface_hub.utils import build_hf_headers, get_session
+
+logger = logging.getLogger("UploadQueue")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", logging.INFO))
+
+STATE_NAME = "upload_queue.json"
+PART_ATTEMPTS = 3
+
+
+def sha256_file(path: str, block_size: int = 8 * 1024**2) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def folder_files(folder: str, path_in_repo: str = "") -> list:
+    """(local path, path in the repo) of every file in a folder, with `path_in_repo` as the prefix."""
+    files = []
+    for root, _, names in os.walk(folder):
+        for name in sorted(names):
+            local_path = os.path.join(root, name)
+            relative_path = os.path.relpath(local_path, folder).replace(os.sep, "/")
+            files.append(
+                (
+                    local_path,
+                    "/".join(filter(None, [path_in_repo.strip("/"), relative_path])),
+                )
+            )
+    return files
+
+
+class HubUploader:
+    """
+    Uploads files to a Hub repo. Large files are sent through the LFS batch API in parts, several
+    at a time, and the parts already sent are recorded so that an interrupted upload carries on
+    where it stopped. The commit itself, and small files, go through `HfApi.create_commit`, which
+    finds the large files already on the Hub and doesn't send them again.
+
+    Args:
+        repo_id (str): The repo to upload to.
+        token (str): The Hub token.
+        endpoint (str): The Hub's address. Defaults to huggingface.co.
+        num_threads (int): How many parts of a file are uploaded at once.
+        large_file_size (int): Files from this size up are uploaded in parts. The Hub stores
+            files over 10MB with LFS.
+    """
+
+    def __init__(
+        self,
+        repo_id: str,
+        token: str = None,
+        endpoint: str = None,
+        repo_type: str = "model",
+        revision: str = "main",
+        num_threads: int = 4,
+        large_file_size: int = 10 * 1024**2,
+    ):
+        self.repo_id = repo_id
+        self.token = token
+        self.api = HfApi(endpoint=endpoint, token=token)
+        self.endpoint = self.api.endpoint
+        self.repo_type = repo_type
+        self.revision = revision
+        self.num_threads = num_threads
+        self.large_file_size = large_file_size
+
+    def upload_large_file(
+        self, path: str, sha256: str, size: int, progress: dict, save_progress
+    ) -> int:
+        """
+        Upload a file's content to LFS storage, unless the Hub already has it.
+
+        Args:
+            progress (dict): Where the upload's part URLs and finished parts are kept.
+            save_progress: Called after each part, to persist `progress`.
+
+        Returns:
+            int: The bytes sent.
+        """
+        actions, errors = post_lfs_batch_info(
+            [UploadInfo(sha256=bytes.fromhex(sha256), size=size, sample=b"")],
+            token=self.token,
+            repo_type=self.repo_type,
+            repo_id=self.repo_id,
+            revision=self.revision,
+            endpoint=self.endpoint,
+        )
+        if errors:
+            raise RuntimeError(
+                f"The Hub refused to store {path}: {errors[0]['error']['message']}"
+            )
+        if actions[0].get("actions") is None:
+            logger.debug(f"{path} is already stored on the Hub.")
+            progress.clear()
+            return 0
+        if progress.get("action") is not None:
+            try:
+                return self._upload_parts(path, size, progress, save_progress)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code >= 500:
+                    raise
+                # The part URLs of the interrupted upload have expired.
+                logger.info(f"Starting the upload of {path} again: {e}")
+        progress.clear()
+        progress.update({"action": actions[0], "etags": {}})
+        save_progress()
+        return self._upload_parts(path, size, progress, save_progress)
+
+    def _upload_parts(self, path: str, size: int, progress: dict, save_progress) -> int:
+        upload = progress["action"]["actions"]["upload"]
+        header = upload.get("header") or {}
+        sent = 0
+        if header.get("chunk_size") is None:
+            with open(path, "rb") as f:
+                response = get_session().put(upload["href"], data=f)
+            response.raise_for_status()
+            sent = size
+        else:
+            chunk_size = int(header["chunk_size"])
+            part_urls = [
+                url
+                for _, url in sorted(
+                    (int(name), url) for name, url in header.items() if name.isdigit()
+                )
+            ]
+            if len(part_urls) != math.ceil(size / chunk_size):
+                raise ValueError(f"The Hub sent {len(part_urls)} part URLs for {path}.")
+            etags = progress["etags"]
+            remaining = [
+                number
+                for number in range(1, len(part_urls) + 1)
+                if str(number) not in etags
+            ]
+            error = None
+            with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+                futures = {
+                    pool.submit(
+                        self._upload_part,
+                        path,
+                        part_urls[number - 1],
+                        (number - 1) * chunk_size,
+                        chunk_size,
+                    ): number
+                    for number in remaining
+                }
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    try:
+                        etag, part_size = future.result()
+                    except Exception as e:
+                        # Parts that are already being sent are kept for the next attempt.
+                        error = error or e
+                        for pending in futures:
+                            pending.cancel()
+                        continue
+                    etags[str(futures[future])] = etag
+                    sent += part_size
+                    save_progress()
+            if error is not None:
+                raise error
+            response = get_session().post(
+                upload["href"],
+                json={
+                    "oid": progress["action"]["oid"],
+                    "parts": [
+                        {"partNumber": number, "etag": etags[str(number)]}
+                        for number in range(1, len(part_urls) + 1)
+                    ],
+                },
+                headers=LFS_HEADERS,
+            )
+            response.raise_for_status()
+        verify = progress["action"]["actions"].get("verify")
+        if verify is not None:
+            response = get_session().post(
+                verify["href"],
+                json={"oid": progress["action"]["oid"], "size": size},
+                headers=build_hf_headers(token=self.token),
+            )
+            response.raise_for_status()
+        return sent
+
+    def _upload_part(self, path: str, url: str, offset: int, chunk_size: int):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(chunk_size)
+        for attempt in range(1, PART_ATTEMPTS + 1):
+            try:
+                response = get_session().put(url, data=data)
+                if response.status_code < 500 or attempt == PART_ATTEMPTS:
+                    response.raise_for_status()
+                    return response.headers["ETag"], len(data)
+            except requests.ConnectionError:
+                if attempt == PART_ATTEMPTS:
+                    raise
+            time.sleep(2**attempt)
+
+    def commit(self, files: list, commit_message: str):
+        """Commit (local path, path in the repo) files, sending the small ones."""
+        return self.api.create_commit(
+            repo_id=self.repo_id,
+            repo_type=self.repo_type,
+            revision=self.revision,
+            operations=[
+                CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=path)
+                for path, path_in_repo in files
+            ],
+            commit_message=commit_message,
+            num_threads=self.num_threads,
+        )
+
+
+class UploadQueue:
+    """
+    Uploads to the Hub from a background thread, one job at a time, so training carries on
+    while checkpoints are published.
+
+    The queue, the hashes of what each path in the repo last received, and the progress of
+    large uploads are kept in `state_dir`, so that a restarted run carries on with the jobs and
+    uploads it didn't finish. Files whose content was already published to the same path are
+    skipped.
+
+    Args:
+        uploader (HubUploader): Sends the files.
+        state_dir (str): Where the queue's state is kept.
+        notify: Called with (message, level) when a job finishes or fails.
+        max_attempts (int): How many times a job is tried before it's given up on.
+        retry_delay (float): The seconds between attempts.
+    """
+
+    def __init__(
+        self,
+        uploader: HubUploader,
+        state_dir: str,
+        notify=None,
+        max_attempts: int = 3,
+        retry_delay: float = 30.0,
+    ):
+        self.uploader = uploader
+        self.state_path = os.path.join(state_dir, STATE_NAME)
+        self.notify = notify or (lambda message, level: None)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._condition = threading.Condition()
+        self._closed = False
+        self._running = None
+        # Jobs that have finished, but whose notification hasn't been sent yet.
+        self._notifying = 0
+        self.uploaded_bytes = 0
+        self.skipped_bytes = 0
+        os.makedirs(state_dir, exist_ok=True)
+        self.state = {"next_id": 1, "jobs": [], "failed": [], "published": {}}
+        self.state.update({"hashes": {}, "uploads": {}})
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state.update(json.load(f))
+        if self.state["jobs"]:
+            logger.info(
+                f"Resuming {len(self.state['jobs'])} unfinished Hub uploads: "
+                + ", ".join(job["description"] for job in self.state["jobs"])
+            )
+        self._thread = threading.Thread(
+            target=self._work, name="UploadQueue", daemon=True
+        )
+        self._thread.start()
+
+    def _save(self):
+        with self._condition:
+            temporary_path = f"{self.state_path}.tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(self.state, f)
+            os.replace(temporary_path, self.state_path)
+
+    def enqueue(
+        self, files: list, commit_message: str, description: str, key: str = None
+    ) -> int:
+        """
+        Queue (local path, path in the repo) files for one commit.
+
+        A job that hasn't started yet is dropped when another with the same `key` is queued,
+        eg. an older checkpoint that the newer one would overwrite on the Hub.
+
+        Returns:
+            int: The job's id.
+        """
+        with self._condition:
+            job_id = self.state["next_id"]
+            self.state["next_id"] += 1
+            if key is not None:
+                superseded = [
+                    job
+                    for job in self.state["jobs"]
+                    if job.get("key") == key and job["id"] != self._running
+                ]
+                for job in superseded:
+                    logger.info(f"Dropping the queued upload of {job['description']}.")
+                    self.state["jobs"].remove(job)
+            self.state["jobs"].append(
+                {
+                    "id": job_id,
+                    "key": key,
+                    "description": description,
+                    "commit_message": commit_message,
+                    "files": [list(file) for file in files],
+                    "attempts": 0,
+                }
+            )
+            self._save()
+            self._condition.notify_all()
+        logger.info(f"Queued the upload of {description}.")
+        return job_id
+
+    def status(self) -> dict:
+        with self._condition:
+            running = next(
+                (job for job in self.state["jobs"] if job["id"] == self._running),
+                None,
+            )
+            return {
+                "queued": len(self.state["jobs"]) - (running is not None),
+                "uploading": running["description"] if running else None,
+                "failed": [job["description"] for job in self.state["failed"]],
+                "uploaded_bytes": self.uploaded_bytes,
+                "skipped_bytes": self.skipped_bytes,
+            }
+
+    def status_message(self) -> str:
+        status = self.status()
+        message = f"{status['queued']} Hub uploads queued"
+        if status["uploading"]:
+            message += f", uploading {status['uploading']}"
+        return (
+            f"{message}. {status['uploaded_bytes'] / 1024**3:.2f} GB uploaded and"
+            f" {status['skipped_bytes'] / 1024**3:.2f} GB unchanged so far."
+        )
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait for every queued job to finish or fail. Returns whether they did."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.state["jobs"] or self._notifying:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self):
+        """Stop after the current job. Jobs that are still queued are resumed by the next run."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self.state["jobs"]:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                job = self.state["jobs"][0]
+                self._running = job["id"]
+            start_time = time.perf_counter()
+            try:
+                uploaded, skipped = self._run(job)
+            except Exception as e:
+                self._failed(job, e)
+                continue
+            finally:
+                with self._condition:
+                    self._running = None
+            with self._condition:
+                self.state["jobs"].remove(job)
+                self._save()
+                self._notifying += 1
+            message = (
+                f"Uploaded {job['description']} to the Hub: {uploaded / 1024**3:.2f} GB"
+                f" in {time.perf_counter() - start_time:.0f} seconds,"
+                f" {skipped / 1024**3:.2f} GB unchanged."
+            )
+            logger.info(message)
+            self._send(f"{message} {self.status_message()}", "info")
+
+    def _failed(self, job: dict, error: Exception):
+        with self._condition:
+            job["attempts"] += 1
+            gave_up = (
+                isinstance(error, FileNotFoundError)
+                or job["attempts"] >= self.max_attempts
+            )
+            if gave_up:
+                self.state["jobs"].remove(job)
+                self.state["failed"].append(job)
+            self._save()
+            self._notifying += 1
+        message = (
+            f"(attempt {job['attempts']}/{self.max_attempts}) Error uploading"
+            f" {job['description']} to the Hub: {error}."
+        )
+        logger.error(message)
+        self._send(
+            message + (" Giving up." if gave_up else " Retrying..."),
+            "error" if gave_up else "warning",
+        )
+        if not gave_up:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed, self.retry_delay)
+
+    def _send(self, message: str, level: str):
+        """Send a job's notification, and only then wake anything waiting for the job."""
+        try:
+            self.notify(message, level)
+        finally:
+            with self._condition:
+                self._notifying -= 1
+                self._condition.notify_all()
+
+    def _hash(self, path: str) -> tuple:
+        stat = os.stat(path)
+        cached = self.state["hashes"].get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2], stat.st_size
+        sha256 = sha256_file(path)
+        with self._condition:
+            self.state["hashes"][path] = [stat.st_size, stat.st_mtime_ns, sha256]
+        return sha256, stat.st_size
+
+    def _run(self, job: dict) -> tuple:
+        changed = []
+        skipped = 0
+        for path, path_in_repo in job["files"]:
+            sha256, size = self._hash(path)
+            if self.state["published"].get(path_in_repo) == sha256:
+                skipped += size
+            else:
+                changed.append((path, path_in_repo, sha256, size))
+        uploaded = 0
+        for path, _, sha256, size in changed:
+            if size >= self.uploader.large_file_size:
+                with self._condition:
+                    progress = self.state["uploads"].setdefault(sha256, {})
+                uploaded += self.uploader.upload_large_file(
+                    path, sha256, size, progress, self._save
+                )
+            else:
+                uploaded += size
+        if changed:
+            self.uploader.commit(
+                [(path, path_in_repo) for path, path_in_repo, _, _ in changed],
+                job["commit_message"],
+            )
+        with self._condition:
+            for _, path_in_repo, sha256, _ in changed:
+                self.state["published"][path_in_repo] = sha256
+                self.state["uploads"].pop(sha256, None)
+            # Forget the hashes of files that are gone, eg. checkpoints that were rotated out.
+            for path in [
+                path for path in self.state["hashes"] if not os.path.exists(path)
+            ]:
+                del self.state["hashes"][path]
+            self.uploaded_bytes += uploaded
+            self.skipped_bytes += skipped
+        return uploaded, skipped
@@ -0,0 +1,81 @@
+import importlib
+import logging
+import os
+
+logger = logging.getLogger("LazyRegistry")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+# Top-level modules that are optional dependencies -> the package that provides them.
+optional_requirements = {
+    "optimi": "torch-optimi",
+    "lycoris": "lycoris-lora",
+    "optimum": "optimum-quanto",
+    "wandb": "wandb",
+}
+
+
+def import_object(path: str):
+    """
+    Import an object from its dotted path, eg. "helpers.sdxl.pipeline.StableDiffusionXLPipeline".
+
+    Missing optional dependencies raise an ImportError naming the package to install.
+    """
+    module_name, _, attribute = path.rpartition(".")
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        missing = (e.name or "").split(".")[0]
+        if missing in optional_requirements:
+            raise ImportError(
+                f"{path} requires `{optional_requirements[missing]}`, which is not installed."
+            ) from e
+        raise
+    return getattr(module, attribute)
+
+
+class LazyRegistry:
+    """
+    A mapping of names to the dotted paths of classes, each imported the first time it's used.
+
+    Registering a class doesn't import anything, so that model families, pipelines and optional
+    optimizers only cost startup time when they're chosen.
+    """
+
+    def __init__(self, kind: str, entries: dict = None):
+        """
+        Args:
+            kind (str): What is registered, for error messages, eg. "pipeline".
+            entries (dict): Names mapped to dotted import paths.
+        """
+        self.kind = kind
+        self.entries = {}
+        self.loaded = {}
+        for name, path in (entries or {}).items():
+            self.register(name, path)
+
+    def register(self, name, path: str):
+        self.entries[name] = path
+        self.loaded.pop(name, None)
+
+    def __contains__(self, name) -> bool:
+        return name in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def get(self, name):
+        if name in self.loaded:
+            return self.loaded[name]
+        if name not in self.entries:
+            raise ValueError(
+                f"Unknown {self.kind} {name!r}. Choose from: {', '.join(map(str, self.entries))}"
+            )
+        logger.debug(f"Importing {self.kind} {name!r} from {self.entries[name]}")
+        self.loaded[name] = import_object(self.entries[name])
+        return self.loaded[name]
+
+    def __getitem__(self, name):
+        return self.get(name)
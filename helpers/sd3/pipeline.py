@@ -16,6 +16,7 @@ import inspect
 from typing import Any, Callable, Dict, List, Optional, Union
 
 import torch
+from helpers.models.vae_decode import decode_latents
 from transformers import (
     CLIPTextModelWithProjection,
     CLIPTokenizer,
@@ -733,6 +734,7 @@ class StableDiffusion3Pipeline(
         clip_skip: Optional[int] = None,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
+        vae_decode: str = "full",
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -816,6 +818,10 @@ class StableDiffusion3Pipeline(
                 The list of tensor inputs for the `callback_on_step_end` function. The tensors specified in the list
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -992,7 +998,7 @@ class StableDiffusion3Pipeline(
                 latents / self.vae.config.scaling_factor
             ) + self.vae.config.shift_factor
 
-            image = self.vae.decode(latents.to(self.vae.dtype), return_dict=False)[0]
+            image = decode_latents(self.vae, latents.to(self.vae.dtype), vae_decode)
             image = self.image_processor.postprocess(image, output_type=output_type)
 
         # Offload all models
@@ -1722,6 +1728,7 @@ class StableDiffusion3Img2ImgPipeline(DiffusionPipeline):
         clip_skip: Optional[int] = None,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
+        vae_decode: str = "full",
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -1801,6 +1808,10 @@ class StableDiffusion3Img2ImgPipeline(DiffusionPipeline):
                 The list of tensor inputs for the `callback_on_step_end` function. The tensors specified in the list
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -1969,7 +1980,7 @@ class StableDiffusion3Img2ImgPipeline(DiffusionPipeline):
                 latents / self.vae.config.scaling_factor
             ) + self.vae.config.shift_factor
 
-            image = self.vae.decode(latents.to(self.vae.dtype), return_dict=False)[0]
+            image = decode_latents(self.vae, latents.to(self.vae.dtype), vae_decode)
             image = self.image_processor.postprocess(image, output_type=output_type)
 
         # Offload all models
@@ -16,6 +16,7 @@ import inspect
 import PIL
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from helpers.training.state_tracker import StateTracker
+from helpers.models.vae_decode import decode_latents
 from diffusers.callbacks import PipelineCallback, MultiPipelineCallbacks
 import torch
 from transformers import (
@@ -1019,6 +1020,7 @@ class StableDiffusionXLPipeline(
         clip_skip: Optional[int] = None,
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
+        vae_decode: str = "full",
         **kwargs,
     ):
         r"""
@@ -1153,6 +1155,10 @@ class StableDiffusionXLPipeline(
                 The list of tensor inputs for the `callback_on_step_end` function. The tensors specified in the list
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -1444,8 +1450,11 @@ class StableDiffusionXLPipeline(
 
         if not output_type == "latent":
             # make sure the VAE is in float32 mode, as it overflows in float16
+            # decoding one image or tile at a time only upcasts the decodes that overflow.
             needs_upcasting = (
-                self.vae.dtype == torch.float16 and self.vae.config.force_upcast
+                vae_decode == "full"
+                and self.vae.dtype == torch.float16
+                and self.vae.config.force_upcast
             )
 
             if needs_upcasting:
@@ -1486,9 +1495,9 @@ class StableDiffusionXLPipeline(
             else:
                 latents = latents / self.vae.config.scaling_factor
 
-            image = self.vae.decode(
-                latents.to(dtype=self.vae.dtype), return_dict=False
-            )[0]
+            image = decode_latents(
+                self.vae, latents.to(dtype=self.vae.dtype), vae_decode
+            )
 
             # cast back to fp16 if needed
             if needs_upcasting:
@@ -2492,6 +2501,7 @@ class StableDiffusionXLImg2ImgPipeline(
             ]
         ] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
+        vae_decode: str = "full",
         **kwargs,
     ):
         r"""
@@ -2648,6 +2658,10 @@ class StableDiffusionXLImg2ImgPipeline(
                 The list of tensor inputs for the `callback_on_step_end` function. The tensors specified in the list
                 will be passed as `callback_kwargs` argument. You will only be able to include variables listed in the
                 `._callback_tensor_inputs` attribute of your pipeline class.
+            vae_decode (`str`, *optional*, defaults to `"full"`):
+                How the latents are decoded. `"full"` decodes every image at once, `"batched"` decodes one image at
+                a time, and `"tiled"` decodes one image at a time in overlapping tiles, which bounds the VAE's peak
+                memory at high resolutions. See `helpers.models.vae_decode`.
 
         Examples:
 
@@ -2972,8 +2986,11 @@ class StableDiffusionXLImg2ImgPipeline(
 
         if not output_type == "latent":
             # make sure the VAE is in float32 mode, as it overflows in float16
+            # decoding one image or tile at a time only upcasts the decodes that overflow.
             needs_upcasting = (
-                self.vae.dtype == torch.float16 and self.vae.config.force_upcast
+                vae_decode == "full"
+                and self.vae.dtype == torch.float16
+                and self.vae.config.force_upcast
             )
 
             if needs_upcasting:
@@ -3014,7 +3031,7 @@ class StableDiffusionXLImg2ImgPipeline(
             else:
                 latents = latents / self.vae.config.scaling_factor
 
-            image = self.vae.decode(latents.to(self.vae.dtype), return_dict=False)[0]
+            image = decode_latents(self.vae, latents.to(self.vae.dtype), vae_decode)
 
             # cast back to fp16 if needed
             if needs_upcasting:
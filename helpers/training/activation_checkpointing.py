@@ -0,0 +1,265 @@
+import logging
+import os
+import torch
+import torch.utils.checkpoint
+
+logger = logging.getLogger("ActivationCheckpointing")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+checkpointing_policies = ["full", "every_n", "attention", "mlp", "auto"]
+# The ModuleLists holding the transformer blocks of the models we train.
+block_list_names = ("transformer_blocks", "single_transformer_blocks", "blocks")
+# The children of a block holding its feed-forward layers. Attention children start with "attn".
+mlp_module_names = ("ff", "ff_context")
+
+
+def find_transformer_blocks(model: torch.nn.Module) -> list:
+    blocks = []
+    for name in block_list_names:
+        module_list = getattr(model, name, None)
+        if isinstance(module_list, torch.nn.ModuleList):
+            blocks.extend(module_list)
+    return blocks
+
+
+class SavedActivationCounter(torch.autograd.graph.saved_tensors_hooks):
+    """
+    Count the bytes autograd saves for the backward pass while active, each storage once.
+
+    Tensors sharing storage with `exclude`, eg. parameters and inputs that are held anyway,
+    aren't counted.
+    """
+
+    def __init__(self, exclude=()):
+        self.excluded = {self._storage_key(tensor)[0] for tensor in exclude}
+        self.seen = set()
+        self.bytes = 0
+        super().__init__(self._pack, lambda tensor: tensor)
+
+    @staticmethod
+    def _storage_key(tensor: torch.Tensor):
+        try:
+            storage = tensor.untyped_storage()
+            return storage.data_ptr(), storage.nbytes()
+        except (RuntimeError, NotImplementedError):
+            # Tensor subclasses, eg. quantised weights, may not expose their storage.
+            return id(tensor), tensor.numel() * tensor.element_size()
+
+    def _pack(self, tensor: torch.Tensor):
+        key, nbytes = self._storage_key(tensor)
+        if key not in self.excluded and key not in self.seen:
+            self.seen.add(key)
+            self.bytes += nbytes
+        return tensor
+
+
+class ActivationCheckpointing:
+    """
+    Select which parts of a transformer are recomputed in the backward pass, instead of holding
+    their activations in memory.
+
+    Policies:
+        full: Every transformer block. The model's own gradient checkpointing does the same.
+        every_n: Every `interval`th block, starting with the first.
+        attention: Only the attention layers of each block.
+        mlp: Only the feed-forward layers of each block.
+        auto: Every block for the first steps, while measuring how much memory one block of each
+            type holds without checkpointing. Then, as many blocks as fit in `memory_budget`
+            stop being checkpointed. This needs CUDA memory statistics.
+
+    Selected modules have their forward wrapped, so this works with models whose own
+    gradient checkpointing is disabled, whatever their forward looks like.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        policy: str = "full",
+        interval: int = 2,
+        memory_budget: float = None,
+        profile_steps: int = 2,
+    ):
+        """
+        Args:
+            model: The transformer.
+            policy (str): One of `checkpointing_policies`.
+            interval (int): The block interval for the "every_n" policy.
+            memory_budget (float): The peak device memory, in GB, that the "auto" policy fits to.
+            profile_steps (int): The number of training steps the "auto" policy measures before
+                fitting, so that lazily created optimizer states are included.
+        """
+        if policy not in checkpointing_policies:
+            raise ValueError(
+                f"Unknown checkpointing policy '{policy}'. Choose from: {', '.join(checkpointing_policies)}"
+            )
+        if policy == "every_n" and interval < 1:
+            raise ValueError("The checkpointing interval must be at least 1.")
+        if policy == "auto" and memory_budget is None:
+            raise ValueError("The auto checkpointing policy requires a memory budget.")
+        self.model = model
+        self.policy = policy
+        self.interval = interval
+        self.memory_budget = memory_budget
+        self.profile_steps = profile_steps
+        self.blocks = find_transformer_blocks(model)
+        # module -> the forward it had before being wrapped
+        self.original_forwards = {}
+        # block class -> bytes of activations it holds without checkpointing
+        self.block_activation_bytes = {}
+        self.pending_measurements = set()
+        self.steps = 0
+        self.fitted = policy != "auto"
+
+    def targets(self) -> list:
+        """The modules the policy checkpoints."""
+        if self.policy in ["full", "auto"]:
+            return list(self.blocks)
+        if self.policy == "every_n":
+            return [
+                block
+                for index, block in enumerate(self.blocks)
+                if index % self.interval == 0
+            ]
+        return [
+            module
+            for block in self.blocks
+            for name, module in block.named_children()
+            if (
+                name.startswith("attn")
+                if self.policy == "attention"
+                else name in mlp_module_names
+            )
+        ]
+
+    def apply(self):
+        if not self.blocks:
+            raise ValueError(
+                f"{type(self.model).__name__} has no transformer blocks that can be checkpointed selectively."
+            )
+        for module in self.targets():
+            self._wrap(module)
+        if self.policy == "auto":
+            self.pending_measurements = {type(block) for block in self.blocks}
+        logger.info(self.report())
+        return self
+
+    def remove(self):
+        """Restore the original forward of every wrapped module."""
+        for module in list(self.original_forwards):
+            self._unwrap(module)
+
+    def _wrap(self, module: torch.nn.Module):
+        if module in self.original_forwards:
+            return
+        self.original_forwards[module] = module.__dict__.get("forward")
+        forward = module.forward
+
+        def checkpointed_forward(*args, **kwargs):
+            return self._forward(module, forward, *args, **kwargs)
+
+        module.forward = checkpointed_forward
+
+    def _unwrap(self, module: torch.nn.Module):
+        original_forward = self.original_forwards.pop(module)
+        if original_forward is None:
+            del module.forward
+        else:
+            module.forward = original_forward
+
+    def _forward(self, module, forward, *args, **kwargs):
+        if not (module.training and torch.is_grad_enabled()):
+            return forward(*args, **kwargs)
+        if type(module) in self.pending_measurements:
+            self.pending_measurements.discard(type(module))
+            return self._measure(module, forward, *args, **kwargs)
+        return torch.utils.checkpoint.checkpoint(
+            forward, *args, use_reentrant=False, **kwargs
+        )
+
+    def _measure(self, module, forward, *args, **kwargs):
+        """Run a block without checkpointing, recording the activations it holds."""
+        inputs = [
+            value
+            for value in (*args, *kwargs.values())
+            if isinstance(value, torch.Tensor)
+        ]
+        counter = SavedActivationCounter(exclude=[*module.parameters(), *inputs])
+        with counter:
+            output = forward(*args, **kwargs)
+        self.block_activation_bytes[type(module)] = counter.bytes
+        logger.debug(
+            f"A {type(module).__name__} holds {counter.bytes / 1024**3:.3f} GB of activations without checkpointing."
+        )
+        return output
+
+    def step(self, device):
+        """Record a completed training step. The auto policy fits itself once it has seen enough."""
+        self.steps += 1
+        if self.fitted or self.steps < self.profile_steps:
+            return
+        device = torch.device(device)
+        if device.type != "cuda":
+            self.fitted = True
+            logger.warning(
+                f"The auto checkpointing policy can't measure peak memory on {device.type}, every block stays checkpointed."
+            )
+            return
+        self.fit(torch.cuda.max_memory_allocated(device))
+
+    def fit(self, peak_memory: int):
+        """
+        Stop checkpointing as many blocks as the memory budget allows.
+
+        Args:
+            peak_memory (int): The peak device memory, in bytes, while every block was checkpointed.
+        """
+        self.fitted = True
+        headroom = self.memory_budget * 1024**3 - peak_memory
+        released = 0
+        # Blocks are released from the end, which holds the same memory as any other choice.
+        for block in reversed(self.blocks):
+            cost = self.block_activation_bytes.get(type(block))
+            if block not in self.original_forwards:
+                continue
+            if cost is None or cost > headroom:
+                break
+            headroom -= cost
+            self._unwrap(block)
+            released += 1
+        logger.info(
+            f"Peak memory with every block checkpointed was {peak_memory / 1024**3:.2f} GB,"
+            f" the budget is {self.memory_budget:.2f} GB."
+            f" {released} blocks no longer need to be checkpointed."
+        )
+        logger.info(self.report())
+        return released
+
+    def summary(self) -> dict:
+        checkpointed = set(self.original_forwards)
+        checkpointed_blocks = [
+            block
+            for block in self.blocks
+            if block in checkpointed
+            or any(module in checkpointed for module in block.children())
+        ]
+        return {
+            "policy": self.policy,
+            "blocks": len(self.blocks),
+            "checkpointed_blocks": len(checkpointed_blocks),
+            "checkpointed_modules": len(checkpointed),
+            "block_activation_gb": {
+                block_class.__name__: nbytes / 1024**3
+                for block_class, nbytes in self.block_activation_bytes.items()
+            },
+        }
+
+    def report(self) -> str:
+        summary = self.summary()
+        report = (
+            f"Activation checkpointing policy '{self.policy}':"
+            f" {summary['checkpointed_modules']} modules in {summary['checkpointed_blocks']}"
+            f" of {summary['blocks']} transformer blocks are recomputed in the backward pass."
+        )
+        for block_class, size in summary["block_activation_gb"].items():
+            report += f" Each {block_class} holds {size:.3f} GB of activations unless checkpointed."
+        return report
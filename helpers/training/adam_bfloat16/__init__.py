@@ -1,5 +1,5 @@
 """
-Different versions appeared, 
+Different versions appeared,
 they have identical interface, but sutiable for different scenarios.
 """
 
@@ -32,6 +32,7 @@ class AdamWBF16(Optimizer):
         betas=(0.9, 0.999),
         eps=1e-8,
         weight_decay=0,
+        foreach: bool = True,
     ):
         """
         Implements AdamW optimization specifically for bfloat16 models.
@@ -41,6 +42,8 @@ class AdamWBF16(Optimizer):
         Uses only one additional bfloat16 weight for keeping correction.
         Do not use schedulers - those can't affect cuda graphs.
         :param lr_function: a callable that maps torch scalar (step) to torch scalar (learning rate)
+        :param foreach: update all parameters of a group at once using multi-tensor ops,
+            with scratch buffers that are reused across steps. Not used on MPS.
         """
         if not 0.0 <= eps:
             raise ValueError(f"Invalid epsilon value: {eps}")
@@ -50,67 +53,179 @@ class AdamWBF16(Optimizer):
             raise ValueError(f"Invalid beta parameter at index 1: {betas[1]}")
         if not 0.0 <= weight_decay:
             raise ValueError(f"Invalid weight_decay value: {weight_decay}")
-        defaults = dict(betas=betas, eps=eps, weight_decay=weight_decay, lr=lr)
+        defaults = dict(
+            betas=betas, eps=eps, weight_decay=weight_decay, lr=lr, foreach=foreach
+        )
         super().__init__(params, defaults)
+        # Scratch space for the foreach update, keyed by (param group, device).
+        self._foreach_buffers = {}
+
+    def _init_state(self, p):
+        state = self.state[p]
+        # Lazy state initialization
+        if len(state) == 0:
+            assert p.dtype == torch.bfloat16, "only bfloat 16 is supported."
+            state["step"] = 0.0
+            # Exponential moving average of gradient values
+            state["exp_avg"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            # Exponential moving average of squared gradient values
+            state["exp_avg_sq"] = torch.zeros_like(
+                p, memory_format=torch.preserve_format
+            )
+            # accumulated shift that should be added to p, but wasn't because of truncation
+            # true value is p + shift
+            state["shift"] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            # using decay at each step will work only for float32, so we just remember how much owe to decay
+            # and decay once in n iterations
+            # Each weight has its own starting point to avoid simultaneous updates in all weights
+            state["accumulated_decay"] = (torch.rand([]) * self.decay_threshold).to(
+                device=p.device
+            )
+        elif not torch.is_tensor(state["accumulated_decay"]):
+            # Older optimizer states kept this as a Python float.
+            state["accumulated_decay"] = torch.tensor(
+                state["accumulated_decay"], dtype=torch.float32, device=p.device
+            )
+        elif state["accumulated_decay"].dtype != torch.float32:
+            # load_state_dict casts floating point state to the dtype of the parameter.
+            state["accumulated_decay"] = state["accumulated_decay"].float()
+        return state
 
     @torch.no_grad()
     def step(self, zero_grad: bool = False):
         """Performs a single optimization step."""
-        for group in self.param_groups:
+        for group_idx, group in enumerate(self.param_groups):
+            params = [p for p in group["params"] if p.grad is not None]
+            if group.get("foreach", True):
+                params_by_device = {}
+                for p in params:
+                    if p.device.type != "mps":
+                        params_by_device.setdefault(p.device, []).append(p)
+                for device, device_params in params_by_device.items():
+                    self._foreach_step(
+                        group_idx, group, device, device_params, zero_grad
+                    )
+                # MPS relies on workarounds in the per-tensor stochastic helpers.
+                params = [p for p in params if p.device.type == "mps"]
             beta1, beta2 = group["betas"]
 
-            for p in group["params"]:
-                if p.grad is not None:
-                    state = self.state[p]
-                    # Lazy state initialization
-                    if len(state) == 0:
-                        assert p.dtype == torch.bfloat16, "only bfloat 16 is supported."
-                        state["step"] = 0.0
-                        # Exponential moving average of gradient values
-                        state["exp_avg"] = torch.zeros_like(
-                            p, memory_format=torch.preserve_format
-                        )
-                        # Exponential moving average of squared gradient values
-                        state["exp_avg_sq"] = torch.zeros_like(
-                            p, memory_format=torch.preserve_format
-                        )
-                        # accumulated shift that should be added to p, but wasn't because of truncation
-                        # true value is p + shift
-                        state["shift"] = torch.zeros_like(
-                            p, memory_format=torch.preserve_format
-                        )
-                        # using decay at each step will work only for float32, so we just remember how much owe to decay
-                        # and decay once in n iterations
-                        # Each weight has its own starting point to avoid simultaneous updates in all weights
-                        state["accumulated_decay"] = float(
-                            torch.rand([]) * self.decay_threshold
-                        )
-
-                    grad = p.grad
-                    state["step"] += 1
-                    lr = group["lr"]
-
-                    state["accumulated_decay"] += group["weight_decay"] * lr
-                    accum_decay = state["accumulated_decay"]
-                    decay_this_iteration = (
-                        accum_decay > self.decay_threshold
-                    ) * accum_decay
-                    state["accumulated_decay"] -= decay_this_iteration
-
-                    _make_step(
-                        grad,
-                        p,
-                        state["shift"],
-                        state["exp_avg"],
-                        state["exp_avg_sq"],
-                        beta1=beta1,
-                        beta2=beta2,
-                        step=state["step"],
-                        lr=lr,
-                        eps=group["eps"],
-                        decay_this_iteration=decay_this_iteration,
-                        zero_grad=zero_grad,
-                    )
+            for p in params:
+                state = self._init_state(p)
+                grad = p.grad
+                state["step"] += 1
+                lr = group["lr"]
+
+                accumulated_decay = state["accumulated_decay"]
+                accumulated_decay.add_(group["weight_decay"] * lr)
+                decay_this_iteration = torch.where(
+                    accumulated_decay > self.decay_threshold,
+                    accumulated_decay,
+                    torch.zeros_like(accumulated_decay),
+                )
+                accumulated_decay.sub_(decay_this_iteration)
+
+                _make_step(
+                    grad,
+                    p,
+                    state["shift"],
+                    state["exp_avg"],
+                    state["exp_avg_sq"],
+                    beta1=beta1,
+                    beta2=beta2,
+                    step=state["step"],
+                    lr=lr,
+                    eps=group["eps"],
+                    decay_this_iteration=decay_this_iteration,
+                    zero_grad=zero_grad,
+                )
+
+    def _get_foreach_buffers(self, group_idx: int, device, params: list, states: list):
+        """
+        Retrieve the scratch buffers for a set of parameters, allocating them on first use.
+
+        The buffers are flat, so the stochastic rounding can be done in three kernels for the whole
+        set, and they're only reallocated when the set of parameters being stepped changes.
+        The accumulated decay of every parameter is gathered into one float32 tensor, and each
+        parameter's state holds a view of its element.
+        """
+        key = (group_idx, device)
+        buffers = self._foreach_buffers.get(key)
+        if (
+            buffers is not None
+            and len(buffers["params"]) == len(params)
+            and all(a is b for a, b in zip(buffers["params"], params))
+            and all(
+                a is state["accumulated_decay"]
+                for a, state in zip(buffers["decay_views"], states)
+            )
+        ):
+            return buffers
+        numel = sum(p.numel() for p in params)
+        fp32_buffer = torch.empty(numel, dtype=torch.float32, device=device)
+        bf16_buffer = torch.empty(numel, dtype=torch.bfloat16, device=device)
+        noise_buffer = torch.empty(numel, dtype=torch.int32, device=device)
+        fp32_views, bf16_views = [], []
+        offset = 0
+        for p in params:
+            fp32_views.append(fp32_buffer[offset : offset + p.numel()].view_as(p))
+            bf16_views.append(bf16_buffer[offset : offset + p.numel()].view_as(p))
+            offset += p.numel()
+        accumulated_decay = torch.stack(
+            [
+                state["accumulated_decay"].to(device=device, dtype=torch.float32)
+                for state in states
+            ]
+        )
+        decay_views = list(accumulated_decay.unbind())
+        for state, decay_view in zip(states, decay_views):
+            state["accumulated_decay"] = decay_view
+        buffers = {
+            "params": list(params),
+            "fp32": fp32_buffer,
+            "noise": noise_buffer,
+            "fp32_views": fp32_views,
+            "bf16_views": bf16_views,
+            "accumulated_decay": accumulated_decay,
+            "decay_views": decay_views,
+        }
+        self._foreach_buffers[key] = buffers
+        return buffers
+
+    def _foreach_step(
+        self, group_idx: int, group: dict, device, params: list, zero_grad: bool
+    ):
+        states = [self._init_state(p) for p in params]
+        buffers = self._get_foreach_buffers(group_idx, device, params, states)
+        beta1, beta2 = group["betas"]
+        lr = group["lr"]
+        for state in states:
+            state["step"] += 1
+
+        # The decay owed to each parameter, as a tensor so that checking it needs no sync.
+        accumulated_decay = buffers["accumulated_decay"]
+        accumulated_decay.add_(group["weight_decay"] * lr)
+        decay_this_iteration = torch.where(
+            accumulated_decay > self.decay_threshold,
+            accumulated_decay,
+            torch.zeros_like(accumulated_decay),
+        )
+        accumulated_decay.sub_(decay_this_iteration)
+
+        _make_step_foreach(
+            [p.grad for p in params],
+            params,
+            [state["shift"] for state in states],
+            [state["exp_avg"] for state in states],
+            [state["exp_avg_sq"] for state in states],
+            buffers,
+            beta1=beta1,
+            beta2=beta2,
+            steps=[state["step"] for state in states],
+            lr=lr,
+            eps=group["eps"],
+            decay_this_iteration=list(decay_this_iteration.unbind()),
+            zero_grad=zero_grad,
+        )
 
 
 def _make_step(
@@ -124,7 +239,7 @@ def _make_step(
     step: float,
     lr: float,
     eps: float,
-    decay_this_iteration: float,
+    decay_this_iteration,
     zero_grad: bool,
 ):
     # Originally:
@@ -158,10 +273,83 @@ def _make_step(
     # shift.add_(buffer.sub_(p))
     add_stochastic_(shift, buffer.sub_(p))
 
-    if decay_this_iteration > 0:
+    if torch.is_tensor(decay_this_iteration):
+        # This is zero on most steps, but multiplying by it is cheaper than a sync to find out.
+        shift.addcmul_(p, decay_this_iteration, value=-1)
+    elif decay_this_iteration > 0:
         shift.add_(p, alpha=-decay_this_iteration)
         # Do NOT do this, it will cause the model to become unstable.
         # add_stochastic_(shift, p, alpha=-decay_this_iteration)
 
     if zero_grad:
         grad.zero_()
+
+
+def _copy_stochastic_foreach_(targets: list, buffers: dict):
+    """Stochastically round the float32 scratch buffer into the bfloat16 targets, see copy_stochastic_."""
+    # add a random 16 bit integer to the lower 16 bit of the mantissa, then mask them off
+    noise = buffers["noise"].random_(0, 1 << 16)
+    result = buffers["fp32"].view(dtype=torch.int32)
+    result.add_(noise)
+    result.bitwise_and_(-65536)  # -65536 = FFFF0000 as a signed int32
+    torch._foreach_copy_(targets, buffers["fp32_views"])
+
+
+def _make_step_foreach(
+    grads: list,
+    params: list,
+    shifts: list,
+    exp_avgs: list,
+    exp_avg_sqs: list,
+    buffers: dict,
+    beta1: float,
+    beta2: float,
+    steps: list,
+    lr: float,
+    eps: float,
+    decay_this_iteration: list,
+    zero_grad: bool,
+):
+    """The same update as _make_step, for a list of parameters at once."""
+    results = buffers["fp32_views"]
+    scratch = buffers["bf16_views"]
+
+    # add_stochastic_(exp_avg, grad, alpha=1 - beta1)
+    torch._foreach_mul_(exp_avgs, beta1)
+    torch._foreach_copy_(results, grads)
+    torch._foreach_add_(results, exp_avgs, alpha=1 - beta1)
+    _copy_stochastic_foreach_(exp_avgs, buffers)
+
+    torch._foreach_mul_(exp_avg_sqs, beta2)
+    torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+    # addcdiv_stochastic_(shift, exp_avg, exp_avg_sq.sqrt() + eps, value=-lr * denom_correction)
+    torch._foreach_copy_(scratch, exp_avg_sqs)
+    torch._foreach_sqrt_(scratch)
+    torch._foreach_add_(scratch, eps)
+    torch._foreach_copy_(results, shifts)
+    torch._foreach_addcdiv_(
+        results,
+        exp_avgs,
+        scratch,
+        [-lr * (1 - beta2**step) ** 0.5 for step in steps],
+    )
+    _copy_stochastic_foreach_(shifts, buffers)
+
+    # add_stochastic_(p, shift), keeping the old value of p in the scratch space
+    torch._foreach_copy_(scratch, params)
+    torch._foreach_copy_(results, shifts)
+    torch._foreach_add_(results, params)
+    _copy_stochastic_foreach_(params, buffers)
+
+    # add_stochastic_(shift, buffer.sub_(p))
+    torch._foreach_sub_(scratch, params)
+    torch._foreach_copy_(results, scratch)
+    torch._foreach_add_(results, shifts)
+    _copy_stochastic_foreach_(shifts, buffers)
+
+    # shift.add_(p, alpha=-decay_this_iteration), where the decay is zero for most parameters on most steps
+    torch._foreach_addcmul_(shifts, params, decay_this_iteration, value=-1)
+
+    if zero_grad:
+        torch._foreach_zero_(grads)
@@ -1,3 +1,4 @@
+import json
 import peft
 import torch
 import safetensors.torch
@@ -115,4 +116,43 @@ def load_lora_weights(dictionary, filename, loraKey="default", use_dora=False):
                 missing_keys.remove(k)
             else:
                 additional_keys.add(k)
-    return (additional_keys, missing_keys)
\ No newline at end of file
+    return (additional_keys, missing_keys)
+
+
+def load_lycoris_config(lycoris_config_path: str):
+    """
+    Read a --lycoris_config file, and apply its preset to LycorisNetwork.
+
+    Returns:
+        tuple: (multiplier, linear_dim, linear_alpha, the remaining create_lycoris kwargs)
+    """
+    from lycoris import LycorisNetwork
+
+    with open(lycoris_config_path, "r") as f:
+        lycoris_config = json.load(f)
+
+    assert (
+        "multiplier" in lycoris_config
+    ), "lycoris_config JSON must contain multiplier key"
+    multiplier = int(lycoris_config["multiplier"])
+    assert (
+        "linear_dim" in lycoris_config
+    ), "lycoris_config JSON must contain linear_dim key"
+    linear_dim = int(lycoris_config["linear_dim"])
+    assert (
+        "linear_alpha" in lycoris_config
+    ), "lycoris_config JSON must contain linear_alpha key"
+    linear_alpha = int(lycoris_config["linear_alpha"])
+
+    apply_preset = lycoris_config.get("apply_preset", None)
+    if apply_preset is not None and apply_preset != {}:
+        LycorisNetwork.apply_preset(apply_preset)
+
+    # This is a kwarg, but mandatory.
+    assert "algo" in lycoris_config, "lycoris_config JSON must contain algo key"
+
+    # Remove the positional arguments we extracted.
+    del lycoris_config["multiplier"]
+    del lycoris_config["linear_dim"]
+    del lycoris_config["linear_alpha"]
+    return multiplier, linear_dim, linear_alpha, lycoris_config
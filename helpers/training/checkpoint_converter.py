@@ -0,0 +1,210 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from safetensors import safe_open
+
+from helpers.training.checkpoint_writer import safetensors_dtypes, stream_safetensors
+
+logger = logging.getLogger("CheckpointConverter")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
+
+# How a converted tensor is built from the tensors it's converted from.
+RESHAPE_FOR_SD = "reshape_for_sd"
+CONCATENATE = "concatenate"
+float_dtypes = {"F64", "F32", "F16", "BF16", "F8_E4M3", "F8_E5M2"}
+
+
+def transform_tensors(transform: str, tensors: list) -> torch.Tensor:
+    if transform is None:
+        return tensors[0]
+    if transform == RESHAPE_FOR_SD:
+        # HF linear weights to SD conv2d weights.
+        return tensors[0].reshape(*tensors[0].shape, 1, 1)
+    if transform == CONCATENATE:
+        return torch.cat(tensors)
+    raise ValueError(f"Unknown conversion transform: {transform}")
+
+
+def transform_shape(transform: str, shapes: list) -> list:
+    if transform is None:
+        return list(shapes[0])
+    if transform == RESHAPE_FOR_SD:
+        return list(shapes[0]) + [1, 1]
+    if transform == CONCATENATE:
+        return [sum(shape[0] for shape in shapes)] + list(shapes[0][1:])
+    raise ValueError(f"Unknown conversion transform: {transform}")
+
+
+def apply_conversion_table(table: dict, state_dict: dict) -> dict:
+    """Convert an in-memory state dict with a table of output name -> (transform, input names)."""
+    return {
+        output_name: transform_tensors(
+            transform, [state_dict[name] for name in input_names]
+        )
+        for output_name, (transform, input_names) in table.items()
+    }
+
+
+def find_weights(directory: str, file_names: list) -> str:
+    """The first of `file_names` that exists in `directory`."""
+    for file_name in file_names:
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"None of {file_names} were found in {directory}.")
+
+
+class TensorSource:
+    """
+    Reads the tensors of a weights file one at a time. Safetensors files are memory-mapped, as are
+    PyTorch files saved in the zip format, so a tensor is only read when it's asked for.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._state_dict = None
+        if path.endswith(".safetensors"):
+            self._file = safe_open(path, framework="pt", device="cpu")
+            return
+        try:
+            self._state_dict = torch.load(
+                path, map_location="cpu", mmap=True, weights_only=True
+            )
+        except RuntimeError:
+            # Files saved in the legacy format can't be memory-mapped.
+            self._state_dict = torch.load(path, map_location="cpu", weights_only=True)
+
+    def keys(self) -> tuple:
+        if self._file is not None:
+            return tuple(self._file.keys())
+        return tuple(self._state_dict.keys())
+
+    def spec(self, name: str):
+        """The safetensors dtype and the shape of a tensor, without reading it."""
+        if self._file is not None:
+            tensor_slice = self._file.get_slice(name)
+            return tensor_slice.get_dtype(), list(tensor_slice.get_shape())
+        tensor = self._state_dict[name]
+        return safetensors_dtypes[tensor.dtype], list(tensor.shape)
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        if self._file is not None:
+            return self._file.get_tensor(name)
+        return self._state_dict[name]
+
+
+class CheckpointConversion:
+    """
+    Converts tensors from a set of weights files into a single checkpoint, following a table
+    that's built once from the source keys.
+
+    Args:
+        sources (dict): The TensorSource of each component, by name.
+        table (dict): output name -> (component, transform, input names).
+        half (bool): Whether floating-point tensors are saved in half precision.
+    """
+
+    def __init__(self, sources: dict, table: dict, half: bool = False):
+        self.sources = sources
+        self.table = table
+        self.half = half
+
+    def tensor_specs(self) -> list:
+        specs = []
+        for output_name, (component, transform, input_names) in self.table.items():
+            input_specs = [self.sources[component].spec(name) for name in input_names]
+            dtype = input_specs[0][0]
+            if self.half and dtype in float_dtypes:
+                dtype = "F16"
+            specs.append(
+                (
+                    output_name,
+                    dtype,
+                    transform_shape(transform, [shape for _, shape in input_specs]),
+                )
+            )
+        return specs
+
+    def get_tensor(self, output_name: str) -> torch.Tensor:
+        component, transform, input_names = self.table[output_name]
+        tensor = transform_tensors(
+            transform,
+            [self.sources[component].get_tensor(name) for name in input_names],
+        )
+        if self.half and tensor.is_floating_point():
+            tensor = tensor.half()
+        return tensor
+
+    def save(self, path: str, use_safetensors: bool = True) -> int:
+        """
+        Write the converted checkpoint. Safetensors output is streamed one tensor at a time, while
+        a .ckpt has to be built in memory for torch.save.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        temporary_path = f"{path}.tmp-{os.getpid()}"
+        if use_safetensors:
+            written = stream_safetensors(
+                temporary_path,
+                self.tensor_specs(),
+                self.get_tensor,
+                metadata={"format": "pt"},
+            )
+        else:
+            torch.save(
+                {"state_dict": {name: self.get_tensor(name) for name in self.table}},
+                temporary_path,
+            )
+            written = os.path.getsize(temporary_path)
+        os.replace(temporary_path, path)
+        return written
+
+
+def _timed_conversion(convert, model_path: str, checkpoint_path: str, kwargs: dict):
+    start_time = time.perf_counter()
+    written = convert(model_path, checkpoint_path, **kwargs)
+    return model_path, checkpoint_path, written, time.perf_counter() - start_time
+
+
+def convert_checkpoints(convert, jobs: list, num_workers: int = 1, **kwargs) -> list:
+    """
+    Run `convert(model_path, checkpoint_path, **kwargs)` for each (model_path, checkpoint_path)
+    job, in a pool of processes, and report the throughput of each conversion and the batch.
+
+    Returns:
+        list: (model_path, checkpoint_path, bytes written, seconds) for each job.
+    """
+    start_time = time.perf_counter()
+    results = []
+    if num_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(jobs))) as pool:
+            futures = [
+                pool.submit(_timed_conversion, convert, model_path, path, kwargs)
+                for model_path, path in jobs
+            ]
+            for future in futures:
+                results.append(future.result())
+                _log_result(*results[-1])
+    else:
+        for model_path, path in jobs:
+            results.append(_timed_conversion(convert, model_path, path, kwargs))
+            _log_result(*results[-1])
+    total_bytes = sum(result[2] for result in results)
+    seconds = time.perf_counter() - start_time
+    logger.info(
+        f"Converted {len(results)} checkpoints, {total_bytes / 1024**3:.2f} GB, in {seconds:.1f} seconds"
+        f" ({total_bytes / 1024**3 / max(seconds, 1e-6):.2f} GB/s)."
+    )
+    return results
+
+
+def _log_result(model_path, checkpoint_path, written, seconds):
+    logger.info(
+        f"Converted {model_path} to {checkpoint_path}: {written / 1024**3:.2f} GB in {seconds:.1f} seconds"
+        f" ({written / 1024**3 / max(seconds, 1e-6):.2f} GB/s)."
+    )
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import time
+from contextlib import ExitStack
+
+import torch
+from safetensors import safe_open
+
+from helpers.training.checkpoint_store import CheckpointStore, has_manifest
+from helpers.training.checkpoint_writer import WEIGHTS_NAME
+
+logger = logging.getLogger("CheckpointLoader")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
+
+# Checkpoint metadata recording which tensors still hold the base model's weights.
+UNCHANGED_FROM_BASE_KEY = "unchanged_from_base"
+BASE_MODEL_KEY = "base_model"
+
+
+class CheckpointReader:
+    """
+    Reads the tensors of a saved model one at a time, without loading the whole model.
+
+    Supports a single safetensors file, sharded safetensors files with an index, and manifests
+    written with --deduplicate_checkpoints. Safetensors files and stored tensors are memory-mapped,
+    so a tensor is only read from disk when it's copied somewhere.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._exit_stack = ExitStack()
+        self._files = {}
+        self.metadata = {}
+        if has_manifest(directory):
+            # Checkpoints are stored in output_dir/checkpoint-N/<model>.
+            self._store = CheckpointStore(os.path.dirname(os.path.dirname(directory)))
+            manifest = self._store.read_manifest(directory)
+            self.metadata = manifest.get("metadata", {})
+            self._entries = manifest["tensors"]
+            self._weight_map = None
+            return
+        index_path = os.path.join(directory, f"{WEIGHTS_NAME}.index.json")
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self._weight_map = json.load(f)["weight_map"]
+        elif os.path.exists(os.path.join(directory, WEIGHTS_NAME)):
+            weights = self._open(WEIGHTS_NAME)
+            self._weight_map = {name: WEIGHTS_NAME for name in weights.keys()}
+            self.metadata = weights.metadata() or {}
+        else:
+            raise FileNotFoundError(
+                f"No safetensors weights were found in {directory}."
+            )
+        self._entries = None
+
+    def _open(self, file_name: str):
+        if file_name not in self._files:
+            self._files[file_name] = self._exit_stack.enter_context(
+                safe_open(
+                    os.path.join(self.directory, file_name),
+                    framework="pt",
+                    device="cpu",
+                )
+            )
+        return self._files[file_name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._exit_stack.close()
+        self._files = {}
+
+    def keys(self):
+        if self._entries is not None:
+            return self._entries.keys()
+        return self._weight_map.keys()
+
+    @property
+    def config(self) -> dict:
+        with open(os.path.join(self.directory, "config.json")) as f:
+            return json.load(f)
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        if self._entries is not None:
+            return self._store.load_tensor(self._entries[name])
+        return self._open(self._weight_map[name]).get_tensor(name)
+
+
+def unchanged_from_base(reader: CheckpointReader, base_model: str) -> set:
+    """The tensors a checkpoint recorded as still holding the weights of `base_model`."""
+    if reader.metadata.get(BASE_MODEL_KEY) != base_model:
+        return set()
+    return set(json.loads(reader.metadata.get(UNCHANGED_FROM_BASE_KEY, "[]")))
+
+
+@torch.no_grad()
+def load_into_tensors(
+    targets: dict,
+    reader: CheckpointReader,
+    skip=(),
+    description: str = "weights",
+    strict: bool = True,
+) -> dict:
+    """
+    Copy a checkpoint's tensors into already-allocated tensors, eg. a live model's parameters,
+    one tensor at a time. Tensors are copied straight from the memory-mapped checkpoint to
+    wherever their target lives, so the checkpoint is never held in host memory as a whole.
+
+    Args:
+        targets (dict): The tensors to load into, by name.
+        reader (CheckpointReader): The checkpoint to load from.
+        skip (set): Names of tensors to leave as they are.
+        description (str): What is being loaded, for the log.
+        strict (bool): Whether the checkpoint may hold tensors that aren't in `targets`.
+
+    Returns:
+        dict: The bytes loaded and skipped, and the seconds it took.
+    """
+    names = set(reader.keys())
+    missing = [name for name in targets if name not in names and name not in skip]
+    unexpected = [name for name in names if name not in targets] if strict else []
+    if missing or unexpected:
+        raise RuntimeError(
+            f"Could not load {description} from {reader.directory}."
+            f" Missing keys: {missing}. Unexpected keys: {unexpected}."
+        )
+    start_time = time.perf_counter()
+    loaded_bytes = 0
+    skipped_bytes = 0
+    for name, target in targets.items():
+        if name in skip:
+            skipped_bytes += target.numel() * target.element_size()
+            continue
+        source = reader.get_tensor(name)
+        if source.shape != target.shape:
+            raise RuntimeError(
+                f"Could not load {name} from {reader.directory}: its shape {list(source.shape)}"
+                f" doesn't match {list(target.shape)}."
+            )
+        target.copy_(source)
+        loaded_bytes += source.numel() * source.element_size()
+        del source
+    if any(target.device.type == "cuda" for target in targets.values()):
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start_time
+    logger.info(
+        f"Loaded {loaded_bytes / 1024**3:.2f} GB of {description} in {seconds:.1f} seconds"
+        f" ({loaded_bytes / 1024**3 / max(seconds, 1e-6):.2f} GB/s),"
+        f" skipping {skipped_bytes / 1024**3:.2f} GB unchanged from the base model."
+    )
+    return {
+        "loaded_bytes": loaded_bytes,
+        "skipped_bytes": skipped_bytes,
+        "seconds": seconds,
+    }
+
+
+def load_into_model(model, reader: CheckpointReader, skip=()) -> dict:
+    """
+    Load a checkpoint's config and weights into a live Diffusers model, in place.
+
+    Quantised models have each tensor loaded through `load_state_dict`, which knows how to copy
+    into quantised tensors.
+    """
+    model.register_to_config(
+        **{
+            key: value
+            for key, value in reader.config.items()
+            if not key.startswith("_")
+        }
+    )
+    targets = model.state_dict()
+    if all(type(tensor) is torch.Tensor for tensor in targets.values()):
+        return load_into_tensors(
+            targets, reader, skip=skip, description=type(model).__name__
+        )
+    for name in reader.keys():
+        if name not in skip:
+            model.load_state_dict({name: reader.get_tensor(name)}, strict=False)
+    return {}
@@ -0,0 +1,212 @@
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+from collections import Counter
+
+import torch
+
+from helpers.training.checkpoint_writer import (
+    safetensors_dtype_sizes,
+    safetensors_dtypes,
+)
+
+logger = logging.getLogger("CheckpointStore")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
+
+MANIFEST_NAME = "diffusion_pytorch_model.manifest.json"
+STORE_DIR_NAME = "tensor_store"
+# Elements of a tensor compared to tell whether it changed without reading all of it.
+SAMPLE_SIZE = 4096
+torch_dtypes = {name: dtype for dtype, name in safetensors_dtypes.items()}
+
+
+def has_manifest(directory: str) -> bool:
+    return os.path.exists(os.path.join(directory, MANIFEST_NAME))
+
+
+class CheckpointStore:
+    """
+    A content-addressed store for the tensors of every checkpoint in an output directory.
+
+    Each tensor's bytes are stored once, as an object named by their SHA-256 hash, and each saved
+    model only writes a manifest of its tensors' names, dtypes, shapes and objects. Tensors that
+    didn't change since the last checkpoint, eg. frozen blocks or most of an EMA model, cost no
+    extra space. A tensor whose version counter and a sample of whose values didn't change since it
+    was last stored isn't read whole again. Objects no longer listed by any checkpoint's manifest
+    are removed by `collect_garbage`.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.objects_dir = os.path.join(output_dir, STORE_DIR_NAME)
+        # (component, tensor name) -> ((data pointer, version, dtype, shape, sample), object hash).
+        # Components, eg. a model and its EMA copy, can share tensor names.
+        self._stored_versions = {}
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _tensor_version(self, tensor: torch.Tensor):
+        # In-place updates, eg. optimizer steps, bump the tensor's version counter. Writes through
+        # `.data`, eg. EMA's copy_to, don't, and a freed tensor's memory can be reused by another,
+        # so evenly spaced values of the tensor (all of them, for small tensors) are compared too.
+        flat = tensor.detach().reshape(-1)
+        if flat.numel() > SAMPLE_SIZE:
+            step = flat.numel() // SAMPLE_SIZE
+            flat = flat[torch.arange(SAMPLE_SIZE, device=flat.device) * step]
+        return (
+            tensor.data_ptr(),
+            tensor._version,
+            tensor.dtype,
+            tuple(tensor.shape),
+            flat.to("cpu").contiguous().view(torch.uint8).numpy().tobytes(),
+        )
+
+    def put(self, name: str, tensor: torch.Tensor, component: str = ""):
+        """
+        Store a tensor's bytes, unless they're already stored.
+
+        Args:
+            name (str): The tensor's name.
+            tensor (torch.Tensor): The tensor.
+            component (str): The model the tensor belongs to, eg. "transformer" or "ema".
+
+        Returns:
+            (str, int): The object hash, and the number of bytes written.
+        """
+        version = self._tensor_version(tensor)
+        key = (component, name)
+        stored = self._stored_versions.get(key)
+        if (
+            stored is not None
+            and stored[0] == version
+            and os.path.exists(self.object_path(stored[1]))
+        ):
+            return stored[1], 0
+        tensor = tensor.detach().to("cpu").contiguous()
+        data = tensor.view(-1).view(torch.uint8).numpy()
+        digest = hashlib.sha256(data).hexdigest()
+        self._stored_versions[key] = (version, digest)
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.tmp-{os.getpid()}"
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+        return digest, data.nbytes
+
+    def save_state_dict(
+        self, state_dict: dict, directory: str, metadata: dict = None
+    ) -> dict:
+        """
+        Store every tensor of a state dict, and write its manifest into `directory`.
+
+        Returns:
+            dict: The total bytes of the state dict, and the bytes actually written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        component = os.path.basename(os.path.normpath(directory))
+        tensors = {}
+        total_bytes = 0
+        written_bytes = 0
+        for name, tensor in state_dict.items():
+            digest, written = self.put(name, tensor, component)
+            tensors[name] = {
+                "dtype": safetensors_dtypes[tensor.dtype],
+                "shape": list(tensor.shape),
+                "object": digest,
+            }
+            total_bytes += tensor.numel() * tensor.element_size()
+            written_bytes += written
+        with open(os.path.join(directory, MANIFEST_NAME), "w") as f:
+            json.dump({"metadata": metadata or {}, "tensors": tensors}, f)
+        return {"total_bytes": total_bytes, "written_bytes": written_bytes}
+
+    def save_model(self, model, directory: str, metadata: dict = None) -> dict:
+        """Save a Diffusers model's config, and store its weights."""
+        os.makedirs(directory, exist_ok=True)
+        model.save_config(directory)
+        return self.save_state_dict(model.state_dict(), directory, metadata=metadata)
+
+    @staticmethod
+    def read_manifest(directory: str) -> dict:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            return json.load(f)
+
+    def load_tensor(self, entry: dict) -> torch.Tensor:
+        """Memory-map the object of a manifest entry as a tensor."""
+        dtype = torch_dtypes[entry["dtype"]]
+        size = math.prod(entry["shape"]) * safetensors_dtype_sizes[entry["dtype"]]
+        if size == 0:
+            return torch.empty(entry["shape"], dtype=dtype)
+        return (
+            torch.from_file(
+                self.object_path(entry["object"]),
+                shared=False,
+                size=size,
+                dtype=torch.uint8,
+            )
+            .view(dtype)
+            .reshape(entry["shape"])
+        )
+
+    def load_state_dict(self, directory: str, device="cpu") -> dict:
+        """Load the state dict described by a manifest, memory-mapping each object."""
+        return {
+            name: self.load_tensor(entry).to(device)
+            for name, entry in self.read_manifest(directory)["tensors"].items()
+        }
+
+    def reference_counts(self) -> Counter:
+        """How many tensors, across the manifests of every checkpoint, refer to each object."""
+        counts = Counter()
+        for manifest_path in glob.glob(
+            os.path.join(self.output_dir, "checkpoint-*", "*", MANIFEST_NAME)
+        ):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            counts.update(entry["object"] for entry in manifest["tensors"].values())
+        return counts
+
+    def collect_garbage(self) -> dict:
+        """
+        Remove the objects that no checkpoint references any more, eg. after checkpoints were
+        rotated out by --checkpoints_total_limit. This has to run after the new checkpoint's
+        manifests were written, or the objects it shares with the removed ones would be lost.
+
+        Returns:
+            dict: The number of objects and bytes removed.
+        """
+        if not os.path.isdir(self.objects_dir):
+            return {"objects": 0, "bytes": 0}
+        referenced = self.reference_counts()
+        removed_objects = 0
+        removed_bytes = 0
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for name in os.listdir(prefix_dir):
+                # Also removes the temporary files of interrupted writes.
+                if name in referenced:
+                    continue
+                path = os.path.join(prefix_dir, name)
+                removed_bytes += os.path.getsize(path)
+                os.remove(path)
+                removed_objects += 1
+            if not os.listdir(prefix_dir):
+                os.rmdir(prefix_dir)
+        self._stored_versions = {
+            key: stored
+            for key, stored in self._stored_versions.items()
+            if stored[1] in referenced
+        }
+        logger.info(
+            f"Removed {removed_objects} unreferenced tensors ({removed_bytes / 1024**3:.2f} GB) from {self.objects_dir}."
+        )
+        return {"objects": removed_objects, "bytes": removed_bytes}
@@ -0,0 +1,433 @@
+import inspect
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+from PIL import Image, ImageDraw, ImageFont
+from safetensors import safe_open
+
+from helpers.training.checkpoint_loader import CheckpointReader, load_into_tensors
+
+logger = logging.getLogger("CheckpointSweep")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
+
+LORA_WEIGHTS_NAME = "pytorch_lora_weights.safetensors"
+# Scheduler presets: diffusers class name, and the config overrides applied to the pipeline's own
+# scheduler config. "default" keeps the pipeline's scheduler.
+scheduler_presets = {
+    "default": (None, {}),
+    "ddim": ("DDIMScheduler", {}),
+    "ddim_zsnr": (
+        "DDIMScheduler",
+        {"rescale_betas_zero_snr": True, "timestep_spacing": "trailing"},
+    ),
+    "ddpm": ("DDPMScheduler", {}),
+    "euler": ("EulerDiscreteScheduler", {}),
+    "euler_a": ("EulerAncestralDiscreteScheduler", {}),
+    "dpm++2m": ("DPMSolverMultistepScheduler", {}),
+    "dpm++2m_karras": ("DPMSolverMultistepScheduler", {"use_karras_sigmas": True}),
+    "unipc": ("UniPCMultistepScheduler", {}),
+    "flow_match_euler": ("FlowMatchEulerDiscreteScheduler", {}),
+}
+# What each pipeline's encode_prompt returns, in order, as the names its __call__ accepts them by.
+prompt_embed_outputs = {
+    "StableDiffusionPipeline": ("prompt_embeds", "negative_prompt_embeds"),
+    "StableDiffusionXLPipeline": (
+        "prompt_embeds",
+        "negative_prompt_embeds",
+        "pooled_prompt_embeds",
+        "negative_pooled_prompt_embeds",
+    ),
+    "StableDiffusion3Pipeline": (
+        "prompt_embeds",
+        "negative_prompt_embeds",
+        "pooled_prompt_embeds",
+        "negative_pooled_prompt_embeds",
+    ),
+    "FluxPipeline": ("prompt_embeds", "pooled_prompt_embeds", None),
+    "PixArtSigmaPipeline": (
+        "prompt_embeds",
+        "prompt_attention_mask",
+        "negative_prompt_embeds",
+        "negative_prompt_attention_mask",
+    ),
+}
+
+
+def list_checkpoints(output_dir: str) -> list:
+    """The (step, path) of each checkpoint-N directory in `output_dir`, oldest first."""
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if name.startswith("checkpoint-") and os.path.isdir(path):
+            try:
+                checkpoints.append((int(name.split("-")[1]), path))
+            except ValueError:
+                continue
+    return sorted(checkpoints)
+
+
+def checkpoint_kind(path: str, component: str) -> str:
+    """Whether a checkpoint holds a full `component`, LoRA or LyCORIS weights."""
+    if os.path.exists(os.path.join(path, "lycoris_config.json")):
+        return "lycoris"
+    if os.path.exists(os.path.join(path, LORA_WEIGHTS_NAME)):
+        return "lora"
+    if os.path.isdir(os.path.join(path, component)):
+        return "full"
+    raise FileNotFoundError(
+        f"{path} holds neither {component} weights nor {LORA_WEIGHTS_NAME}."
+    )
+
+
+def make_grid(images: dict, row_labels: list, column_labels: list) -> Image.Image:
+    """
+    Tile images into a labelled grid.
+
+    Args:
+        images (dict): The image at each (row label, column label). Missing cells are left blank.
+        row_labels (list): The rows, top to bottom.
+        column_labels (list): The columns, left to right.
+    """
+    width = max(image.width for image in images.values())
+    height = max(image.height for image in images.values())
+    font = ImageFont.load_default()
+    measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    label_width = 10 + max(
+        measure.textbbox((0, 0), str(label), font=font)[2] for label in row_labels
+    )
+    label_height = 30
+    grid = Image.new(
+        "RGB",
+        (
+            label_width + width * len(column_labels),
+            label_height + height * len(row_labels),
+        ),
+        "white",
+    )
+    draw = ImageDraw.Draw(grid)
+    for column, column_label in enumerate(column_labels):
+        draw.text(
+            (label_width + column * width + 5, 8),
+            str(column_label),
+            fill="black",
+            font=font,
+        )
+    for row, row_label in enumerate(row_labels):
+        top = label_height + row * height
+        draw.text((5, top + height // 2), str(row_label), fill="black", font=font)
+        for column, column_label in enumerate(column_labels):
+            image = images.get((row_label, column_label))
+            if image is not None:
+                grid.paste(image, (label_width + column * width, top))
+    return grid
+
+
+def tile_directory(directory: str) -> str:
+    """
+    Tile the `{shortname}-{checkpoint}.png` images in a directory into a grid, with a row per
+    short name and a column per checkpoint.
+
+    Returns:
+        str: The path of the grid.
+    """
+    images = {}
+    for file_name in os.listdir(directory):
+        name, extension = os.path.splitext(file_name)
+        if extension != ".png" or "-" not in name or name == "grid":
+            continue
+        shortname, label = name.rsplit("-", 1)
+        with Image.open(os.path.join(directory, file_name)) as image:
+            images[(shortname, label)] = image.convert("RGB")
+    if not images:
+        raise FileNotFoundError(
+            f"No {{shortname}}-{{checkpoint}}.png images in {directory}."
+        )
+    labels = {label for _, label in images}
+    grid = make_grid(
+        images,
+        sorted({shortname for shortname, _ in images}),
+        sorted(
+            labels,
+            key=lambda label: (
+                not label.isdigit(),
+                int(label) if label.isdigit() else 0,
+                label,
+            ),
+        ),
+    )
+    grid_path = os.path.join(directory, "grid.png")
+    grid.save(grid_path)
+    return grid_path
+
+
+class StageTimer:
+    """Accumulates the wall time spent in each stage of a sweep."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start_time
+            self.counts[name] += 1
+
+    def report(self) -> str:
+        return "\n".join(
+            f"  {name:<16} {self.seconds[name]:8.2f} s total,"
+            f" {self.seconds[name] / self.counts[name]:6.2f} s each over {self.counts[name]}"
+            for name in self.seconds
+        )
+
+
+class WeightSwapper:
+    """
+    Swaps the trained component's weights in a loaded pipeline for each checkpoint's, and takes
+    them out again afterwards, so the rest of the pipeline is built once for a whole sweep.
+
+    Full checkpoints are copied straight into the component's existing parameters, and any text
+    encoders they hold are not loaded. Checkpoints are expected oldest first, and the base model
+    before any full checkpoint, since a full checkpoint's weights replace the base model's.
+    """
+
+    def __init__(self, pipeline, component: str, lycoris_multiplier: float = 1.0):
+        self.pipeline = pipeline
+        self.component = component
+        self.model = getattr(pipeline, component)
+        self.lycoris_multiplier = lycoris_multiplier
+        self._remove = None
+
+    def changes_text_encoders(self, path: str) -> bool:
+        """Whether a checkpoint also holds text encoder weights, so prompts must be re-encoded."""
+        if path is None:
+            return False
+        if checkpoint_kind(path, self.component) == "full":
+            # Only the trained component is swapped in from a full checkpoint, so the text
+            # encoders stay the base model's even if the checkpoint holds its own.
+            return False
+        with safe_open(
+            os.path.join(path, LORA_WEIGHTS_NAME), framework="pt", device="cpu"
+        ) as f:
+            return any(key.startswith("text_encoder") for key in f.keys())
+
+    def apply(self, label: str, path: str = None):
+        """Use the weights of the checkpoint at `path`, or the base model's if it's None."""
+        if path is None:
+            return
+        kind = checkpoint_kind(path, self.component)
+        if kind == "full":
+            with CheckpointReader(os.path.join(path, self.component)) as reader:
+                load_into_tensors(
+                    self.model.state_dict(), reader, description=f"{label} weights"
+                )
+        elif kind == "lora":
+            adapter_name = f"sweep-{label}"
+            self.pipeline.load_lora_weights(path, adapter_name=adapter_name)
+            self._remove = lambda: self.pipeline.delete_adapters(adapter_name)
+        else:
+            from lycoris import create_lycoris_from_weights
+
+            wrapper, _ = create_lycoris_from_weights(
+                self.lycoris_multiplier,
+                os.path.join(path, LORA_WEIGHTS_NAME),
+                self.model,
+            )
+            wrapper.to(self.model.device, dtype=self.model.dtype)
+            wrapper.apply_to()
+            self._remove = wrapper.restore
+
+    def remove(self):
+        """Take out the adapter weights of the last checkpoint applied."""
+        if self._remove is not None:
+            self._remove()
+            self._remove = None
+
+
+class PromptEmbedCache:
+    """
+    Encodes each prompt once, and reuses its embeds for every checkpoint and scheduler that
+    shares the same text encoders.
+    """
+
+    def __init__(self, pipeline, device):
+        self.pipeline = pipeline
+        self.device = device
+        self.outputs = next(
+            (
+                prompt_embed_outputs[cls.__name__]
+                for cls in type(pipeline).__mro__
+                if cls.__name__ in prompt_embed_outputs
+            ),
+            None,
+        )
+        self._embeds = {}
+
+    def call_kwargs(
+        self,
+        prompt: str,
+        negative_prompt: str,
+        guidance_scale: float,
+        text_encoder_version=None,
+    ) -> dict:
+        """The prompt arguments for the pipeline's __call__, as embeds where it's supported."""
+        if self.outputs is None:
+            return {"prompt": prompt, "negative_prompt": negative_prompt}
+        key = (prompt, negative_prompt, guidance_scale > 1.0, text_encoder_version)
+        if key not in self._embeds:
+            parameters = inspect.signature(self.pipeline.encode_prompt).parameters
+            kwargs = {
+                "prompt": prompt,
+                "prompt_2": None,
+                "prompt_3": None,
+                "device": self.device,
+                "num_images_per_prompt": 1,
+                "do_classifier_free_guidance": guidance_scale > 1.0,
+                "negative_prompt": negative_prompt,
+            }
+            with torch.no_grad():
+                embeds = self.pipeline.encode_prompt(
+                    **{
+                        name: value
+                        for name, value in kwargs.items()
+                        if name in parameters
+                    }
+                )
+            self._embeds[key] = {
+                name: embed
+                for name, embed in zip(self.outputs, embeds)
+                if name is not None and embed is not None
+            }
+        return self._embeds[key]
+
+
+class CheckpointSweep:
+    """
+    Generates every prompt with every checkpoint and scheduler, from one loaded pipeline.
+
+    Args:
+        pipeline: The base pipeline, on its device.
+        component (str): The trained component, eg. "unet" or "transformer".
+        prompts (dict): The prompts, by short name.
+        checkpoints (list): (label, path) for each checkpoint, with a None path for the base model.
+        schedulers (list): Names from `scheduler_presets`.
+        output_dir (str): Where the images and the grid are saved.
+        seed (int): The seed of every image.
+        negative_prompt (str): The negative prompt of every image.
+        pipeline_kwargs (dict): Other arguments for the pipeline's __call__, eg. the step count.
+        lycoris_multiplier (float): The strength LyCORIS checkpoints are applied with.
+        timer (StageTimer): Where the time of each stage is added up, eg. to include loading.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        component: str,
+        prompts: dict,
+        checkpoints: list,
+        schedulers: list,
+        output_dir: str,
+        seed: int = 42,
+        negative_prompt: str = None,
+        pipeline_kwargs: dict = None,
+        lycoris_multiplier: float = 1.0,
+        timer: StageTimer = None,
+    ):
+        self.pipeline = pipeline
+        self.prompts = prompts
+        self.checkpoints = checkpoints
+        self.schedulers = schedulers
+        self.output_dir = output_dir
+        self.seed = seed
+        self.negative_prompt = negative_prompt
+        self.pipeline_kwargs = pipeline_kwargs or {}
+        self.device = pipeline.device
+        self.swapper = WeightSwapper(pipeline, component, lycoris_multiplier)
+        self.embeds = PromptEmbedCache(pipeline, self.device)
+        self.timer = timer or StageTimer()
+        self._base_scheduler = pipeline.scheduler
+
+    def scheduler(self, name: str):
+        class_name, overrides = scheduler_presets[name]
+        if class_name is None:
+            return self._base_scheduler
+        import diffusers
+
+        return getattr(diffusers, class_name).from_config(
+            self._base_scheduler.config, **overrides
+        )
+
+    def run(self) -> str:
+        """
+        Run the sweep, and save each image and a prompts × schedulers by checkpoints grid.
+
+        Returns:
+            str: The path of the grid.
+        """
+        images = {}
+        guidance_scale = self.pipeline_kwargs.get("guidance_scale", 1.0)
+        call_parameters = inspect.signature(self.pipeline.__call__).parameters
+        for label, path in self.checkpoints:
+            with self.timer.stage("swap weights"):
+                self.swapper.apply(label, path)
+            try:
+                text_encoder_version = (
+                    label if self.swapper.changes_text_encoders(path) else None
+                )
+                for scheduler_name in self.schedulers:
+                    self.pipeline.scheduler = self.scheduler(scheduler_name)
+                    image_dir = os.path.join(self.output_dir, scheduler_name)
+                    os.makedirs(image_dir, exist_ok=True)
+                    for shortname, prompt in self.prompts.items():
+                        with self.timer.stage("encode prompts"):
+                            prompt_kwargs = self.embeds.call_kwargs(
+                                prompt,
+                                self.negative_prompt,
+                                guidance_scale,
+                                text_encoder_version,
+                            )
+                        call_kwargs = {
+                            name: value
+                            for name, value in {
+                                **prompt_kwargs,
+                                **self.pipeline_kwargs,
+                            }.items()
+                            if name in call_parameters
+                        }
+                        with self.timer.stage("generate"):
+                            image = self.pipeline(
+                                **call_kwargs,
+                                generator=torch.Generator(
+                                    device=self.device
+                                ).manual_seed(self.seed),
+                            ).images[0]
+                        image.save(os.path.join(image_dir, f"{shortname}-{label}.png"))
+                        images[(f"{shortname} / {scheduler_name}", label)] = image
+            finally:
+                with self.timer.stage("swap weights"):
+                    self.swapper.remove()
+        self.pipeline.scheduler = self._base_scheduler
+
+        with self.timer.stage("grid"):
+            grid = make_grid(
+                images,
+                [
+                    f"{shortname} / {scheduler_name}"
+                    for shortname in self.prompts
+                    for scheduler_name in self.schedulers
+                ],
+                [label for label, _ in self.checkpoints],
+            )
+            grid_path = os.path.join(self.output_dir, "grid.png")
+            grid.save(grid_path)
+        logger.info(
+            f"Saved the sweep to {grid_path}. Time spent:\n{self.timer.report()}"
+        )
+        return grid_path
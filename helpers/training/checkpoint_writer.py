@@ -0,0 +1,149 @@
+import json
+import logging
+import math
+import os
+import shutil
+import struct
+
+import torch
+
+logger = logging.getLogger("CheckpointWriter")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
+
+safetensors_dtypes = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+    torch.float8_e4m3fn: "F8_E4M3",
+    torch.float8_e5m2: "F8_E5M2",
+}
+safetensors_dtype_sizes = {
+    "F64": 8,
+    "F32": 4,
+    "F16": 2,
+    "BF16": 2,
+    "I64": 8,
+    "I32": 4,
+    "I16": 2,
+    "I8": 1,
+    "U8": 1,
+    "BOOL": 1,
+    "F8_E4M3": 1,
+    "F8_E5M2": 1,
+}
+WEIGHTS_NAME = "diffusion_pytorch_model.safetensors"
+
+
+def safetensors_header(tensor_specs: list, metadata: dict = None) -> bytes:
+    """
+    Build a safetensors header, with the length prefix, from the tensors' shapes alone.
+
+    Args:
+        tensor_specs (list): (name, safetensors dtype, shape) for each tensor, in the order their
+            data will be written.
+        metadata (dict): String metadata to store in the header.
+    """
+    header = {}
+    if metadata:
+        header["__metadata__"] = metadata
+    offset = 0
+    for name, dtype, shape in tensor_specs:
+        size = math.prod(shape) * safetensors_dtype_sizes[dtype]
+        header[name] = {
+            "dtype": dtype,
+            "shape": list(shape),
+            "data_offsets": [offset, offset + size],
+        }
+        offset += size
+    encoded = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # The data that follows the header must be 8-byte aligned.
+    encoded += b" " * (-len(encoded) % 8)
+    return struct.pack("<Q", len(encoded)) + encoded
+
+
+def stream_safetensors(
+    path: str, tensor_specs: list, load_tensor, metadata: dict = None
+) -> int:
+    """
+    Write a safetensors file one tensor at a time, so that at most one tensor is copied to host
+    memory at once.
+
+    Args:
+        path (str): The file to write.
+        tensor_specs (list): (name, safetensors dtype, shape) for each tensor.
+        load_tensor (callable): Returns the tensor for a name.
+        metadata (dict): String metadata to store in the header.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    header = safetensors_header(tensor_specs, metadata)
+    written = len(header)
+    with open(path, "wb") as f:
+        f.write(header)
+        for name, dtype, shape in tensor_specs:
+            tensor = load_tensor(name).detach().to("cpu").contiguous()
+            if safetensors_dtypes[tensor.dtype] != dtype or list(tensor.shape) != list(
+                shape
+            ):
+                raise ValueError(
+                    f"Tensor {name} changed while it was written: expected {dtype} {list(shape)},"
+                    f" got {safetensors_dtypes[tensor.dtype]} {list(tensor.shape)}."
+                )
+            if tensor.numel() > 0:
+                data = tensor.view(-1).view(torch.uint8).numpy()
+                f.write(data)
+                written += data.nbytes
+            del tensor
+        f.flush()
+        os.fsync(f.fileno())
+    return written
+
+
+def save_state_dict(state_dict: dict, path: str, metadata: dict = None) -> int:
+    """Stream a state dict into a single safetensors file."""
+    tensor_specs = [
+        (name, safetensors_dtypes[tensor.dtype], tuple(tensor.shape))
+        for name, tensor in state_dict.items()
+    ]
+    return stream_safetensors(
+        path, tensor_specs, state_dict.__getitem__, metadata=metadata
+    )
+
+
+def save_model(model, directory: str, metadata: dict = None) -> int:
+    """
+    Save a Diffusers model as its config and a single, unsharded safetensors file.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    model.save_config(directory)
+    return save_state_dict(
+        model.state_dict(),
+        os.path.join(directory, WEIGHTS_NAME),
+        metadata={"format": "pt", **(metadata or {})},
+    )
+
+
+def replace_path(source: str, destination: str):
+    """
+    Move a file or directory into place by renaming it, replacing any existing destination.
+    Both paths must be on the same filesystem.
+    """
+    if not os.path.isdir(source) or not os.path.exists(destination):
+        os.replace(source, destination)
+        return
+    # Directories can't be renamed over one another, so the old one is moved aside first.
+    previous = f"{destination}.previous-{os.getpid()}"
+    os.rename(destination, previous)
+    os.rename(source, destination)
+    shutil.rmtree(previous)
@@ -1,3 +1,4 @@
+import time
 import torch
 import logging
 import concurrent.futures
@@ -97,12 +98,18 @@ def fetch_pixel_values(fp, data_backend_id: str):
     return training_sample.prepare(return_tensor=True).image
 
 
-def fetch_latent(fp, data_backend_id: str):
+def extract_crop_variants(examples):
+    return [example.get("crop_variant", 0) for example in examples]
+
+
+def fetch_latent(fp, data_backend_id: str, crop_variant: int = 0):
     """Worker method to fetch latent for a single image."""
     debug_log(
-        f" -> pull latents for fp {fp} from cache via data backend {data_backend_id}"
+        f" -> pull latents for fp {fp} (crop variant {crop_variant}) from cache via data backend {data_backend_id}"
+    )
+    latent = StateTracker.get_vaecache(id=data_backend_id).retrieve_from_cache(
+        fp, crop_variant
     )
-    latent = StateTracker.get_vaecache(id=data_backend_id).retrieve_from_cache(fp)
 
     # Move to CPU and pin memory if it's not on the GPU
     if not torch.backends.mps.is_available():
@@ -130,7 +137,7 @@ def deepfloyd_pixels(filepaths, data_backend_id: str):
     return pixels
 
 
-def compute_latents(filepaths, data_backend_id: str):
+def compute_latents(filepaths, data_backend_id: str, crop_variants: list = None):
     # Use a thread pool to fetch latents concurrently
     try:
         if "deepfloyd" in StateTracker.get_args().model_type:
@@ -138,14 +145,21 @@ def compute_latents(filepaths, data_backend_id: str):
 
             return latents
         if StateTracker.get_args().vae_cache_ondemand:
-            latents = StateTracker.get_vaecache(id=data_backend_id).encode_images(
-                [None] * len(filepaths), filepaths
-            )
+            vaecache = StateTracker.get_vaecache(id=data_backend_id)
+            if vaecache.lookahead is not None:
+                latents = vaecache.lookahead.retrieve(filepaths)
+            else:
+                latents = vaecache.encode_images([None] * len(filepaths), filepaths)
         else:
+            if crop_variants is None:
+                crop_variants = [0] * len(filepaths)
             with concurrent.futures.ThreadPoolExecutor() as executor:
                 latents = list(
                     executor.map(
-                        fetch_latent, filepaths, [data_backend_id] * len(filepaths)
+                        fetch_latent,
+                        filepaths,
+                        [data_backend_id] * len(filepaths),
+                        crop_variants,
                     )
                 )
     except Exception as e:
@@ -407,7 +421,12 @@ def collate_fn(batch):
     debug_log("Extract filepaths")
     filepaths = extract_filepaths(examples)
     debug_log("Compute latents")
-    latent_batch = compute_latents(filepaths, data_backend_id)
+    latent_start_time = time.monotonic()
+    latent_batch = compute_latents(
+        filepaths, data_backend_id, extract_crop_variants(examples)
+    )
+    # With --vae_cache_ondemand, this is how long the step waited on the VAE.
+    vae_encode_stall = time.monotonic() - latent_start_time
     if "deepfloyd" not in StateTracker.get_args().model_type:
         debug_log("Check latents")
         latent_batch = check_latent_shapes(
@@ -475,4 +494,5 @@ def collate_fn(batch):
         "batch_luminance": batch_luminance,
         "conditioning_pixel_values": conditioning_latents,
         "encoder_attention_mask": attn_mask,
+        "vae_encode_stall": vae_encode_stall,
     }
@@ -13,6 +13,25 @@ def determine_subfolder(folder_value: str = None):
     return str(folder_value)
 
 
+def load_quantised_diffusion_model(args, name, model_cls, pretrained_path, **key_args):
+    """
+    Return the model from the quantised model cache, if it was quantised by an earlier launch.
+    """
+    if "quanto" not in args.base_model_precision or args.controlnet:
+        # ControlNet is created from the full-precision U-net.
+        return None
+    from helpers.caching.quantised_models import load_quantised_model
+
+    return load_quantised_model(
+        args,
+        name,
+        model_cls,
+        pretrained_path,
+        precision=args.base_model_precision,
+        **key_args,
+    )
+
+
 def load_diffusion_model(args, weight_dtype):
     pretrained_load_args = {
         "revision": args.revision,
@@ -30,43 +49,101 @@ def load_diffusion_model(args, weight_dtype):
             logger.error(
                 f"Can not load SD3 model class. This release requires the latest version of Diffusers: {e}"
             )
-        transformer = SD3Transformer2DModel.from_pretrained(
+        transformer_path = (
             args.pretrained_transformer_model_name_or_path
-            or args.pretrained_model_name_or_path,
-            subfolder=determine_subfolder(args.pretrained_transformer_subfolder),
+            or args.pretrained_model_name_or_path
+        )
+        transformer_subfolder = determine_subfolder(
+            args.pretrained_transformer_subfolder
+        )
+        transformer = load_quantised_diffusion_model(
+            args,
+            "transformer",
+            SD3Transformer2DModel,
+            transformer_path,
+            subfolder=transformer_subfolder,
+            dtype=weight_dtype,
             **pretrained_load_args,
         )
+        if transformer is None:
+            transformer = SD3Transformer2DModel.from_pretrained(
+                transformer_path,
+                subfolder=transformer_subfolder,
+                **pretrained_load_args,
+            )
     elif args.flux and not args.flux_attention_masked_training:
         from diffusers.models import FluxTransformer2DModel
 
-        transformer = FluxTransformer2DModel.from_pretrained(
+        transformer_path = (
             args.pretrained_transformer_model_name_or_path
-            or args.pretrained_model_name_or_path,
-            subfolder=determine_subfolder(args.pretrained_transformer_subfolder),
-            torch_dtype=weight_dtype,
+            or args.pretrained_model_name_or_path
+        )
+        transformer_subfolder = determine_subfolder(
+            args.pretrained_transformer_subfolder
+        )
+        transformer = load_quantised_diffusion_model(
+            args,
+            "transformer",
+            FluxTransformer2DModel,
+            transformer_path,
+            subfolder=transformer_subfolder,
+            dtype=weight_dtype,
             **pretrained_load_args,
         )
+        if transformer is None:
+            transformer = FluxTransformer2DModel.from_pretrained(
+                transformer_path,
+                subfolder=transformer_subfolder,
+                torch_dtype=weight_dtype,
+                **pretrained_load_args,
+            )
     elif args.flux and args.flux_attention_masked_training:
         from helpers.models.flux.transformer import (
             FluxTransformer2DModelWithMasking,
         )
 
-        transformer = FluxTransformer2DModelWithMasking.from_pretrained(
+        transformer = load_quantised_diffusion_model(
+            args,
+            "transformer",
+            FluxTransformer2DModelWithMasking,
             args.pretrained_model_name_or_path,
             subfolder="transformer",
-            torch_dtype=weight_dtype,
+            dtype=weight_dtype,
             **pretrained_load_args,
         )
+        if transformer is None:
+            transformer = FluxTransformer2DModelWithMasking.from_pretrained(
+                args.pretrained_model_name_or_path,
+                subfolder="transformer",
+                torch_dtype=weight_dtype,
+                **pretrained_load_args,
+            )
     elif args.pixart_sigma:
         from diffusers.models import PixArtTransformer2DModel
 
-        transformer = PixArtTransformer2DModel.from_pretrained(
+        transformer_path = (
             args.pretrained_transformer_model_name_or_path
-            or args.pretrained_model_name_or_path,
-            subfolder=determine_subfolder(args.pretrained_transformer_subfolder),
-            torch_dtype=weight_dtype,
+            or args.pretrained_model_name_or_path
+        )
+        transformer_subfolder = determine_subfolder(
+            args.pretrained_transformer_subfolder
+        )
+        transformer = load_quantised_diffusion_model(
+            args,
+            "transformer",
+            PixArtTransformer2DModel,
+            transformer_path,
+            subfolder=transformer_subfolder,
+            dtype=weight_dtype,
             **pretrained_load_args,
         )
+        if transformer is None:
+            transformer = PixArtTransformer2DModel.from_pretrained(
+                transformer_path,
+                subfolder=transformer_subfolder,
+                torch_dtype=weight_dtype,
+                **pretrained_load_args,
+            )
     elif args.smoldit:
         logger.info("Loading SmolDiT model..")
         if args.validation_noise_scheduler is None:
@@ -94,11 +171,25 @@ def load_diffusion_model(args, weight_dtype):
         ):
             unet_variant = "fp16"
         pretrained_load_args["variant"] = unet_variant
-        unet = UNet2DConditionModel.from_pretrained(
+        unet_path = (
             args.pretrained_unet_model_name_or_path
-            or args.pretrained_model_name_or_path,
-            subfolder=determine_subfolder(args.pretrained_unet_subfolder),
+            or args.pretrained_model_name_or_path
+        )
+        unet_subfolder = determine_subfolder(args.pretrained_unet_subfolder)
+        unet = load_quantised_diffusion_model(
+            args,
+            "unet",
+            UNet2DConditionModel,
+            unet_path,
+            subfolder=unet_subfolder,
+            dtype=weight_dtype,
             **pretrained_load_args,
         )
+        if unet is None:
+            unet = UNet2DConditionModel.from_pretrained(
+                unet_path,
+                subfolder=unet_subfolder,
+                **pretrained_load_args,
+            )
 
     return unet, transformer
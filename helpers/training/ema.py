@@ -7,6 +7,7 @@ import transformers
 from typing import Any, Dict, Iterable, Optional, Union
 from diffusers.utils.deprecation_utils import deprecate
 from diffusers.utils import is_transformers_available
+from helpers.training.checkpoint_loader import CheckpointReader, load_into_tensors
 
 logger = logging.getLogger("EMAModel")
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
@@ -132,6 +133,33 @@ class EMAModel:
         ema_model.load_state_dict(ema_kwargs)
         return ema_model
 
+    def load_checkpoint(
+        self, reader: CheckpointReader, parameter_names: list, skip=()
+    ) -> dict:
+        """
+        Load an EMA model saved by `save_pretrained`, or into a checkpoint store, in place.
+
+        Args:
+            reader (CheckpointReader): The saved EMA model.
+            parameter_names (list): The names of the tracked parameters, in order.
+            skip (set): Names of parameters to leave as they are.
+        """
+        config = reader.config
+        self.load_state_dict(
+            {
+                key: config[key]
+                for key in self.state_dict()
+                if key != "shadow_params" and key in config
+            }
+        )
+        return load_into_tensors(
+            dict(zip(parameter_names, self.shadow_params)),
+            reader,
+            skip=skip,
+            description="EMA weights",
+            strict=False,
+        )
+
     def save_pretrained(self, path, max_shard_size: str = "10GB"):
         if self.model_cls is None:
             raise ValueError(
@@ -0,0 +1,186 @@
+import logging
+import os
+import torch
+
+logger = logging.getLogger("FlatParameters")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+
+class FlatParameterBuffer:
+    """
+    Pack the trainable parameters of an optimizer into a few contiguous buffers.
+
+    LoRA and LyCORIS train thousands of tiny tensors, so anything that visits them one at a time
+    (casting gradients, clipping, the optimizer step) is bound by kernel launches. Here, each
+    parameter group's tensors are grouped by device and dtype, and copied into one flat buffer per
+    group. Every original parameter becomes a view into its buffer, so module state dicts keep
+    their per-name layout, and loading weights in-place updates the buffer.
+
+    The optimizer is given a single flat parameter per buffer in place of the individual tensors,
+    and the gradients are accumulated straight into a matching flat gradient buffer, optionally
+    in a higher precision than the weights.
+
+    Optimizer states saved this way hold flat tensors, and can't be resumed without packing.
+    """
+
+    def __init__(
+        self,
+        optimizer,
+        device=None,
+        dtype: torch.dtype = None,
+        grad_dtype: torch.dtype = None,
+    ):
+        """
+        Args:
+            optimizer: The optimizer whose param groups should be packed. It must not have stepped yet.
+            device: Move the parameters here before packing, eg. to where the model will end up.
+            dtype: Cast the parameters to this dtype before packing.
+            grad_dtype: The dtype to accumulate gradients in. Defaults to the dtype of the parameters.
+        """
+        if len(optimizer.state) > 0:
+            raise ValueError(
+                "Parameters can only be packed before the optimizer has taken a step."
+            )
+        self.grad_dtype = grad_dtype
+        # One entry per flat buffer: the flat parameter, its gradient, and the tensors it holds.
+        self.buffers = []
+        for group in optimizer.param_groups:
+            params_by_placement = {}
+            for p in group["params"]:
+                placement = (
+                    torch.device(device) if device is not None else p.device,
+                    dtype if dtype is not None else p.dtype,
+                )
+                params_by_placement.setdefault(placement, []).append(p)
+            flat_params = []
+            for (buffer_device, buffer_dtype), params in params_by_placement.items():
+                flat_params.append(
+                    self._pack(params, device=buffer_device, dtype=buffer_dtype)
+                )
+            group["params"] = flat_params
+        logger.info(
+            f"Packed {sum(len(buffer['params']) for buffer in self.buffers)} trainable tensors"
+            f" ({sum(buffer['flat_param'].numel() for buffer in self.buffers) / 1e6:.2f}M parameters)"
+            f" into {len(self.buffers)} flat buffers."
+        )
+
+    def _pack(self, params: list, device, dtype) -> torch.nn.Parameter:
+        numel = sum(p.numel() for p in params)
+        flat_param = torch.nn.Parameter(
+            torch.empty(numel, device=device, dtype=dtype),
+            requires_grad=True,
+        )
+        grad_dtype = self.grad_dtype or dtype
+        flat_grad = torch.zeros(numel, device=device, dtype=grad_dtype)
+        offsets = []
+        offset = 0
+        for p in params:
+            flat_view = flat_param.data[offset : offset + p.numel()].view_as(p)
+            flat_view.copy_(p.data)
+            p.data = flat_view
+            offsets.append(offset)
+            offset += p.numel()
+        buffer = {
+            "flat_param": flat_param,
+            "flat_grad": flat_grad,
+            "params": params,
+            "offsets": offsets,
+        }
+        self.buffers.append(buffer)
+        self._attach_grads(buffer)
+        return flat_param
+
+    @staticmethod
+    def _set_grad(tensor: torch.Tensor, grad: torch.Tensor):
+        if grad.dtype == tensor.dtype:
+            tensor.grad = grad
+        else:
+            # Gradients must match the dtype of their parameter when assigned,
+            # but autograd will accumulate into a higher precision one set this way.
+            tensor.grad = torch.zeros(
+                (), dtype=tensor.dtype, device=grad.device
+            ).expand_as(tensor)
+            tensor.grad.data = grad
+
+    def _attach_grads(self, buffer: dict):
+        flat_grad = buffer["flat_grad"]
+        self._set_grad(buffer["flat_param"], flat_grad)
+        for p, offset in zip(buffer["params"], buffer["offsets"]):
+            self._set_grad(p, flat_grad[offset : offset + p.numel()].view_as(p))
+
+    def parameters(self) -> list:
+        """The flat parameters, whose gradients are the flat gradient buffers."""
+        return [buffer["flat_param"] for buffer in self.buffers]
+
+    def is_packed(self) -> bool:
+        """Whether every tensor is still a view into its buffer, and its gradient too."""
+        for buffer in self.buffers:
+            flat_param, flat_grad = buffer["flat_param"], buffer["flat_grad"]
+            element_size = flat_param.element_size()
+            grad_element_size = flat_grad.element_size()
+            for p, offset in zip(buffer["params"], buffer["offsets"]):
+                if p.data_ptr() != flat_param.data_ptr() + offset * element_size:
+                    return False
+                if (
+                    p.grad is None
+                    or p.grad.data_ptr()
+                    != flat_grad.data_ptr() + offset * grad_element_size
+                ):
+                    return False
+        return True
+
+    def repack(self):
+        """
+        Restore the packing after something replaced a tensor's storage, eg. `module.to()`
+        changing its device or dtype. The flat parameters keep their identity, so an optimizer
+        holding them isn't affected. Gradients are reset.
+        """
+        for buffer in self.buffers:
+            flat_param = buffer["flat_param"]
+            for p, offset in zip(buffer["params"], buffer["offsets"]):
+                flat_view = flat_param.data[offset : offset + p.numel()].view_as(p)
+                if p.data_ptr() != flat_view.data_ptr():
+                    flat_view.copy_(p.data)
+                    p.data = flat_view
+            buffer["flat_grad"].zero_()
+            self._attach_grads(buffer)
+
+    def zero_grad(self):
+        """Zero every gradient, with one kernel per buffer."""
+        for buffer in self.buffers:
+            buffer["flat_grad"].zero_()
+            if buffer["flat_param"].grad is None:
+                self._attach_grads(buffer)
+
+    @torch.no_grad()
+    def clip_grad_norm_(self, max_norm: float, accelerator=None) -> torch.Tensor:
+        """
+        Clip the gradient norm of all packed tensors, as torch.nn.utils.clip_grad_norm_ would.
+
+        Args:
+            max_norm (float): The maximum total norm.
+            accelerator: If given, gradients are unscaled first when a grad scaler is in use.
+
+        Returns:
+            torch.Tensor: The total norm, before clipping.
+        """
+        if accelerator is not None:
+            accelerator.unscale_gradients()
+        flat_grads = [buffer["flat_grad"] for buffer in self.buffers]
+        if len(flat_grads) == 0:
+            return torch.tensor(0.0)
+        norm_device = flat_grads[0].device
+        total_norm = torch.linalg.vector_norm(
+            torch.stack(
+                [
+                    torch.linalg.vector_norm(flat_grad, dtype=torch.float32).to(
+                        norm_device
+                    )
+                    for flat_grad in flat_grads
+                ]
+            )
+        )
+        clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        for flat_grad in flat_grads:
+            flat_grad.mul_(clip_coef.to(flat_grad.device))
+        return total_norm
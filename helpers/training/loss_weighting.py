@@ -0,0 +1,85 @@
+import torch
+
+from helpers.training.min_snr_gamma import compute_snr
+
+
+class SNRLossWeighting:
+    """
+    Min-SNR loss weighting, from lookup tables built once per noise schedule.
+
+    The SNR of every training timestep, and the loss weight derived from it, are computed when
+    the weighting is created, with the same arithmetic `compute_snr` uses each step. Weighting
+    a batch is then a single gather from a table on the loss device, and the weighted loss is
+    reduced in one operation.
+
+    Variants:
+        min-SNR: weight = min(snr, gamma) / snr, or / (snr + 1) for v-prediction.
+        soft-min: snr uses the soft-min formula of `compute_snr(use_soft_min=True)`.
+        debiased: the weight is further multiplied by 1 / sqrt(snr), with snr clamped to 1000,
+            as in debiased estimation (https://arxiv.org/abs/2310.08442).
+    """
+
+    def __init__(
+        self,
+        noise_scheduler,
+        snr_gamma: float,
+        prediction_type: str = None,
+        use_soft_min: bool = False,
+        sigma_data: float = 1.0,
+        debiased: bool = False,
+    ):
+        """
+        Args:
+            noise_scheduler: A scheduler with `alphas_cumprod`.
+            snr_gamma (float): The min-SNR gamma.
+            prediction_type (str): Defaults to the scheduler's configured prediction type.
+            use_soft_min (bool): Use the soft-min SNR calculation, which needs `sigma_data`.
+            sigma_data (float): The standard deviation of the data, for soft-min.
+            debiased (bool): Apply debiased estimation on top of the min-SNR weights.
+        """
+        if prediction_type is None:
+            prediction_type = noise_scheduler.config.prediction_type
+        self.snr_gamma = snr_gamma
+        self.prediction_type = prediction_type
+        self.use_soft_min = use_soft_min
+        self.debiased = debiased
+        timesteps = torch.arange(len(noise_scheduler.alphas_cumprod))
+        self.snr = compute_snr(
+            timesteps,
+            noise_scheduler,
+            use_soft_min=use_soft_min,
+            sigma_data=sigma_data,
+        )
+        snr_divisor = self.snr
+        if prediction_type == "v_prediction":
+            snr_divisor = self.snr + 1
+        self.weights = (
+            torch.minimum(self.snr, snr_gamma * torch.ones_like(self.snr)) / snr_divisor
+        )
+        if debiased:
+            self.weights = self.weights / torch.sqrt(torch.clamp(self.snr, max=1000))
+        # device -> weights table
+        self.device_weights = {}
+
+    def get_weights(self, timesteps: torch.Tensor) -> torch.Tensor:
+        """The loss weight of each timestep."""
+        weights = self.device_weights.get(timesteps.device)
+        if weights is None:
+            weights = self.weights.to(timesteps.device)
+            self.device_weights[timesteps.device] = weights
+        return weights[timesteps]
+
+    def loss(
+        self, model_pred: torch.Tensor, target: torch.Tensor, timesteps: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        The mean over the batch of each sample's mean squared error, times its timestep's weight.
+        """
+        squared_error = (model_pred.float() - target.float()) ** 2
+        weights = self.get_weights(timesteps)
+        return (
+            torch.einsum(
+                "bn,b->", squared_error.reshape(squared_error.shape[0], -1), weights
+            )
+            / squared_error.numel()
+        )
@@ -1,26 +1,14 @@
+import importlib.util
+import logging
 import os
-from accelerate.logging import get_logger
-import accelerate
-import torch
+from helpers.registry import import_object
 
-logger = get_logger(__name__, log_level=os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+logger = logging.getLogger("OptimizerParam")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
 
-target_level = os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO")
-logger.setLevel(target_level)
-
-is_optimi_available = False
-from helpers.training.adam_bfloat16 import AdamWBF16
-
-try:
-    from optimum.quanto import QTensor
-except:
-    pass
-
-try:
-    import optimi
-
-    is_optimi_available = True
-except:
+# Optimizer classes are imported by `optimizer_parameters` when they're chosen.
+is_optimi_available = importlib.util.find_spec("optimi") is not None
+if not is_optimi_available:
     logger.error(
         "Could not load optimi library. Please install `torch-optimi` for better memory efficiency."
     )
@@ -32,8 +20,9 @@ optimizer_choices = {
             "betas": (0.9, 0.999),
             "weight_decay": 1e-2,
             "eps": 1e-6,
+            "foreach": True,
         },
-        "class": AdamWBF16,
+        "class": "helpers.training.adam_bfloat16.AdamWBF16",
     },
     "optimi-stableadamw": {
         "precision": "any",
@@ -46,7 +35,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "foreach": True,
         },
-        "class": optimi.StableAdamW,
+        "class": "optimi.StableAdamW",
     },
     "optimi-adamw": {
         "precision": "any",
@@ -58,7 +47,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "max_lr": None,
         },
-        "class": optimi.AdamW,
+        "class": "optimi.AdamW",
     },
     "optimi-lion": {
         "precision": "any",
@@ -70,7 +59,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "foreach": True,
         },
-        "class": optimi.Lion,
+        "class": "optimi.Lion",
     },
     "optimi-radam": {
         "precision": "any",
@@ -83,7 +72,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "foreach": True,
         },
-        "class": optimi.RAdam,
+        "class": "optimi.RAdam",
     },
     "optimi-ranger": {
         "precision": "any",
@@ -99,7 +88,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "foreach": True,
         },
-        "class": optimi.Ranger,
+        "class": "optimi.Ranger",
     },
     "optimi-adan": {
         "precision": "any",
@@ -113,7 +102,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "foreach": True,
         },
-        "class": optimi.Adan,
+        "class": "optimi.Adan",
     },
     "optimi-adam": {
         "precision": "any",
@@ -126,7 +115,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "max_lr": None,
         },
-        "class": optimi.Adam,
+        "class": "optimi.Adam",
     },
     "optimi-sgd": {
         "precision": "any",
@@ -141,7 +130,7 @@ optimizer_choices = {
             "kahan_sum": True,
             "foreach": True,
         },
-        "class": optimi.SGD,
+        "class": "optimi.SGD",
     },
 }
 
@@ -195,7 +184,7 @@ def optimizer_parameters(optimizer, args):
     """Return the parameters for the optimizer"""
     if optimizer in optimizer_choices:
         optimizer_details = optimizer_choices.get(optimizer)
-        optimizer_class = optimizer_choices.get(optimizer).get("class")
+        optimizer_class = import_object(optimizer_details.get("class"))
         optimizer_params = optimizer_choices.get(optimizer).get("default_settings")
         optimizer_params.update(convert_arg_to_parameters(args))
         if args.optimizer_release_gradients and "optimi-" in optimizer:
@@ -246,7 +235,9 @@ def determine_optimizer_class_with_config(
 ) -> tuple:
     extra_optimizer_args = {}
     if use_deepspeed_optimizer:
-        optimizer_class = accelerate.utils.DummyOptim
+        from accelerate.utils import DummyOptim
+
+        optimizer_class = DummyOptim
         extra_optimizer_args["lr"] = float(args.learning_rate)
         extra_optimizer_args["betas"] = (args.adam_beta1, args.adam_beta2)
         extra_optimizer_args["eps"] = args.adam_epsilon
@@ -0,0 +1,78 @@
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger("PromptEmbedBank")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
+
+
+class PromptEmbedBank:
+    """
+    The embeds of every validation prompt, moved to the inference device once and kept there.
+
+    Each kind of embed is stacked into one tensor with a row per prompt, so that gathering a
+    prompt's embeds is a slice rather than a trip to the text embed cache and a copy to the
+    device. The negative prompt's embeds are the same for every prompt, and are kept once.
+
+    Args:
+        prompt_embeds (dict): The pipeline arguments of each prompt, eg. "prompt_embeds" and
+            "negative_prompt_embeds", by prompt.
+        device: Where the embeds are kept.
+        dtype: The precision floating-point embeds are kept in. Masks keep their own dtype.
+    """
+
+    def __init__(self, prompt_embeds: dict, device, dtype):
+        self.device = device
+        self.dtype = dtype
+        self.index = {prompt: row for row, prompt in enumerate(prompt_embeds)}
+        self.shared = {}
+        self.stacked = {}
+        names = {name for embeds in prompt_embeds.values() for name in embeds}
+        for name in names:
+            values = [embeds.get(name) for embeds in prompt_embeds.values()]
+            if name.startswith("negative_"):
+                self.shared[name] = self._to_device(values[0])
+            elif all(
+                isinstance(value, torch.Tensor) and value.shape == values[0].shape
+                for value in values
+            ):
+                self.stacked[name] = self._to_device(torch.stack(values))
+            else:
+                # Eg. long prompts that were encoded to different lengths.
+                self.stacked[name] = [self._to_device(value) for value in values]
+        logger.debug(
+            f"Kept the embeds of {len(self.index)} prompts on {device}:"
+            f" {self.nbytes() / 1024**2:.1f} MB."
+        )
+
+    def _to_device(self, value):
+        if not isinstance(value, torch.Tensor):
+            return value
+        if value.is_floating_point():
+            return value.to(device=self.device, dtype=self.dtype)
+        return value.to(device=self.device)
+
+    def __contains__(self, prompt: str) -> bool:
+        return prompt in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def embeds(self, prompt: str) -> dict:
+        """The pipeline arguments of a prompt, as views into the bank."""
+        row = self.index[prompt]
+        return {
+            **{name: values[row] for name, values in self.stacked.items()},
+            **self.shared,
+        }
+
+    def nbytes(self) -> int:
+        tensors = list(self.shared.values())
+        for values in self.stacked.values():
+            tensors.extend(values if isinstance(values, list) else [values])
+        return sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in tensors
+            if isinstance(tensor, torch.Tensor)
+        )
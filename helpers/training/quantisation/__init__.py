@@ -10,13 +10,18 @@ else:
 
 try:
     from optimum.quanto import freeze, quantize, qfloat8, qint8, qint4, qint2, QTensor
+    from optimum.quanto.nn import QModuleMixin
 except ImportError as e:
     raise ImportError(
         f"To use Quanto, please install the optimum library: `pip install optimum-quanto`: {e}"
     )
 
+from helpers.caching.quantised_models import quantised_model_cache
 
-def _quanto_model(model, model_precision, base_model_precision=None):
+
+def _quanto_model(
+    model, model_precision, base_model_precision=None, name=None, cache=None
+):
     if model_precision is None:
         model_precision = base_model_precision
     if model is None:
@@ -24,6 +29,9 @@ def _quanto_model(model, model_precision, base_model_precision=None):
     if model_precision == "no_change" or model_precision is None:
         logger.info(f"...No quantisation applied to {model.__class__.__name__}.")
         return
+    if any(isinstance(module, QModuleMixin) for module in model.modules()):
+        logger.info(f"{model.__class__.__name__} is already quantised.")
+        return
 
     logger.info(f"Quantising {model.__class__.__name__}. Using {model_precision}.")
     if model_precision == "int2-quanto":
@@ -52,19 +60,26 @@ def _quanto_model(model, model_precision, base_model_precision=None):
     quantize(model, weights=weight_quant)
     logger.info("Freezing model.")
     freeze(model)
+    if cache is not None:
+        cache.save(name, model)
 
 
 def quantoise(
     unet, transformer, text_encoder_1, text_encoder_2, text_encoder_3, controlnet, args
 ):
     logger.info("Loading Quanto for LoRA training. This may take a few minutes.")
+    cache = quantised_model_cache(args)
     if transformer is not None:
-        _quanto_model(transformer, args.base_model_precision)
+        _quanto_model(
+            transformer, args.base_model_precision, name="transformer", cache=cache
+        )
     if unet is not None:
-        _quanto_model(unet, args.base_model_precision)
+        _quanto_model(unet, args.base_model_precision, name="unet", cache=cache)
     if controlnet is not None:
         _quanto_model(controlnet, args.base_model_precision)
 
+    # Text encoders aren't cached: text embeds are computed before they're quantised, and a
+    # cached text encoder would already be quantised when they are.
     if text_encoder_1 is not None:
         _quanto_model(
             text_encoder_1, args.text_encoder_1_precision, args.base_model_precision
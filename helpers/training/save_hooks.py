@@ -1,4 +1,4 @@
-from diffusers.training_utils import EMAModel, _set_state_dict_into_text_encoder
+from diffusers.training_utils import _set_state_dict_into_text_encoder
 from helpers.training.wrappers import unwrap_model
 from diffusers.utils import (
     convert_state_dict_to_diffusers,
@@ -14,9 +14,24 @@ import os
 import logging
 import shutil
 import json
+import time
+from contextlib import ExitStack
 from safetensors import safe_open
-from safetensors.torch import save_file
 from tqdm import tqdm
+from helpers.training.checkpoint_writer import (
+    WEIGHTS_NAME,
+    replace_path,
+    save_model,
+    stream_safetensors,
+)
+from helpers.training.checkpoint_store import CheckpointStore
+from helpers.training.checkpoint_loader import (
+    BASE_MODEL_KEY,
+    UNCHANGED_FROM_BASE_KEY,
+    CheckpointReader,
+    load_into_model,
+    unchanged_from_base,
+)
 
 
 logger = logging.getLogger("SaveHookManager")
@@ -76,22 +91,38 @@ def merge_safetensors_files(directory):
 
     # Collect all unique safetensors files from weight_map
     files_to_load = set(weight_map.values())
-    all_tensors = {}
-
-    # Load tensors from each unique file
     for file_name in files_to_load:
-        part_file_path = os.path.join(directory, file_name)
-        if not os.path.exists(part_file_path):
+        if not os.path.exists(os.path.join(directory, file_name)):
             raise FileNotFoundError(f"Part file {file_name} not found.")
 
-        with safe_open(part_file_path, framework="pt", device="cpu") as f:
-            for tensor_key in f.keys():
-                if tensor_key in weight_map:
-                    all_tensors[tensor_key] = f.get_tensor(tensor_key)
-
-    # Step 4: Save all loaded tensors into a single new safetensors file
-    output_file_path = os.path.join(directory, "diffusion_pytorch_model.safetensors")
-    save_file(all_tensors, output_file_path)
+    # Step 3: Read the shapes from each part's header, and stream each tensor from its
+    # memory-mapped part into the merged file, rather than loading every part at once.
+    with ExitStack() as stack:
+        part_files = {
+            file_name: stack.enter_context(
+                safe_open(
+                    os.path.join(directory, file_name), framework="pt", device="cpu"
+                )
+            )
+            for file_name in files_to_load
+        }
+        tensor_specs = []
+        for tensor_key, file_name in weight_map.items():
+            tensor_slice = part_files[file_name].get_slice(tensor_key)
+            tensor_specs.append(
+                (tensor_key, tensor_slice.get_dtype(), tuple(tensor_slice.get_shape()))
+            )
+        output_file_path = os.path.join(directory, WEIGHTS_NAME)
+        temporary_file_path = f"{output_file_path}.tmp"
+        stream_safetensors(
+            temporary_file_path,
+            tensor_specs,
+            lambda tensor_key: part_files[weight_map[tensor_key]].get_tensor(
+                tensor_key
+            ),
+            metadata={"format": "pt"},
+        )
+    os.replace(temporary_file_path, output_file_path)
     # Step 5: If the file now exists, remove the index and part files
     if os.path.exists(output_file_path):
         os.remove(json_file_path)
@@ -124,6 +155,12 @@ class SaveHookManager:
         self.ema_model = ema_model
         self.accelerator = accelerator
         self.use_deepspeed_optimizer = use_deepspeed_optimizer
+        # The frozen parameters that still hold the base model's weights, when training was
+        # resumed. None for a fresh run, where that's every frozen parameter.
+        self.unchanged_from_base = None
+        self.checkpoint_store = None
+        if getattr(args, "deduplicate_checkpoints", False):
+            self.checkpoint_store = CheckpointStore(args.output_dir)
 
         self.denoiser_class = None
         self.denoiser_subdir = None
@@ -277,16 +314,25 @@ class SaveHookManager:
         logger.info("LyCORIS weights have been saved to disk")
 
     def _save_full_model(self, models, weights, output_dir):
-        # Create a temporary directory for atomic saves
-        temporary_dir = output_dir.replace("checkpoint", "temporary")
+        # Models are written to a temporary directory next to the checkpoint, then renamed into
+        # it, so that a checkpoint never holds a partly-written model.
+        temporary_dir = os.path.join(
+            os.path.dirname(output_dir),
+            os.path.basename(output_dir).replace("checkpoint", "temporary"),
+        )
         os.makedirs(temporary_dir, exist_ok=True)
 
         if self.args.use_ema:
             tqdm.write("Saving EMA model")
-            self.ema_model.save_pretrained(
-                os.path.join(temporary_dir, self.ema_model_subdir),
-                max_shard_size="10GB",
-            )
+            if self.checkpoint_store is not None:
+                self._store_ema_model(
+                    os.path.join(temporary_dir, self.ema_model_subdir)
+                )
+            else:
+                self.ema_model.save_pretrained(
+                    os.path.join(temporary_dir, self.ema_model_subdir),
+                    max_shard_size="10GB",
+                )
 
         if self.unet is not None:
             sub_dir = "unet"
@@ -295,25 +341,99 @@ class SaveHookManager:
         if self.args.controlnet:
             sub_dir = "controlnet"
         for model in models:
-            model.save_pretrained(
-                os.path.join(temporary_dir, sub_dir), max_shard_size="10GB"
-            )
-            merge_safetensors_files(os.path.join(temporary_dir, sub_dir))
+            start_time = time.perf_counter()
+            model = unwrap_model(self.accelerator, model)
+            metadata = self._checkpoint_metadata(model)
+            if self.checkpoint_store is not None:
+                # Only the tensors that changed since the last checkpoint are written.
+                stored = self.checkpoint_store.save_model(
+                    model, os.path.join(temporary_dir, sub_dir), metadata=metadata
+                )
+                written = stored["written_bytes"]
+                logger.info(
+                    f"Stored {stored['total_bytes'] / 1024**3:.2f} GB of {sub_dir} weights, of which {written / 1024**3:.2f} GB changed, in {time.perf_counter() - start_time:.1f} seconds."
+                )
+            else:
+                # Each tensor is streamed straight into a single safetensors file.
+                written = save_model(
+                    model, os.path.join(temporary_dir, sub_dir), metadata=metadata
+                )
+                logger.info(
+                    f"Wrote {written / 1024**3:.2f} GB of {sub_dir} weights in {time.perf_counter() - start_time:.1f} seconds."
+                )
             if weights:
                 weights.pop()  # Pop the last weight
 
-        # Copy contents of temporary directory to output directory
+        # Move the contents of the temporary directory into the output directory
         for item in os.listdir(temporary_dir):
-            s = os.path.join(temporary_dir, item)
-            d = os.path.join(output_dir, item)
-            if os.path.isdir(s):
-                shutil.copytree(s, d, dirs_exist_ok=True)  # Python 3.8+
-            else:
-                shutil.copy2(s, d)
+            replace_path(
+                os.path.join(temporary_dir, item), os.path.join(output_dir, item)
+            )
 
         # Remove the temporary directory
         shutil.rmtree(temporary_dir)
 
+        if self.checkpoint_store is not None:
+            # Checkpoints rotated out before this one was saved may have left tensors unreferenced.
+            self.checkpoint_store.collect_garbage()
+
+    def _ema_denoiser(self):
+        return unwrap_model(
+            self.accelerator, self.unet if self.unet is not None else self.transformer
+        )
+
+    def _store_ema_model(self, directory):
+        # The shadow parameters are stored under the denoiser's parameter names, without building
+        # a copy of the model to hold them.
+        denoiser = self._ema_denoiser()
+        os.makedirs(directory, exist_ok=True)
+        config = json.loads(denoiser.to_json_string())
+        ema_state = self.ema_model.state_dict()
+        ema_state.pop("shadow_params")
+        config.update(ema_state)
+        with open(os.path.join(directory, "config.json"), "w") as f:
+            json.dump(config, f, indent=2, sort_keys=True)
+        self.checkpoint_store.save_state_dict(
+            {
+                name: shadow_param
+                for (name, _), shadow_param in zip(
+                    denoiser.named_parameters(), self.ema_model.shadow_params
+                )
+            },
+            directory,
+        )
+
+    def _base_model(self) -> str:
+        return json.dumps(
+            [
+                getattr(self.args, name, None)
+                for name in (
+                    "pretrained_model_name_or_path",
+                    "pretrained_transformer_model_name_or_path",
+                    "pretrained_unet_model_name_or_path",
+                    "controlnet_model_name_or_path",
+                    "revision",
+                    "variant",
+                )
+            ]
+        )
+
+    def _frozen_parameter_names(self, model) -> set:
+        return {
+            name for name, param in model.named_parameters() if not param.requires_grad
+        }
+
+    def _checkpoint_metadata(self, model) -> dict:
+        # Frozen parameters never change, so those that were frozen since the base model was
+        # loaded can be skipped when resuming.
+        unchanged = self._frozen_parameter_names(model)
+        if self.unchanged_from_base is not None:
+            unchanged &= self.unchanged_from_base
+        return {
+            BASE_MODEL_KEY: self._base_model(),
+            UNCHANGED_FROM_BASE_KEY: json.dumps(sorted(unchanged)),
+        }
+
     def save_model_hook(self, models, weights, output_dir):
         # Write "training_state.json" to the output directory containing the training state
         StateTracker.save_training_state(
@@ -417,38 +537,45 @@ class SaveHookManager:
         logger.info("LyCORIS weights have been loaded from disk")
 
     def _load_full_model(self, models, input_dir):
+        # Weights are copied one at a time from the memory-mapped checkpoint into the live
+        # models, skipping frozen weights that the checkpoint recorded as unchanged since they
+        # were loaded from the same base model.
+        with CheckpointReader(os.path.join(input_dir, self.denoiser_subdir)) as reader:
+            recorded_unchanged = unchanged_from_base(reader, self._base_model())
         if self.args.use_ema:
-            load_model = EMAModel.from_pretrained(
-                os.path.join(input_dir, self.ema_model_subdir), self.ema_model_cls
-            )
-            self.ema_model.load_state_dict(load_model.state_dict())
+            denoiser = self._ema_denoiser()
+            with CheckpointReader(
+                os.path.join(input_dir, self.ema_model_subdir)
+            ) as reader:
+                self.ema_model.load_checkpoint(
+                    reader,
+                    [name for name, _ in denoiser.named_parameters()],
+                    skip=(
+                        set()
+                        if self.args.controlnet
+                        else recorded_unchanged
+                        & self._frozen_parameter_names(denoiser)
+                    ),
+                )
             self.ema_model.to(self.accelerator.device)
-            del load_model
         if self.args.model_type == "full":
             return_exception = False
             for i in range(len(models)):
                 try:
                     # pop models so that they are not loaded again
                     model = models.pop()
-
-                    # load diffusers style into model
-                    if self.args.controlnet or self.args.unet:
-                        merge_safetensors_files(
-                            os.path.join(input_dir, self.denoiser_subdir)
-                        )
-
-                    load_model = self.denoiser_class.from_pretrained(
-                        input_dir, subfolder=self.denoiser_subdir
+                    self.unchanged_from_base = (
+                        recorded_unchanged & self._frozen_parameter_names(model)
                     )
+                    with CheckpointReader(
+                        os.path.join(input_dir, self.denoiser_subdir)
+                    ) as reader:
+                        load_into_model(model, reader, skip=self.unchanged_from_base)
                     if self.args.sd3 and not self.args.train_text_encoder:
                         logger.info(
                             "Unloading text encoders for full SD3 training without --train_text_encoder"
                         )
                         (self.text_encoder_1, self.text_encoder_2) = (None, None)
-
-                    model.register_to_config(**load_model.config)
-                    model.load_state_dict(load_model.state_dict())
-                    del load_model
                 except Exception as e:
                     import traceback
 
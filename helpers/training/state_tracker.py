@@ -2,6 +2,7 @@ from os import environ
 from pathlib import Path
 import json
 import logging
+import threading
 
 logger = logging.getLogger("StateTracker")
 logger.setLevel(environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
@@ -29,6 +30,7 @@ class StateTracker:
     all_vae_cache_files = {}
     all_text_cache_files = {}
     all_caption_files = None
+    all_caption_indexes = {}
 
     ## Backend entities for retrieval
     default_text_embed_cache = None
@@ -48,11 +50,14 @@ class StateTracker:
     args = None
     # Aspect to resolution map, we'll store once generated for consistency.
     aspect_resolution_map = {}
+    # Datasets are initialised from several threads at once.
+    aspect_resolution_map_lock = threading.Lock()
 
     # hugging face hub user details
     hf_user = None
 
     webhook_handler = None
+    text_encoder_manager = None
 
     @classmethod
     def delete_cache_files(
@@ -361,6 +366,26 @@ class StateTracker:
             cls.all_caption_files = cls._load_from_disk("all_caption_files")
         return cls.all_caption_files
 
+    @classmethod
+    def set_caption_index(
+        cls, data_backend_id: str, caption_index: dict, save: bool = True
+    ):
+        """caption_index is a dict of {caption_path: [signature, caption_text]}"""
+        cls.all_caption_indexes[data_backend_id] = caption_index
+        if save:
+            cls._save_to_disk(
+                "caption_index_{}".format(data_backend_id),
+                cls.all_caption_indexes[data_backend_id],
+            )
+
+    @classmethod
+    def get_caption_index(cls, data_backend_id: str):
+        if cls.all_caption_indexes.get(data_backend_id) is None:
+            cls.all_caption_indexes[data_backend_id] = (
+                cls._load_from_disk("caption_index_{}".format(data_backend_id)) or {}
+            )
+        return cls.all_caption_indexes[data_backend_id]
+
     @classmethod
     def get_validation_sample_images(cls):
         return cls.validation_sample_images
@@ -429,6 +454,14 @@ class StateTracker:
     def set_webhook_handler(cls, webhook_handler):
         cls.webhook_handler = webhook_handler
 
+    @classmethod
+    def set_text_encoder_manager(cls, text_encoder_manager):
+        cls.text_encoder_manager = text_encoder_manager
+
+    @classmethod
+    def get_text_encoder_manager(cls):
+        return cls.text_encoder_manager
+
     @classmethod
     def set_vae(cls, vae):
         cls.vae = vae
@@ -501,13 +534,14 @@ class StateTracker:
     def set_resolution_by_aspect(
         cls, dataloader_resolution: float, aspect: float, resolution: int
     ):
-        if dataloader_resolution not in cls.aspect_resolution_map:
-            cls.aspect_resolution_map[dataloader_resolution] = {}
-        cls.aspect_resolution_map[dataloader_resolution][str(aspect)] = resolution
-        cls._save_to_disk(
-            f"aspect_resolution_map-{dataloader_resolution}",
-            cls.aspect_resolution_map[dataloader_resolution],
-        )
+        with cls.aspect_resolution_map_lock:
+            if dataloader_resolution not in cls.aspect_resolution_map:
+                cls.aspect_resolution_map[dataloader_resolution] = {}
+            cls.aspect_resolution_map[dataloader_resolution][str(aspect)] = resolution
+            cls._save_to_disk(
+                f"aspect_resolution_map-{dataloader_resolution}",
+                cls.aspect_resolution_map[dataloader_resolution],
+            )
         logger.debug(
             f"Aspect resolution map: {cls.aspect_resolution_map[dataloader_resolution]}"
         )
@@ -521,12 +555,12 @@ class StateTracker:
 
     @classmethod
     def load_aspect_resolution_map(cls, dataloader_resolution: float):
-        if dataloader_resolution not in cls.aspect_resolution_map:
-            cls.aspect_resolution_map = {dataloader_resolution: {}}
-
-        cls.aspect_resolution_map[dataloader_resolution] = (
-            cls._load_from_disk(f"aspect_resolution_map-{dataloader_resolution}") or {}
-        )
+        # The maps of other resolutions are kept, as their datasets may still be initialising.
+        with cls.aspect_resolution_map_lock:
+            cls.aspect_resolution_map[dataloader_resolution] = (
+                cls._load_from_disk(f"aspect_resolution_map-{dataloader_resolution}")
+                or {}
+            )
         logger.debug(
             f"Aspect resolution map: {cls.aspect_resolution_map[dataloader_resolution]}"
         )
@@ -0,0 +1,206 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from helpers.caching.memory import format_memory_usage, memory_usage, reclaim_memory
+from helpers.training.multi_process import should_log
+
+logger = logging.getLogger("TextEncoderManager")
+if should_log():
+    logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+else:
+    logger.setLevel(logging.ERROR)
+
+offload_targets = ["delete", "cpu", "disk"]
+
+
+def _tensor_sources(model) -> dict:
+    """Map the name of every parameter and buffer to the first name of the tensor it shares."""
+    sources = {}
+    names = {}
+    for name, tensor in chain(
+        model.named_parameters(remove_duplicate=False),
+        model.named_buffers(remove_duplicate=False),
+    ):
+        names[name] = sources.setdefault(id(tensor), name)
+    return names
+
+
+class TextEncoderManager:
+    """
+    Keeps the text encoders on the accelerator only while something needs them.
+
+    Callers hold the encoders with `acquire(reason)` or `loaded(reason)`, eg. while the text embed
+    caches are built, or while a prompt missing from the cache is encoded. Once nothing holds them,
+    they're offloaded to the `offload` target:
+
+    - delete: released for good. Later cache misses can't be encoded.
+    - cpu: moved to system memory.
+    - disk: written once to a safetensors copy in `offload_dir`, then moved to the meta device,
+        releasing both host and device memory. The copy is memory-mapped back in when the
+        encoders are next needed.
+    """
+
+    def __init__(
+        self,
+        text_encoders: list,
+        device,
+        offload: str = "delete",
+        offload_dir: str = None,
+    ):
+        if offload not in offload_targets:
+            raise ValueError(
+                f"Unknown text encoder offload target: {offload}. Choose from {offload_targets}."
+            )
+        if offload == "disk" and offload_dir is None:
+            raise ValueError(
+                "Offloading text encoders to disk requires an offload_dir."
+            )
+        self.text_encoders = [
+            text_encoder for text_encoder in text_encoders if text_encoder is not None
+        ]
+        self.device = device
+        self.offload_target = offload
+        self.offload_dir = offload_dir
+        # "device", "cpu", "meta" or "deleted"
+        self.location = "device"
+        self.holders = {}
+        self._created = time.time()
+        self._lock = threading.RLock()
+        # Moving a model to the meta device unties its shared weights, so their names are kept.
+        self._tensor_sources = {}
+        # Quantised encoders can't be written to safetensors, so they go to the CPU instead.
+        self._disk_offload = [
+            offload == "disk"
+            and all(
+                type(parameter.data) is torch.Tensor
+                for parameter in text_encoder.parameters()
+            )
+            for text_encoder in self.text_encoders
+        ]
+
+    def offload(self):
+        """Offload the encoders now, unless something holds them."""
+        with self._lock:
+            if not self.holders and self.location == "device":
+                self._offload()
+
+    @property
+    def can_rematerialise(self) -> bool:
+        return self.offload_target != "delete" and len(self.text_encoders) > 0
+
+    def acquire(self, reason: str):
+        """Hold the encoders on the accelerator until `release(reason)`."""
+        with self._lock:
+            if self.location == "deleted":
+                raise ValueError(
+                    f"The text encoders are needed for {reason}, but they were unloaded."
+                    " Use --text_encoder_offload=cpu or --text_encoder_offload=disk to allow them to be loaded again."
+                )
+            self.holders[reason] = self.holders.get(reason, 0) + 1
+            if self.location != "device":
+                self._rematerialise(reason)
+
+    def release(self, reason: str):
+        with self._lock:
+            if reason not in self.holders:
+                return
+            self.holders[reason] -= 1
+            if self.holders[reason] <= 0:
+                del self.holders[reason]
+            if not self.holders and self.location == "device":
+                self._offload()
+
+    @contextmanager
+    def loaded(self, reason: str):
+        self.acquire(reason)
+        try:
+            yield self.text_encoders
+        finally:
+            self.release(reason)
+
+    def memory_report(self) -> str:
+        return format_memory_usage(memory_usage())
+
+    def _offload_path(self, index: int) -> str:
+        return os.path.join(self.offload_dir, f"text_encoder_{index + 1}.safetensors")
+
+    def _offload(self):
+        before = self.memory_report()
+        if self.offload_target == "delete":
+            self.text_encoders.clear()
+            self.location = "deleted"
+        else:
+            for index, text_encoder in enumerate(self.text_encoders):
+                if not self._disk_offload[index]:
+                    text_encoder.to("cpu")
+                    continue
+                if index not in self._tensor_sources:
+                    self._write_offload_copy(index, text_encoder)
+                text_encoder.to("meta")
+            self.location = (
+                "meta" if self.offload_target == "disk" else self.offload_target
+            )
+        reclaim_memory()
+        logger.info(
+            f"Offloaded the text encoders to {self.offload_target}."
+            f"\n-> Before: {before}\n-> After: {self.memory_report()}"
+        )
+
+    def _write_offload_copy(self, index: int, text_encoder):
+        sources = _tensor_sources(text_encoder)
+        tensors = dict(
+            chain(text_encoder.named_parameters(), text_encoder.named_buffers())
+        )
+        self._tensor_sources[index] = sources
+        path = self._offload_path(index)
+        if os.path.exists(path) and os.path.getmtime(path) >= self._created:
+            # Another process on this machine already wrote it during this run.
+            return
+        os.makedirs(self.offload_dir, exist_ok=True)
+        logger.info(f"Writing text encoder {index + 1} to {path}")
+        temporary_path = f"{path}.tmp-{os.getpid()}"
+        save_file(
+            {
+                name: tensors[name].detach().to("cpu").contiguous()
+                for name in set(sources.values())
+            },
+            temporary_path,
+        )
+        os.replace(temporary_path, path)
+
+    def _rematerialise(self, reason: str):
+        before = self.memory_report()
+        for index, text_encoder in enumerate(self.text_encoders):
+            if self.location == "meta" and self._disk_offload[index]:
+                self._load_offload_copy(index, text_encoder)
+            else:
+                text_encoder.to(self.device)
+        self.location = "device"
+        logger.info(
+            f"Loaded the text encoders for {reason}."
+            f"\n-> Before: {before}\n-> After: {self.memory_report()}"
+        )
+
+    def _load_offload_copy(self, index: int, text_encoder):
+        tensors = load_file(self._offload_path(index), device="cpu")
+        restored = {}
+        for name, source in self._tensor_sources[index].items():
+            module_name, _, attribute = name.rpartition(".")
+            module = text_encoder.get_submodule(module_name)
+            is_parameter = attribute in module._parameters
+            if source not in restored:
+                tensor = tensors[source].to(self.device)
+                if is_parameter:
+                    tensor = torch.nn.Parameter(tensor, requires_grad=False)
+                restored[source] = tensor
+            if is_parameter:
+                module._parameters[attribute] = restored[source]
+            else:
+                module._buffers[attribute] = restored[source]
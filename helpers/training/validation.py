@@ -1,16 +1,14 @@
+import inspect
 import torch
 import os
-import wandb
 import logging
+from contextlib import nullcontext
 from tqdm import tqdm
 from helpers.training.wrappers import unwrap_model
+from helpers.training.prompt_embed_bank import PromptEmbedBank
 from PIL import Image
 from helpers.training.state_tracker import StateTracker
-from helpers.sdxl.pipeline import (
-    StableDiffusionXLPipeline,
-    StableDiffusionXLImg2ImgPipeline,
-)
-from helpers.legacy.pipeline import StableDiffusionPipeline
+from helpers.models.registry import get_pipeline_class
 from diffusers.schedulers import (
     EulerDiscreteScheduler,
     EulerAncestralDiscreteScheduler,
@@ -26,17 +24,6 @@ from helpers.image_manipulation.brightness import calculate_luminance
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
 
-try:
-    from helpers.sd3.pipeline import (
-        StableDiffusion3Pipeline,
-        StableDiffusion3Img2ImgPipeline,
-    )
-except ImportError:
-    logger.error(
-        "Stable Diffusion 3 not available in this release of Diffusers. Please upgrade."
-    )
-    raise ImportError()
-
 SCHEDULER_NAME_MAP = {
     "euler": EulerDiscreteScheduler,
     "euler-a": EulerAncestralDiscreteScheduler,
@@ -49,17 +36,12 @@ SCHEDULER_NAME_MAP = {
 import logging
 import os
 import time
-from diffusers.utils import is_wandb_available
 from helpers.prompts import PromptHandler
 from diffusers import (
     AutoencoderKL,
     DDIMScheduler,
 )
 
-if is_wandb_available():
-    import wandb
-
-
 logger = logging.getLogger("validation")
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL") or "INFO")
 
@@ -432,6 +414,7 @@ class Validation:
         self.ema_model = ema_model
         self.vae = vae
         self.pipeline = None
+        self.prompt_embed_bank = None
         self.deepfloyd = True if "deepfloyd" in self.args.model_type else False
         self.deepfloyd_stage2 = (
             True if "deepfloyd-stage2" in self.args.model_type else False
@@ -526,52 +509,46 @@ class Validation:
         model_type = StateTracker.get_model_type()
         if model_type == "sdxl":
             if self.args.controlnet:
-                from diffusers.pipelines import StableDiffusionXLControlNetPipeline
-
-                return StableDiffusionXLControlNetPipeline
+                return get_pipeline_class("sdxl", "controlnet")
             if self.args.validation_using_datasets:
-                return StableDiffusionXLImg2ImgPipeline
-            return StableDiffusionXLPipeline
+                return get_pipeline_class("sdxl", "img2img")
+            return get_pipeline_class("sdxl")
         elif model_type == "flux":
-            from helpers.models.flux import FluxPipeline
-
             if self.args.controlnet:
                 raise NotImplementedError("Flux ControlNet is not yet supported.")
             if self.args.validation_using_datasets:
                 raise NotImplementedError(
                     "Flux inference validation using img2img is not yet supported. Please remove --validation_using_datasets."
                 )
-            return FluxPipeline
+            return get_pipeline_class("flux")
         elif model_type == "kolors":
             if self.args.controlnet:
                 raise NotImplementedError("Kolors ControlNet is not yet supported.")
-            if self.args.validation_using_datasets:
-                try:
-                    from helpers.kolors.pipeline import KolorsImg2ImgPipeline
-                except:
-                    logger.error(
-                        "Kolors pipeline requires the latest version of Diffusers."
-                    )
-                return KolorsImg2ImgPipeline
             try:
-                from helpers.kolors.pipeline import KolorsPipeline
-            except Exception:
+                if self.args.validation_using_datasets:
+                    return get_pipeline_class("kolors", "img2img")
+                return get_pipeline_class("kolors")
+            except ImportError:
                 logger.error(
                     "Kolors pipeline requires the latest version of Diffusers."
                 )
-            return KolorsPipeline
+                raise
         elif model_type == "legacy":
             if self.deepfloyd_stage2:
-                from diffusers.pipelines import IFSuperResolutionPipeline
-
-                return IFSuperResolutionPipeline
-            return StableDiffusionPipeline
+                return get_pipeline_class("legacy", "superresolution")
+            return get_pipeline_class("legacy")
         elif model_type == "sd3":
             if self.args.controlnet:
                 raise Exception("SD3 ControlNet is not yet supported.")
-            if self.args.validation_using_datasets:
-                return StableDiffusion3Img2ImgPipeline
-            return StableDiffusion3Pipeline
+            try:
+                if self.args.validation_using_datasets:
+                    return get_pipeline_class("sd3", "img2img")
+                return get_pipeline_class("sd3")
+            except ImportError:
+                logger.error(
+                    "Stable Diffusion 3 not available in this release of Diffusers. Please upgrade."
+                )
+                raise
         elif model_type == "pixart_sigma":
             if self.args.controlnet:
                 raise Exception(
@@ -581,13 +558,9 @@ class Validation:
                 raise Exception(
                     "PixArt Sigma inference validation using img2img is not yet supported. Please remove --validation_using_datasets."
                 )
-            from helpers.pixart.pipeline import PixArtSigmaPipeline
-
-            return PixArtSigmaPipeline
+            return get_pipeline_class("pixart_sigma")
         elif model_type == "smoldit":
-            from helpers.models.smoldit import SmolDiTPipeline
-
-            return SmolDiTPipeline
+            return get_pipeline_class("smoldit")
         else:
             raise NotImplementedError(
                 f"Model type {model_type} not implemented for validation."
@@ -909,7 +882,7 @@ class Validation:
                 "vae": self.vae,
                 "safety_checker": None,
             }
-            if type(pipeline_cls) is StableDiffusionXLPipeline:
+            if type(pipeline_cls) is get_pipeline_class("sdxl"):
                 del extra_pipeline_kwargs["safety_checker"]
                 del extra_pipeline_kwargs["text_encoder"]
                 del extra_pipeline_kwargs["tokenizer"]
@@ -1043,23 +1016,70 @@ class Validation:
             del self.pipeline
             self.pipeline = None
 
+    def _hold_text_encoders(self):
+        """
+        Keep the text encoders loaded for the whole validation run if any prompt has to be encoded,
+        rather than loading them again for each one.
+        """
+        text_encoder_manager = StateTracker.get_text_encoder_manager()
+        if (
+            text_encoder_manager is None
+            or not text_encoder_manager.can_rematerialise
+            or self.embed_cache is None
+            or not self.validation_prompts
+            or not self.embed_cache.uncached_prompts(self.validation_prompts)
+        ):
+            return nullcontext()
+        return text_encoder_manager.loaded("validation prompts")
+
+    def _validation_content(self):
+        """The (shortname, prompt) or (shortname, prompt, image) of each validation sample."""
+        if self.validation_image_inputs:
+            # Override the pipeline inputs to be entirely based upon the validation image inputs.
+            return self.validation_image_inputs
+        if self.validation_shortnames is None:
+            return []
+        return list(zip(self.validation_shortnames, self.validation_prompts))
+
+    def _build_prompt_embed_bank(self, validation_content):
+        """
+        Gather the embeds of every validation prompt into a bank on the inference device. The
+        validation prompts don't change over a training run, so this only happens once, and the
+        text encoders are only needed for prompts that were never cached.
+        """
+        prompts = list(dict.fromkeys(content[1] for content in validation_content))
+        missing = [
+            prompt
+            for prompt in prompts
+            if self.prompt_embed_bank is None or prompt not in self.prompt_embed_bank
+        ]
+        if not missing:
+            return self.prompt_embed_bank
+        prompt_embeds = {}
+        with self._hold_text_encoders():
+            for prompt in prompts:
+                try:
+                    prompt_embeds[prompt] = self._gather_prompt_embeds(prompt)
+                except Exception as e:
+                    import traceback
+
+                    logger.error(
+                        f"Error gathering text embed for validation prompt {prompt}: {e}, traceback: {traceback.format_exc()}"
+                    )
+        self.prompt_embed_bank = PromptEmbedBank(
+            prompt_embeds, self.inference_device, self.weight_dtype
+        )
+        return self.prompt_embed_bank
+
     def process_prompts(self):
         """Processes each validation prompt and logs the result."""
         validation_images = {}
-        _content = zip(self.validation_shortnames, self.validation_prompts)
-        total_samples = (
-            len(self.validation_shortnames)
-            if self.validation_shortnames is not None
-            else 0
-        )
-        if self.validation_image_inputs:
-            # Override the pipeline inputs to be entirely based upon the validation image inputs.
-            _content = self.validation_image_inputs
-            total_samples = len(_content) if _content is not None else 0
+        _content = self._validation_content()
+        self._build_prompt_embed_bank(_content)
         for content in tqdm(
-            _content if _content else [],
+            _content,
             desc="Processing validation prompts",
-            total=total_samples,
+            total=len(_content),
             leave=False,
             position=1,
         ):
@@ -1155,15 +1175,10 @@ class Validation:
             )
             if validation_shortname not in validation_images:
                 validation_images[validation_shortname] = []
-            try:
-                extra_validation_kwargs.update(self._gather_prompt_embeds(prompt))
-            except Exception as e:
-                import traceback
-
-                logger.error(
-                    f"Error gathering text embed for validation prompt {prompt}: {e}, traceback: {traceback.format_exc()}"
-                )
+            if prompt not in self.prompt_embed_bank:
+                # The error was logged when the bank was built.
                 continue
+            extra_validation_kwargs.update(self.prompt_embed_bank.embeds(prompt))
 
             try:
                 pipeline_kwargs = {
@@ -1184,6 +1199,8 @@ class Validation:
                     pipeline_kwargs["guidance_scale_real"] = float(
                         self.args.validation_guidance_real
                     )
+                if "vae_decode" in inspect.signature(self.pipeline.__call__).parameters:
+                    pipeline_kwargs["vae_decode"] = self.args.validation_vae_decode
                 if (
                     isinstance(self.args.validation_no_cfg_until_timestep, int)
                     and self.args.flux
@@ -1260,6 +1277,8 @@ class Validation:
     def _log_validations_to_trackers(self, validation_images):
         for tracker in self.accelerator.trackers:
             if tracker.name == "wandb":
+                import wandb
+
                 resolution_list = [
                     f"{res[0]}x{res[1]}" for res in get_validation_resolutions()
                 ]
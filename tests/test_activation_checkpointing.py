@@ -0,0 +1,102 @@
+import unittest
+import torch
+
+from helpers.models.smoldit import SmolDiT2DModel
+from helpers.training.activation_checkpointing import ActivationCheckpointing
+
+
+def tiny_smoldit():
+    torch.manual_seed(0)
+    return SmolDiT2DModel(
+        sample_size=8,
+        patch_size=2,
+        num_attention_heads=2,
+        num_kv_heads=1,
+        attention_head_dim=8,
+        in_channels=4,
+        out_channels=4,
+        num_layers=4,
+        cross_attention_dim=16,
+    )
+
+
+class TestActivationCheckpointing(unittest.TestCase):
+    def setUp(self):
+        self.model = tiny_smoldit()
+        self.model.train()
+        torch.manual_seed(1)
+        self.inputs = {
+            "hidden_states": torch.randn(2, 4, 8, 8),
+            "timestep": torch.tensor([10, 500]),
+            "encoder_hidden_states": torch.randn(2, 6, 16),
+        }
+
+    def gradients(self):
+        self.model.zero_grad(set_to_none=True)
+        self.model(**self.inputs).sample.square().mean().backward()
+        return {
+            name: p.grad.clone()
+            for name, p in self.model.named_parameters()
+            if p.grad is not None
+        }
+
+    def assertGradientsEqual(self, expected, result):
+        self.assertEqual(expected.keys(), result.keys())
+        for name in expected:
+            self.assertTrue(
+                torch.allclose(expected[name], result[name], atol=1e-6), name
+            )
+
+    def test_policies_match_gradients(self):
+        expected = self.gradients()
+        for policy, checkpointed_modules in [
+            ("full", 4),
+            ("every_n", 2),
+            ("attention", 8),
+            ("mlp", 4),
+        ]:
+            with self.subTest(policy=policy):
+                checkpointing = ActivationCheckpointing(
+                    self.model, policy=policy, interval=2
+                ).apply()
+                self.assertEqual(
+                    checkpointing.summary()["checkpointed_modules"],
+                    checkpointed_modules,
+                )
+                self.assertGradientsEqual(expected, self.gradients())
+                checkpointing.remove()
+                self.assertNotIn("forward", self.model.blocks[0].__dict__)
+
+    def test_model_gradient_checkpointing(self):
+        expected = self.gradients()
+        self.model.enable_gradient_checkpointing()
+        self.assertTrue(self.model.gradient_checkpointing)
+        self.assertGradientsEqual(expected, self.gradients())
+
+    def test_auto_policy_fits_budget(self):
+        checkpointing = ActivationCheckpointing(
+            self.model, policy="auto", memory_budget=1.0
+        ).apply()
+        self.gradients()
+        block_bytes = checkpointing.block_activation_bytes[type(self.model.blocks[0])]
+        self.assertGreater(block_bytes, 0)
+        # Leave room for exactly two blocks' activations.
+        peak_memory = 1024**3 - 2 * block_bytes - 1
+        checkpointing.step("cpu")
+        self.assertFalse(checkpointing.fitted)
+        self.assertEqual(checkpointing.fit(peak_memory), 2)
+        self.assertEqual(checkpointing.summary()["checkpointed_blocks"], 2)
+        self.assertIn("forward", self.model.blocks[1].__dict__)
+        self.assertNotIn("forward", self.model.blocks[3].__dict__)
+
+    def test_invalid_configuration(self):
+        with self.assertRaises(ValueError):
+            ActivationCheckpointing(self.model, policy="sometimes")
+        with self.assertRaises(ValueError):
+            ActivationCheckpointing(self.model, policy="auto")
+        with self.assertRaises(ValueError):
+            ActivationCheckpointing(torch.nn.Linear(2, 2), policy="mlp").apply()
+
+
+if __name__ == "__main__":
+    unittest.main()
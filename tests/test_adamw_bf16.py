@@ -0,0 +1,83 @@
+import unittest
+import torch
+
+from helpers.training.adam_bfloat16 import AdamWBF16
+
+SHAPES = [(16, 64), (64, 16), (8,), (32, 32)]
+
+
+def make_params():
+    torch.manual_seed(0)
+    return [
+        torch.nn.Parameter(torch.randn(shape, dtype=torch.bfloat16) * 0.01)
+        for shape in SHAPES
+    ]
+
+
+def set_grads(params, step):
+    generator = torch.Generator().manual_seed(step)
+    for p in params:
+        p.grad = torch.randn(p.shape, generator=generator).to(torch.bfloat16)
+
+
+class TestAdamWBF16Foreach(unittest.TestCase):
+    def test_foreach_matches_per_tensor_update(self):
+        initial_params = make_params()
+        per_tensor_params, foreach_params = make_params(), make_params()
+        per_tensor = AdamWBF16(
+            per_tensor_params, lr=1e-3, weight_decay=1e-1, foreach=False
+        )
+        foreach = AdamWBF16(foreach_params, lr=1e-3, weight_decay=1e-1, foreach=True)
+        for step in range(50):
+            set_grads(per_tensor_params, step)
+            set_grads(foreach_params, step)
+            per_tensor.step()
+            foreach.step()
+        for initial, a, b in zip(initial_params, per_tensor_params, foreach_params):
+            # The true value of each weight is p + shift.
+            value_a = a.float() + per_tensor.state[a]["shift"].float()
+            value_b = b.float() + foreach.state[b]["shift"].float()
+            update = (value_a - initial.float()).abs().mean()
+            difference = (value_a - value_b).abs().mean()
+            # Only the stochastic rounding draws differ.
+            self.assertLess(difference, update * 0.05)
+
+    def test_scratch_buffers_are_reused(self):
+        params = make_params()
+        optimizer = AdamWBF16(params, lr=1e-3, weight_decay=1e-2)
+        set_grads(params, 0)
+        optimizer.step()
+        buffers = optimizer._foreach_buffers[(0, params[0].device)]
+        data_ptr = buffers["fp32"].data_ptr()
+        set_grads(params, 1)
+        optimizer.step()
+        self.assertIs(optimizer._foreach_buffers[(0, params[0].device)], buffers)
+        self.assertEqual(buffers["fp32"].data_ptr(), data_ptr)
+        # Each parameter's decay bookkeeping is a view into one tensor.
+        accumulated_decay = optimizer.state[params[1]]["accumulated_decay"]
+        self.assertTrue(torch.is_tensor(accumulated_decay))
+        self.assertEqual(
+            accumulated_decay.data_ptr(),
+            buffers["accumulated_decay"][1].data_ptr(),
+        )
+
+    def test_load_state_dict_with_float_decay(self):
+        params = make_params()
+        optimizer = AdamWBF16(params, lr=1e-3, weight_decay=1e-2)
+        set_grads(params, 0)
+        optimizer.step()
+        state_dict = optimizer.state_dict()
+        for state in state_dict["state"].values():
+            state["accumulated_decay"] = float(state["accumulated_decay"])
+        optimizer.load_state_dict(state_dict)
+        set_grads(params, 1)
+        optimizer.step()
+        for p in params:
+            self.assertEqual(optimizer.state[p]["step"], 2)
+            self.assertEqual(
+                optimizer.state[p]["accumulated_decay"].dtype, torch.float32
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
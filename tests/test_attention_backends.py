@@ -0,0 +1,123 @@
+import unittest
+import warnings
+import torch
+import torch.nn.functional as F
+
+from helpers.models.attention_backends import (
+    SlidingWindowBias,
+    attention,
+    attention_backends,
+    flex_attention_available,
+    set_attention_backend,
+)
+from helpers.models.smoldit.transformer import SmolDiTAttention
+
+
+def reference_window_mask(batch_size, heads, sequence_length, window_size):
+    mask = torch.zeros(batch_size, heads, sequence_length, sequence_length)
+    for i in range(sequence_length):
+        start = max(0, i - window_size)
+        end = min(sequence_length, i + window_size + 1)
+        mask[:, :, i, start:end] = 1
+    return mask
+
+
+def reference_attention(query, key, value, attn_mask=None, scale=None):
+    heads_per_kv_head = query.shape[1] // key.shape[1]
+    key = torch.repeat_interleave(key, heads_per_kv_head, dim=1)
+    value = torch.repeat_interleave(value, heads_per_kv_head, dim=1)
+    return F.scaled_dot_product_attention(
+        query, key, value, attn_mask=attn_mask, scale=scale
+    )
+
+
+class TestAttentionBackends(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.query = torch.randn(2, 8, 40, 16)
+        self.key = torch.randn(2, 2, 40, 16)
+        self.value = torch.randn(2, 2, 40, 16)
+        self.backends = [
+            name
+            for name in attention_backends
+            if name != "flex" or flex_attention_available()
+        ]
+
+    def run_backend(self, name, attn_mask):
+        options = {"chunk_size": 16} if name == "chunked" else {}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return attention(
+                self.query,
+                self.key,
+                self.value,
+                attn_mask=attn_mask,
+                scale=0.3,
+                backend=name,
+                **options,
+            )
+
+    def test_sliding_window(self):
+        expected = reference_attention(
+            self.query,
+            self.key,
+            self.value,
+            attn_mask=reference_window_mask(2, 8, 40, 5),
+            scale=0.3,
+        )
+        for name in self.backends:
+            with self.subTest(backend=name):
+                result = self.run_backend(name, SlidingWindowBias(5))
+                self.assertTrue(torch.allclose(result, expected, atol=1e-5))
+
+    def test_padding_bias(self):
+        padding = torch.zeros(2, 1, 1, 40)
+        padding[1, ..., 30:] = -10000.0
+        expected = reference_attention(
+            self.query, self.key, self.value, attn_mask=padding, scale=0.3
+        )
+        for name in self.backends:
+            with self.subTest(backend=name):
+                result = self.run_backend(name, padding)
+                self.assertTrue(torch.allclose(result, expected, atol=1e-5))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            attention(self.query, self.key, self.value, backend="missing")
+
+
+class TestSmolDiTAttentionBackends(unittest.TestCase):
+    def test_backends_match_sdpa(self):
+        torch.manual_seed(0)
+        module = SmolDiTAttention(
+            query_dim=64,
+            cross_attention_dim=None,
+            dim_head=16,
+            num_heads=4,
+            kv_heads=2,
+            sliding_window=3,
+        )
+        hidden_states = torch.randn(2, 24, 64)
+        expected = module(hidden_states)
+        # The sliding window used to be built as a dense tensor.
+        self.assertTrue(
+            torch.equal(
+                module.sliding_window_attention_mask(24, 3, 2, 4, "cpu"),
+                reference_window_mask(2, 4, 24, 3),
+            )
+        )
+        for name in ("gqa", "chunked"):
+            with self.subTest(backend=name):
+                self.assertEqual(
+                    set_attention_backend(
+                        module, name, **({"chunk_size": 8} if name == "chunked" else {})
+                    ),
+                    1,
+                )
+                self.assertTrue(
+                    torch.allclose(module(hidden_states), expected, atol=1e-5)
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
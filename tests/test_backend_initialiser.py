@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+from helpers.data_backend.initialiser import BackendInitialiser
+
+
+def shared_cache_file(init_backend):
+    return [("metadata", init_backend["cache_file"])]
+
+
+class TestBackendInitialiser(unittest.TestCase):
+    def setUp(self):
+        self.init_backends = [
+            {"id": "a", "cache_file": "one.json"},
+            {"id": "b", "cache_file": "two.json"},
+            {"id": "c", "cache_file": "one.json"},
+        ]
+
+    def test_dependency_groups(self):
+        initialiser = BackendInitialiser(
+            max_workers=4, shared_resources=shared_cache_file
+        )
+        groups = initialiser.dependency_groups(self.init_backends)
+        self.assertEqual(
+            [[init_backend["id"] for init_backend in group] for group in groups],
+            [["a", "c"], ["b"]],
+        )
+
+    def test_independent_datasets_run_concurrently(self):
+        initialiser = BackendInitialiser(
+            max_workers=4, shared_resources=shared_cache_file
+        )
+        # "a" and "b" can only both pass the barrier if they run at the same time.
+        barrier = threading.Barrier(2, timeout=10)
+        order = []
+
+        def phase(init_backend):
+            if init_backend["id"] != "c":
+                barrier.wait()
+            order.append(init_backend["id"])
+
+        initialiser.run("listing", self.init_backends, phase, concurrent=True)
+        # "c" shares a cache file with "a", so it runs after it.
+        self.assertLess(order.index("a"), order.index("c"))
+        self.assertEqual(set(initialiser.timings), {"a", "b", "c"})
+        self.assertIn("listing", initialiser.timings["c"])
+        self.assertIn("(id=b) listing=", initialiser.report())
+
+    def test_sequential_phases_keep_config_order(self):
+        initialiser = BackendInitialiser(max_workers=4)
+        order = []
+        initialiser.run(
+            "encode",
+            self.init_backends,
+            lambda init_backend: order.append(
+                (init_backend["id"], threading.current_thread())
+            ),
+        )
+        self.assertEqual([backend_id for backend_id, _ in order], ["a", "b", "c"])
+        self.assertTrue(
+            all(thread is threading.current_thread() for _, thread in order)
+        )
+
+    def test_errors_propagate(self):
+        initialiser = BackendInitialiser(max_workers=4)
+
+        def phase(init_backend):
+            if init_backend["id"] == "b":
+                raise ValueError("No images were discovered.")
+
+        with self.assertRaises(ValueError):
+            initialiser.run("listing", self.init_backends, phase, concurrent=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from helpers.training.checkpoint_converter import (
+    CONCATENATE,
+    RESHAPE_FOR_SD,
+    CheckpointConversion,
+    TensorSource,
+    apply_conversion_table,
+)
+
+
+class TestCheckpointConverter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.vae = {
+            "to_q.weight": torch.randn(4, 4),
+            "to_k.weight": torch.randn(4, 4),
+            "step": torch.tensor(3),
+        }
+        self.text_encoder = {
+            "q_proj.bias": torch.randn(4, dtype=torch.bfloat16),
+            "k_proj.bias": torch.randn(4, dtype=torch.bfloat16),
+            "v_proj.bias": torch.randn(4, dtype=torch.bfloat16),
+        }
+        self.vae_path = os.path.join(self.directory.name, "vae.safetensors")
+        save_file(self.vae, self.vae_path)
+        # A PyTorch .bin file, read through torch.load's memory map.
+        self.text_encoder_path = os.path.join(self.directory.name, "text_encoder.bin")
+        torch.save(self.text_encoder, self.text_encoder_path)
+        self.table = {
+            "q.weight": ("vae", RESHAPE_FOR_SD, ("to_q.weight",)),
+            "k.weight": ("vae", None, ("to_k.weight",)),
+            "step": ("vae", None, ("step",)),
+            "in_proj_bias": (
+                "text_encoder",
+                CONCATENATE,
+                ("q_proj.bias", "k_proj.bias", "v_proj.bias"),
+            ),
+        }
+        self.expected = {
+            "q.weight": self.vae["to_q.weight"].reshape(4, 4, 1, 1),
+            "k.weight": self.vae["to_k.weight"],
+            "step": self.vae["step"],
+            "in_proj_bias": torch.cat(list(self.text_encoder.values())),
+        }
+
+    def conversion(self, half=False):
+        return CheckpointConversion(
+            {
+                "vae": TensorSource(self.vae_path),
+                "text_encoder": TensorSource(self.text_encoder_path),
+            },
+            self.table,
+            half=half,
+        )
+
+    def test_streamed_conversion_matches_in_memory_conversion(self):
+        path = os.path.join(self.directory.name, "converted.safetensors")
+        self.conversion().save(path)
+        converted = load_file(path)
+        self.assertEqual(set(converted), set(self.expected))
+        for name, tensor in self.expected.items():
+            self.assertEqual(converted[name].dtype, tensor.dtype, name)
+            self.assertTrue(torch.equal(converted[name], tensor), name)
+        in_memory = apply_conversion_table(
+            {
+                "in_proj_bias": (
+                    CONCATENATE,
+                    ("q_proj.bias", "k_proj.bias", "v_proj.bias"),
+                )
+            },
+            self.text_encoder,
+        )
+        self.assertTrue(
+            torch.equal(in_memory["in_proj_bias"], converted["in_proj_bias"])
+        )
+
+    def test_half_precision_keeps_integer_tensors(self):
+        path = os.path.join(self.directory.name, "converted.ckpt")
+        conversion = self.conversion(half=True)
+        specs = {name: dtype for name, dtype, _ in conversion.tensor_specs()}
+        self.assertEqual(specs["q.weight"], "F16")
+        self.assertEqual(specs["step"], "I64")
+        conversion.save(path, use_safetensors=False)
+        converted = torch.load(path, weights_only=True)["state_dict"]
+        self.assertEqual(converted["in_proj_bias"].dtype, torch.float16)
+        self.assertEqual(converted["step"].dtype, torch.int64)
+        self.assertEqual(list(converted["q.weight"].shape), [4, 4, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import json
+import os
+import tempfile
+import unittest
+
+import torch
+from diffusers import ConfigMixin, ModelMixin
+from diffusers.configuration_utils import register_to_config
+
+from helpers.training.checkpoint_loader import (
+    BASE_MODEL_KEY,
+    UNCHANGED_FROM_BASE_KEY,
+    CheckpointReader,
+    load_into_model,
+    unchanged_from_base,
+)
+from helpers.training.checkpoint_store import CheckpointStore
+from helpers.training.checkpoint_writer import save_model
+
+
+class TinyModel(ModelMixin, ConfigMixin):
+    @register_to_config
+    def __init__(self, width: int = 4):
+        super().__init__()
+        self.frozen = torch.nn.Linear(width, width)
+        self.trained = torch.nn.Linear(width, width)
+        self.frozen.requires_grad_(False)
+
+
+class TestCheckpointLoader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        torch.manual_seed(0)
+        self.saved = TinyModel()
+        self.metadata = {
+            BASE_MODEL_KEY: "base",
+            UNCHANGED_FROM_BASE_KEY: json.dumps(["frozen.bias", "frozen.weight"]),
+        }
+
+    def assertLoaded(self, model, names):
+        for name, tensor in model.state_dict().items():
+            self.assertEqual(
+                torch.equal(tensor, self.saved.state_dict()[name]),
+                name in names,
+                name,
+            )
+
+    def test_loads_in_place_skipping_unchanged_weights(self):
+        model_dir = os.path.join(self.directory.name, "transformer")
+        save_model(self.saved, model_dir, metadata=self.metadata)
+        model = TinyModel()
+        parameter = model.trained.weight
+        with CheckpointReader(model_dir) as reader:
+            skip = unchanged_from_base(reader, "base")
+            self.assertEqual(skip, {"frozen.weight", "frozen.bias"})
+            stats = load_into_model(model, reader, skip=skip)
+        self.assertIs(model.trained.weight, parameter)
+        self.assertLoaded(model, {"trained.weight", "trained.bias"})
+        self.assertEqual(stats["loaded_bytes"], (16 + 4) * 4)
+        self.assertEqual(stats["skipped_bytes"], (16 + 4) * 4)
+
+    def test_different_base_model_loads_everything(self):
+        model_dir = os.path.join(self.directory.name, "transformer")
+        save_model(self.saved, model_dir, metadata=self.metadata)
+        model = TinyModel()
+        with CheckpointReader(model_dir) as reader:
+            skip = unchanged_from_base(reader, "another base")
+            self.assertEqual(skip, set())
+            load_into_model(model, reader, skip=skip)
+        self.assertLoaded(model, set(self.saved.state_dict()))
+
+    def test_loads_sharded_and_stored_checkpoints(self):
+        sharded_dir = os.path.join(self.directory.name, "sharded")
+        self.saved.save_pretrained(sharded_dir, max_shard_size=100)
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(
+                    sharded_dir, "diffusion_pytorch_model.safetensors.index.json"
+                )
+            )
+        )
+        stored_dir = os.path.join(self.directory.name, "checkpoint-1", "transformer")
+        CheckpointStore(self.directory.name).save_model(self.saved, stored_dir)
+        for model_dir in (sharded_dir, stored_dir):
+            model = TinyModel()
+            with CheckpointReader(model_dir) as reader:
+                load_into_model(model, reader)
+            self.assertLoaded(model, set(self.saved.state_dict()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import torch
+
+from helpers.training.checkpoint_store import CheckpointStore
+
+
+class TestCheckpointStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.store = CheckpointStore(self.directory.name)
+        self.state_dict = {
+            "frozen.weight": torch.randn(4, 3, dtype=torch.bfloat16),
+            "trained.weight": torch.randn(3, 5),
+            "step": torch.tensor(7),
+            "empty": torch.zeros(0, 2, dtype=torch.float16),
+            "mask": torch.tensor([True, False, True]),
+        }
+
+    def save_checkpoint(self, step):
+        return self.store.save_state_dict(
+            self.state_dict,
+            os.path.join(self.directory.name, f"checkpoint-{step}", "transformer"),
+        )
+
+    def stored_objects(self):
+        return {
+            name for _, _, names in os.walk(self.store.objects_dir) for name in names
+        }
+
+    def test_round_trip(self):
+        self.save_checkpoint(1)
+        loaded = self.store.load_state_dict(
+            os.path.join(self.directory.name, "checkpoint-1", "transformer")
+        )
+        self.assertEqual(set(loaded), set(self.state_dict))
+        for name, tensor in self.state_dict.items():
+            self.assertEqual(loaded[name].dtype, tensor.dtype, name)
+            self.assertTrue(torch.equal(loaded[name], tensor), name)
+
+    def test_unchanged_tensors_are_not_written_again(self):
+        first = self.save_checkpoint(1)
+        self.assertEqual(first["written_bytes"], first["total_bytes"])
+        objects = self.stored_objects()
+
+        self.state_dict["trained.weight"].add_(1)
+        second = self.save_checkpoint(2)
+        self.assertEqual(second["total_bytes"], first["total_bytes"])
+        self.assertEqual(
+            second["written_bytes"],
+            self.state_dict["trained.weight"].numel() * 4,
+        )
+        self.assertEqual(len(self.stored_objects() - objects), 1)
+
+        # A fresh store, eg. after resuming, still recognises the stored tensors by their contents.
+        self.store = CheckpointStore(self.directory.name)
+        self.assertEqual(self.save_checkpoint(3)["written_bytes"], 0)
+
+    def test_writes_through_data_are_stored(self):
+        # Large enough that only a sample of it is compared.
+        self.state_dict["large.weight"] = torch.zeros(64, 1024)
+        self.save_checkpoint(1)
+        # Neither bumps the version counter.
+        self.state_dict["trained.weight"].data.add_(1)
+        self.state_dict["large.weight"].data.copy_(torch.ones(64, 1024))
+        self.assertEqual(self.state_dict["trained.weight"]._version, 0)
+        second = self.save_checkpoint(2)
+        self.assertEqual(
+            second["written_bytes"],
+            self.state_dict["trained.weight"].numel() * 4
+            + self.state_dict["large.weight"].numel() * 4,
+        )
+        loaded = self.store.load_state_dict(
+            os.path.join(self.directory.name, "checkpoint-2", "transformer")
+        )
+        for name in ("trained.weight", "large.weight"):
+            self.assertTrue(torch.equal(loaded[name], self.state_dict[name]), name)
+
+    def test_models_sharing_tensor_names_are_not_hashed_again(self):
+        # EMA weights are stored under the same names as the model's.
+        ema_state_dict = {
+            name: tensor.clone() + 1 for name, tensor in self.state_dict.items()
+        }
+
+        def save_checkpoint(step):
+            checkpoint_dir = os.path.join(self.directory.name, f"checkpoint-{step}")
+            self.store.save_state_dict(
+                ema_state_dict, os.path.join(checkpoint_dir, "ema")
+            )
+            self.store.save_state_dict(
+                self.state_dict, os.path.join(checkpoint_dir, "transformer")
+            )
+
+        save_checkpoint(1)
+        with patch(
+            "helpers.training.checkpoint_store.hashlib.sha256", wraps=hashlib.sha256
+        ) as sha256:
+            save_checkpoint(2)
+            save_checkpoint(3)
+        self.assertEqual(sha256.call_count, 0)
+        loaded = self.store.load_state_dict(
+            os.path.join(self.directory.name, "checkpoint-3", "ema")
+        )
+        self.assertTrue(
+            torch.equal(loaded["trained.weight"], ema_state_dict["trained.weight"])
+        )
+
+    def test_rotated_out_tensors_are_collected(self):
+        self.save_checkpoint(1)
+        objects = self.stored_objects()
+        self.state_dict["trained.weight"].add_(1)
+        self.save_checkpoint(2)
+
+        self.assertEqual(self.store.collect_garbage()["objects"], 0)
+        shutil.rmtree(os.path.join(self.directory.name, "checkpoint-1"))
+        self.assertEqual(self.store.collect_garbage()["objects"], 1)
+        self.assertEqual(len(objects - self.stored_objects()), 1)
+        self.assertEqual(
+            set(
+                self.store.load_state_dict(
+                    os.path.join(self.directory.name, "checkpoint-2", "transformer")
+                )
+            ),
+            set(self.state_dict),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
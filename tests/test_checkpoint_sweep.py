@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+
+import torch
+from diffusers import ConfigMixin, ModelMixin
+from diffusers.configuration_utils import register_to_config
+from PIL import Image
+
+from helpers.training.checkpoint_sweep import (
+    CheckpointSweep,
+    StageTimer,
+    WeightSwapper,
+    checkpoint_kind,
+    list_checkpoints,
+    make_grid,
+    tile_directory,
+)
+from helpers.training.checkpoint_writer import save_model
+
+
+class TinyModel(ModelMixin, ConfigMixin):
+    @register_to_config
+    def __init__(self, width: int = 4):
+        super().__init__()
+        self.linear = torch.nn.Linear(width, width)
+
+
+class FakePipeline:
+    """Returns an image whose colour is the transformer's first weight at generation time."""
+
+    def __init__(self):
+        self.transformer = TinyModel()
+        self.scheduler = object()
+        self.device = torch.device("cpu")
+        self.calls = []
+
+    def __call__(self, prompt=None, negative_prompt=None, generator=None, **kwargs):
+        value = int(self.transformer.linear.weight[0, 0].item())
+        self.calls.append((prompt, value))
+        image = Image.new("RGB", (8, 8), (value, value, value))
+        return type("Output", (), {"images": [image]})
+
+
+class TestCheckpointSweep(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.output_dir = self.directory.name
+
+    def save_checkpoint(self, step, value):
+        model = TinyModel()
+        with torch.no_grad():
+            model.linear.weight.fill_(value)
+        path = os.path.join(self.output_dir, f"checkpoint-{step}")
+        save_model(model, os.path.join(path, "transformer"))
+        return path
+
+    def test_lists_checkpoints_by_step(self):
+        for step in (100, 20):
+            self.save_checkpoint(step, step)
+        os.makedirs(os.path.join(self.output_dir, "checkpoint-temporary"))
+        os.makedirs(os.path.join(self.output_dir, "tensor_store"))
+        checkpoints = list_checkpoints(self.output_dir)
+        self.assertEqual([step for step, _ in checkpoints], [20, 100])
+        self.assertEqual(checkpoint_kind(checkpoints[0][1], "transformer"), "full")
+        with self.assertRaises(FileNotFoundError):
+            checkpoint_kind(checkpoints[0][1], "unet")
+
+    def test_sweep_swaps_weights_into_one_pipeline(self):
+        checkpoints = [
+            (str(step), self.save_checkpoint(step, step)) for step in (10, 20)
+        ]
+        pipeline = FakePipeline()
+        with torch.no_grad():
+            pipeline.transformer.linear.weight.fill_(1)
+        parameter = pipeline.transformer.linear.weight
+        sweep_dir = os.path.join(self.output_dir, "sweep")
+        timer = StageTimer()
+        grid_path = CheckpointSweep(
+            pipeline,
+            "transformer",
+            {"cat": "a cat", "dog": "a dog"},
+            [("base", None)] + checkpoints,
+            ["default"],
+            sweep_dir,
+            timer=timer,
+        ).run()
+        self.assertIs(pipeline.transformer.linear.weight, parameter)
+        self.assertEqual(
+            pipeline.calls,
+            [(prompt, value) for value in (1, 10, 20) for prompt in ("a cat", "a dog")],
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(sweep_dir, "default", "dog-20.png"))
+        )
+        with Image.open(grid_path) as grid:
+            self.assertEqual(grid.height, 30 + 2 * 8)
+        self.assertEqual(timer.counts["generate"], 6)
+        self.assertIn("swap weights", timer.report())
+
+    def test_full_checkpoints_keep_the_base_text_encoders(self):
+        path = self.save_checkpoint(10, 10)
+        save_model(TinyModel(), os.path.join(path, "text_encoder"))
+        swapper = WeightSwapper(FakePipeline(), "transformer")
+        # Their text encoder weights aren't loaded, so prompts needn't be encoded again.
+        self.assertFalse(swapper.changes_text_encoders(path))
+        self.assertFalse(swapper.changes_text_encoders(None))
+
+    def test_tiles_a_directory_by_step(self):
+        for label, value in (("100", 100), ("5", 5), ("base", 0)):
+            Image.new("RGB", (8, 8), (value, 0, 0)).save(
+                os.path.join(self.output_dir, f"cat-{label}.png")
+            )
+        grid_path = tile_directory(self.output_dir)
+        with Image.open(grid_path) as grid:
+            pixels = [
+                grid.getpixel((grid.width - 8 * i, grid.height - 1)) for i in (3, 2, 1)
+            ]
+        self.assertEqual([pixel[0] for pixel in pixels], [5, 100, 0])
+
+    def test_grid_leaves_missing_cells_blank(self):
+        image = Image.new("RGB", (8, 8), "black")
+        grid = make_grid({("a", "1"): image}, ["a", "b"], ["1", "2"])
+        self.assertEqual(
+            grid.getpixel((grid.width - 1, grid.height - 1)), (255, 255, 255)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
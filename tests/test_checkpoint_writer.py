@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+import unittest
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from helpers.training.checkpoint_writer import (
+    WEIGHTS_NAME,
+    replace_path,
+    save_state_dict,
+)
+from helpers.training.save_hooks import merge_safetensors_files
+
+
+class TestCheckpointWriter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.state_dict = {
+            "weight": torch.randn(4, 3, dtype=torch.bfloat16),
+            "bias": torch.randn(3),
+            "transposed": torch.randn(3, 5).t(),
+            "step": torch.tensor(7),
+            "empty": torch.zeros(0, 2, dtype=torch.float16),
+            "mask": torch.tensor([True, False, True]),
+        }
+
+    def assertStateDictEqual(self, loaded, expected):
+        self.assertEqual(set(loaded), set(expected))
+        for name, tensor in expected.items():
+            self.assertEqual(loaded[name].dtype, tensor.dtype, name)
+            self.assertTrue(torch.equal(loaded[name], tensor), name)
+
+    def test_streamed_file_loads_with_safetensors(self):
+        path = os.path.join(self.directory.name, WEIGHTS_NAME)
+        written = save_state_dict(self.state_dict, path, metadata={"format": "pt"})
+        self.assertEqual(written, os.path.getsize(path))
+        self.assertStateDictEqual(load_file(path), self.state_dict)
+
+    def test_merge_shards(self):
+        names = list(self.state_dict)
+        shards = {
+            "part-1.safetensors": names[:3],
+            "part-2.safetensors": names[3:],
+        }
+        weight_map = {}
+        for file_name, shard_names in shards.items():
+            save_file(
+                {name: self.state_dict[name].contiguous() for name in shard_names},
+                os.path.join(self.directory.name, file_name),
+            )
+            weight_map.update({name: file_name for name in shard_names})
+        with open(
+            os.path.join(
+                self.directory.name, "diffusion_pytorch_model.safetensors.index.json"
+            ),
+            "w",
+        ) as f:
+            json.dump({"weight_map": weight_map}, f)
+
+        merge_safetensors_files(self.directory.name)
+        self.assertEqual(os.listdir(self.directory.name), [WEIGHTS_NAME])
+        self.assertStateDictEqual(
+            load_file(os.path.join(self.directory.name, WEIGHTS_NAME)),
+            self.state_dict,
+        )
+
+    def test_replace_directory(self):
+        source = os.path.join(self.directory.name, "temporary", "transformer")
+        destination = os.path.join(self.directory.name, "transformer")
+        for directory, content in ((source, "new"), (destination, "old")):
+            os.makedirs(directory)
+            with open(os.path.join(directory, "config.json"), "w") as f:
+                f.write(content)
+        replace_path(source, destination)
+        self.assertFalse(os.path.exists(source))
+        with open(os.path.join(destination, "config.json")) as f:
+            self.assertEqual(f.read(), "new")
+        self.assertEqual(
+            sorted(os.listdir(self.directory.name)), ["temporary", "transformer"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+from io import BytesIO
+from unittest.mock import MagicMock, Mock, patch
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from helpers.image_manipulation.perceptual_hash import (
+    hamming_distances,
+    image_hash,
+    image_hashes,
+)
+from helpers.metadata.backends.json import JsonMetadataBackend
+from helpers.metadata.deduplication import HammingIndex, find_duplicates
+from helpers.training.state_tracker import StateTracker
+from tests.helpers.data import MockDataBackend
+
+
+def draw_image(seed: int, size=(256, 192)) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x, y = rng.integers(0, size[0]), rng.integers(0, size[1])
+        radius = int(rng.integers(10, 60))
+        draw.ellipse(
+            (x - radius, y - radius, x + radius, y + radius),
+            fill=tuple(int(value) for value in rng.integers(0, 256, 3)),
+        )
+    return image
+
+
+class TestPerceptualHash(unittest.TestCase):
+    def test_resized_copies_hash_alike(self):
+        for method in ("phash", "dhash"):
+            original = draw_image(0)
+            hashes = image_hashes(
+                [original, original.resize((128, 96)), draw_image(1)], method
+            )
+            self.assertEqual(hashes.dtype, np.uint64)
+            distances = hamming_distances(hashes, int(hashes[0]))
+            self.assertLessEqual(distances[1], 4, method)
+            self.assertGreater(distances[2], 12, method)
+            self.assertEqual(image_hash(original, method), f"{int(hashes[0]):016x}")
+
+    def test_index_matches_a_scan(self):
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(0, 2**64, 2000, dtype=np.uint64)
+        # Near-copies of the first hashes, with 1 to 5 bits flipped.
+        for i in range(50):
+            value = int(hashes[i])
+            for bit in rng.choice(64, i % 5 + 1, replace=False):
+                value ^= 1 << int(bit)
+            hashes[1000 + i] = value
+        index = HammingIndex(max_distance=3)
+        for key, value in enumerate(hashes):
+            index.add(key, int(value))
+        for value in hashes[:100]:
+            distances = hamming_distances(hashes, int(value))
+            expected = sorted(np.flatnonzero(distances <= 3).tolist())
+            matches = index.query(int(value))
+            self.assertEqual(sorted(key for key, _ in matches), expected)
+            self.assertEqual(matches[0][1], 0)
+
+    def test_groups_do_not_chain(self):
+        duplicates = find_duplicates(
+            [("a", 0b0000), ("b", 0b0011), ("c", 0b1111), ("d", 0b0001)],
+            max_distance=2,
+        )
+        # c is within 2 bits of b, but b was grouped with a.
+        self.assertEqual(duplicates, {"b": "a", "d": "a"})
+
+
+class TestMetadataBackendDeduplication(unittest.TestCase):
+    def setUp(self):
+        self.data_backend = MockDataBackend()
+        self.data_backend.id = "foo"
+        self.data_backend.exists = Mock(return_value=False)
+        self.data_backend.write = Mock(return_value=True)
+        StateTracker.set_args(MagicMock())
+        self.images = {
+            "/data/large.png": (draw_image(0).resize((512, 384)), 1.33),
+            "/data/small.png": (draw_image(0), 1.33),
+            "/data/other.png": (draw_image(1), 1.33),
+            "/data/square.png": (draw_image(2, (256, 256)), 1.0),
+        }
+
+    def backend(self, action: str) -> JsonMetadataBackend:
+        with patch(
+            "helpers.training.state_tracker.StateTracker._save_to_disk",
+            return_value=True,
+        ):
+            backend = JsonMetadataBackend(
+                id="foo",
+                instance_data_dir="/data",
+                cache_file="/data/cache",
+                metadata_file="/data/metadata",
+                batch_size=1,
+                data_backend=self.data_backend,
+                resolution=1,
+                resolution_type="area",
+                accelerator=Mock(),
+                deduplicate={"hash": "phash", "max_distance": 4, "action": action},
+            )
+        backend.aspect_ratio_bucket_indices = {}
+        for path, (image, aspect_ratio) in self.images.items():
+            backend.aspect_ratio_bucket_indices.setdefault(
+                str(aspect_ratio), []
+            ).append(path)
+            backend.image_metadata[path] = {
+                "original_size": image.size,
+                "aspect_ratio": aspect_ratio,
+                "phash": image_hash(image),
+            }
+        return backend
+
+    def test_drop_keeps_the_largest_image(self):
+        backend = self.backend("drop")
+        backend.deduplicate_images(set(self.images))
+        self.assertEqual(backend.duplicates, {"/data/small.png": "/data/large.png"})
+        self.assertEqual(
+            backend.aspect_ratio_bucket_indices,
+            {
+                "1.33": ["/data/large.png", "/data/other.png"],
+                "1.0": ["/data/square.png"],
+            },
+        )
+        # Dropped images aren't discovered again as new files.
+        with patch(
+            "helpers.training.state_tracker.StateTracker.get_image_files",
+            return_value=list(self.images),
+        ):
+            self.assertEqual(backend._discover_new_files(), [])
+
+        # Once deduplication is turned off, they go back into their buckets.
+        backend.deduplicate = None
+        backend.deduplicate_images(set(self.images))
+        self.assertEqual(backend.duplicates, {})
+        self.assertIn("/data/small.png", backend.aspect_ratio_bucket_indices["1.33"])
+
+    def test_downweight_marks_the_group_as_seen(self):
+        backend = self.backend("downweight")
+        backend.deduplicate_images(set(self.images))
+        self.assertEqual(
+            sum(len(images) for images in backend.aspect_ratio_bucket_indices.values()),
+            4,
+        )
+        backend.mark_batch_as_seen(["/data/small.png", "/data/square.png"])
+        self.assertTrue(backend.is_seen("/data/large.png"))
+        self.assertFalse(backend.is_seen("/data/other.png"))
+
+    def test_missing_hashes_are_computed_from_the_images(self):
+        backend = self.backend("drop")
+        for metadata in backend.image_metadata.values():
+            del metadata["phash"]
+        images = {path: image for path, (image, _) in self.images.items()}
+
+        def read(path):
+            buffer = BytesIO()
+            images[path].save(buffer, format="PNG")
+            return buffer.getvalue()
+
+        self.data_backend.read = Mock(side_effect=read)
+        with patch.object(backend, "save_image_metadata") as save_image_metadata:
+            backend.deduplicate_images(set(self.images))
+        save_image_metadata.assert_called_once()
+        self.assertEqual(backend.duplicates, {"/data/small.png": "/data/large.png"})
+        self.assertIn("phash", backend.image_metadata["/data/other.png"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+import torch
+import safetensors.torch
+
+from helpers.training.flat_parameters import FlatParameterBuffer
+
+
+class TinyAdapter(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.lora_A = torch.nn.Linear(8, 2, bias=False)
+        self.lora_B = torch.nn.Linear(2, 8, bias=False)
+        self.frozen = torch.nn.Linear(8, 8)
+        self.frozen.requires_grad_(False)
+
+    def forward(self, x):
+        return self.frozen(x) + self.lora_B(self.lora_A(x))
+
+
+def trainable(model):
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+class TestFlatParameterBuffer(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = TinyAdapter()
+        torch.nn.init.normal_(self.model.lora_B.weight)
+        self.reference = TinyAdapter()
+        self.reference.load_state_dict(self.model.state_dict())
+        self.inputs = torch.randn(4, 8)
+
+    def test_matches_unpacked_training(self):
+        optimizer = torch.optim.AdamW(trainable(self.model), lr=1e-2)
+        flat_parameters = FlatParameterBuffer(optimizer)
+        reference_optimizer = torch.optim.AdamW(trainable(self.reference), lr=1e-2)
+        self.assertEqual(len(optimizer.param_groups[0]["params"]), 1)
+        self.assertTrue(flat_parameters.is_packed())
+        for _ in range(3):
+            self.model(self.inputs).pow(2).mean().backward()
+            norm = flat_parameters.clip_grad_norm_(0.1)
+            optimizer.step()
+            flat_parameters.zero_grad()
+
+            self.reference(self.inputs).pow(2).mean().backward()
+            reference_norm = torch.nn.utils.clip_grad_norm_(
+                trainable(self.reference), 0.1
+            )
+            reference_optimizer.step()
+            reference_optimizer.zero_grad()
+            torch.testing.assert_close(norm, reference_norm)
+        for (name, p), (_, reference_p) in zip(
+            self.model.named_parameters(), self.reference.named_parameters()
+        ):
+            torch.testing.assert_close(p, reference_p, msg=name)
+        self.assertTrue(flat_parameters.is_packed())
+
+    def test_fp32_gradient_accumulation(self):
+        self.model.to(torch.bfloat16)
+        optimizer = torch.optim.SGD(trainable(self.model), lr=1e-2)
+        flat_parameters = FlatParameterBuffer(optimizer, grad_dtype=torch.float32)
+        for _ in range(2):
+            self.model(self.inputs.to(torch.bfloat16)).float().pow(2).mean().backward()
+        self.assertEqual(self.model.lora_A.weight.grad.dtype, torch.float32)
+        self.assertEqual(flat_parameters.parameters()[0].grad.dtype, torch.float32)
+        self.assertTrue(flat_parameters.is_packed())
+        self.assertGreater(flat_parameters.buffers[0]["flat_grad"].abs().sum(), 0)
+
+    def test_state_dict_round_trip(self):
+        optimizer = torch.optim.AdamW(trainable(self.model), lr=1e-2)
+        flat_parameters = FlatParameterBuffer(optimizer)
+        state_dict = self.model.state_dict()
+        self.assertEqual(
+            list(state_dict.keys()), list(self.reference.state_dict().keys())
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "adapter.safetensors")
+            safetensors.torch.save_file(
+                {k: v for k, v in state_dict.items() if "lora" in k}, path
+            )
+            loaded = safetensors.torch.load_file(path)
+        self.model.lora_A.weight.data.zero_()
+        self.model.load_state_dict(loaded, strict=False)
+        torch.testing.assert_close(
+            self.model.lora_A.weight, self.reference.lora_A.weight
+        )
+        # Loading copies into the views, so the optimizer still sees the weights.
+        self.assertTrue(flat_parameters.is_packed())
+
+    def test_repack_after_move(self):
+        optimizer = torch.optim.AdamW(trainable(self.model), lr=1e-2)
+        flat_parameters = FlatParameterBuffer(optimizer)
+        flat_param = flat_parameters.parameters()[0]
+        self.model.to(torch.float64)
+        self.assertFalse(flat_parameters.is_packed())
+        flat_parameters.repack()
+        self.assertTrue(flat_parameters.is_packed())
+        self.assertIs(optimizer.param_groups[0]["params"][0], flat_param)
+        # The weights are copied back into the buffer, which keeps its dtype.
+        torch.testing.assert_close(
+            self.model.lora_B.weight, self.reference.lora_B.weight
+        )
+
+    def test_refuses_optimizer_with_state(self):
+        optimizer = torch.optim.AdamW(trainable(self.model), lr=1e-2)
+        self.model(self.inputs).sum().backward()
+        optimizer.step()
+        with self.assertRaises(ValueError):
+            FlatParameterBuffer(optimizer)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+import torch
+
+from helpers.models.flux.positions import (
+    FluxPositionCache,
+    prepare_latent_image_ids,
+    prepare_text_ids,
+)
+from helpers.models.flux.transformer import EmbedND, expand_flux_attention_mask
+
+
+def reference_latent_image_ids(batch_size, height, width):
+    latent_image_ids = torch.zeros(height // 2, width // 2, 3)
+    latent_image_ids[..., 1] = (
+        latent_image_ids[..., 1] + torch.arange(height // 2)[:, None]
+    )
+    latent_image_ids[..., 2] = (
+        latent_image_ids[..., 2] + torch.arange(width // 2)[None, :]
+    )
+    return (
+        latent_image_ids[None, :].repeat(batch_size, 1, 1, 1).reshape(batch_size, -1, 3)
+    )
+
+
+class CountingEmbedND(EmbedND):
+    def __init__(self):
+        super().__init__(dim=32, theta=10000, axes_dim=[8, 12, 12])
+        self.calls = 0
+
+    def forward(self, ids):
+        self.calls += 1
+        return super().forward(ids)
+
+
+class TestFluxPositionCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = FluxPositionCache()
+
+    def test_latent_image_ids_match_reference(self):
+        for height, width in [(64, 64), (48, 80), (96, 32)]:
+            img_ids = prepare_latent_image_ids(3, height, width, "cpu", torch.float32)
+            self.assertTrue(
+                torch.equal(img_ids, reference_latent_image_ids(3, height, width))
+            )
+        text_ids = prepare_text_ids(2, 77, "cpu", torch.bfloat16)
+        self.assertEqual(text_ids.shape, (2, 77, 3))
+        self.assertEqual(text_ids.dtype, torch.bfloat16)
+        self.assertFalse(text_ids.any())
+
+    def test_ids_are_reused(self):
+        first = self.cache.latent_image_ids(64, 64, "cpu", torch.float32)
+        second = self.cache.latent_image_ids(64, 64, "cpu", torch.float32)
+        self.assertIs(first, second)
+        other_dtype = self.cache.latent_image_ids(64, 64, "cpu", torch.bfloat16)
+        self.assertIsNot(first, other_dtype)
+
+    def test_entries_are_bounded(self):
+        cache = FluxPositionCache(max_entries=2)
+        for size in (16, 32, 48):
+            cache.latent_image_ids(size, size, "cpu", torch.float32)
+        self.assertEqual(len(cache.ids), 2)
+
+    def test_rotary_embedding_is_cached(self):
+        pos_embed = CountingEmbedND()
+        img_ids = self.cache.latent_image_ids(32, 48, "cpu", torch.float32).expand(
+            4, -1, -1
+        )
+        txt_ids = self.cache.text_ids(16, "cpu", torch.float32).expand(4, -1, -1)
+        expected = EmbedND(dim=32, theta=10000, axes_dim=[8, 12, 12])(
+            torch.cat((txt_ids, img_ids), dim=1)
+        )
+        first = self.cache.rotary_embedding(pos_embed, txt_ids, img_ids)
+        second = self.cache.rotary_embedding(
+            pos_embed, txt_ids[:1].expand(4, -1, -1), img_ids[:1].expand(4, -1, -1)
+        )
+        self.assertTrue(torch.allclose(first, expected))
+        self.assertIs(first, second)
+        self.assertEqual(pos_embed.calls, 1)
+
+    def test_rotary_embedding_sees_in_place_changes(self):
+        pos_embed = CountingEmbedND()
+        img_ids = reference_latent_image_ids(2, 16, 16)
+        txt_ids = torch.zeros(2, 8, 3)
+        self.cache.rotary_embedding(pos_embed, txt_ids, img_ids)
+        img_ids[1] += 1
+        result = self.cache.rotary_embedding(pos_embed, txt_ids, img_ids)
+        self.assertEqual(pos_embed.calls, 2)
+        expected = EmbedND(dim=32, theta=10000, axes_dim=[8, 12, 12])(
+            torch.cat((txt_ids, img_ids), dim=1)
+        )
+        self.assertTrue(torch.allclose(result, expected))
+
+
+class TestExpandFluxAttentionMask(unittest.TestCase):
+    def test_expanded_mask(self):
+        hidden_states = torch.zeros(2, 6, 4)
+        attn_mask = torch.tensor([[1, 1, 0], [1, 0, 0]])
+        expanded = expand_flux_attention_mask(hidden_states, attn_mask)
+        self.assertTrue(
+            torch.equal(
+                expanded,
+                torch.tensor([[1, 1, 1, 1, 1, 0], [1, 1, 1, 1, 0, 0]]).float(),
+            )
+        )
+        self.assertEqual(expanded.device, attn_mask.device)
+        joint = expand_flux_attention_mask(hidden_states, attn_mask, sequence_length=9)
+        self.assertTrue(
+            torch.equal(
+                joint,
+                expand_flux_attention_mask(torch.zeros(2, 9, 4), attn_mask),
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
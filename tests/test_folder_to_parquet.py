@@ -0,0 +1,223 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+from PIL import Image
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+def save_image(path: str, size: tuple, colour: tuple):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", size, colour).save(path)
+
+
+@unittest.skipIf(pq is None, "pyarrow is not available")
+class TestFolderToParquet(unittest.TestCase):
+    def setUp(self):
+        from toolkit.datasets import folder_to_parquet
+
+        self.folder_to_parquet = folder_to_parquet
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.input_folder = os.path.join(self.directory.name, "images")
+        self.output_folder = os.path.join(self.directory.name, "packed")
+        save_image(self.path("a.png"), (96, 64), (200, 30, 30))
+        save_image(self.path("b.jpg"), (64, 64), (30, 200, 30))
+        save_image(self.path("sub/c.png"), (64, 96), (30, 30, 200))
+        save_image(self.path("d.png"), (128, 64), (90, 90, 90))
+        with open(self.path("a.txt"), "w") as f:
+            f.write("a red image\n")
+        with open(self.path("notes.md"), "w") as f:
+            f.write("not an image")
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.input_folder, filename)
+
+    def pack(self) -> dict:
+        # Every image gets a row group and a shard of its own.
+        return self.folder_to_parquet.pack_folder(
+            self.input_folder,
+            self.output_folder,
+            workers=2,
+            row_group_size=0,
+            shard_size=0,
+        )
+
+    def metadata(self) -> dict:
+        return self.folder_to_parquet.load_metadata(self.output_folder)
+
+    def stored_images(self) -> list:
+        return [
+            row
+            for name in sorted(os.listdir(self.output_folder))
+            if name.startswith("images-")
+            for row in pq.read_table(os.path.join(self.output_folder, name)).to_pylist()
+        ]
+
+    def test_packs_incrementally(self):
+        self.assertEqual(self.pack(), {"unchanged": 0, "read": 4, "unreadable": 0})
+        metadata = self.metadata()
+        self.assertEqual(sorted(metadata), ["a.png", "b.jpg", "d.png", "sub/c.png"])
+        self.assertEqual(metadata["a.png"]["caption"], "a red image")
+        self.assertEqual(metadata["sub/c.png"]["caption"], "c")
+        self.assertEqual(
+            (metadata["sub/c.png"]["width"], metadata["sub/c.png"]["height"]), (64, 96)
+        )
+        self.assertEqual(len({row["shard"] for row in metadata.values()}), 4)
+        with open(self.path("a.png"), "rb") as f:
+            self.assertEqual(
+                next(
+                    row["image"]
+                    for row in self.stored_images()
+                    if row["filename"] == "a.png"
+                ),
+                f.read(),
+            )
+
+        # Nothing changed, so nothing is read.
+        self.assertEqual(self.pack(), {"unchanged": 4, "read": 0, "unreadable": 0})
+
+        save_image(self.path("b.jpg"), (32, 48), (30, 200, 30))
+        shutil.copy(self.path("a.png"), self.path("copy.png"))
+        os.remove(self.path("sub/c.png"))
+        # A new modification time, but the same contents.
+        stat = os.stat(self.path("a.png"))
+        os.utime(self.path("a.png"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertEqual(self.pack(), {"unchanged": 1, "read": 3, "unreadable": 0})
+
+        updated = self.metadata()
+        self.assertEqual(sorted(updated), ["a.png", "b.jpg", "copy.png", "d.png"])
+        self.assertEqual(updated["d.png"], metadata["d.png"])
+        self.assertEqual(
+            updated["a.png"],
+            {**metadata["a.png"], "mtime_ns": stat.st_mtime_ns + 10**9},
+        )
+        self.assertEqual(
+            (updated["b.jpg"]["width"], updated["b.jpg"]["height"]), (32, 48)
+        )
+        self.assertNotEqual(updated["b.jpg"]["shard"], metadata["b.jpg"]["shard"])
+        # The copy is stored once, with the image it copies.
+        self.assertEqual(updated["copy.png"]["shard"], updated["a.png"]["shard"])
+        stored = self.stored_images()
+        self.assertEqual(len(stored), 5)
+        self.assertEqual(len({row["file_hash"] for row in stored}), 5)
+
+    def test_unreadable_files_are_skipped(self):
+        with open(self.path("broken.png"), "wb") as f:
+            f.write(b"not a png")
+        self.assertEqual(self.pack(), {"unchanged": 0, "read": 4, "unreadable": 1})
+        self.assertNotIn("broken.png", self.metadata())
+        # Removed after the folder was listed.
+        self.assertIsNone(
+            self.folder_to_parquet.probe_image(
+                (self.path("missing.png"), "missing.png", None, True)
+            )
+        )
+
+    def metadata_backend(self):
+        from helpers.data_backend.local import LocalDataBackend
+        from helpers.metadata.backends.parquet import ParquetMetadataBackend
+        from helpers.training.state_tracker import StateTracker
+
+        StateTracker.set_args(
+            MagicMock(
+                aspect_bucket_alignment=8,
+                aspect_bucket_rounding=2,
+                resolution=64,
+                resolution_type="pixel",
+                crop=False,
+                minimum_image_size=None,
+            )
+        )
+        data_backend = LocalDataBackend(accelerator=Mock(), id="packed")
+        with patch(
+            "helpers.training.state_tracker.StateTracker._save_to_disk",
+            return_value=True,
+        ):
+            return ParquetMetadataBackend(
+                id="packed",
+                instance_data_dir=self.input_folder,
+                cache_file=os.path.join(self.directory.name, "cache"),
+                metadata_file=os.path.join(self.directory.name, "metadata"),
+                data_backend=data_backend,
+                accelerator=Mock(),
+                batch_size=1,
+                resolution=64,
+                resolution_type="pixel",
+                parquet_config={
+                    "path": os.path.join(self.output_folder, "metadata.parquet"),
+                    "filename_column": "filename",
+                    "caption_column": "caption",
+                    "width_column": "width",
+                    "height_column": "height",
+                    "aspect_ratio_column": "aspect_ratio",
+                    "luminance_column": "luminance",
+                    "phash_column": "phash",
+                    "identifier_includes_extension": True,
+                },
+                deduplicate={"hash": "phash", "max_distance": 4, "action": "drop"},
+            )
+
+    def process_for_bucket(self, backend, filename: str) -> dict:
+        """The metadata `backend` finds for an image, which is bucketed."""
+        buckets = {}
+        image_metadata = {}
+        with patch(
+            "helpers.training.state_tracker.StateTracker.get_data_backend_config",
+            return_value={"resolution": 64, "resolution_type": "pixel"},
+        ):
+            backend._process_for_bucket(
+                self.path(filename), buckets, metadata_updates=image_metadata
+            )
+        self.assertEqual(sum(map(len, buckets.values())), 1, filename)
+        return image_metadata[self.path(filename)]
+
+    def test_metadata_backend_reads_the_packed_metadata(self):
+        self.pack()
+        backend = self.metadata_backend()
+        self.assertEqual(backend.caption_cache["a.png"], "a red image")
+        metadata = self.metadata()
+        for filename, row in metadata.items():
+            image_metadata = self.process_for_bucket(backend, filename)
+            self.assertEqual(
+                image_metadata["original_size"], (row["width"], row["height"])
+            )
+            self.assertEqual(image_metadata["luminance"], int(row["luminance"]))
+            self.assertEqual(image_metadata["phash"], row["phash"])
+
+    def test_missing_hashes_are_computed_from_the_images(self):
+        self.pack()
+        metadata_path = os.path.join(self.output_folder, "metadata.parquet")
+        rows = pq.read_table(metadata_path).to_pylist()
+        expected = {row["filename"]: row["phash"] for row in rows}
+        for row in rows:
+            if row["filename"] == "a.png":
+                row["phash"] = None
+        pq.write_table(
+            pa.Table.from_pylist(rows, schema=self.folder_to_parquet.metadata_schema),
+            metadata_path,
+        )
+        backend = self.metadata_backend()
+        image_metadata = self.process_for_bucket(backend, "a.png")
+        self.assertNotIn("phash", image_metadata)
+        self.assertEqual(
+            self.process_for_bucket(backend, "b.jpg")["phash"], expected["b.jpg"]
+        )
+
+        backend.image_metadata[self.path("a.png")] = image_metadata
+        self.assertEqual(
+            backend._image_hash(self.path("a.png"), "phash"),
+            (expected["a.png"], True),
+        )
+        self.assertEqual(image_metadata["phash"], expected["a.png"])
+
+
+if __name__ == "__main__":
+    unittest.main()
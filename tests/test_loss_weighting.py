@@ -0,0 +1,84 @@
+import unittest
+import torch
+import torch.nn.functional as F
+from diffusers import DDPMScheduler
+
+from helpers.training.loss_weighting import SNRLossWeighting
+from helpers.training.min_snr_gamma import compute_snr
+
+
+def reference_loss(
+    model_pred, target, timesteps, noise_scheduler, snr_gamma, **snr_kwargs
+):
+    # The per-step min-SNR loss train.py used to compute.
+    snr = compute_snr(timesteps, noise_scheduler, **snr_kwargs)
+    snr_divisor = snr
+    if noise_scheduler.config.prediction_type == "v_prediction":
+        snr_divisor = snr + 1
+    mse_loss_weights = (
+        torch.stack([snr, snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0]
+        / snr_divisor
+    )
+    loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
+    return (
+        loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
+    ).mean(), mse_loss_weights
+
+
+class TestSNRLossWeighting(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.timesteps = torch.randint(0, 1000, (6,))
+        self.model_pred = torch.randn(6, 4, 8, 8, dtype=torch.bfloat16)
+        self.target = torch.randn(6, 4, 8, 8)
+
+    def test_matches_reference(self):
+        for prediction_type in ["epsilon", "v_prediction"]:
+            for snr_kwargs in [{}, {"use_soft_min": True, "sigma_data": 0.5}]:
+                with self.subTest(prediction_type=prediction_type, **snr_kwargs):
+                    noise_scheduler = DDPMScheduler(prediction_type=prediction_type)
+                    weighting = SNRLossWeighting(noise_scheduler, 5.0, **snr_kwargs)
+                    expected_loss, expected_weights = reference_loss(
+                        self.model_pred,
+                        self.target,
+                        self.timesteps,
+                        noise_scheduler,
+                        5.0,
+                        **snr_kwargs,
+                    )
+                    self.assertTrue(
+                        torch.equal(
+                            weighting.get_weights(self.timesteps), expected_weights
+                        )
+                    )
+                    self.assertTrue(
+                        torch.allclose(
+                            weighting.loss(
+                                self.model_pred, self.target, self.timesteps
+                            ),
+                            expected_loss,
+                            rtol=1e-6,
+                        )
+                    )
+
+    def test_debiased(self):
+        noise_scheduler = DDPMScheduler()
+        weighting = SNRLossWeighting(noise_scheduler, 5.0, debiased=True)
+        snr = compute_snr(self.timesteps, noise_scheduler)
+        _, min_snr_weights = reference_loss(
+            self.model_pred, self.target, self.timesteps, noise_scheduler, 5.0
+        )
+        self.assertTrue(
+            torch.allclose(
+                weighting.get_weights(self.timesteps),
+                min_snr_weights / torch.sqrt(torch.clamp(snr, max=1000)),
+            )
+        )
+
+    def test_soft_min_requires_sigma_data(self):
+        with self.assertRaises(ValueError):
+            SNRLossWeighting(DDPMScheduler(), 5.0, use_soft_min=True, sigma_data=None)
+
+
+if __name__ == "__main__":
+    unittest.main()
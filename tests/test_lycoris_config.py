@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+import unittest
+from types import ModuleType
+from unittest.mock import MagicMock, patch
+
+from helpers.training import lycoris_defaults
+from helpers.training.adapter import load_lycoris_config
+
+
+class TestLycorisConfig(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        # lycoris, as far as the config loader uses it.
+        self.lycoris = ModuleType("lycoris")
+        self.lycoris.LycorisNetwork = MagicMock()
+
+    def load(self, config: dict):
+        path = os.path.join(self.directory.name, "lycoris_config.json")
+        with open(path, "w") as f:
+            json.dump(config, f)
+        with patch.dict("sys.modules", {"lycoris": self.lycoris}):
+            return load_lycoris_config(path)
+
+    def test_applies_the_preset(self):
+        config = lycoris_defaults["lokr"]
+        multiplier, linear_dim, linear_alpha, kwargs = self.load(config)
+        self.lycoris.LycorisNetwork.apply_preset.assert_called_once_with(
+            config["apply_preset"]
+        )
+        self.assertEqual(
+            (multiplier, linear_dim, linear_alpha),
+            (
+                int(config["multiplier"]),
+                int(config["linear_dim"]),
+                int(config["linear_alpha"]),
+            ),
+        )
+        self.assertEqual(kwargs["algo"], "lokr")
+        self.assertNotIn("multiplier", kwargs)
+
+    def test_empty_preset_is_not_applied(self):
+        self.load(
+            {
+                "algo": "lora",
+                "multiplier": 1,
+                "linear_dim": 4,
+                "linear_alpha": 1,
+                "apply_preset": {},
+            }
+        )
+        self.lycoris.LycorisNetwork.apply_preset.assert_not_called()
+
+    def test_requires_an_algo(self):
+        with self.assertRaises(AssertionError):
+            self.load({"multiplier": 1, "linear_dim": 4, "linear_alpha": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+import torch
+
+from helpers.training.prompt_embed_bank import PromptEmbedBank
+
+
+class TestPromptEmbedBank(unittest.TestCase):
+    def setUp(self):
+        self.negative = torch.randn(1, 77, 8)
+        self.prompt_embeds = {
+            prompt: {
+                "prompt_embeds": torch.randn(1, 77, 8),
+                "pooled_prompt_embeds": torch.randn(1, 8),
+                "prompt_mask": torch.ones(1, 77, dtype=torch.int64),
+                "negative_prompt_embeds": self.negative,
+                "negative_mask": None,
+            }
+            for prompt in ("a cat", "a dog")
+        }
+
+    def test_embeds_are_views_of_one_stacked_tensor(self):
+        bank = PromptEmbedBank(self.prompt_embeds, "cpu", torch.bfloat16)
+        self.assertEqual(len(bank), 2)
+        self.assertNotIn("a bird", bank)
+        embeds = bank.embeds("a dog")
+        expected = self.prompt_embeds["a dog"]
+        self.assertEqual(embeds.keys(), expected.keys())
+        self.assertEqual(embeds["prompt_embeds"].shape, (1, 77, 8))
+        self.assertEqual(embeds["prompt_embeds"].dtype, torch.bfloat16)
+        self.assertTrue(
+            torch.equal(
+                embeds["prompt_embeds"], expected["prompt_embeds"].to(torch.bfloat16)
+            )
+        )
+        self.assertEqual(
+            embeds["prompt_embeds"].data_ptr(),
+            bank.stacked["prompt_embeds"][1].data_ptr(),
+        )
+        self.assertEqual(embeds["prompt_mask"].dtype, torch.int64)
+        self.assertIsNone(embeds["negative_mask"])
+        self.assertIs(
+            embeds["negative_prompt_embeds"],
+            bank.embeds("a cat")["negative_prompt_embeds"],
+        )
+
+    def test_prompts_of_different_lengths_are_kept_apart(self):
+        self.prompt_embeds["a dog"]["prompt_embeds"] = torch.randn(1, 154, 8)
+        bank = PromptEmbedBank(self.prompt_embeds, "cpu", torch.float32)
+        self.assertEqual(bank.embeds("a cat")["prompt_embeds"].shape, (1, 77, 8))
+        self.assertEqual(bank.embeds("a dog")["prompt_embeds"].shape, (1, 154, 8))
+        self.assertEqual(bank.embeds("a dog")["pooled_prompt_embeds"].shape, (1, 8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,14 @@
+import os
+import tempfile
 import unittest
 import pandas as pd
 from unittest.mock import patch, MagicMock
 from helpers.prompts import (
     PromptHandler,
+    compiled_caption_filters,
 )
+from helpers.data_backend.local import LocalDataBackend
+from helpers.training.state_tracker import StateTracker
 
 
 class TestPromptHandler(unittest.TestCase):
@@ -255,5 +260,124 @@ class TestPromptHandler(unittest.TestCase):
         mock_filter.assert_called_once_with(self.data_backend, captions)
 
 
+class TestGetAllCaptions(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.instance_data_dir = os.path.join(self.temp_dir.name, "data")
+        self.output_dir = os.path.join(self.temp_dir.name, "output")
+        os.makedirs(self.instance_data_dir)
+        os.makedirs(self.output_dir)
+        self.image_paths = []
+        for idx in range(4):
+            image_path = os.path.join(self.instance_data_dir, f"image_{idx}.png")
+            with open(image_path, "wb") as f:
+                f.write(b"")
+            with open(os.path.splitext(image_path)[0] + ".txt", "w") as f:
+                f.write(f"caption {idx}")
+            self.image_paths.append(image_path)
+        self.data_backend = LocalDataBackend(accelerator=None, id="captions")
+        self.original_args = StateTracker.args
+        StateTracker.args = MagicMock(output_dir=self.output_dir)
+        StateTracker.all_caption_indexes = {}
+        compiled_caption_filters.clear()
+        self.backend_config = {"instance_data_dir": self.instance_data_dir}
+        self.patches = [
+            patch(
+                "helpers.training.state_tracker.StateTracker.get_image_files",
+                return_value={path: False for path in self.image_paths},
+            ),
+            patch(
+                "helpers.training.state_tracker.StateTracker.get_data_backend_config",
+                return_value=self.backend_config,
+            ),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        StateTracker.args = self.original_args
+        StateTracker.all_caption_indexes = {}
+        self.temp_dir.cleanup()
+
+    def get_all_captions(self):
+        return PromptHandler.get_all_captions(
+            instance_data_dir=self.instance_data_dir,
+            use_captions=True,
+            prepend_instance_prompt=True,
+            data_backend=self.data_backend,
+            caption_strategy="textfile",
+            instance_prompt="sks",
+            max_workers=2,
+        )
+
+    def test_textfile_captions_reused_from_index(self):
+        with patch.object(
+            self.data_backend, "read", wraps=self.data_backend.read
+        ) as mock_read:
+            captions = self.get_all_captions()
+        self.assertEqual(mock_read.call_count, 4)
+        self.assertEqual(sorted(captions), [f"sks caption {idx}" for idx in range(4)])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.output_dir, "caption_index_captions.json"))
+        )
+
+        # A restart loads the index from disk, and only the edited caption is read again.
+        StateTracker.all_caption_indexes = {}
+        edited_caption = os.path.splitext(self.image_paths[2])[0] + ".txt"
+        with open(edited_caption, "w") as f:
+            f.write("an edited caption\nand a second one")
+        stat_result = os.stat(edited_caption)
+        os.utime(
+            edited_caption,
+            ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1_000_000_000),
+        )
+        with patch.object(
+            self.data_backend, "read", wraps=self.data_backend.read
+        ) as mock_read:
+            captions = self.get_all_captions()
+        mock_read.assert_called_once_with(edited_caption)
+        self.assertIn("sks an edited caption", captions)
+        self.assertIn("sks and a second one", captions)
+        self.assertIn("sks caption 0", captions)
+        self.assertEqual(len(captions), 5)
+
+    def test_missing_textfile_caption_raises(self):
+        os.remove(os.path.splitext(self.image_paths[1])[0] + ".txt")
+        with self.assertRaises(FileNotFoundError):
+            self.get_all_captions()
+
+    def test_filter_list_compiled_once(self):
+        filter_path = os.path.join(self.temp_dir.name, "filter.txt")
+        with open(filter_path, "w") as f:
+            f.write("s/caption/photo\n^sks \nsecond")
+        self.backend_config["caption_filter_list"] = filter_path
+        self.assertEqual(
+            PromptHandler.filter_caption(self.data_backend, "sks caption second one"),
+            "photo  one",
+        )
+        compiled_filters = compiled_caption_filters[self.data_backend.id][1]
+        self.assertEqual(
+            PromptHandler.filter_captions(self.data_backend, ["sks caption"]),
+            ["photo"],
+        )
+        self.assertIs(
+            compiled_caption_filters[self.data_backend.id][1], compiled_filters
+        )
+
+        # Editing the filter list is picked up.
+        with open(filter_path, "w") as f:
+            f.write("caption")
+        stat_result = os.stat(filter_path)
+        os.utime(
+            filter_path,
+            ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1_000_000_000),
+        )
+        self.assertEqual(
+            PromptHandler.filter_caption(self.data_backend, "sks caption"), "sks "
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
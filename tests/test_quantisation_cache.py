@@ -0,0 +1,164 @@
+import os
+import tempfile
+import unittest
+from types import ModuleType
+from unittest.mock import MagicMock, patch
+
+import torch
+from diffusers import ConfigMixin, ModelMixin
+from diffusers.configuration_utils import register_to_config
+
+from helpers.caching.quantised_models import (
+    QuantisedModelCache,
+    weights_fingerprint,
+)
+
+
+class TinyModel(ModelMixin, ConfigMixin):
+    @register_to_config
+    def __init__(self, features: int = 4):
+        super().__init__()
+        self.linear = torch.nn.Linear(features, features)
+        self.register_buffer("scale", torch.ones(features), persistent=False)
+
+
+def requantize(model, state_dict, quantization_map, device):
+    # Like quanto's, the weights are copied into the model's own parameters, keeping their dtype.
+    model.to_empty(device=device)
+    model.load_state_dict(state_dict)
+
+
+def fake_quanto() -> dict:
+    """optimum.quanto, as far as the cache uses it, without quantising anything."""
+    quanto = ModuleType("optimum.quanto")
+    quanto.quantization_map = lambda model: {}
+    quanto.requantize = requantize
+    optimum = ModuleType("optimum")
+    optimum.quanto = quanto
+    return {"optimum": optimum, "optimum.quanto": quanto}
+
+
+class TestQuantisedModelCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.model_path = os.path.join(self.directory.name, "model")
+        self.cache_dir = os.path.join(self.directory.name, "cache")
+        self.write_weights(b"weights")
+
+    def write_weights(self, data: bytes, mtime_ns: int = 1_000_000_000):
+        folder = os.path.join(self.model_path, "transformer")
+        os.makedirs(folder, exist_ok=True)
+        for name, contents in [
+            ("config.json", b"{}"),
+            ("diffusion_pytorch_model.safetensors", data),
+        ]:
+            path = os.path.join(folder, name)
+            with open(path, "wb") as f:
+                f.write(contents)
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def cache(self, mixed_precision: str = "bf16") -> QuantisedModelCache:
+        return QuantisedModelCache(
+            self.cache_dir, extra_key={"mixed_precision": mixed_precision}
+        )
+
+    def load(
+        self,
+        cache: QuantisedModelCache,
+        precision: str = "int8-quanto",
+        dtype: torch.dtype = torch.float32,
+    ):
+        with patch.dict("sys.modules", fake_quanto()):
+            return cache.load(
+                "transformer",
+                TinyModel,
+                self.model_path,
+                subfolder="transformer",
+                precision=precision,
+                dtype=dtype,
+            )
+
+    def store(self, cache: QuantisedModelCache, model: TinyModel):
+        with patch.dict("sys.modules", fake_quanto()):
+            cache.save("transformer", model)
+
+    def test_local_weights_fingerprint(self):
+        fingerprint = weights_fingerprint(self.model_path, "transformer")
+        self.assertEqual(
+            [name for name, _, _ in fingerprint],
+            ["config.json", "diffusion_pytorch_model.safetensors"],
+        )
+        self.assertEqual(
+            weights_fingerprint(self.model_path, "transformer"), fingerprint
+        )
+        self.assertIsNone(weights_fingerprint(self.model_path, "text_encoder"))
+        self.write_weights(b"weights", mtime_ns=2_000_000_000)
+        self.assertNotEqual(
+            weights_fingerprint(self.model_path, "transformer"), fingerprint
+        )
+
+    def test_hub_weights_fingerprint_is_the_snapshot(self):
+        snapshot = os.path.join(
+            "hub", "models--org--model", "snapshots", "abc123", "transformer"
+        )
+        with patch(
+            "huggingface_hub.try_to_load_from_cache",
+            return_value=os.path.join(snapshot, "config.json"),
+        ):
+            self.assertEqual(weights_fingerprint("org/model", "transformer"), "abc123")
+        # Not downloaded yet, so nothing can be cached.
+        with patch("huggingface_hub.try_to_load_from_cache", return_value=None):
+            self.assertIsNone(weights_fingerprint("org/model", "transformer"))
+
+    def test_miss_then_hit(self):
+        cache = self.cache()
+        self.assertIsNone(self.load(cache))
+        model = TinyModel()
+        model.scale.fill_(2)
+        self.store(cache, model)
+        self.assertEqual(cache.pending, {})
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # A later launch maps the stored weights in.
+        loaded = self.load(self.cache())
+        self.assertIsInstance(loaded, TinyModel)
+        self.assertFalse(loaded.training)
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(loaded.state_dict()[name], tensor), name)
+        self.assertTrue(torch.equal(loaded.scale, model.scale))
+
+    def test_unquantised_weights_keep_their_dtype(self):
+        cache = self.cache()
+        self.load(cache, dtype=torch.bfloat16)
+        model = TinyModel().to(torch.bfloat16)
+        self.store(cache, model)
+
+        loaded = self.load(self.cache(), dtype=torch.bfloat16)
+        for name, tensor in loaded.state_dict().items():
+            self.assertEqual(tensor.dtype, torch.bfloat16, name)
+            self.assertTrue(torch.equal(tensor, model.state_dict()[name]), name)
+
+    def test_changes_invalidate_entries(self):
+        cache = self.cache()
+        self.load(cache)
+        self.store(cache, TinyModel())
+        self.assertIsNotNone(self.load(self.cache()))
+
+        self.assertIsNone(self.load(self.cache(), precision="int4-quanto"))
+        self.assertIsNone(self.load(self.cache(mixed_precision="fp16")))
+        self.write_weights(b"new weights")
+        self.assertIsNone(self.load(self.cache()))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_save_without_a_miss_stores_nothing(self):
+        self.store(self.cache(), TinyModel())
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_disabled_by_args(self):
+        args = MagicMock(disable_quantised_model_cache=True)
+        self.assertIsNone(QuantisedModelCache.from_args(args))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+from helpers.registry import LazyRegistry, import_object, optional_requirements
+
+
+class TestLazyRegistry(unittest.TestCase):
+    def test_imports_on_first_use(self):
+        registry = LazyRegistry("thing", {"ordered": "collections.OrderedDict"})
+        self.assertIn("ordered", registry)
+        self.assertEqual(registry.loaded, {})
+        from collections import OrderedDict
+
+        self.assertIs(registry.get("ordered"), OrderedDict)
+        self.assertIs(registry.loaded["ordered"], OrderedDict)
+        with self.assertRaises(ValueError):
+            registry.get("missing")
+
+    def test_missing_optional_dependency(self):
+        with patch.dict(optional_requirements, {"not_installed": "not-installed"}):
+            with self.assertRaisesRegex(ImportError, "requires `not-installed`"):
+                import_object("not_installed.Optimizer")
+
+    def test_cli_imports_are_lazy(self):
+        # Listing optimizers and model configurations shouldn't load torch or diffusers.
+        code = (
+            "import sys, configure, helpers.models.smoldit;"
+            "print(','.join(m for m in ['torch', 'diffusers', 'optimi'] if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(result.stdout.strip(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -66,6 +66,39 @@ class TestMultiAspectSampler(unittest.TestCase):
         self.assertEqual(self.sampler.exhausted_buckets, ["1.0"])
         self.assertEqual(self.sampler.buckets, [])
 
+    def test_select_crop_variant(self):
+        image_metadata = {
+            "crop_coordinates": (0, 0),
+            "crop_variant_coordinates": [(0, 0), (0, 16), (8, 32)],
+        }
+        with patch(
+            "helpers.multiaspect.sampler.StateTracker.get_data_backend_config",
+            return_value={"crop_variants": 3},
+        ), patch("helpers.multiaspect.sampler.StateTracker.get_epoch", return_value=1):
+            selected = self.sampler._select_crop_variant("image1", image_metadata)
+            # The same epoch always selects the same variant.
+            self.assertEqual(
+                self.sampler._select_crop_variant("image1", image_metadata), selected
+            )
+        self.assertEqual(
+            selected["crop_coordinates"],
+            image_metadata["crop_variant_coordinates"][selected["crop_variant"]],
+        )
+        # The stored metadata still describes the primary crop.
+        self.assertEqual(image_metadata["crop_coordinates"], (0, 0))
+        self.assertNotIn("crop_variant", image_metadata)
+
+    def test_select_crop_variant_without_coordinates(self):
+        image_metadata = {"crop_coordinates": (0, 0)}
+        with patch(
+            "helpers.multiaspect.sampler.StateTracker.get_data_backend_config",
+            return_value={"crop_variants": 3},
+        ):
+            self.assertIs(
+                self.sampler._select_crop_variant("image1", image_metadata),
+                image_metadata,
+            )
+
     @skip("Infinite Loop Boulevard")
     def test_iter_yields_correct_batches(self):
         # Add about 100 images to the metadata_backend
@@ -0,0 +1,50 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from helpers.caching.text_embeds import TextEmbeddingCache
+
+
+class TestTextEmbeddingCacheExistence(unittest.TestCase):
+    def setUp(self):
+        self.backend = MagicMock()
+        self.backend.id = "foo"
+        self.backend.type = "aws"
+        self.text_embed_cache = TextEmbeddingCache(
+            id="foo",
+            data_backend=self.backend,
+            text_encoders=[MagicMock()],
+            tokenizers=[MagicMock()],
+            accelerator=MagicMock(),
+            cache_dir="cache",
+            model_type="sdxl",
+        )
+        self.cached_filename = self.text_embed_cache.hash_prompt_with_path("a cat")
+
+    def tearDown(self):
+        self.text_embed_cache.process_write_batches = False
+
+    def test_cached_prompts_are_resolved_from_the_listing(self):
+        with patch(
+            "helpers.caching.text_embeds.StateTracker.get_text_cache_files",
+            return_value={self.cached_filename: False},
+        ):
+            self.text_embed_cache.discover_all_files()
+        with patch.object(
+            self.text_embed_cache, "compute_embeddings_for_sdxl_prompts"
+        ) as compute:
+            result = self.text_embed_cache.compute_embeddings_for_prompts(
+                ["a cat"], return_concat=False
+            )
+        self.assertIsNone(result)
+        compute.assert_not_called()
+        self.backend.exists.assert_not_called()
+
+    def test_written_embeds_are_indexed(self):
+        self.text_embed_cache.cache_index.populate([])
+        self.text_embed_cache.process_write_batch([(("embeds",), self.cached_filename)])
+        self.assertIn(self.cached_filename, self.text_embed_cache.cache_index)
+        self.backend.exists.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
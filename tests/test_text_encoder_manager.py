@@ -0,0 +1,68 @@
+import tempfile
+import unittest
+
+import torch
+
+from helpers.training.text_encoder_manager import TextEncoderManager
+
+
+class TiedTextEncoder(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(8, 4)
+        self.projection = torch.nn.Linear(4, 8)
+        self.projection.weight = self.embedding.weight
+        self.register_buffer("position_ids", torch.arange(8), persistent=False)
+
+    def forward(self, input_ids):
+        return self.projection(self.embedding(input_ids + self.position_ids[0]))
+
+
+class TestTextEncoderManager(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.text_encoder = TiedTextEncoder().requires_grad_(False)
+        self.input_ids = torch.tensor([[1, 2, 3]])
+        self.expected = self.text_encoder(self.input_ids)
+
+    def test_disk_offload_releases_and_rematerialises(self):
+        with tempfile.TemporaryDirectory() as offload_dir:
+            manager = TextEncoderManager(
+                [self.text_encoder, None],
+                device="cpu",
+                offload="disk",
+                offload_dir=offload_dir,
+            )
+            manager.offload()
+            self.assertEqual(manager.location, "meta")
+            self.assertTrue(self.text_encoder.embedding.weight.is_meta)
+            with manager.loaded("cache miss") as (text_encoder,):
+                self.assertIs(text_encoder, self.text_encoder)
+                self.assertIs(
+                    text_encoder.projection.weight, text_encoder.embedding.weight
+                )
+                self.assertTrue(
+                    torch.equal(text_encoder(self.input_ids), self.expected)
+                )
+            self.assertTrue(self.text_encoder.embedding.weight.is_meta)
+
+    def test_offloads_once_nothing_holds_them(self):
+        manager = TextEncoderManager([self.text_encoder], device="cpu", offload="cpu")
+        manager.acquire("validation prompts")
+        with manager.loaded("encoding prompts"):
+            pass
+        self.assertEqual(manager.location, "device")
+        manager.release("validation prompts")
+        self.assertEqual(manager.location, "cpu")
+        self.assertTrue(manager.can_rematerialise)
+
+    def test_deleted_encoders_can_not_be_loaded(self):
+        manager = TextEncoderManager([self.text_encoder], device="cpu")
+        manager.offload()
+        self.assertFalse(manager.can_rematerialise)
+        with self.assertRaises(ValueError):
+            manager.acquire("cache miss")
+
+
+if __name__ == "__main__":
+    unittest.main()
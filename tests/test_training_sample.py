@@ -79,6 +79,53 @@ class TestTrainingSample(unittest.TestCase):
             isinstance(prepared_sample.aspect_ratio, float)
         )  # Placeholder check
 
+    def test_crop_variant_coordinates(self):
+        """Test that crop variants share the primary crop's size and record their own coordinates."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value={
+                "crop": True,
+                "crop_style": "random",
+                "crop_aspect": "square",
+                "crop_variants": 3,
+                "resolution": 512,
+                "resolution_type": "pixel",
+            }
+        )
+        sample = TrainingSample(self.image, self.data_backend_id, self.image_metadata)
+        prepared_sample = sample.prepare()
+        coordinates = prepared_sample.crop_variant_coordinates
+        self.assertEqual(len(coordinates), 3)
+        self.assertEqual(coordinates[0], tuple(prepared_sample.crop_coordinates))
+        for top, left in coordinates:
+            self.assertLessEqual(left + 512, sample.cropper.intermediary_width)
+            self.assertLessEqual(top + 512, sample.cropper.intermediary_height)
+
+    def test_prepare_at_crop_coordinates(self):
+        """Test that a recorded crop can be reproduced exactly."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value={
+                "crop": True,
+                "crop_style": "random",
+                "crop_aspect": "square",
+                "resolution": 512,
+                "resolution_type": "pixel",
+            }
+        )
+        image = Image.fromarray(
+            np.random.randint(0, 255, (768, 1024, 3), dtype=np.uint8)
+        )
+        first = TrainingSample(image, self.data_backend_id, self.image_metadata)
+        second = TrainingSample(image, self.data_backend_id, self.image_metadata)
+        prepared_first = first.prepare(crop_coordinates=(0, 100))
+        prepared_second = second.prepare(crop_coordinates=(0, 100))
+        self.assertEqual(tuple(prepared_first.crop_coordinates), (0, 100))
+        self.assertEqual(prepared_first.image.size, (512, 512))
+        self.assertTrue(
+            np.array_equal(
+                np.array(prepared_first.image), np.array(prepared_second.image)
+            )
+        )
+
 
 # Helper mock classes and functions
 class MockCropper:
@@ -0,0 +1,272 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helpers.publishing.upload_queue import HubUploader, UploadQueue
+
+REPO_ID = "user/model"
+CHUNK_SIZE = 1024
+LARGE_FILE_SIZE = 2048
+
+
+class LocalHub(BaseHTTPRequestHandler):
+    """Just enough of the Hub's preupload, LFS multipart and commit APIs to upload to."""
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: dict = None, status: int = 200, headers: dict = None):
+        data = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        hub = self.server.hub
+        body = self._body()
+        if self.path.startswith(f"/api/models/{REPO_ID}/preupload/"):
+            files = json.loads(body)["files"]
+            self._send(
+                {
+                    "files": [
+                        {
+                            "path": file["path"],
+                            "uploadMode": (
+                                "lfs" if file["size"] >= LARGE_FILE_SIZE else "regular"
+                            ),
+                            "shouldIgnore": False,
+                        }
+                        for file in files
+                    ]
+                }
+            )
+        elif self.path == f"/{REPO_ID}.git/info/lfs/objects/batch":
+            hub.batch_requests += 1
+            objects = []
+            for obj in json.loads(body)["objects"]:
+                if obj["oid"] in hub.objects:
+                    objects.append(obj)
+                    continue
+                parts = -(-obj["size"] // CHUNK_SIZE)
+                base = f"http://{self.headers['Host']}/lfs/{obj['oid']}"
+                header = {"chunk_size": str(CHUNK_SIZE)}
+                header.update(
+                    {
+                        f"{number:05d}": f"{base}/part/{number}"
+                        for number in range(1, parts + 1)
+                    }
+                )
+                objects.append(
+                    {
+                        **obj,
+                        "actions": {
+                            "upload": {"href": f"{base}/complete", "header": header},
+                            "verify": {"href": f"{base}/verify"},
+                        },
+                    }
+                )
+            self._send({"objects": objects})
+        elif re.fullmatch(r"/lfs/\w+/complete", self.path):
+            oid = self.path.split("/")[2]
+            request = json.loads(body)
+            data = b"".join(
+                hub.parts[oid][part["partNumber"]] for part in request["parts"]
+            )
+            if hashlib.sha256(data).hexdigest() != oid:
+                return self._send(status=400)
+            hub.objects[oid] = data
+            self._send()
+        elif re.fullmatch(r"/lfs/\w+/verify", self.path):
+            self._send(status=200 if json.loads(body)["oid"] in hub.objects else 404)
+        elif self.path.startswith(f"/api/models/{REPO_ID}/commit/"):
+            lines = [json.loads(line) for line in body.decode().splitlines()]
+            files = {}
+            for line in lines:
+                if line["key"] == "file":
+                    files[line["value"]["path"]] = base64.b64decode(
+                        line["value"]["content"]
+                    )
+                elif line["key"] == "lfsFile":
+                    files[line["value"]["path"]] = hub.objects[line["value"]["oid"]]
+            hub.commits.append((lines[0]["value"]["summary"], files))
+            hub.files.update(files)
+            self._send(
+                {
+                    "commitUrl": f"http://{self.headers['Host']}/{REPO_ID}/commit/1",
+                    "commitOid": "1" * 40,
+                    "pullRequestUrl": None,
+                }
+            )
+        else:
+            self._send(status=404)
+
+    def do_PUT(self):
+        hub = self.server.hub
+        body = self._body()
+        match = re.fullmatch(r"/lfs/(\w+)/part/(\d+)", self.path)
+        if match is None:
+            return self._send(status=404)
+        oid, number = match.group(1), int(match.group(2))
+        hub.part_uploads.append(number)
+        if number in hub.refused_parts:
+            return self._send(status=403)
+        hub.parts.setdefault(oid, {})[number] = body
+        self._send(headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+
+class TestUploadQueue(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), LocalHub)
+        self.server.hub = self
+        self.objects, self.parts, self.files = {}, {}, {}
+        self.commits, self.part_uploads = [], []
+        self.refused_parts = set()
+        self.batch_requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = f"http://127.0.0.1:{self.server.server_port}"
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.folder = os.path.join(self.temporary_dir.name, "checkpoint")
+        self.state_dir = os.path.join(self.temporary_dir.name, "publishing")
+        os.makedirs(self.folder)
+        self.large = self.write("model.safetensors", os.urandom(5 * CHUNK_SIZE + 100))
+        self.small = self.write("config.json", b'{"steps": 1}')
+        self.files_in_repo = [
+            (self.large, "model.safetensors"),
+            (self.small, "config.json"),
+        ]
+        self.notifications = []
+        self.notify_delay = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temporary_dir.cleanup()
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def notify(self, message: str, level: str):
+        time.sleep(self.notify_delay)
+        self.notifications.append((level, message))
+
+    def queue(self, max_attempts: int = 3) -> UploadQueue:
+        uploader = HubUploader(
+            REPO_ID,
+            token="hf_test",
+            endpoint=self.endpoint,
+            num_threads=3,
+            large_file_size=LARGE_FILE_SIZE,
+        )
+        return UploadQueue(
+            uploader,
+            self.state_dir,
+            notify=self.notify,
+            max_attempts=max_attempts,
+            retry_delay=0,
+        )
+
+    def test_uploads_in_parts_and_skips_unchanged_files(self):
+        queue = self.queue()
+        queue.enqueue(self.files_in_repo, "step 1", "checkpoint-1", key="model")
+        self.assertTrue(queue.wait(30))
+        self.assertEqual(len(self.commits), 1)
+        self.assertEqual(self.files["model.safetensors"], self.read(self.large))
+        self.assertEqual(self.files["config.json"], self.read(self.small))
+        self.assertEqual(sorted(self.part_uploads), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.notifications[-1][0], "info")
+        self.assertIn("checkpoint-1", self.notifications[-1][1])
+
+        self.write("config.json", b'{"steps": 2}')
+        queue.enqueue(self.files_in_repo, "step 2", "checkpoint-2", key="model")
+        self.assertTrue(queue.wait(30))
+        self.assertEqual(len(self.commits), 2)
+        self.assertEqual(list(self.commits[1][1]), ["config.json"])
+        self.assertEqual(len(self.part_uploads), 6)
+        self.assertEqual(queue.status()["skipped_bytes"], os.path.getsize(self.large))
+        queue.close()
+
+    def test_resumes_a_large_upload_from_its_finished_parts(self):
+        self.refused_parts = {4}
+        queue = self.queue(max_attempts=1)
+        queue.enqueue(self.files_in_repo, "step 1", "checkpoint-1")
+        self.assertTrue(queue.wait(30))
+        queue.close()
+        self.assertEqual(self.commits, [])
+        self.assertEqual(queue.status()["failed"], ["checkpoint-1"])
+        self.assertEqual(self.notifications[-1][0], "error")
+
+        # A new run only sends the parts that didn't make it.
+        sent_parts = set(self.part_uploads) - {4}
+        self.refused_parts = set()
+        self.part_uploads = []
+        queue = self.queue()
+        queue.enqueue(self.files_in_repo, "step 1", "checkpoint-1")
+        self.assertTrue(queue.wait(30))
+        queue.close()
+        self.assertIn(4, self.part_uploads)
+        self.assertEqual(sent_parts & set(self.part_uploads), set())
+        self.assertEqual(sent_parts | set(self.part_uploads), {1, 2, 3, 4, 5, 6})
+        self.assertEqual(self.files["model.safetensors"], self.read(self.large))
+        with open(os.path.join(self.state_dir, "upload_queue.json")) as f:
+            self.assertEqual(json.load(f)["uploads"], {})
+
+    def test_queued_jobs_resume_after_a_restart(self):
+        queue = self.queue()
+        queue.close()
+        queue.enqueue(self.files_in_repo, "step 1", "checkpoint-1", key="model")
+        queue.enqueue(self.files_in_repo, "step 2", "checkpoint-2", key="model")
+        self.assertEqual(queue.status()["queued"], 1)
+        self.assertEqual(self.commits, [])
+
+        queue = self.queue()
+        self.assertTrue(queue.wait(30))
+        queue.close()
+        self.assertEqual([message for message, _ in self.commits], ["step 2"])
+
+    def test_missing_files_fail_without_retrying(self):
+        queue = self.queue()
+        os.remove(self.large)
+        queue.enqueue(self.files_in_repo, "step 1", "checkpoint-1")
+        self.assertTrue(queue.wait(30))
+        queue.close()
+        self.assertEqual(self.batch_requests, 0)
+        self.assertEqual(queue.status()["failed"], ["checkpoint-1"])
+        self.assertEqual(len(self.notifications), 1)
+
+    def test_wait_returns_after_notifications_are_sent(self):
+        self.notify_delay = 0.5
+        queue = self.queue(max_attempts=1)
+        queue.enqueue(self.files_in_repo, "step 1", "checkpoint-1")
+        self.assertTrue(queue.wait(30))
+        self.assertEqual([level for level, _ in self.notifications], ["info"])
+
+        os.remove(self.large)
+        queue.enqueue(self.files_in_repo, "step 2", "checkpoint-2")
+        self.assertTrue(queue.wait(30))
+        queue.close()
+        self.assertEqual([level for level, _ in self.notifications], ["info", "error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
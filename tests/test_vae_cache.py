@@ -0,0 +1,213 @@
+import math
+import unittest
+from unittest.mock import MagicMock
+import torch
+
+from helpers.caching.vae import VAECache
+from helpers.training.state_tracker import StateTracker
+
+
+class FakeLatentDist:
+    def __init__(self, pixel_values):
+        self.mean = pixel_values.mean(dim=1, keepdim=True).repeat(1, 4, 1, 1)
+        self.logvar = torch.full_like(self.mean, math.log(0.25))
+
+    def sample(self):
+        return self.mean + torch.exp(0.5 * self.logvar) * torch.randn_like(self.mean)
+
+
+class TestVAECacheDistribution(unittest.TestCase):
+    def setUp(self):
+        StateTracker.set_vae_dtype(torch.float32)
+        self.store = {}
+        backend = MagicMock()
+        backend.id = "foo"
+        backend.type = "local"
+        backend.exists = lambda filename: filename in self.store
+        backend.torch_load = lambda filename: self.store[filename]
+        backend.list_files = lambda instance_data_dir, file_extensions: [
+            (instance_data_dir, [], list(self.store))
+        ]
+        backend.write_batch = lambda filenames, data: self.store.update(
+            dict(zip(filenames, data))
+        )
+        vae = MagicMock()
+        vae.config = MagicMock(scaling_factor=0.5, shift_factor=0.1)
+        vae.encode = lambda pixel_values: MagicMock(
+            latent_dist=FakeLatentDist(pixel_values)
+        )
+        metadata_backend = MagicMock(image_metadata_loaded=True)
+        self.vae_cache = VAECache(
+            id="foo",
+            vae=vae,
+            accelerator=MagicMock(device="cpu"),
+            metadata_backend=metadata_backend,
+            instance_data_dir="/data",
+            image_data_backend=backend,
+            cache_dir="/cache",
+            store_distribution=True,
+        )
+        self.vae_cache.build_vae_cache_filename_map(["/data/a.png"])
+
+    def test_encode_returns_scaled_distribution(self):
+        pixel_values = torch.ones(3, 8, 8)
+        outputs = self.vae_cache.encode_images(
+            [pixel_values], ["/data/a.png"], load_from_cache=False
+        )
+        self.assertIsInstance(outputs[0], dict)
+        self.assertEqual(outputs[0]["latent_mean"].dtype, torch.float16)
+        # (mean - shift) * scale, and the variance scales by scale^2.
+        self.assertTrue(
+            torch.allclose(
+                outputs[0]["latent_mean"].float(),
+                torch.full((4, 8, 8), 0.45),
+                atol=1e-3,
+            )
+        )
+        self.assertTrue(
+            torch.allclose(
+                outputs[0]["latent_logvar"].float(),
+                torch.full((4, 8, 8), math.log(0.25 * 0.25)),
+                atol=1e-3,
+            )
+        )
+
+    def test_reads_draw_fresh_samples(self):
+        self.store["/cache/a.pt"] = {
+            "latent_mean": torch.zeros(4, 64, 64, dtype=torch.float16),
+            "latent_logvar": torch.zeros(4, 64, 64, dtype=torch.float16),
+        }
+        first = self.vae_cache.retrieve_from_cache("/data/a.png")
+        second = self.vae_cache.retrieve_from_cache("/data/a.png")
+        self.assertEqual(first.shape, (4, 64, 64))
+        self.assertFalse(torch.equal(first, second))
+        self.assertAlmostEqual(first.float().std().item(), 1.0, delta=0.05)
+
+    def test_plain_latents_pass_through(self):
+        latent = torch.randn(4, 8, 8)
+        self.store["/cache/a.pt"] = latent
+        self.assertTrue(
+            torch.equal(self.vae_cache.retrieve_from_cache("/data/a.png"), latent)
+        )
+
+
+class TestVAECacheCropVariants(unittest.TestCase):
+    def setUp(self):
+        self.store = {}
+        backend = MagicMock()
+        backend.id = "foo"
+        backend.type = "local"
+        backend.exists = lambda filename: filename in self.store
+        backend.torch_load = lambda filename: self.store[filename]
+        backend.list_files = lambda instance_data_dir, file_extensions: [
+            (instance_data_dir, [], list(self.store))
+        ]
+        backend.write_batch = lambda filenames, data: self.store.update(
+            dict(zip(filenames, data))
+        )
+        self.metadata_backend = MagicMock(image_metadata_loaded=True)
+        self.metadata_backend.get_metadata_attribute_by_filepath.return_value = [
+            (0, 0),
+            (0, 8),
+        ]
+        self.vae_cache = VAECache(
+            id="foo",
+            vae=MagicMock(),
+            accelerator=MagicMock(device="cpu"),
+            metadata_backend=self.metadata_backend,
+            instance_data_dir="/data",
+            image_data_backend=backend,
+            cache_dir="/cache",
+            crop_variants=2,
+        )
+        self.vae_cache.build_vae_cache_filename_map(["/data/a.png"])
+
+    def test_variant_filenames_map_back_to_image(self):
+        self.assertEqual(
+            self.vae_cache.generate_vae_cache_filename("/data/a.png", 1)[0],
+            "/cache/a-crop1.pt",
+        )
+        self.assertEqual(
+            self.vae_cache._image_filename_from_vaecache_filename("/cache/a-crop1.pt"),
+            "/data/a.png",
+        )
+        self.assertEqual(
+            self.vae_cache.image_path_to_vae_path["/data/a.png"], "/cache/a.pt"
+        )
+
+    def test_already_cached_requires_every_variant(self):
+        self.store["/cache/a.pt"] = torch.zeros(4, 8, 8)
+        self.assertFalse(self.vae_cache.already_cached("/data/a.png"))
+        self.vae_cache._write_latents_in_batch(
+            [("/cache/a-crop1.pt", "/cache/a-crop1.pt", torch.ones(4, 8, 8))]
+        )
+        self.assertTrue(self.vae_cache.already_cached("/data/a.png"))
+        self.assertTrue(
+            torch.equal(
+                self.vae_cache.retrieve_from_cache("/data/a.png", crop_variant=1),
+                torch.ones(4, 8, 8),
+            )
+        )
+
+    def test_metadata_without_variant_coordinates(self):
+        self.metadata_backend.get_metadata_attribute_by_filepath.return_value = None
+        self.store["/cache/a.pt"] = torch.zeros(4, 8, 8)
+        self.assertTrue(self.vae_cache.already_cached("/data/a.png"))
+
+
+class TestVAECacheExistenceIndex(unittest.TestCase):
+    def setUp(self):
+        StateTracker.set_vae_dtype(torch.float32)
+        self.store = {"/cache/a.pt": torch.zeros(4, 8, 8)}
+        self.backend = MagicMock()
+        self.backend.id = "foo"
+        self.backend.type = "local"
+        self.backend.exists = MagicMock(side_effect=lambda f: f in self.store)
+        self.backend.torch_load = lambda filename: self.store[filename]
+        self.backend.list_files = MagicMock(
+            side_effect=lambda instance_data_dir, file_extensions: [
+                (instance_data_dir, [], list(self.store))
+            ]
+        )
+        self.backend.write_batch = lambda filenames, data: self.store.update(
+            dict(zip(filenames, data))
+        )
+        self.vae_cache = VAECache(
+            id="foo",
+            vae=MagicMock(),
+            accelerator=MagicMock(device="cpu"),
+            metadata_backend=MagicMock(image_metadata_loaded=True),
+            instance_data_dir="/data",
+            image_data_backend=self.backend,
+            cache_dir="/cache",
+            vae_cache_ondemand=True,
+        )
+        self.vae_cache.build_vae_cache_filename_map(["/data/a.png", "/data/b.png"])
+
+    def test_existence_checks_use_one_listing(self):
+        self.assertTrue(self.vae_cache.already_cached("/data/a.png"))
+        self.assertFalse(self.vae_cache.already_cached("/data/b.png"))
+        self.vae_cache.retrieve_from_cache("/data/a.png")
+        self.backend.list_files.assert_called_once()
+        self.backend.exists.assert_not_called()
+
+    def test_writes_update_the_index(self):
+        self.assertFalse(self.vae_cache.already_cached("/data/b.png"))
+        self.vae_cache._write_latents_in_batch(
+            [("/cache/b.pt", "/data/b.png", torch.ones(4, 8, 8))]
+        )
+        self.assertTrue(self.vae_cache.already_cached("/data/b.png"))
+        self.backend.exists.assert_not_called()
+
+    def test_precomputed_reads_confirm_misses(self):
+        self.vae_cache.vae_cache_ondemand = False
+        self.vae_cache.cache_index.populate([])
+        # Written by another process after we listed the cache.
+        latent = self.vae_cache.retrieve_from_cache("/data/a.png")
+        self.assertTrue(torch.equal(latent, self.store["/cache/a.pt"]))
+        self.assertIn("/cache/a.pt", self.vae_cache.cache_index)
+        self.assertEqual(self.vae_cache.cache_index.backend_checks, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import types
+import unittest
+
+import torch
+from diffusers import AutoencoderKL
+
+from helpers.models.vae_decode import decode_latents, tile_starts
+
+
+class UpsamplingVAE(torch.nn.Module):
+    """Decodes by repeating each latent pixel, so any tiling must reproduce the full decode."""
+
+    def __init__(self, overflow_in_fp16: bool = False):
+        super().__init__()
+        self.config = types.SimpleNamespace(block_out_channels=[1, 1, 1, 1])
+        self.scale = torch.nn.Parameter(torch.ones(1))
+        self.overflow_in_fp16 = overflow_in_fp16
+        self.decoded_shapes = []
+
+    @property
+    def dtype(self):
+        return self.scale.dtype
+
+    def decode(self, latents, return_dict=True):
+        self.decoded_shapes.append(tuple(latents.shape))
+        image = torch.nn.functional.interpolate(latents[:, :3], scale_factor=8)
+        if self.overflow_in_fp16 and self.dtype == torch.float16:
+            image = image * torch.inf
+        return (image * self.scale,)
+
+
+class TestVAEDecode(unittest.TestCase):
+    def test_tiles_cover_every_side(self):
+        self.assertEqual(tile_starts(40, 64, 16), [0])
+        self.assertEqual(tile_starts(128, 64, 16), [0, 48, 64])
+        self.assertEqual(tile_starts(112, 64, 16), [0, 48])
+
+    def test_tiled_decode_matches_full_decode(self):
+        vae = UpsamplingVAE()
+        latents = torch.randn(2, 4, 40, 72)
+        full = decode_latents(vae, latents, "full")
+        tiled = decode_latents(vae, latents, "tiled", tile_size=16, tile_overlap=4)
+        self.assertEqual(tiled.shape, (2, 3, 320, 576))
+        self.assertTrue(torch.allclose(full, tiled, atol=1e-6))
+        self.assertLessEqual(max(shape[2] for shape in vae.decoded_shapes[1:]), 16)
+        self.assertEqual({shape[0] for shape in vae.decoded_shapes[1:]}, {1})
+
+    def test_fp16_overflow_is_decoded_again_in_fp32(self):
+        vae = UpsamplingVAE(overflow_in_fp16=True).to(torch.float16)
+        latents = torch.randn(1, 4, 8, 8, dtype=torch.float16)
+        for mode in ("full", "batched", "tiled"):
+            image = decode_latents(vae, latents, mode, tile_size=4, tile_overlap=2)
+            self.assertTrue(torch.isfinite(image).all(), mode)
+            self.assertEqual(vae.dtype, torch.float16)
+
+    def test_batched_decode_matches_full_decode(self):
+        torch.manual_seed(0)
+        vae = AutoencoderKL(
+            block_out_channels=[8, 8],
+            down_block_types=["DownEncoderBlock2D"] * 2,
+            up_block_types=["UpDecoderBlock2D"] * 2,
+            latent_channels=4,
+            norm_num_groups=4,
+            sample_size=32,
+        )
+        latents = torch.randn(3, 4, 16, 16)
+        full = decode_latents(vae, latents, "full")
+        batched = decode_latents(vae, latents, "batched")
+        tiled = decode_latents(vae, latents, "tiled", tile_size=8, tile_overlap=4)
+        self.assertTrue(torch.allclose(full, batched, atol=1e-5))
+        self.assertEqual(tiled.shape, full.shape)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+import threading
+from unittest.mock import MagicMock, patch
+import torch
+
+from helpers.caching.vae_lookahead import VAEEncodeLookahead
+from helpers.multiaspect.sampler import MultiAspectSampler
+from helpers.training.exceptions import MultiDatasetExhausted
+
+
+def fake_encode_images(images, filepaths):
+    return [torch.full((4, 8, 8), float(len(filepath))) for filepath in filepaths]
+
+
+class TestVAEEncodeLookahead(unittest.TestCase):
+    def setUp(self):
+        self.vae_cache = MagicMock()
+        self.vae_cache.id = "foo"
+        self.vae_cache.accelerator = MagicMock(device="cpu")
+        self.vae_cache.encode_images = MagicMock(side_effect=fake_encode_images)
+        self.lookahead = VAEEncodeLookahead(self.vae_cache, max_parked=4)
+
+    def tearDown(self):
+        self.lookahead.stop()
+
+    def test_retrieve_returns_parked_latents(self):
+        self.lookahead.enqueue(["a", "bb"])
+        latents = self.lookahead.retrieve(["a", "bb"])
+        self.assertEqual([latent[0, 0, 0].item() for latent in latents], [1.0, 2.0])
+        self.assertEqual(self.lookahead.hits, 2)
+        self.assertEqual(self.lookahead.misses, 0)
+        # The training thread never had to call the VAE cache itself.
+        self.vae_cache.encode_images.assert_called_once()
+
+    def test_retrieve_encodes_misses_in_order(self):
+        self.lookahead.enqueue(["bb"])
+        latents = self.lookahead.retrieve(["ccc", "bb", "a"])
+        self.assertEqual(
+            [latent[0, 0, 0].item() for latent in latents], [3.0, 2.0, 1.0]
+        )
+        self.assertEqual(self.lookahead.hits, 1)
+        self.assertEqual(self.lookahead.misses, 2)
+        self.assertGreaterEqual(self.lookahead.last_stall_time, 0.0)
+
+    def test_parked_latents_are_bounded(self):
+        release = threading.Event()
+
+        def slow_encode(images, filepaths):
+            release.wait()
+            return fake_encode_images(images, filepaths)
+
+        self.vae_cache.encode_images.side_effect = slow_encode
+        for batch in (["a", "b"], ["c", "d"], ["e", "f"]):
+            self.lookahead.enqueue(batch)
+        release.set()
+        self.lookahead.retrieve(["e", "f"])
+        self.assertLessEqual(len(self.lookahead.parked), 4)
+        self.assertNotIn("a", self.lookahead.parked)
+
+    def test_failed_encode_falls_back_to_training_thread(self):
+        self.vae_cache.encode_images.side_effect = [
+            RuntimeError("boom"),
+            fake_encode_images(None, ["a"]),
+        ]
+        self.lookahead.enqueue(["a"])
+        latents = self.lookahead.retrieve(["a"])
+        self.assertEqual(latents[0][0, 0, 0].item(), 1.0)
+        self.assertEqual(self.lookahead.misses, 1)
+
+
+class TestSamplerLookahead(unittest.TestCase):
+    def setUp(self):
+        metadata_backend = MagicMock()
+        metadata_backend.id = "foo"
+        metadata_backend.aspect_ratio_bucket_indices = {"1.0": ["image1"]}
+        data_backend = MagicMock()
+        data_backend.id = "foo"
+        self.sampler = MultiAspectSampler(
+            id="foo",
+            metadata_backend=metadata_backend,
+            data_backend=data_backend,
+            accelerator=MagicMock(),
+            batch_size=1,
+            lookahead=2,
+        )
+        self.lookahead = MagicMock()
+
+    def _batches(self, count):
+        for idx in range(count):
+            yield ({"image_path": f"image{idx}"},)
+        raise MultiDatasetExhausted()
+
+    def test_lookahead_announces_and_drains_before_exhausting(self):
+        with patch.object(
+            self.sampler, "_iter_batches", side_effect=lambda: self._batches(3)
+        ), patch(
+            "helpers.multiaspect.sampler.StateTracker.get_data_backends",
+            return_value={"foo": {"vaecache": MagicMock(lookahead=self.lookahead)}},
+        ):
+            # The trainer builds a fresh iterator for every step.
+            yielded = [next(iter(self.sampler)) for _ in range(3)]
+            self.assertEqual(
+                [batch[0]["image_path"] for batch in yielded],
+                ["image0", "image1", "image2"],
+            )
+            announced = [call.args[0] for call in self.lookahead.enqueue.call_args_list]
+            self.assertEqual(announced, [["image0"], ["image1"], ["image2"]])
+            with self.assertRaises(MultiDatasetExhausted):
+                next(iter(self.sampler))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Time AdamWBF16 optimizer steps on a synthetic LoRA parameter set, comparing
+the per-tensor update against the foreach update.
+
+Example:
+    python toolkit/benchmarks/benchmark_adamw_bf16.py --layers 280 --rank 16 --device cpu
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.training.adam_bfloat16 import AdamWBF16
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--layers",
+        type=int,
+        default=280,
+        help="Number of adapted linear layers. Each contributes a lora_A and lora_B tensor.",
+    )
+    parser.add_argument("--rank", type=int, default=16, help="LoRA rank.")
+    parser.add_argument(
+        "--features",
+        type=int,
+        default=1280,
+        help="Input and output features of each adapted layer.",
+    )
+    parser.add_argument("--steps", type=int, default=20, help="Timed steps.")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed steps.")
+    parser.add_argument("--device", type=str, default="cpu")
+    return parser.parse_args()
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def lora_parameters(args, device):
+    params = []
+    for _ in range(args.layers):
+        params.append(
+            torch.nn.Parameter(
+                torch.randn(
+                    args.rank, args.features, dtype=torch.bfloat16, device=device
+                )
+                * 0.01
+            )
+        )
+        params.append(
+            torch.nn.Parameter(
+                torch.zeros(
+                    args.features, args.rank, dtype=torch.bfloat16, device=device
+                )
+            )
+        )
+    for p in params:
+        p.grad = torch.randn_like(p)
+    return params
+
+
+def time_steps(args, device, foreach: bool) -> float:
+    torch.manual_seed(0)
+    params = lora_parameters(args, device)
+    optimizer = AdamWBF16(params, lr=1e-4, weight_decay=1e-2, foreach=foreach)
+    for _ in range(args.warmup):
+        optimizer.step()
+    synchronize(device)
+    start_time = time.perf_counter()
+    for _ in range(args.steps):
+        optimizer.step()
+    synchronize(device)
+    return (time.perf_counter() - start_time) / args.steps
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    numel = args.layers * 2 * args.rank * args.features
+    print(
+        f"{args.layers * 2} LoRA tensors, {numel / 1e6:.2f}M parameters, on {device}."
+    )
+    per_tensor_time = time_steps(args, device, foreach=False)
+    foreach_time = time_steps(args, device, foreach=True)
+    print(f"per-tensor: {per_tensor_time * 1000:.2f} ms/step")
+    print(f"foreach:    {foreach_time * 1000:.2f} ms/step")
+    print(f"speedup:    {per_tensor_time / foreach_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Time each attention backend on SmolDiT- and Flux-shaped toy inputs, and report its peak memory.
+
+Each backend runs in a fresh process, so the peak resident memory of one doesn't hide another's.
+On CUDA, the peak allocated memory is reported instead.
+
+Example:
+    python toolkit/benchmarks/benchmark_attention_backends.py --sequence_length 2048 --device cpu
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import warnings
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.models.attention_backends import (
+    SlidingWindowBias,
+    attention,
+    attention_backends,
+    flex_attention_available,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=[
+            name
+            for name in attention_backends
+            if name != "flex" or flex_attention_available()
+        ],
+    )
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--sequence_length", type=int, default=2048)
+    parser.add_argument("--head_dim", type=int, default=64)
+    parser.add_argument(
+        "--smoldit_heads",
+        type=int,
+        nargs=2,
+        default=[16, 4],
+        metavar=("HEADS", "KV_HEADS"),
+        help="Query and key/value heads for the SmolDiT sliding window case.",
+    )
+    parser.add_argument("--sliding_window", type=int, default=128)
+    parser.add_argument(
+        "--flux_heads",
+        type=int,
+        default=8,
+        help="Heads for the Flux padding mask case.",
+    )
+    parser.add_argument("--chunk_size", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=5, help="Timed calls.")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed calls.")
+    parser.add_argument("--device", type=str, default="cpu")
+    return parser.parse_args()
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def inputs(args, case: str, device: torch.device):
+    torch.manual_seed(0)
+    length = args.sequence_length
+    if case == "smoldit":
+        heads, kv_heads = args.smoldit_heads
+        attn_mask = SlidingWindowBias(args.sliding_window)
+    else:
+        heads = kv_heads = args.flux_heads
+        # Flux's text padding, as a 0/1 bias over the keys.
+        attn_mask = torch.ones(args.batch_size, 1, 1, length, device=device)
+        attn_mask[:, ..., : length // 8] = 0
+    query = torch.randn(args.batch_size, heads, length, args.head_dim, device=device)
+    key = torch.randn(args.batch_size, kv_heads, length, args.head_dim, device=device)
+    value = torch.randn_like(key)
+    return query, key, value, attn_mask
+
+
+def run_backend(args, case: str, backend: str, results):
+    device = torch.device(args.device)
+    options = {"chunk_size": args.chunk_size} if backend == "chunked" else {}
+    query, key, value, attn_mask = inputs(args, case, device)
+    synchronize(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    baseline_memory = peak_memory_mb(device)
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter("ignore")
+        for _ in range(args.warmup):
+            attention(query, key, value, attn_mask, backend=backend, **options)
+        synchronize(device)
+        start_time = time.perf_counter()
+        for _ in range(args.steps):
+            attention(query, key, value, attn_mask, backend=backend, **options)
+        synchronize(device)
+    elapsed = (time.perf_counter() - start_time) / args.steps
+    results.put((elapsed, peak_memory_mb(device) - baseline_memory))
+
+
+def main():
+    args = parse_args()
+    context = multiprocessing.get_context("spawn")
+    for case in ("smoldit", "flux"):
+        if case == "smoldit":
+            heads, kv_heads = args.smoldit_heads
+            description = f"{heads} heads sharing {kv_heads} key/value heads, sliding window {args.sliding_window}"
+        else:
+            description = f"{args.flux_heads} heads, padding mask"
+        print(
+            f"{case}: batch {args.batch_size}, {args.sequence_length} tokens, {description}, on {args.device}."
+        )
+        for backend in args.backends:
+            results = context.Queue()
+            process = context.Process(
+                target=run_backend, args=(args, case, backend, results)
+            )
+            process.start()
+            elapsed, peak_memory = results.get()
+            process.join()
+            print(
+                f"  {backend:<8} {elapsed * 1000:9.2f} ms/call"
+                f" {peak_memory:9.1f} MB peak memory above inputs"
+            )
+
+
+if __name__ == "__main__":
+    main()
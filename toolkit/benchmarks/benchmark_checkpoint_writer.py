@@ -0,0 +1,190 @@
+"""
+Compare the bytes written, time and peak host memory of saving a full-model checkpoint.
+
+- save_pretrained: the previous path. The model is written with save_pretrained in shards,
+    every shard is loaded back into memory and merged into one file, and the result is copied
+    into the checkpoint directory.
+- streaming: each tensor is streamed into a single safetensors file in a temporary directory,
+    which is then renamed into the checkpoint directory.
+
+Each method runs in a fresh process, so the peak resident memory of one doesn't hide another's.
+
+Example:
+    python toolkit/benchmarks/benchmark_checkpoint_writer.py --size_gb 2 --shard_size 500MB
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import psutil
+import torch
+from diffusers import ConfigMixin, ModelMixin
+from diffusers.configuration_utils import register_to_config
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.training.checkpoint_writer import WEIGHTS_NAME, replace_path, save_model
+
+
+class BenchmarkModel(ModelMixin, ConfigMixin):
+    @register_to_config
+    def __init__(self, layers: int = 8, width: int = 4096, dtype: str = "bf16"):
+        super().__init__()
+        # Created in the target precision, so that building the model doesn't set the peak.
+        self.layers = torch.nn.ModuleList(
+            [
+                torch.nn.Linear(
+                    width,
+                    width,
+                    dtype=torch.bfloat16 if dtype == "bf16" else torch.float32,
+                )
+                for _ in range(layers)
+            ]
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--size_gb", type=float, default=2.0, help="The size of the model's weights."
+    )
+    parser.add_argument("--width", type=int, default=4096)
+    parser.add_argument(
+        "--shard_size",
+        type=str,
+        default="10GB",
+        help="save_pretrained's max_shard_size. Below --size_gb, the shards have to be merged.",
+    )
+    parser.add_argument("--dtype", type=str, choices=["fp32", "bf16"], default="bf16")
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="Where the checkpoints are written. Default: a temporary directory.",
+    )
+    return parser.parse_args()
+
+
+def peak_memory_gb() -> float:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+
+
+def bytes_written() -> int:
+    counters = psutil.Process().io_counters()
+    # Bytes passed to write(), whether or not they have reached the disk yet.
+    return getattr(counters, "write_chars", counters.write_bytes)
+
+
+def merge_in_memory(directory: str):
+    index_path = os.path.join(directory, f"{WEIGHTS_NAME}.index.json")
+    if not os.path.exists(index_path):
+        return
+    with open(index_path) as f:
+        weight_map = json.load(f)["weight_map"]
+    all_tensors = {}
+    for file_name in set(weight_map.values()):
+        with safe_open(
+            os.path.join(directory, file_name), framework="pt", device="cpu"
+        ) as f:
+            for key in f.keys():
+                all_tensors[key] = f.get_tensor(key)
+    save_file(all_tensors, os.path.join(directory, WEIGHTS_NAME))
+    os.remove(index_path)
+    for file_name in set(weight_map.values()):
+        os.remove(os.path.join(directory, file_name))
+
+
+def save_with_save_pretrained(model, temporary_dir: str, checkpoint_dir: str, args):
+    model.save_pretrained(
+        os.path.join(temporary_dir, "transformer"), max_shard_size=args.shard_size
+    )
+    merge_in_memory(os.path.join(temporary_dir, "transformer"))
+    shutil.copytree(temporary_dir, checkpoint_dir, dirs_exist_ok=True)
+    shutil.rmtree(temporary_dir)
+
+
+def save_with_streaming(model, temporary_dir: str, checkpoint_dir: str, args):
+    save_model(model, os.path.join(temporary_dir, "transformer"))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    replace_path(
+        os.path.join(temporary_dir, "transformer"),
+        os.path.join(checkpoint_dir, "transformer"),
+    )
+    shutil.rmtree(temporary_dir)
+
+
+methods = {
+    "save_pretrained": save_with_save_pretrained,
+    "streaming": save_with_streaming,
+}
+
+
+def run_method(args, method: str, output_dir: str, results):
+    dtype = torch.bfloat16 if args.dtype == "bf16" else torch.float32
+    layer_bytes = args.width * (args.width + 1) * dtype.itemsize
+    layers = max(1, round(args.size_gb * 1024**3 / layer_bytes))
+    model = BenchmarkModel(layers=layers, width=args.width, dtype=args.dtype)
+    model_memory = psutil.Process().memory_info().rss / 1024**3
+    temporary_dir = os.path.join(output_dir, f"temporary-{method}")
+    checkpoint_dir = os.path.join(output_dir, f"checkpoint-{method}")
+    written_before = bytes_written()
+    start_time = time.perf_counter()
+    methods[method](model, temporary_dir, checkpoint_dir, args)
+    elapsed = time.perf_counter() - start_time
+    written = bytes_written() - written_before
+    checkpoint_size = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(checkpoint_dir)
+        for name in names
+    )
+    shutil.rmtree(checkpoint_dir)
+    results.put(
+        (
+            checkpoint_size,
+            written,
+            elapsed,
+            model_memory,
+            peak_memory_gb() - model_memory,
+        )
+    )
+
+
+def main():
+    args = parse_args()
+    output_dir = args.output_dir or tempfile.mkdtemp()
+    os.makedirs(output_dir, exist_ok=True)
+    context = multiprocessing.get_context("spawn")
+    print(
+        f"Saving {args.size_gb} GB of {args.dtype} weights, max_shard_size={args.shard_size}, to {output_dir}."
+    )
+    try:
+        for method in methods:
+            results = context.Queue()
+            process = context.Process(
+                target=run_method, args=(args, method, output_dir, results)
+            )
+            process.start()
+            checkpoint_size, written, elapsed, model_memory, peak_memory = results.get()
+            process.join()
+            print(
+                f"  {method:<16} {written / 1024**3:7.2f} GB written"
+                f" ({written / max(checkpoint_size, 1):.1f}x the checkpoint)"
+                f" {elapsed:7.2f} s"
+                f" {peak_memory:7.2f} GB peak memory above the process with the model loaded ({model_memory:.2f} GB)"
+            )
+    finally:
+        if args.output_dir is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
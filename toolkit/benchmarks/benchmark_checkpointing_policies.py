@@ -0,0 +1,145 @@
+"""
+Compare the memory and speed of each --gradient_checkpointing_policy on a small SmolDiT.
+
+For each policy, a forward and backward pass is timed, and the activations held for the
+backward pass are measured. On CUDA, the peak allocated memory is reported too.
+
+Example:
+    python toolkit/benchmarks/benchmark_checkpointing_policies.py --layers 8 --resolution 32 --device cpu
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.models.smoldit import SmolDiT2DModel
+from helpers.training.activation_checkpointing import (
+    ActivationCheckpointing,
+    SavedActivationCounter,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--head_dim", type=int, default=32)
+    parser.add_argument(
+        "--resolution", type=int, default=32, help="Latent height and width."
+    )
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--interval", type=int, default=2)
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        help="Also fit the auto policy to this many GB of peak memory. Requires CUDA.",
+    )
+    parser.add_argument("--steps", type=int, default=3, help="Timed steps.")
+    parser.add_argument("--device", type=str, default="cpu")
+    return parser.parse_args()
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def training_step(model, inputs):
+    model.zero_grad(set_to_none=True)
+    counter = SavedActivationCounter(exclude=list(model.parameters()))
+    with counter:
+        loss = model(**inputs).sample.square().mean()
+    loss.backward()
+    return counter.bytes
+
+
+def benchmark(args, model, inputs, device, policy: str) -> dict:
+    checkpointing = None
+    if policy != "none":
+        checkpointing = ActivationCheckpointing(
+            model,
+            policy=policy,
+            interval=args.interval,
+            memory_budget=args.memory_budget,
+        ).apply()
+    # Warm up, which is also when the auto policy fits itself.
+    for _ in range(2):
+        training_step(model, inputs)
+        if checkpointing is not None:
+            checkpointing.step(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    synchronize(device)
+    start_time = time.perf_counter()
+    for _ in range(args.steps):
+        activation_bytes = training_step(model, inputs)
+    synchronize(device)
+    result = {
+        "policy": policy,
+        "step_time": (time.perf_counter() - start_time) / args.steps,
+        "activation_mb": activation_bytes / 1024**2,
+        "peak_mb": (
+            torch.cuda.max_memory_allocated(device) / 1024**2
+            if device.type == "cuda"
+            else None
+        ),
+        "checkpointed_modules": (
+            checkpointing.summary()["checkpointed_modules"] if checkpointing else 0
+        ),
+    }
+    if checkpointing is not None:
+        checkpointing.remove()
+    return result
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = SmolDiT2DModel(
+        sample_size=args.resolution,
+        patch_size=2,
+        num_attention_heads=args.heads,
+        num_kv_heads=max(1, args.heads // 4),
+        attention_head_dim=args.head_dim,
+        in_channels=4,
+        out_channels=4,
+        num_layers=args.layers,
+        cross_attention_dim=128,
+    ).to(device)
+    model.train()
+    inputs = {
+        "hidden_states": torch.randn(
+            args.batch_size, 4, args.resolution, args.resolution, device=device
+        ),
+        "timestep": torch.randint(0, 1000, (args.batch_size,), device=device),
+        "encoder_hidden_states": torch.randn(args.batch_size, 77, 128, device=device),
+    }
+    policies = ["none", "full", "every_n", "attention", "mlp"]
+    if args.memory_budget is not None:
+        policies.append("auto")
+    results = [benchmark(args, model, inputs, device, policy) for policy in policies]
+    baseline = results[0]
+    print(
+        f"SmolDiT with {args.layers} blocks, {(args.resolution // 2) ** 2} image tokens,"
+        f" batch {args.batch_size}, on {device}."
+    )
+    for result in results:
+        line = (
+            f"  {result['policy']:<10} {result['checkpointed_modules']:3d} modules"
+            f" {result['step_time'] * 1000:9.1f} ms/step"
+            f" ({result['step_time'] / baseline['step_time']:.2f}x)"
+            f" {result['activation_mb']:8.1f} MB activations held"
+        )
+        if result["peak_mb"] is not None:
+            line += f" {result['peak_mb']:8.1f} MB peak"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Measure the throughput of hashing images for a dataset's `deduplicate` option, and of looking up
+near-duplicates among millions of hashes.
+
+Hashing compares the per-pixel Python loop that toolkit/datasets/folder_to_parquet.py used, with
+the vectorised pHash and dHash, one image at a time and in batches. Queries compare the
+multi-index used for deduplication against scanning every hash with numpy.
+
+The hashes are random, so each block of the multi-index is evenly filled. Real datasets have
+more hashes in common, which makes multi-index queries slower than reported here.
+
+Example:
+    python toolkit/benchmarks/benchmark_perceptual_hash.py --images 256 --hashes 1000000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.image_manipulation.perceptual_hash import (
+    hamming_distances,
+    image_hashes,
+)
+from helpers.metadata.deduplication import HammingIndex
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=256, help="Images hashed.")
+    parser.add_argument(
+        "--resolution", type=int, default=1024, help="The images' edge, in pixels."
+    )
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument(
+        "--hashes", type=int, default=1000000, help="Hashes in the index."
+    )
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--max_distance", type=int, default=4)
+    return parser.parse_args()
+
+
+def python_average_hash(image):
+    """The average hash folder_to_parquet.py computed before, one pixel at a time."""
+    image = image.convert("L").resize((8, 8))
+    pixels = list(image.getdata())
+    avg = sum(pixels) / len(pixels)
+    bits = "".join("1" if pixel > avg else "0" for pixel in pixels)
+    return int(bits, 2)
+
+
+def timed(function) -> float:
+    start_time = time.perf_counter()
+    function()
+    return time.perf_counter() - start_time
+
+
+def benchmark_hashing(args):
+    rng = np.random.default_rng(0)
+    # Smooth noise, so that the thumbnails aren't flat grey.
+    images = [
+        Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)).resize(
+            (args.resolution, args.resolution), Image.Resampling.BILINEAR
+        )
+        for _ in range(args.images)
+    ]
+    batches = [
+        images[i : i + args.batch_size] for i in range(0, len(images), args.batch_size)
+    ]
+    modes = {
+        "python average hash": lambda: [python_average_hash(image) for image in images],
+    }
+    for method in ("phash", "dhash"):
+        modes[f"{method}, per image"] = lambda method=method: [
+            image_hashes([image], method) for image in images
+        ]
+        modes[f"{method}, batched"] = lambda method=method: [
+            image_hashes(batch, method) for batch in batches
+        ]
+    print(f"Hashing {args.images} images of {args.resolution}px:")
+    for mode, function in modes.items():
+        elapsed = timed(function)
+        print(f"  {mode:<22} {args.images / elapsed:10.1f} images/s")
+
+
+def benchmark_queries(args):
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 2**64, args.hashes, dtype=np.uint64)
+    # Each query is one of the hashes with up to max_distance bits flipped.
+    queries = []
+    for value in rng.choice(hashes, args.queries):
+        value = int(value)
+        for bit in rng.choice(64, rng.integers(0, args.max_distance + 1), False):
+            value ^= 1 << int(bit)
+        queries.append(value)
+
+    index = HammingIndex(args.max_distance)
+    build_time = timed(
+        lambda: [index.add(key, int(value)) for key, value in enumerate(hashes)]
+    )
+    print(
+        f"Querying {args.hashes} hashes within {args.max_distance} bits,"
+        f" {args.queries} queries (the index took {build_time:.1f} s to build):"
+    )
+    found = []
+    elapsed = timed(lambda: found.extend(len(index.query(value)) for value in queries))
+    print(f"  {'multi-index':<22} {args.queries / elapsed:10.1f} queries/s")
+    # Scanning every hash is far slower, so it only runs a sample of the queries.
+    sample = queries[: max(1, args.queries // 20)]
+    scanned = []
+    elapsed = timed(
+        lambda: scanned.extend(
+            int((hamming_distances(hashes, value) <= args.max_distance).sum())
+            for value in sample
+        )
+    )
+    print(f"  {'numpy scan':<22} {len(sample) / elapsed:10.1f} queries/s")
+    if found[: len(sample)] != scanned:
+        raise RuntimeError("The multi-index and the scan found different matches.")
+
+
+def main():
+    args = parse_args()
+    benchmark_hashing(args)
+    benchmark_queries(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Audit the import cost of the trainer's entry points with `python -X importtime`.
+
+Each module is imported in a fresh interpreter. The wall time of the best run is reported, along
+with the modules it imports directly and the packages that account for most of the import time,
+which is where lazy loading pays off.
+
+Example:
+    python toolkit/benchmarks/benchmark_startup.py --modules configure train --top 10
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+repository_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--modules",
+        nargs="+",
+        default=[
+            "configure",
+            "helpers.arguments",
+            "helpers.training.validation",
+            "train",
+        ],
+        help="The modules to import, relative to the repository root.",
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Report the best run.")
+    parser.add_argument(
+        "--top", type=int, default=8, help="How many offenders to list."
+    )
+    return parser.parse_args()
+
+
+def parse_importtime(stderr: str) -> list:
+    """The (self microseconds, cumulative microseconds, depth, module) of each import."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return imports
+
+
+def import_module(module: str) -> tuple:
+    start_time = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=repository_root,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start_time
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1:] or ["unknown error"]
+        print(f"  import {module} failed: {error[0]}")
+    return elapsed, parse_importtime(result.stderr)
+
+
+def report(module: str, elapsed: float, imports: list, top: int):
+    print(f"import {module}: {elapsed:.2f}s wall")
+    # importtime lists each module after everything it imports, so the module's direct imports
+    # are the entries one level deeper that precede it.
+    direct = []
+    targets = [index for index, entry in enumerate(imports) if entry[3] == module]
+    if targets:
+        target_depth = imports[targets[-1]][2]
+        for _, cumulative_us, depth, name in reversed(imports[: targets[-1]]):
+            if depth <= target_depth:
+                break
+            if depth == target_depth + 1:
+                direct.append((cumulative_us, name))
+    print("  Slowest direct imports:")
+    for cumulative_us, name in sorted(direct, reverse=True)[:top]:
+        print(f"    {cumulative_us / 1e6:7.3f}s  {name}")
+    packages = defaultdict(int)
+    for self_us, _, _, name in imports:
+        packages[name.split(".")[0]] += self_us
+    print("  Import time by package:")
+    for name, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"    {self_us / 1e6:7.3f}s  {name}")
+
+
+def main():
+    args = parse_args()
+    for module in args.modules:
+        best_elapsed, best_imports = None, []
+        for _ in range(args.runs):
+            elapsed, imports = import_module(module)
+            if best_elapsed is None or elapsed < best_elapsed:
+                best_elapsed, best_imports = elapsed, imports
+        report(module, best_elapsed, best_imports, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Time each --validation_vae_decode mode on a randomly initialised SDXL-shaped VAE, and report its
+peak memory and how far its images are from a full decode.
+
+Each mode runs in a fresh process, so the peak resident memory of one doesn't hide another's.
+On CUDA, the peak allocated memory is reported instead.
+
+Example:
+    python toolkit/benchmarks/benchmark_vae_decode.py --resolution 1024 --batch_size 2 --device cpu
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import torch
+from diffusers import AutoencoderKL
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.models.vae_decode import decode_latents, vae_decode_modes
+
+dtypes = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--resolution", type=int, default=1024, help="The images' edge, in pixels."
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=2,
+        help="Images decoded per call, as --num_validation_images would.",
+    )
+    parser.add_argument(
+        "--block_out_channels",
+        type=int,
+        nargs="+",
+        default=[128, 256, 512, 512],
+        help="The VAE's width at each level. The default is the SD and SDXL VAE's.",
+    )
+    parser.add_argument("--tile_size", type=int, default=64)
+    parser.add_argument("--tile_overlap", type=int, default=16)
+    parser.add_argument("--dtype", type=str, choices=list(dtypes), default="fp32")
+    parser.add_argument("--steps", type=int, default=2, help="Timed decodes.")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--modes",
+        type=str,
+        nargs="+",
+        choices=list(vae_decode_modes),
+        default=list(vae_decode_modes),
+    )
+    return parser.parse_args()
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build(args, device: torch.device):
+    torch.manual_seed(0)
+    levels = len(args.block_out_channels)
+    vae = AutoencoderKL(
+        block_out_channels=args.block_out_channels,
+        down_block_types=["DownEncoderBlock2D"] * levels,
+        up_block_types=["UpDecoderBlock2D"] * levels,
+        latent_channels=4,
+        layers_per_block=2,
+    )
+    vae = vae.to(device=device, dtype=dtypes[args.dtype]).eval()
+    size = args.resolution // 2 ** (levels - 1)
+    latents = torch.randn(args.batch_size, 4, size, size, device=device)
+    return vae, latents.to(vae.dtype)
+
+
+def run_mode(args, mode: str, results):
+    device = torch.device(args.device)
+    vae, latents = build(args, device)
+    options = {"tile_size": args.tile_size, "tile_overlap": args.tile_overlap}
+    synchronize(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    baseline_memory = peak_memory_mb(device)
+    start_time = time.perf_counter()
+    for _ in range(args.steps):
+        image = decode_latents(vae, latents, mode, **options)
+    synchronize(device)
+    elapsed = (time.perf_counter() - start_time) / args.steps
+    results.put(
+        (elapsed, peak_memory_mb(device) - baseline_memory, image.float().cpu())
+    )
+
+
+def main():
+    args = parse_args()
+    context = multiprocessing.get_context("spawn")
+    print(
+        f"Decoding {args.batch_size} images of {args.resolution}px with a {args.dtype} VAE"
+        f" of width {args.block_out_channels}, on {args.device}."
+    )
+    reference = None
+    for mode in args.modes:
+        results = context.Queue()
+        process = context.Process(target=run_mode, args=(args, mode, results))
+        process.start()
+        elapsed, peak_memory, image = results.get()
+        process.join()
+        if reference is None:
+            reference = image
+        print(
+            f"  {mode:<8} {elapsed:8.2f} s/decode"
+            f" {peak_memory:9.1f} MB peak memory above the VAE and latents"
+            f" {(image - reference).abs().max().item():8.4f} max difference from {args.modes[0]}"
+        )
+
+
+if __name__ == "__main__":
+    main()
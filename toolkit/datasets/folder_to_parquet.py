@@ -1,72 +1,374 @@
 """
 This script exists to scan a folder and import all of the image data into equally sized parquet files.
 
-Fields collected:
+Images are probed in a process pool, and written as they arrive into row groups of a bounded
+size, across as many `images-{n}.parquet` shards as they need, so memory doesn't grow with the
+dataset. Alongside them, `metadata.parquet` holds one row of metadata per image, and can be
+used as the `parquet` `path` of a dataset with `metadata_backend=parquet` whose
+`instance_data_dir` is the input folder:
 
-filename
-image hash
+    "parquet": {
+        "path": "/path/to/output/metadata.parquet",
+        "filename_column": "filename",
+        "caption_column": "caption",
+        "width_column": "width",
+        "height_column": "height",
+        "aspect_ratio_column": "aspect_ratio",
+        "luminance_column": "luminance",
+        "phash_column": "phash",
+        "identifier_includes_extension": true
+    }
+
+Running it again on the same output folder only reads the images that were added or changed.
+Images are stored by the hash of their file, so a renamed or copied image isn't stored twice.
+
+Fields collected in metadata.parquet:
+
+filename (relative to the input folder)
+caption (from a .txt file beside the image, or else the filename)
 width
 height
+aspect_ratio
 luminance
-image_data
+phash (a perceptual hash, for a dataset's `deduplicate` option)
+file_hash, file_size, mtime_ns (to find changed images)
+shard (the images-{n}.parquet file holding the image)
+
+Fields in images-{n}.parquet:
+
+file_hash
+filename
+image (the original compressed file)
 """
 
-import os, argparse
+import os, sys, argparse, hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from PIL import Image
-import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.image_manipulation.brightness import calculate_luminance
+from helpers.image_manipulation.perceptual_hash import image_hash
+from helpers.training import image_file_extensions
+
+METADATA_FILE = "metadata.parquet"
+metadata_schema = pa.schema(
+    [
+        ("filename", pa.string()),
+        ("caption", pa.string()),
+        ("width", pa.int64()),
+        ("height", pa.int64()),
+        ("aspect_ratio", pa.float32()),
+        ("luminance", pa.float32()),
+        ("phash", pa.string()),
+        ("file_hash", pa.string()),
+        ("file_size", pa.int64()),
+        ("mtime_ns", pa.int64()),
+        ("shard", pa.string()),
+    ]
+)
+image_schema = pa.schema(
+    [
+        ("file_hash", pa.string()),
+        ("filename", pa.string()),
+        ("image", pa.binary()),
+    ]
+)
+
+
+def probe_image(task):
+    """
+    Read an image's size and statistics. Runs in the process pool.
+
+    Args:
+        task (tuple): (path, filename, known file hash or None, whether to return the file)
+
+    Returns:
+        dict: The image's metadata row, with its file under "image". Only "file_hash" is set if
+            it matches the known hash, and None is returned if it isn't a readable image, eg. if
+            it was removed since the folder was listed.
+    """
+    path, filename, known_hash, include_image = task
+    try:
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            file_data = f.read()
+    except OSError:
+        return None
+    row = {
+        "filename": filename,
+        "file_hash": hashlib.sha256(file_data).hexdigest(),
+        "file_size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if row["file_hash"] == known_hash:
+        return row
+    try:
+        image = Image.open(BytesIO(file_data))
+        width, height = image.size
+        # JPEGs are decoded at a fraction of their size, which is plenty for the statistics.
+        image.draft("RGB", (256, 256))
+        image = image.convert("RGB")
+    except Exception:
+        return None
+    caption_path = os.path.splitext(path)[0] + ".txt"
+    if os.path.exists(caption_path):
+        with open(caption_path, encoding="utf-8") as f:
+            caption = f.read().strip()
+    else:
+        caption = os.path.splitext(os.path.basename(filename))[0]
+    row.update(
+        {
+            "caption": caption,
+            "width": width,
+            "height": height,
+            "aspect_ratio": width / height,
+            "luminance": float(calculate_luminance(image)),
+            "phash": image_hash(image, "phash"),
+            "image": file_data if include_image else None,
+        }
+    )
+    return row
+
 
-def get_image_hash(image):
-    """Calculate the hash of an image."""
-    image = image.convert("L").resize((8, 8))
-    pixels = list(image.getdata())
-    avg = sum(pixels) / len(pixels)
-    bits = "".join("1" if pixel > avg else "0" for pixel in pixels)
-    return int(bits, 2)
+def bounded_map(executor, function, tasks, window: int):
+    """Like executor.map, but only `window` tasks are in flight, so results don't pile up."""
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(function, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
-def get_image_luminance(image):
-    """Calculate the luminance of an image."""
-    image = image.convert("L")
-    pixels = list(image.getdata())
-    return sum(pixels) / len(pixels)
+class ShardWriter:
+    """
+    Writes rows into images-{n}.parquet shards, a row group at a time. A row group is written
+    once its images reach `row_group_size` bytes, and a new shard is started once a shard
+    reaches `shard_size` bytes.
+    """
 
+    def __init__(
+        self, output_folder: str, first_shard: int, row_group_size: int, shard_size: int
+    ):
+        self.output_folder = output_folder
+        self.shard_number = first_shard
+        self.row_group_size = row_group_size
+        self.shard_size = shard_size
+        self.writer = None
+        self.rows = []
+        self.row_group_bytes = 0
+        self.shard_bytes = 0
 
-def get_size(image):
-    """Get the size of an image."""
-    return image.size
+    @property
+    def shard(self) -> str:
+        return f"images-{self.shard_number:05d}.parquet"
 
+    def add(self, row: dict) -> str:
+        """Queue a row for writing. Returns the shard it'll be written to."""
+        if self.shard_bytes > 0 and self.shard_bytes >= self.shard_size:
+            self.close()
+            self.shard_number += 1
+            self.shard_bytes = 0
+        self.rows.append(row)
+        self.row_group_bytes += len(row["image"])
+        self.shard_bytes += len(row["image"])
+        if self.row_group_bytes >= self.row_group_size:
+            self.flush()
+        return self.shard
 
-argparser = argparse.ArgumentParser()
-argparser.add_argument("input_folder", help="Folder to scan for images")
-argparser.add_argument("output_folder", help="Folder to save parquet files")
+    def flush(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                os.path.join(self.output_folder, self.shard), image_schema
+            )
+        self.writer.write_table(
+            pa.Table.from_pylist(self.rows, schema=image_schema),
+            row_group_size=len(self.rows),
+        )
+        self.rows = []
+        self.row_group_bytes = 0
 
-args = argparser.parse_args()
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
-os.makedirs(args.output_folder, exist_ok=True)
 
-data = []
-for root, _, files in os.walk(args.input_folder):
-    for file in tqdm(files, desc="Processing images"):
+def load_metadata(output_folder: str) -> dict:
+    """The rows of an existing metadata.parquet, by filename."""
+    metadata_path = os.path.join(output_folder, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return {}
+    table = pq.read_table(metadata_path, schema=metadata_schema)
+    return {row["filename"]: row for row in table.to_pylist()}
+
+
+def next_shard_number(output_folder: str) -> int:
+    numbers = [
+        int(name[len("images-") : -len(".parquet")])
+        for name in os.listdir(output_folder)
+        if name.startswith("images-") and name.endswith(".parquet")
+    ]
+    return max(numbers, default=-1) + 1
+
+
+def list_images(input_folder: str):
+    for root, _, files in os.walk(input_folder):
+        for file in sorted(files):
+            if os.path.splitext(file)[1][1:].lower() in image_file_extensions:
+                path = os.path.join(root, file)
+                yield path, os.path.relpath(path, input_folder).replace(os.sep, "/")
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("input_folder", help="Folder to scan for images")
+    argparser.add_argument("output_folder", help="Folder to save parquet files")
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes reading images.",
+    )
+    argparser.add_argument(
+        "--row_group_size_mb",
+        type=int,
+        default=128,
+        help="Image bytes per row group.",
+    )
+    argparser.add_argument(
+        "--shard_size_mb",
+        type=int,
+        default=1024,
+        help="Image bytes per images-{n}.parquet file.",
+    )
+    argparser.add_argument(
+        "--skip_image_data",
+        action="store_true",
+        help="Only write metadata.parquet, leaving the images in the input folder.",
+    )
+    return argparser.parse_args()
+
+
+def pack_folder(
+    input_folder: str,
+    output_folder: str,
+    workers: int = 1,
+    row_group_size: int = 128 * 1024**2,
+    shard_size: int = 1024**3,
+    skip_image_data: bool = False,
+) -> dict:
+    """
+    Pack the images of `input_folder` into `output_folder`, updating what an earlier run wrote.
+
+    Args:
+        input_folder (str): Folder to scan for images.
+        output_folder (str): Folder to write metadata.parquet and the image shards into.
+        workers (int): Processes reading images.
+        row_group_size (int): Image bytes per row group.
+        shard_size (int): Image bytes per images-{n}.parquet file.
+        skip_image_data (bool): Only write metadata.parquet.
+
+    Returns:
+        dict: The number of images that were unchanged, read, and skipped as unreadable.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    previous = load_metadata(output_folder)
+    # Where each stored image is, by the hash of its file.
+    stored = {row["file_hash"]: row["shard"] for row in previous.values()}
+    metadata = {}
+    tasks = []
+    for path, filename in list_images(input_folder):
+        row = previous.get(filename)
         try:
-            image = Image.open(os.path.join(root, file))
-        except:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if row is not None and (row["file_size"], row["mtime_ns"]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            metadata[filename] = row
             continue
+        known_hash = row["file_hash"] if row is not None else None
+        tasks.append((path, filename, known_hash, not skip_image_data))
+    unchanged = len(metadata)
+    print(
+        f"{unchanged} images are unchanged, reading {len(tasks)} with {workers} processes."
+    )
 
-        width, height = get_size(image)
-        luminance = get_image_luminance(image)
-        image_hash = get_image_hash(image)
-        # Get the smallest original compressed representation of the image
-        file_data = open(os.path.join(root, file), "rb").read()
-        image_data = np.frombuffer(file_data, dtype=np.uint8)
+    writer = ShardWriter(
+        output_folder, next_shard_number(output_folder), row_group_size, shard_size
+    )
+    unreadable = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for row in tqdm(
+            bounded_map(executor, probe_image, tasks, window=workers * 4),
+            total=len(tasks),
+            desc="Processing images",
+        ):
+            if row is None:
+                unreadable += 1
+                continue
+            if "image" not in row:
+                # The file changed on disk, but not its content.
+                metadata[row["filename"]] = {
+                    **previous[row["filename"]],
+                    "mtime_ns": row["mtime_ns"],
+                }
+                continue
+            image = row.pop("image")
+            if image is not None and row["file_hash"] not in stored:
+                stored[row["file_hash"]] = writer.add(
+                    {
+                        "file_hash": row["file_hash"],
+                        "filename": row["filename"],
+                        "image": image,
+                    }
+                )
+            row["shard"] = stored.get(row["file_hash"])
+            metadata[row["filename"]] = row
+    writer.close()
 
-        data.append((file, image_hash, width, height, luminance, image_data))
+    # The metadata is small, so it's rewritten whole. Images that were removed from the input
+    # folder are dropped from it, but stay in their shards.
+    metadata_path = os.path.join(output_folder, METADATA_FILE)
+    pq.write_table(
+        pa.Table.from_pylist(
+            [metadata[filename] for filename in sorted(metadata)],
+            schema=metadata_schema,
+        ),
+        f"{metadata_path}.tmp",
+    )
+    os.replace(f"{metadata_path}.tmp", metadata_path)
+    return {
+        "unchanged": unchanged,
+        "read": len(tasks) - unreadable,
+        "unreadable": unreadable,
+    }
+
+
+def main():
+    args = parse_args()
+    pack_folder(
+        args.input_folder,
+        args.output_folder,
+        workers=args.workers,
+        row_group_size=args.row_group_size_mb * 1024**2,
+        shard_size=args.shard_size_mb * 1024**2,
+        skip_image_data=args.skip_image_data,
+    )
+    print("Done!")
 
-df = pd.DataFrame(
-    data, columns=["filename", "image_hash", "width", "height", "luminance", "image"]
-)
-df.to_parquet(os.path.join(args.output_folder, "images.parquet"), index=False)
 
-print("Done!")
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,115 @@
-import os
-import pandas as pd
-from PIL import Image
-from concurrent.futures import ProcessPoolExecutor
-from tqdm import tqdm
-
-# set 'fork' spawn mode
-import multiprocessing as mp
-
-mp.set_start_method("fork")
+"""
+Update the width, height and aspect ratio of a parquet file's images from the metadata
+SimpleTuner wrote for them, as `{id}.json` files.
 
-PARQUET_FILE = "photo-concept-bucket.parquet"
-IMAGE_DATA = "output_dir"
+The parquet file is read and written a row group at a time, into a temporary file that replaces
+it at the end, so memory doesn't grow with its size. The metadata files are read in a process
+pool.
 
-# Load the parquet file
-df = pd.read_parquet(PARQUET_FILE, engine="pyarrow")
+Example:
+    python toolkit/datasets/update_parquet.py --parquet_file photo-concept-bucket.parquet --metadata_dir output_dir
+"""
 
-# Function to process a chunk of IDs
-import json
+import os, argparse, json
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
 
 
-def process_images(ids_chunk):
-    summary = {
-        "id": [],
-        "old_width": [],
-        "new_width": [],
-        "old_height": [],
-        "new_height": [],
-        "old_aspect_ratio": [],
-        "new_aspect_ratio": [],
+def read_metadata(task):
+    """The (width, height, aspect ratio) SimpleTuner found for an image, or None."""
+    metadata_dir, id = task
+    metadata_path = os.path.join(metadata_dir, f"{id}.json")
+    if not os.path.exists(metadata_path):
+        return None
+    # Use the simpletuner data if the image is not found
+    try:
+        with open(metadata_path) as f:
+            row = json.load(f)
+        width, height = row["image_size"]
+        return width, height, row["aspect_ratio"]
+    except KeyError:
+        print(f"Image {metadata_path} not found in simpletuner data")
+        return None
+
+
+def update_columns(table: pa.Table, id_column: str, found: list) -> tuple:
+    """Replace the width, height and aspect_ratio of the rows with metadata. Returns the table and how many changed."""
+    columns = {
+        name: table.column(name).to_pylist()
+        for name in ("width", "height", "aspect_ratio")
     }
-
-    for id in ids_chunk:
-        metadata_path = os.path.join(IMAGE_DATA, f"{id}.json")
-        if not os.path.exists(metadata_path):
-            continue
-        # Use the simpletuner data if the image is not found
-        try:
-            with open(metadata_path) as f:
-                row = json.load(f)
-            width, height = row["image_size"]
-            aspect_ratio = row["aspect_ratio"]
-        except KeyError:
-            print(f"Image {metadata_path} not found in simpletuner data")
+    ids = table.column(id_column).to_pylist()
+    updated = 0
+    for i, metadata in enumerate(found):
+        if metadata is None:
             continue
-
-        # Locate the row in the DataFrame
-        row = df.loc[df["id"] == id]
-
-        # Check for differences
-        if not row.empty and (
-            row.iloc[0]["width"] != width or row.iloc[0]["height"] != height
-        ):
+        width, height, aspect_ratio = metadata
+        if columns["width"][i] != width or columns["height"][i] != height:
             print(
-                f"Updated image {id}: {row.iloc[0]['width']}x{row.iloc[0]['height']} -> {width}x{height}"
+                f"Updated image {ids[i]}: {columns['width'][i]}x{columns['height'][i]} -> {width}x{height}"
             )
-            summary["id"].append(id)
-            summary["old_width"].append(row.iloc[0]["width"])
-            summary["new_width"].append(width)
-            summary["old_height"].append(row.iloc[0]["height"])
-            summary["new_height"].append(height)
-            summary["old_aspect_ratio"].append(row.iloc[0]["aspect_ratio"])
-            summary["new_aspect_ratio"].append(aspect_ratio)
-
-    return summary
-
-
-# Split IDs into chunks for parallel processing
-ids = df["id"].values
-num_processes = os.cpu_count()
-chunk_size = len(ids) // num_processes + (len(ids) % num_processes > 0)
-id_chunks = [ids[i : i + chunk_size] for i in range(0, len(ids), chunk_size)]
-
-# Process the images in parallel
-with ProcessPoolExecutor(max_workers=num_processes) as executor:
-    results = list(tqdm(executor.map(process_images, id_chunks), total=len(id_chunks)))
-
-# Combine results from all processes
-combined_summary = pd.DataFrame()
-for result in results:
-    combined_summary = pd.concat([combined_summary, pd.DataFrame(result)])
+            columns["width"][i] = width
+            columns["height"][i] = height
+            columns["aspect_ratio"][i] = aspect_ratio
+            updated += 1
+    for name, values in columns.items():
+        index = table.schema.get_field_index(name)
+        field = table.schema.field(index)
+        table = table.set_column(index, field, pa.array(values, type=field.type))
+    return table, updated
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--parquet_file",
+        default="photo-concept-bucket.parquet",
+        help="The parquet file to update in place.",
+    )
+    argparser.add_argument(
+        "--metadata_dir",
+        default="output_dir",
+        help="Folder of {id}.json metadata files.",
+    )
+    argparser.add_argument("--id_column", default="id")
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes reading metadata files.",
+    )
+    return argparser.parse_args()
+
+
+def main():
+    args = parse_args()
+    parquet_file = pq.ParquetFile(args.parquet_file)
+    temporary_file = f"{args.parquet_file}.tmp"
+    updated = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor, pq.ParquetWriter(
+        temporary_file, parquet_file.schema_arrow
+    ) as writer:
+        for i in tqdm(range(parquet_file.num_row_groups), desc="Row groups"):
+            table = parquet_file.read_row_group(i)
+            tasks = [
+                (args.metadata_dir, id)
+                for id in table.column(args.id_column).to_pylist()
+            ]
+            found = list(
+                executor.map(
+                    read_metadata,
+                    tasks,
+                    chunksize=max(1, len(tasks) // (args.workers * 4)),
+                )
+            )
+            table, row_group_updated = update_columns(table, args.id_column, found)
+            updated += row_group_updated
+            writer.write_table(table, row_group_size=table.num_rows)
+    os.replace(temporary_file, args.parquet_file)
+    print(f"Updated {updated} images.")
 
-# Update the DataFrame based on the combined summary
-for index, row in combined_summary.iterrows():
-    idx = df.index[df["id"] == row["id"]].tolist()[0]
-    df.at[idx, "width"] = row["new_width"]
-    df.at[idx, "height"] = row["new_height"]
-    df.at[idx, "aspect_ratio"] = row["new_aspect_ratio"]
 
-# Save the updated DataFrame to the parquet file
-df.to_parquet(PARQUET_FILE, engine="pyarrow")
+if __name__ == "__main__":
+    main()
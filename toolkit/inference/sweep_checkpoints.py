@@ -0,0 +1,184 @@
+"""
+Generate a grid of prompts × schedulers by checkpoints from a training run.
+
+The base pipeline is loaded once, and each checkpoint's weights are swapped into its trained
+component: full checkpoints are copied into the existing parameters, while LoRA and LyCORIS
+checkpoints are applied and taken out again. Prompt embeds are encoded once and reused for every
+checkpoint and scheduler, unless a LoRA checkpoint also trained the text encoders. Text encoders
+saved in full checkpoints aren't loaded.
+
+Images are saved to {sweep_dir}/{scheduler}/{shortname}-{checkpoint}.png, with the grid in
+{sweep_dir}/grid.png, and the time spent in each stage is logged at the end.
+
+Example:
+    python toolkit/inference/sweep_checkpoints.py \\
+        --pretrained_model_name_or_path stabilityai/stable-diffusion-xl-base-1.0 \\
+        --output_dir output/models --include_base --schedulers default euler_a \\
+        --shortnames woman lion
+
+To tile images that were already generated, eg. {shortname}-{step}.png files, into a grid:
+    python toolkit/inference/sweep_checkpoints.py --tile_directory test_results
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from helpers.training.checkpoint_sweep import (
+    CheckpointSweep,
+    StageTimer,
+    list_checkpoints,
+    scheduler_presets,
+    tile_directory,
+)
+
+dtypes = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pretrained_model_name_or_path", type=str)
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        help="The training output directory that holds the checkpoint-N directories.",
+    )
+    parser.add_argument(
+        "--checkpoints",
+        type=int,
+        nargs="+",
+        default=None,
+        help="The steps of the checkpoints to sweep. Defaults to every checkpoint.",
+    )
+    parser.add_argument(
+        "--include_base",
+        action="store_true",
+        help="Generate with the base model too, as the first column of the grid.",
+    )
+    parser.add_argument(
+        "--component",
+        type=str,
+        default=None,
+        help="The trained component. Defaults to the transformer if the pipeline has one, else the unet.",
+    )
+    parser.add_argument(
+        "--schedulers",
+        type=str,
+        nargs="+",
+        default=["default"],
+        choices=list(scheduler_presets),
+    )
+    parser.add_argument(
+        "--prompt_library",
+        type=str,
+        default=None,
+        help="A JSON file of prompts by short name. Defaults to the built-in prompt library.",
+    )
+    parser.add_argument(
+        "--shortnames",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only generate these prompts from the library.",
+    )
+    parser.add_argument("--negative_prompt", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--num_inference_steps", type=int, default=30)
+    parser.add_argument("--guidance_scale", type=float, default=7.5)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--dtype", type=str, default="bf16", choices=list(dtypes))
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+    )
+    parser.add_argument("--lycoris_multiplier", type=float, default=1.0)
+    parser.add_argument(
+        "--sweep_dir",
+        type=str,
+        default=None,
+        help="Where the images and the grid are saved. Defaults to {output_dir}/sweep.",
+    )
+    parser.add_argument(
+        "--tile_directory",
+        type=str,
+        default=None,
+        help="Only tile the {shortname}-{checkpoint}.png images in this directory into a grid.",
+    )
+    args = parser.parse_args()
+    if args.tile_directory is None and (
+        args.pretrained_model_name_or_path is None or args.output_dir is None
+    ):
+        parser.error(
+            "--pretrained_model_name_or_path and --output_dir are required to run a sweep."
+        )
+    return args
+
+
+def load_prompts(args) -> dict:
+    if args.prompt_library is not None:
+        with open(args.prompt_library) as f:
+            prompts = json.load(f)
+    else:
+        from helpers.prompts import prompts
+    if args.shortnames:
+        prompts = {shortname: prompts[shortname] for shortname in args.shortnames}
+    return prompts
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.tile_directory is not None:
+        logging.info(f"Saved {tile_directory(args.tile_directory)}")
+        return
+
+    checkpoints = [
+        (str(step), path)
+        for step, path in list_checkpoints(args.output_dir)
+        if args.checkpoints is None or step in args.checkpoints
+    ]
+    if args.include_base:
+        checkpoints.insert(0, ("base", None))
+    if not checkpoints:
+        raise FileNotFoundError(f"No checkpoints to sweep in {args.output_dir}.")
+
+    from diffusers import DiffusionPipeline
+
+    timer = StageTimer()
+    with timer.stage("load pipeline"):
+        pipeline = DiffusionPipeline.from_pretrained(
+            args.pretrained_model_name_or_path, torch_dtype=dtypes[args.dtype]
+        ).to(args.device)
+    pipeline.set_progress_bar_config(disable=True)
+    component = args.component or (
+        "transformer" if getattr(pipeline, "transformer", None) is not None else "unet"
+    )
+    CheckpointSweep(
+        pipeline,
+        component,
+        load_prompts(args),
+        checkpoints,
+        args.schedulers,
+        args.sweep_dir or os.path.join(args.output_dir, "sweep"),
+        seed=args.seed,
+        negative_prompt=args.negative_prompt,
+        pipeline_kwargs={
+            "num_inference_steps": args.num_inference_steps,
+            "guidance_scale": args.guidance_scale,
+            "width": args.width,
+            "height": args.height,
+        },
+        lycoris_multiplier=args.lycoris_multiplier,
+        timer=timer,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
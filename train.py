@@ -32,8 +32,13 @@ from helpers.arguments import parse_args
 from helpers.caching.memory import reclaim_memory
 from helpers.training.validation import Validation, prepare_validation_prompt_list
 from helpers.training.state_tracker import StateTracker
+from helpers.training.text_encoder_manager import TextEncoderManager
 from helpers.training.schedulers import load_scheduler_from_args
-from helpers.training.adapter import determine_adapter_target_modules, load_lora_weights
+from helpers.training.adapter import (
+    determine_adapter_target_modules,
+    load_lora_weights,
+    load_lycoris_config,
+)
 from helpers.training.diffusion_model import load_diffusion_model
 from helpers.training.text_encoding import (
     load_tes,
@@ -48,6 +53,8 @@ from helpers.training.optimizer_param import (
 )
 from helpers.data_backend.factory import BatchFetcher
 from helpers.training.deepspeed import deepspeed_zero_init_disabled_context_manager
+from helpers.training.flat_parameters import FlatParameterBuffer
+from helpers.training.activation_checkpointing import ActivationCheckpointing
 from helpers.training.wrappers import unwrap_model
 from helpers.data_backend.factory import configure_multi_databackend
 from helpers.data_backend.factory import random_dataloader_iterator
@@ -55,7 +62,7 @@ from helpers.training.custom_schedule import (
     generate_timestep_weights,
     segmented_timestep_selection,
 )
-from helpers.training.min_snr_gamma import compute_snr
+from helpers.training.loss_weighting import SNRLossWeighting
 from accelerate.logging import get_logger
 
 logger = get_logger(__name__, log_level=os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
@@ -81,15 +88,8 @@ import torch.nn.functional as F
 import torch.utils.checkpoint
 from accelerate import Accelerator
 from accelerate.utils import ProjectConfiguration, set_seed
-
-try:
-    from lycoris import LycorisNetwork
-except:
-    print("[ERROR] Lycoris not available. Please install ")
 from tqdm.auto import tqdm
 from transformers import PretrainedConfig, CLIPTokenizer
-from helpers.sdxl.pipeline import StableDiffusionXLPipeline
-from diffusers import StableDiffusion3Pipeline
 
 from diffusers import (
     AutoencoderKL,
@@ -113,8 +113,11 @@ from diffusers.utils import (
 from diffusers.utils.import_utils import is_xformers_available
 from transformers.utils import ContextManagers
 
+from helpers.models.attention_backends import set_attention_backend
+from helpers.models.registry import get_pipeline_class
 from helpers.models.flux import (
     prepare_latent_image_ids,
+    prepare_text_ids,
     pack_latents,
     unpack_latents,
 )
@@ -472,48 +475,33 @@ def main():
     accelerator.wait_for_everyone()
 
     if args.model_type == "full" or not args.train_text_encoder:
-        # Grab GPU memory used:
-        if torch.cuda.is_available():
-            memory_before_unload = torch.cuda.memory_allocated() / 1024**3
-        elif torch.backends.mps.is_available():
-            memory_before_unload = torch.mps.current_allocated_memory() / 1024**3
-        else:
-            logger.warning(
-                "CUDA, ROCm, or Apple MPS not detected here. We cannot report VRAM reductions."
-            )
-            memory_before_unload = 0
         if accelerator.is_main_process:
-            logger.info("Unloading text encoders, as they are not being trained.")
-
-        if text_encoder_1 is not None:
-            text_encoder_1 = text_encoder_1.to("cpu")
-        if text_encoder_2 is not None:
-            text_encoder_2 = text_encoder_2.to("cpu")
-        if text_encoder_3 is not None:
-            text_encoder_3 = text_encoder_3.to("cpu")
-        del text_encoder_1, text_encoder_2, text_encoder_3
+            logger.info(
+                f"Offloading text encoders to {args.text_encoder_offload}, as they are not being trained."
+            )
+        text_encoder_manager = TextEncoderManager(
+            text_encoders=[text_encoder_1, text_encoder_2, text_encoder_3],
+            device=accelerator.device,
+            offload=args.text_encoder_offload,
+            offload_dir=os.path.join(args.cache_dir, "text_encoders"),
+        )
+        StateTracker.set_text_encoder_manager(text_encoder_manager)
         text_encoder_1 = None
         text_encoder_2 = None
         text_encoder_3 = None
         text_encoders = []
-        if prompt_handler is not None:
-            prompt_handler.text_encoders = []
-        for backend_id, backend in StateTracker.get_data_backends().items():
-            if "text_embed_cache" in backend:
-                backend["text_embed_cache"].text_encoders = None
-                backend["text_embed_cache"].pipeline = None
-        reclaim_memory()
-        if torch.cuda.is_available():
-            memory_after_unload = torch.cuda.memory_allocated() / 1024**3
-        elif torch.backends.mps.is_available():
-            memory_after_unload = torch.mps.current_allocated_memory() / 1024**3
-        else:
-            memory_after_unload = 0
-        memory_saved = memory_after_unload - memory_before_unload
-        logger.info(
-            f"After nuking text encoders from orbit, we freed {abs(round(memory_saved, 2))} GB of VRAM."
-            " The real memories were the friends we trained a model on along the way."
-        )
+        if args.text_encoder_offload == "delete":
+            if prompt_handler is not None:
+                prompt_handler.text_encoders = []
+            for backend_id, backend in StateTracker.get_data_backends().items():
+                if "text_embed_cache" in backend:
+                    backend["text_embed_cache"].text_encoders = None
+                    backend["text_embed_cache"].pipeline = None
+        # Otherwise, the text embed caches keep their references, so that cache misses can
+        # still be encoded once the manager loads the encoders again.
+        # Processes on one machine share the disk copy, which the first one writes.
+        with accelerator.local_main_process_first():
+            text_encoder_manager.offload()
 
     unet, transformer = load_diffusion_model(args, weight_dtype)
     disable_accelerator = os.environ.get("SIMPLETUNER_DISABLE_ACCELERATOR", False)
@@ -716,33 +704,9 @@ def main():
                 + "configuration file location with --lycoris_config"
             )
 
-        with open(args.lycoris_config, "r") as f:
-            lycoris_config = json.load(f)
-
-        assert (
-            "multiplier" in lycoris_config
-        ), "lycoris_config JSON must contain multiplier key"
-        multiplier = int(lycoris_config["multiplier"])
-        assert (
-            "linear_dim" in lycoris_config
-        ), "lycoris_config JSON must contain linear_dim key"
-        linear_dim = int(lycoris_config["linear_dim"])
-        assert (
-            "linear_alpha" in lycoris_config
-        ), "lycoris_config JSON must contain linear_alpha key"
-        linear_alpha = int(lycoris_config["linear_alpha"])
-
-        apply_preset = lycoris_config.get("apply_preset", None)
-        if apply_preset is not None and apply_preset != {}:
-            LycorisNetwork.apply_preset(apply_preset)
-
-        # This is a kwarg, but mandatory.
-        assert "algo" in lycoris_config, "lycoris_config JSON must contain algo key"
-
-        # Remove the positional arguments we extracted.
-        del lycoris_config["multiplier"]
-        del lycoris_config["linear_dim"]
-        del lycoris_config["linear_alpha"]
+        multiplier, linear_dim, linear_alpha, lycoris_config = load_lycoris_config(
+            args.lycoris_config
+        )
 
         logger.info(f"Using lycoris training mode")
         if webhook_handler is not None:
@@ -834,11 +798,19 @@ def main():
             )
             transformer = apply_bitfit_freezing(transformer, args)
 
+    activation_checkpointing = None
     if args.gradient_checkpointing:
         if unet is not None:
             unet.enable_gradient_checkpointing()
-        if transformer is not None and not args.smoldit:
+        if transformer is not None and args.gradient_checkpointing_policy == "full":
             transformer.enable_gradient_checkpointing()
+        elif transformer is not None:
+            activation_checkpointing = ActivationCheckpointing(
+                transformer,
+                policy=args.gradient_checkpointing_policy,
+                interval=args.gradient_checkpointing_interval,
+                memory_budget=args.gradient_checkpointing_memory_budget,
+            ).apply()
         if args.controlnet:
             controlnet.enable_gradient_checkpointing()
         if hasattr(args, "train_text_encoder") and args.train_text_encoder:
@@ -1088,6 +1060,29 @@ def main():
                 except Exception as e:
                     logger.error(f"Failed to pin EMA model to CPU: {e}")
 
+    flat_parameters = None
+    if args.flatten_adapter_parameters:
+        if use_deepspeed_optimizer:
+            logger.warning(
+                "--flatten_adapter_parameters is not supported with DeepSpeed, and will be ignored."
+            )
+        else:
+            # Pack the adapter weights where they'll end up once the model is moved to the GPU below.
+            flat_parameters = FlatParameterBuffer(
+                optimizer,
+                device=accelerator.device,
+                dtype=(
+                    weight_dtype
+                    if not is_quantized or args.lora_type == "lycoris"
+                    else None
+                ),
+                grad_dtype=(
+                    torch.float32
+                    if not args.adam_bfloat16 and args.gradient_precision == "fp32"
+                    else None
+                ),
+            )
+
     idx_count = 0
     for _, backend in StateTracker.get_data_backends().items():
         if idx_count == 0 or "train_dataloader" not in backend:
@@ -1320,6 +1315,11 @@ def main():
         accelerator._lycoris_wrapped_network = accelerator._lycoris_wrapped_network.to(
             accelerator.device, dtype=weight_dtype
         )
+    if flat_parameters is not None and not flat_parameters.is_packed():
+        logger.warning(
+            "Adapter weights were moved after packing them into flat buffers, repacking."
+        )
+        flat_parameters.repack()
     if args.enable_xformers_memory_efficient_attention and not any(
         [args.sd3, args.pixart_sigma, args.flux, args.smoldit, args.kolors]
     ):
@@ -1342,6 +1342,16 @@ def main():
             "xformers is not enabled, as it is incompatible with this model type."
         )
         args.enable_xformers_memory_efficient_attention = False
+    if transformer is not None and args.attention_backend != "sdpa":
+        set_attention_backend(
+            transformer,
+            args.attention_backend,
+            **(
+                {"chunk_size": args.attention_chunk_size}
+                if args.attention_backend == "chunked"
+                else {}
+            ),
+        )
 
     if args.controlnet:
         controlnet.train()
@@ -1390,12 +1400,23 @@ def main():
     )
     accelerator.wait_for_everyone()
 
+    snr_loss_weighting = None
+    if not flow_matching and args.snr_gamma is not None and args.snr_gamma != 0:
+        snr_loss_weighting = SNRLossWeighting(
+            noise_scheduler,
+            args.snr_gamma,
+            use_soft_min=args.use_soft_min_snr,
+            sigma_data=args.soft_min_snr_sigma_data,
+            debiased=args.use_debiased_estimation,
+        )
+
     # Some values that are required to be initialised later.
     timesteps_buffer = []
     train_loss = 0.0
     grad_norm = None
     step = global_step
     training_luminance_values = []
+    vae_encode_stall_values = []
     current_epoch_step = None
     global bf
     bf, fetch_thread = None, None
@@ -1542,6 +1563,8 @@ def main():
             # Add the current batch of training data's avg luminance to a list.
             if "batch_luminance" in batch:
                 training_luminance_values.append(batch["batch_luminance"])
+            if "vae_encode_stall" in batch:
+                vae_encode_stall_values.append(batch["vae_encode_stall"])
 
             with accelerator.accumulate(training_models):
                 training_logger.debug("Sending latent batch to GPU.")
@@ -1788,11 +1811,12 @@ def main():
                             / 1000
                         )
 
-                        text_ids = torch.zeros(
+                        text_ids = prepare_text_ids(
                             packed_noisy_latents.shape[0],
                             batch["prompt_embeds"].shape[1],
-                            3,
-                        ).to(device=accelerator.device, dtype=base_weight_dtype)
+                            accelerator.device,
+                            base_weight_dtype,
+                        )
                         training_logger.debug(
                             "DTypes:"
                             f"\n-> Text IDs shape: {text_ids.shape if hasattr(text_ids, 'shape') else None}, dtype: {text_ids.dtype if hasattr(text_ids, 'dtype') else None}"
@@ -1945,35 +1969,9 @@ def main():
                     # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
                     # Since we predict the noise instead of x_0, the original formulation is slightly changed.
                     # This is discussed in Section 4.2 of the same paper.
+                    # The weights of every timestep were computed once, before training.
                     training_logger.debug("Using min-SNR loss")
-                    snr = compute_snr(timesteps, noise_scheduler)
-                    snr_divisor = snr
-                    if noise_scheduler.config.prediction_type == "v_prediction" or (
-                        flow_matching and args.flow_matching_loss == "diffusion"
-                    ):
-                        snr_divisor = snr + 1
-
-                    training_logger.debug(
-                        "Calculating MSE loss weights using SNR as divisor"
-                    )
-                    mse_loss_weights = (
-                        torch.stack(
-                            [snr, args.snr_gamma * torch.ones_like(timesteps)],
-                            dim=1,
-                        ).min(dim=1)[0]
-                        / snr_divisor
-                    )
-
-                    # We first calculate the original loss. Then we mean over the non-batch dimensions and
-                    # rebalance the sample-wise losses with their respective loss weights.
-                    # Finally, we take the mean of the rebalanced loss.
-                    loss = F.mse_loss(
-                        model_pred.float(), target.float(), reduction="none"
-                    )
-                    loss = (
-                        loss.mean(dim=list(range(1, len(loss.shape))))
-                        * mse_loss_weights
-                    ).mean()
+                    loss = snr_loss_weighting.loss(model_pred, target, timesteps)
 
                 # Gather the losses across all processes for logging (if we use distributed training).
                 avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
@@ -1994,8 +1992,13 @@ def main():
                         )
                     accelerator.backward(loss)
 
-                    if not args.adam_bfloat16 and args.gradient_precision == "fp32":
+                    if (
+                        not args.adam_bfloat16
+                        and args.gradient_precision == "fp32"
+                        and flat_parameters is None
+                    ):
                         # After backward, convert gradients to fp32 for stable accumulation
+                        # Flattened adapter parameters already accumulate into an fp32 buffer.
                         for param in params_to_optimize:
                             if param.grad is not None:
                                 param.grad.data = param.grad.data.to(torch.float32)
@@ -2007,9 +2010,14 @@ def main():
                         and args.max_grad_norm > 0
                     ):
                         # StableAdamW does not need clipping, similar to Adafactor.
-                        grad_norm = accelerator.clip_grad_norm_(
-                            params_to_optimize, args.max_grad_norm
-                        )
+                        if flat_parameters is not None:
+                            grad_norm = flat_parameters.clip_grad_norm_(
+                                args.max_grad_norm, accelerator=accelerator
+                            )
+                        else:
+                            grad_norm = accelerator.clip_grad_norm_(
+                                params_to_optimize, args.max_grad_norm
+                            )
                     training_logger.debug("Stepping components forward.")
                     if args.optimizer_release_gradients:
                         step_offset = 0  # simpletuner indexes steps from 1.
@@ -2022,7 +2030,13 @@ def main():
                         optimizer.optimizer_accumulation = should_not_release_gradients
                     else:
                         optimizer.step()
-                    optimizer.zero_grad(set_to_none=args.set_grads_to_none)
+                    if flat_parameters is not None:
+                        # The gradients are views into the flat buffers, so they're never released.
+                        # Like the wrapped optimizer, only zero them once they've been accumulated.
+                        if accelerator.sync_gradients:
+                            flat_parameters.zero_grad()
+                    else:
+                        optimizer.zero_grad(set_to_none=args.set_grads_to_none)
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
@@ -2041,6 +2055,8 @@ def main():
                 }
                 if grad_norm is not None:
                     logs["grad_norm"] = grad_norm
+                if activation_checkpointing is not None:
+                    activation_checkpointing.step(accelerator.device)
                 progress_bar.update(1)
                 global_step += 1
                 current_epoch_step += 1
@@ -2084,6 +2100,9 @@ def main():
                     training_luminance_values
                 )
                 logs["train_luminance"] = avg_training_data_luminance
+                if args.vae_cache_ondemand and len(vae_encode_stall_values) > 0:
+                    # Total time this optimisation step spent waiting for latents.
+                    logs["vae_encode_stall"] = sum(vae_encode_stall_values)
 
                 logger.debug(
                     f"Step {global_step} of {args.max_train_steps}: loss {loss.item()}, lr {lr}, epoch {epoch}/{args.num_train_epochs}, ema_decay_value {ema_decay_value}, train_loss {train_loss}"
@@ -2097,6 +2116,7 @@ def main():
 
                 # Reset some values for the next go.
                 training_luminance_values = []
+                vae_encode_stall_values = []
                 train_loss = 0.0
 
                 if global_step % args.checkpointing_steps == 0:
@@ -2244,6 +2264,8 @@ def main():
                     text_encoder_lora_layers=text_encoder_lora_layers,
                 )
             elif args.sd3:
+                from diffusers import StableDiffusion3Pipeline
+
                 StableDiffusion3Pipeline.save_lora_weights(
                     save_directory=args.output_dir,
                     transformer_lora_layers=transformer_lora_layers,
@@ -2251,7 +2273,7 @@ def main():
                     text_encoder_2_lora_layers=text_encoder_2_lora_layers,
                 )
             else:
-                StableDiffusionXLPipeline.save_lora_weights(
+                get_pipeline_class("sdxl").save_lora_weights(
                     save_directory=args.output_dir,
                     unet_lora_layers=unet_lora_layers,
                     text_encoder_lora_layers=text_encoder_lora_layers,
@@ -2291,6 +2313,8 @@ def main():
         if args.model_type == "full":
             # Now we build a full SDXL Pipeline to export the model with.
             if args.sd3:
+                from diffusers import StableDiffusion3Pipeline
+
                 pipeline = StableDiffusion3Pipeline.from_pretrained(
                     args.pretrained_model_name_or_path,
                     text_encoder=text_encoder_1
@@ -2393,9 +2417,7 @@ def main():
                     torch_dtype=weight_dtype,
                 )
             elif args.smoldit:
-                from helpers.models.smoldit import SmolDiTPipeline
-
-                pipeline = SmolDiTPipeline(
+                pipeline = get_pipeline_class("smoldit")(
                     text_encoder=text_encoder_1
                     or (
                         text_encoder_cls_1.from_pretrained(
@@ -2427,11 +2449,9 @@ def main():
                 )
 
             else:
-                sdxl_pipeline_cls = StableDiffusionXLPipeline
-                if args.kolors:
-                    from helpers.kolors.pipeline import KolorsPipeline
-
-                    sdxl_pipeline_cls = KolorsPipeline
+                sdxl_pipeline_cls = get_pipeline_class(
+                    "kolors" if args.kolors else "sdxl"
+                )
                 pipeline = sdxl_pipeline_cls.from_pretrained(
                     args.pretrained_model_name_or_path,
                     text_encoder=(
@@ -2490,6 +2510,7 @@ def main():
 
         if args.push_to_hub and accelerator.is_main_process:
             hub_manager.upload_model(validation_images, webhook_handler)
+            hub_manager.wait_for_uploads()
     accelerator.end_training()
     # List any running child threads remaining:
     import threading